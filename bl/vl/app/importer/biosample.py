@@ -62,12 +62,17 @@ class Recorder(core.Core):
   SOURCE_TYPE_CHOICES=['Tube', 'Individual', 'PlateWell', 'NO_SOURCE']
   VESSEL_CONTENT_CHOICES=[x.enum_label() for x in VesselContent.__enums__]
   VESSEL_STATUS_CHOICES=[x.enum_label() for x in VesselStatus.__enums__]
+  # known vessels are only used to detect duplicates
+  VESSEL_FIELDS = ['id', 'vid']
 
   def __init__(self, host=None, user=None, passwd=None, keep_tokens=1,
                operator='Alfred E. Neumann', batch_size=10000,
-               action_setup_conf=None, logger=None):
+               action_setup_conf=None, logger=None, preload_cache=None,
+               workers=0, share_actions=False):
     super(Recorder, self).__init__(host, user, passwd, keep_tokens=keep_tokens,
-                                   logger=logger)
+                                   logger=logger, preload_cache=preload_cache,
+                                   workers=workers,
+                                   share_actions=share_actions)
     self.operator = operator
     self.batch_size = batch_size
     self.action_setup_conf = action_setup_conf
@@ -76,43 +81,44 @@ class Recorder(core.Core):
     self.preloaded_vessels = {}
 
   def record(self, records, otsv, rtsv, blocking_validation):
-    def records_by_chunk(batch_size, records):
-      offset = 0
-      while len(records[offset:]) > 0:
-        yield records[offset:offset+batch_size]
-        offset += batch_size
-    if not records:
+    """
+    Import records, which can be any iterable (e.g., a
+    RecordCanonizer stream over the input file): they are checked and
+    saved one chunk at a time.
+    """
+    first, records = core.peek(records)
+    if first is None:
       msg = 'No records are going to be imported'
       self.logger.critical(msg)
       raise core.ImporterValidationError(msg)
-    study = self.find_study(records)
-    self.source_klass = self.find_source_klass(records)
-    self.vessel_klass = self.find_vessel_klass(records)
-    self.preload_sources()
-    if self.vessel_klass == self.kb.PlateWell:
-      self.preload_plates()
-    records, bad_records = self.do_consistency_checks(records)
-    for br in bad_records:
-      rtsv.writerow(br)
-    if blocking_validation and len(bad_records) >= 1:
-      raise core.ImporterValidationError('%d invalid records' % len(bad_records))
+    study = self.get_study(first['study'])
+    self.source_klass = self.find_source_klass([first])
+    self.vessel_klass = self.find_vessel_klass([first])
+    self.uniform_fields = dict((k, first.get(k)) for k in
+                               ('study', 'source_type', 'vessel_type'))
+    self.seen_keys = core.SpillableKeySet(logger=self.logger)
     device = self.get_device('importer-%s.biosample' % version,
                              'CRS4', 'IMPORT', version)
-    act_setups = set(Recorder.get_action_setup_options(r, self.action_setup_conf)
-                     for r in records)
-    asetup = {}
-    for acts in act_setups:
-    # asetup = self.get_action_setup('import-prog-%f' % time.time(),
-    #                                json.dumps(self.action_setup_conf))
-      setup_conf = {'label' : 'import-prog-%f' % time.time(),
-                    'conf' : acts}
-      setup = self.kb.factory.create(self.kb.ActionSetup, 
-                                     setup_conf)
-      asetup[acts] = self.kb.save(setup)
-    for i, c in enumerate(records_by_chunk(self.batch_size, records)):
-      self.logger.info('start processing chunk %d' % i)
-      self.process_chunk(otsv, c, study, asetup, device)
-      self.logger.info('done processing chunk %d' % i)
+    executor = self.make_executor(
+      self.workers, lambda w, c, out: w.process_chunk(out, c, study, device),
+      otsv
+      )
+    pipeline = core.ChunkPipeline(
+      self.do_consistency_checks,
+      lambda c: self.process_chunk(otsv, c, study, device),
+      rtsv, self.batch_size, self.logger, blocking_validation,
+      executor=executor
+      )
+    try:
+      stats = pipeline.run(records)
+    finally:
+      self.seen_keys.close()
+      self.close_preload_cache()
+    self.logger.info('imported %(good)d of %(records)d records' % stats)
+
+  def get_action_setup_by_options(self, r):
+    acts = Recorder.get_action_setup_options(r, self.action_setup_conf)
+    return self.get_action_setup_by_conf('import-prog', acts)
 
   def find_source_klass(self, records):
     try:
@@ -123,38 +129,59 @@ class Recorder(core.Core):
   def find_vessel_klass(self, records):
     return self.find_klass('vessel_type', records)
 
-  def preload_sources(self):
+  def preload_chunk(self, records):
+    """
+    Preload the sources, plates and vessels referenced by records.
+    """
     if self.source_klass:
-      self.preload_by_type('sources', self.source_klass, self.preloaded_sources)
-
-  def preload_plates(self):
-    self.preload_by_type('plates', self.kb.TiterPlate, self.preloaded_plates)
-
-  def do_consistency_checks(self, records):
+      self.preload_by_keys(self.source_klass, 'vid',
+                           [r.get('source') for r in records],
+                           self.preloaded_sources)
+    if self.vessel_klass == self.kb.PlateWell:
+      self.preload_by_keys(self.kb.TiterPlate, 'vid',
+                           [r.get('plate') for r in records],
+                           self.preloaded_plates)
+      keys = [make_unique_key(self.preloaded_plates[r['plate']].label,
+                              r['label'])
+              for r in records if r.get('plate') in self.preloaded_plates
+              and r.get('label')]
+      self.preload_by_keys(self.vessel_klass, 'containerSlotLabelUK', keys,
+                           self.preloaded_vessels, fields=self.VESSEL_FIELDS)
+    else:
+      self.preload_by_keys(self.vessel_klass, 'label',
+                           [r.get('label') for r in records],
+                           self.preloaded_vessels, fields=self.VESSEL_FIELDS)
+
+  def check_uniform_fields(self, r):
+    for k, v in self.uniform_fields.iteritems():
+      if r.get(k) != v:
+        return 'all records should have the same %s' % k
+    return None
+
+  def do_consistency_checks(self, records, offset=0):
+    self.preload_chunk(records)
     self.logger.info('start consistency checks')
     if self.vessel_klass == self.kb.PlateWell:
-      return self.do_consistency_checks_plate_well(records)
+      return self.do_consistency_checks_plate_well(records, offset)
     else:
-      return self.do_consistency_checks_tube(records)
-
-  def do_consistency_checks_plate_well(self, records):
-    def preload_vessels():
-      self.logger.info('start preloading vessels')
-      objs = self.kb.get_objects(self.vessel_klass)
-      for o in objs:
-        assert not o.containerSlotLabelUK in self.preloaded_vessels
-        self.preloaded_vessels[o.containerSlotLabelUK] = o
-      self.logger.info('done preloading vessels')
+      return self.do_consistency_checks_tube(records, offset)
+
+  def do_consistency_checks_plate_well(self, records, offset=0):
     def build_key(r):
       plate = self.preloaded_plates[r['plate']]
       return make_unique_key(plate.label, r['label'])
-    preload_vessels()
     good_records = []
     bad_records = []
-    grecs_keys = {}
     mandatory_fields = ['label', 'source', 'plate', 'row', 'column']
-    for i, r in enumerate(records):
+    for i, r in enumerate(records, offset):
       reject = 'Rejecting import of record %d: ' % i
+      f = self.check_uniform_fields(r)
+      if f:
+        self.logger.error(reject + f)
+        bad_rec = copy.deepcopy(r)
+        bad_rec['error'] = f
+        bad_records.append(bad_rec)
+        continue
       if self.missing_fields(mandatory_fields, r):
         f = 'missing mandatory field'
         self.logger.error(reject + f)
@@ -195,7 +222,7 @@ class Recorder(core.Core):
         bad_rec['error'] = f
         bad_records.append(bad_rec)
         continue
-      if key in grecs_keys:
+      if key in self.seen_keys:
         f = 'multiple records for label %s in plate %s' % (r['label'], r['plate'])
         self.logger.error(reject + f)
         bad_rec = copy.deepcopy(r)
@@ -203,24 +230,22 @@ class Recorder(core.Core):
         bad_records.append(bad_rec)
         continue
       good_records.append(r)
-      grecs_keys[key] = i
+      self.seen_keys.add(key)
     self.logger.info('done consistency checks')
     return good_records, bad_records
 
-  def do_consistency_checks_tube(self, records):
-    def preload_vessels():
-      self.logger.info('start preloading vessels')
-      objs = self.kb.get_objects(self.vessel_klass)
-      for o in objs:
-        assert not o.label in self.preloaded_vessels
-        self.preloaded_vessels[o.label] = o
-      self.logger.info('done preloading vessels')
-    preload_vessels()
+  def do_consistency_checks_tube(self, records, offset=0):
     good_records = []
     bad_records = []
-    grecs_labels = {}
-    for i, r in enumerate(records):
+    for i, r in enumerate(records, offset):
       reject = 'Rejecting import of record %d.' % i
+      f = self.check_uniform_fields(r)
+      if f:
+        self.logger.error(reject + f)
+        bad_rec = copy.deepcopy(r)
+        bad_rec['error'] = f
+        bad_records.append(bad_rec)
+        continue
       if r['label'] in self.preloaded_vessels:
         f = 'there is a pre-existing vessel with label %s' % r['label']
         self.logger.warn(reject + f)
@@ -245,47 +270,39 @@ class Recorder(core.Core):
         bad_rec['error'] = f
         bad_records.append(bad_rec)
         continue
-      if r['label'] in grecs_labels:
+      if r['label'] in self.seen_keys:
         f = 'there is a pre-existing vessel with label %s' % r['label']
         self.logger.error(reject + f)
         bad_rec = copy.deepcopy(r)
         bad_rec['error'] = f
         bad_records.append(bad_rec)
       good_records.append(r)
-      grecs_labels[r['label']] = i
+      self.seen_keys.add(r['label'])
     self.logger.info('done consistency checks')
     return good_records, bad_records
 
-  def process_chunk(self, otsv, chunk, study, asetup, device):
+  def process_chunk(self, otsv, chunk, study, device):
     aklass = {
       self.kb.Individual: self.kb.ActionOnIndividual,
       self.kb.Tube: self.kb.ActionOnVessel,
       self.kb.PlateWell: self.kb.ActionOnVessel,
       type(None) : self.kb.Action,
       }
+    afactory = self.make_action_factory(self.operator)
     actions = []
     target_content = []
     for r in chunk:
-      conf = {
-        'setup': asetup[Recorder.get_action_setup_options(r, self.action_setup_conf)],
-        'device': device,
-        'actionCategory': getattr(self.kb.ActionCategory, r['action_category']),
-        'operator': self.operator,
-        'context': study,
-        }
-      if r['source']:
-        target = self.preloaded_sources[r['source']]
-        conf['target'] = target
-      else:
-        target = None
+      target = self.preloaded_sources[r['source']] if r['source'] else None
       target_content.append(getattr(target, 'content', None))
-      actions.append(self.kb.factory.create(aklass[target.__class__], conf))
+      actions.append(afactory.create(
+        aklass[target.__class__], self.get_action_setup_by_options(r), device,
+        getattr(self.kb.ActionCategory, r['action_category']), study, target
+        ))
     assert len(actions) == len(chunk)
-    self.kb.save_array(actions)
+    afactory.save(unload=True)
     vessels = []
     for a, r, c in it.izip(actions, chunk, target_content):
       self.logger.debug(r)
-      a.unload()
       current_volume = float(r['current_volume'])
       initial_volume = current_volume
       content = (c if r['action_category'] == 'ALIQUOTING' else
@@ -399,12 +416,14 @@ def implementation(logger, host, user, passwd, args, close_handles):
   recorder = Recorder(host=host, user=user, passwd=passwd,
                       keep_tokens=args.keep_tokens,
                       batch_size=args.batch_size, operator=args.operator,
-                      action_setup_conf=action_setup_conf, logger=logger)
+                      action_setup_conf=action_setup_conf, logger=logger,
+                      preload_cache=getattr(args, 'preload_cache', None),
+                      workers=getattr(args, 'workers', 0),
+                      share_actions=getattr(args, 'share_actions', False))
   f = csv.DictReader(args.ifile, delimiter='\t')
   recorder.logger.info('start processing file %s' % args.ifile.name)
-  records = [r for r in f]
   canonizer = RecordCanonizer(fields_to_canonize, args)
-  canonizer.canonize_list(records)
+  records = canonizer.canonize_stream(f)
   o = csv.DictWriter(args.ofile,
                      fieldnames=['study', 'label', 'type', 'vid'],
                      delimiter='\t', lineterminator=os.linesep)
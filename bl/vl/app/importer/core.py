@@ -1,20 +1,476 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import json
+import os, sys, copy, json, time, tempfile, shutil, threading, Queue
+import anydbm, shelve
+import cPickle as pickle
+import itertools as it
 
 from bl.core.utils import NullLogger
 from bl.vl.kb import KnowledgeBase as KB
 
+
+# max number of keys held in memory by a SpillableKeySet
+MAX_KEYS_IN_MEMORY = 1000000
+# max number of chunks read ahead of the check and save stages
+PREFETCH_CHUNKS = 2
+
+
 class ImporterValidationError(Exception):
   pass
 
+
+def records_by_chunk(batch_size, records):
+  """
+  Yield lists of at most batch_size records from any iterable.
+  """
+  records = iter(records)
+  while True:
+    chunk = list(it.islice(records, batch_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def peek(records):
+  """
+  Return the first record (None if there are no records) and an
+  iterator over all records, including the first one.
+  """
+  records = iter(records)
+  try:
+    first = records.next()
+  except StopIteration:
+    return None, iter([])
+  return first, it.chain([first], records)
+
+
+class SpillableKeySet(object):
+  """
+  A set of keys (strings or tuples of strings) used to detect
+  duplicate records.  Keys are held in memory up to max_keys, then
+  moved to a dbm file in a temporary directory.
+  """
+
+  def __init__(self, max_keys=MAX_KEYS_IN_MEMORY, logger=None):
+    self.max_keys = max_keys
+    self.logger = logger or NullLogger()
+    self.keys = set()
+    self.db = None
+    self.wd = None
+    self.n_spilled = 0
+
+  @staticmethod
+  def __encode(key):
+    return key if isinstance(key, str) else repr(key)
+
+  def __spill(self):
+    if self.db is None:
+      self.wd = tempfile.mkdtemp(prefix='bl_vl_keys_')
+      self.db = anydbm.open(os.path.join(self.wd, 'keys'), 'n')
+    self.logger.debug('spilling %d keys to disk' % len(self.keys))
+    for k in self.keys:
+      self.db[k] = ''
+    self.n_spilled += len(self.keys)
+    self.keys = set()
+
+  def add(self, key):
+    self.keys.add(self.__encode(key))
+    if len(self.keys) >= self.max_keys:
+      self.__spill()
+
+  def __contains__(self, key):
+    key = self.__encode(key)
+    return key in self.keys or (self.db is not None and self.db.has_key(key))
+
+  def __len__(self):
+    return len(self.keys) + self.n_spilled
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      shutil.rmtree(self.wd, ignore_errors=True)
+      self.db = self.wd = None
+
+
+class RowBuffer(object):
+  """
+  Collects the rows written by a chunk processed by a ChunkExecutor.
+  """
+
+  def __init__(self):
+    self.rows = []
+
+  def writerow(self, row):
+    self.rows.append(row)
+
+  def writerows(self, rows):
+    self.rows.extend(rows)
+
+
+class _Task(object):
+
+  def __init__(self, index, chunk, deps):
+    self.index = index
+    self.chunk = chunk
+    self.deps = deps
+    self.out = RowBuffer()
+    self.done = threading.Event()
+
+
+class ChunkExecutor(object):
+  """
+  Process chunks concurrently on a pool of workers.
+
+  Each worker (typically a Recorder clone with its own KB session, see
+  Core.clone) runs in its own thread and processes chunks with
+  save_chunk(worker, chunk, out), where out is a RowBuffer: rows are
+  written to out_stream in submission order, so that the output does
+  not depend on scheduling.
+
+  If chunk_keys is given, chunk_keys(chunk) must return the keys
+  (e.g., VIDs of the target objects) of the records in chunk: a chunk
+  is not started until all previously submitted chunks sharing a key
+  with it are done.  At most max_pending chunks are held in memory.
+
+  If a chunk fails, chunks that have not been started yet are
+  skipped, and the error is raised by the next call to submit or
+  join.
+  """
+
+  def __init__(self, workers, save_chunk, out_stream=None, chunk_keys=None,
+               logger=None, max_pending=None):
+    self.save_chunk = save_chunk
+    self.out_stream = out_stream
+    self.chunk_keys = chunk_keys
+    self.logger = logger or NullLogger()
+    self.slots = threading.BoundedSemaphore(max_pending or 2 * len(workers))
+    self.lock = threading.Lock()
+    self.queue = Queue.Queue()
+    self.pending = {}
+    self.last_by_key = {}
+    self.n_submitted = 0
+    self.n_written = 0
+    self.error = None
+    self.cancelled = False
+    self.threads = []
+    for w in workers:
+      t = threading.Thread(target=self.__work, args=(w,))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def __work(self, worker):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        return
+      for d in task.deps:
+        d.done.wait()
+      if self.error is None and not self.cancelled:
+        self.logger.info('start processing chunk %d' % task.index)
+        try:
+          self.save_chunk(worker, task.chunk, task.out)
+          self.logger.info('done processing chunk %d' % task.index)
+        except Exception:
+          with self.lock:
+            if self.error is None:
+              self.error = sys.exc_info()
+          task.out.rows = []
+      task.done.set()
+      self.__write_done()
+
+  def __write_done(self):
+    with self.lock:
+      while self.n_written in self.pending:
+        task = self.pending[self.n_written]
+        if not task.done.is_set():
+          break
+        del self.pending[self.n_written]
+        if self.out_stream is not None:
+          for row in task.out.rows:
+            self.out_stream.writerow(row)
+        self.n_written += 1
+        self.slots.release()
+
+  def __raise_error(self):
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+
+  def submit(self, chunk):
+    self.__raise_error()
+    self.slots.acquire()
+    deps = set()
+    keys = self.chunk_keys(chunk) if self.chunk_keys else ()
+    with self.lock:
+      for k in keys:
+        d = self.last_by_key.get(k)
+        if d is not None and not d.done.is_set():
+          deps.add(d)
+      task = _Task(self.n_submitted, chunk, deps)
+      for k in keys:
+        self.last_by_key[k] = task
+      self.pending[task.index] = task
+      self.n_submitted += 1
+    self.queue.put(task)
+
+  def close(self, cancel=False):
+    """
+    Wait for the workers to exit.  With cancel=True, chunks that have
+    not been started yet are skipped.
+    """
+    self.cancelled = self.cancelled or cancel
+    for _ in self.threads:
+      self.queue.put(None)
+    for t in self.threads:
+      t.join()
+    self.threads = []
+
+  def join(self):
+    self.close()
+    self.__raise_error()
+
+
+class ChunkPipeline(object):
+  """
+  Streaming import of records, one chunk at a time.
+
+  Records are read (and canonized, if records is a generator such as
+  the one returned by RecordCanonizer.canonize_stream) in a background
+  thread, at most prefetch chunks ahead of the consumer; each chunk is
+  then checked with check_chunk(chunk, offset), which must return the
+  good and bad records, and the good ones are saved with
+  save_chunk(chunk).  Bad records are written to the report as soon as
+  they are found.
+
+  With blocking_validation, nothing is saved if any record is
+  rejected: good records are spooled to a temporary file and saved
+  only once all of them have been checked.
+
+  If executor (a ChunkExecutor) is given, good chunks are submitted
+  to it instead of being saved with save_chunk.
+  """
+
+  __END = object()
+
+  def __init__(self, check_chunk, save_chunk, report, batch_size,
+               logger=None, blocking_validation=False,
+               prefetch=PREFETCH_CHUNKS, executor=None):
+    self.check_chunk = check_chunk
+    self.save_chunk = save_chunk
+    self.report = report
+    self.batch_size = batch_size
+    self.logger = logger or NullLogger()
+    self.blocking_validation = blocking_validation
+    self.prefetch = prefetch
+    self.executor = executor
+    self.stats = {'records': 0, 'good': 0, 'bad': 0, 'chunks': 0}
+
+  def __read(self, records, queue, stop):
+    def put(item):
+      while not stop.is_set():
+        try:
+          queue.put(item, timeout=0.5)
+          return True
+        except Queue.Full:
+          pass
+      return False
+    try:
+      for c in records_by_chunk(self.batch_size, records):
+        if not put(c):
+          return
+      put(self.__END)
+    except Exception:
+      put(sys.exc_info())
+
+  def __chunks(self, records):
+    queue = Queue.Queue(maxsize=max(1, self.prefetch))
+    stop = threading.Event()
+    reader = threading.Thread(target=self.__read, args=(records, queue, stop))
+    reader.daemon = True
+    reader.start()
+    try:
+      while True:
+        c = queue.get()
+        if c is self.__END:
+          return
+        if isinstance(c, tuple):  # exc_info from the reader
+          raise c[0], c[1], c[2]
+        yield c
+    finally:
+      stop.set()
+      reader.join()
+
+  def __save(self, i, chunk):
+    if self.executor:
+      self.executor.submit(chunk)
+      return
+    self.logger.info('start processing chunk %d' % i)
+    self.save_chunk(chunk)
+    self.logger.info('done processing chunk %d' % i)
+
+  def run(self, records):
+    spool = tempfile.TemporaryFile() if self.blocking_validation else None
+    try:
+      for c in self.__chunks(records):
+        good, bad = self.check_chunk(c, self.stats['records'])
+        for br in bad:
+          self.report.writerow(br)
+        self.stats['records'] += len(c)
+        self.stats['good'] += len(good)
+        self.stats['bad'] += len(bad)
+        if not good:
+          continue
+        if spool:
+          pickle.dump(good, spool, pickle.HIGHEST_PROTOCOL)
+        else:
+          self.__save(self.stats['chunks'], good)
+        self.stats['chunks'] += 1
+      if self.stats['records'] == 0:
+        msg = 'No records are going to be imported'
+        self.logger.critical(msg)
+        raise ImporterValidationError(msg)
+      if spool:
+        if self.stats['bad'] >= 1:
+          raise ImporterValidationError('%d invalid records' %
+                                        self.stats['bad'])
+        spool.seek(0)
+        for i in xrange(self.stats['chunks']):
+          self.__save(i, pickle.load(spool))
+      if self.executor:
+        self.executor.join()
+    finally:
+      if self.executor:
+        self.executor.close(cancel=True)
+      if spool:
+        spool.close()
+    return self.stats
+
+
+def _ref_key(v):
+  # hashable key for a field value of an action: KB objects are
+  # identified by their OMERO id (by identity if not saved yet)
+  ome_obj = getattr(v, 'ome_obj', None)
+  if ome_obj is None:
+    return v
+  if ome_obj.id is None:
+    return id(v)
+  return (type(v).__name__, ome_obj.id._val)
+
+
+class ActionFactory(object):
+  """
+  Create the actions that link imported objects to their sources.
+
+  With shared=True, records whose actions would be identical (same
+  class, setup, device, category, operator, context and target) get
+  the same action, e.g., a single action for all records imported
+  without a source, or one per source for aliquots: this is allowed
+  by the model, since an action can be referenced by any number of
+  objects, but objects then can't be deleted together with 'their'
+  action.  Actions are shared until the next call to save.
+  """
+
+  def __init__(self, kb, operator, shared=False, batch_size=None):
+    self.kb = kb
+    self.operator = operator
+    self.shared = shared
+    self.batch_size = batch_size
+    self.pending = []
+    self.by_key = {}
+    self.stats = {'requested': 0, 'created': 0}
+
+  def create(self, klass, setup, device, category, context, target=None):
+    self.stats['requested'] += 1
+    conf = {
+      'setup': setup,
+      'device': device,
+      'actionCategory': category,
+      'operator': self.operator,
+      'context': context,
+      }
+    if target is not None:
+      conf['target'] = target
+    if self.shared:
+      key = (klass,) + tuple((k, _ref_key(v)) for k, v in sorted(conf.items()))
+      a = self.by_key.get(key)
+      if a is not None:
+        return a
+    a = self.kb.factory.create(klass, conf)
+    self.pending.append(a)
+    self.stats['created'] += 1
+    if self.shared:
+      self.by_key[key] = a
+    return a
+
+  def save(self, unload=False):
+    """
+    Save all actions created since the last call, with save_array
+    calls of at most batch_size actions (all of them if batch_size is
+    None).  With unload=True, saved actions are unloaded, so that
+    objects that reference them are saved without sending them again.
+    """
+    pending, self.pending = self.pending, []
+    self.by_key = {}
+    for c in records_by_chunk(self.batch_size or len(pending) or 1, pending):
+      self.kb.save_array(c)
+    if unload:
+      for a in pending:
+        a.unload()
+    return pending
+
+
+class PreloadCache(object):
+  """
+  A local cache, kept in a shelve file across importer runs, of the
+  projections fetched by Core.preload_by_keys.  Only keys found in the
+  KB are stored, so that objects created later are always looked up;
+  objects deleted from the KB after being cached are not detected:
+  remove the file to reset the cache.
+  """
+
+  def __init__(self, path, namespace):
+    self.db = shelve.open(path)
+    self.namespace = namespace
+
+  def __key(self, klass, key_field, fields, key):
+    return '%s|%s|%s|%s|%r' % (self.namespace, klass.get_ome_table(),
+                               key_field, ','.join(fields), key)
+
+  def lookup(self, klass, key_field, fields, keys):
+    hits = {}
+    for k in keys:
+      v = self.db.get(self.__key(klass, key_field, fields, k))
+      if v is not None:
+        hits[k] = v
+    return hits
+
+  def update(self, klass, key_field, fields, mapping):
+    for k, v in mapping.iteritems():
+      self.db[self.__key(klass, key_field, fields, k)] = v
+
+  def close(self):
+    self.db.close()
+
+
 class Core(object):
 
   def __init__(self, host=None, user=None, passwd=None, group=None,
-               keep_tokens=1, study_label=None, logger=None):
-    self.kb = KB(driver='omero')(host, user, passwd, group, keep_tokens)
+               keep_tokens=1, study_label=None, logger=None,
+               preload_cache=None, workers=0, share_actions=False):
+    self.kb_args = (host, user, passwd, group, keep_tokens)
+    self.kb = KB(driver='omero')(*self.kb_args)
     self.logger = logger or NullLogger()
+    self.lock = threading.RLock()
+    self.workers = workers
+    self.share_actions = share_actions
+    # devices, studies and action setups are looked up (or created)
+    # once per importer: keys are (kind, label), or ('action_setup',
+    # label prefix, conf) for get_action_setup_by_conf
+    self.memo = {}
+    self.preload_cache = None
+    if preload_cache:
+      self.preload_cache = PreloadCache(preload_cache, '%s@%s' % (user, host))
     self.record_counter = 0
     self.default_study = None
     if study_label:
@@ -25,6 +481,52 @@ class Core(object):
                        (s.label, s.omero_id, s.id))
       self.default_study = s
 
+  def clone(self):
+    """
+    Return a shallow copy of this object with its own KB session, to
+    be used as a ChunkExecutor worker.  Clones share everything else,
+    including self.lock, which must guard shared state that workers
+    modify.
+    """
+    other = copy.copy(self)
+    other.kb = KB(driver='omero')(*self.kb_args)
+    # same server, so lookups can be shared
+    other.memo = self.memo
+    return other
+
+  def make_executor(self, n_workers, save_chunk, out_stream,
+                    chunk_keys=None):
+    """
+    Return a ChunkExecutor running on n_workers clones of this
+    object, or None if n_workers is less than 1.
+    """
+    if n_workers < 1:
+      return None
+    workers = [self.clone() for _ in xrange(n_workers)]
+    return ChunkExecutor(workers, save_chunk, out_stream, chunk_keys,
+                         self.logger)
+
+  def save_chunks(self, chunks, save_chunk, out_stream, chunk_keys=None):
+    """
+    Save chunks with save_chunk(worker, chunk, out): one at a time,
+    with self as the worker, or concurrently on self.workers clones
+    (see make_executor).
+    """
+    executor = self.make_executor(self.workers, save_chunk, out_stream,
+                                  chunk_keys)
+    if executor is None:
+      for i, c in enumerate(chunks):
+        self.logger.info('start processing chunk %d' % i)
+        save_chunk(self, c, out_stream)
+        self.logger.info('done processing chunk %d' % i)
+      return
+    try:
+      for c in chunks:
+        executor.submit(c)
+      executor.join()
+    finally:
+      executor.close(cancel=True)
+
   @classmethod
   def find_action_setup_conf(klass, args):
     action_setup_conf = {}
@@ -52,26 +554,50 @@ class Core(object):
       options['object_history'] = object_history
     return json.dumps(options)
 
+  def __memoized(self, key, lookup):
+    with self.lock:
+      if key not in self.memo:
+        self.memo[key] = lookup()
+      return self.memo[key]
+
+  def make_action_factory(self, operator, batch_size=None):
+    return ActionFactory(self.kb, operator, self.share_actions, batch_size)
+
   def get_device(self, label, maker, model, release):
-    device = self.kb.get_device(label)
-    if not device:
-      self.logger.debug('creating a device')
-      device = self.kb.create_device(label, maker, model, release)
-    return device
+    def lookup():
+      device = self.kb.get_device(label)
+      if not device:
+        self.logger.debug('creating a device')
+        device = self.kb.create_device(label, maker, model, release)
+      return device
+    return self.__memoized(('device', label), lookup)
 
   def get_action_setup(self, label, conf):
     """
     Return the ActionSetup corresponding to label if there is one,
     else create a new one using conf.
     """
-    asetup = self.kb.get_action_setup(label)
-    if not asetup:
-      kb_conf = {
-        'label': label,
-        'conf': json.dumps(conf),
-        }
-      asetup = self.kb.factory.create(self.kb.ActionSetup, kb_conf).save()
-    return asetup
+    def lookup():
+      asetup = self.kb.get_action_setup(label)
+      if not asetup:
+        kb_conf = {
+          'label': label,
+          'conf': json.dumps(conf),
+          }
+        asetup = self.kb.factory.create(self.kb.ActionSetup, kb_conf).save()
+      return asetup
+    return self.__memoized(('action_setup', label), lookup)
+
+  def get_action_setup_by_conf(self, prefix, conf):
+    """
+    Return an ActionSetup with the given conf (a JSON string) and a
+    '<prefix>-<timestamp>' label, creating it the first time a conf
+    is seen by this importer.
+    """
+    def lookup():
+      kb_conf = {'label': '%s-%f' % (prefix, time.time()), 'conf': conf}
+      return self.kb.factory.create(self.kb.ActionSetup, kb_conf).save()
+    return self.__memoized(('action_setup', prefix, conf), lookup)
 
   def get_action_class_by_target(self, target):
     for K in self.kb.Action.__subclasses__():
@@ -83,10 +609,12 @@ class Core(object):
   def get_study(self, label):
     if self.default_study:
       return self.default_study
-    study = self.kb.get_study(label)
-    if not study:
-      study = self.kb.factory.create(self.kb.Study, {'label': label}).save()
-    return study
+    def lookup():
+      study = self.kb.get_study(label)
+      if not study:
+        study = self.kb.factory.create(self.kb.Study, {'label': label}).save()
+      return study
+    return self.__memoized(('study', label), lookup)
 
   def find_study(self, records):
     study_label = records[0]['study']
@@ -117,6 +645,39 @@ class Core(object):
     self.__preload_items__('id', klass, preloaded)
     self.logger.info('done preloading %s' % name)
 
+  def preload_by_keys(self, klass, key_field, keys, preloaded, fields=None):
+    """
+    Add to preloaded the objects of class klass whose key_field is in
+    keys (e.g., the labels or VIDs referenced by the input records),
+    skipping keys that are already there.  Only the referenced
+    objects are fetched, with chunked 'in' queries.
+
+    If fields (e.g., ['id', 'vid']) is given, objects are not loaded:
+    keys are mapped to tuples of the values of fields, which are also
+    looked up in, and added to, the local preload cache, if any.
+    """
+    keys = set(k for k in keys if k is not None and k not in preloaded)
+    if not keys:
+      return
+    cache = self.preload_cache if fields else None
+    if cache:
+      hits = cache.lookup(klass, key_field, fields, keys)
+      preloaded.update(hits)
+      keys.difference_update(hits)
+      if not keys:
+        return
+    res = self.kb.get_by_field(klass, key_field, list(keys), fields=fields)
+    self.logger.debug('preloaded %d of %d %s objects by %s' %
+                      (len(res), len(keys), klass.get_ome_table(), key_field))
+    preloaded.update(res)
+    if cache:
+      cache.update(klass, key_field, fields, res)
+
+  def close_preload_cache(self):
+    if self.preload_cache:
+      self.preload_cache.close()
+      self.preload_cache = None
+
   def preload_studies(self, preloaded):
     self.logger.info('start preloading studies')
     self.__preload_items__('label', self.kb.Study, preloaded)
@@ -145,3 +706,8 @@ class RecordCanonizer(object):
   def canonize_list(self, l):
     for r in l:
       self.canonize(r)
+
+  def canonize_stream(self, records):
+    for r in records:
+      self.canonize(r)
+      yield r
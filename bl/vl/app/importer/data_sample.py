@@ -128,9 +128,10 @@ class Recorder(core.Core):
   def __init__(self, study_label=None,
                host=None, user=None, passwd=None, keep_tokens=1,
                batch_size=1000, operator='Alfred E. Neumann',
-               action_setup_conf=None, logger=None):
+               action_setup_conf=None, logger=None, workers=0):
     super(Recorder, self).__init__(host, user, passwd, keep_tokens=keep_tokens,
-                                   study_label=study_label, logger=logger)
+                                   study_label=study_label, logger=logger,
+                                   workers=workers)
     self.batch_size = batch_size
     self.action_setup_conf = action_setup_conf
     self.operator = operator
@@ -163,10 +164,8 @@ class Recorder(core.Core):
       rtsv.writerow(br)
     if blocking_validation and len(bad_records) >= 1:
       raise core.ImporterValidationError('%d invalid records' % len(bad_records))
-    for i, c in enumerate(records_by_chunk(self.batch_size, records)):
-      self.logger.info('start processing chunk %d' % i)
-      self.process_chunk(otsv, c, study)
-      self.logger.info('done processing chunk %d' % i)
+    self.save_chunks(records_by_chunk(self.batch_size, records),
+                     lambda w, c, out: w.process_chunk(out, c, study), otsv)
 
   def find_source_klass(self, records):
     return self.find_klass('source_type', records)
@@ -417,7 +416,7 @@ def implementation(logger, host, user, passwd, args, close_handles):
                       host=host, user=user, passwd=passwd,
                       operator=args.operator,
                       action_setup_conf=action_setup_conf,
-                      logger=logger)
+                      logger=logger, workers=getattr(args, 'workers', 0))
   f = csv.DictReader(args.ifile, delimiter='\t')
   logger.info('start processing file %s' % args.ifile.name)
   records = [r for r in f]
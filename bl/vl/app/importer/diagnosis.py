@@ -32,9 +32,11 @@ class Recorder(core.Core):
   def __init__(self, study_label,
                host=None, user=None, passwd=None,  keep_tokens=1,
                action_setup_conf=None,
-               batch_size=1000,  operator='Alfred E. Neumann', logger=None):
+               batch_size=1000,  operator='Alfred E. Neumann', logger=None,
+               workers=0):
     super(Recorder, self).__init__(host, user, passwd, keep_tokens=keep_tokens,
-                                   study_label=study_label, logger=logger)
+                                   study_label=study_label, logger=logger,
+                                   workers=workers)
     self.batch_size = batch_size
     self.action_setup_conf = action_setup_conf
     self.operator = operator
@@ -60,10 +62,11 @@ class Recorder(core.Core):
                              maker='CRS4', model='importer', release=version)
     asetup = self.get_action_setup('importer.diagnosis-%f' % time.time(),
                                    json.dumps(self.action_setup_conf))
-    for i, c in enumerate(records_by_chunk(self.batch_size, records)):
-      self.logger.info('start processing chunk %d' % i)
-      self.process_chunk(c, study, asetup, device)
-      self.logger.info('done processing chunk %d' % i)
+    # EHR records of the same individual are added in input order
+    self.save_chunks(records_by_chunk(self.batch_size, records),
+                     lambda w, c, out: w.process_chunk(c, study, asetup,
+                                                       device),
+                     None, chunk_keys=lambda c: [r['individual'] for r in c])
 
   def preload_individuals(self):
     self.preload_by_type('individuals', self.kb.Individual,
@@ -159,7 +162,8 @@ def implementation(logger, host, user, passwd, args, close_handles):
   recorder = Recorder(args.study,
                       host=host, user=user, passwd=passwd,
                       operator=args.operator,
-                      action_setup_conf=action_setup_conf, logger=logger)
+                      action_setup_conf=action_setup_conf, logger=logger,
+                      workers=getattr(args, 'workers', 0))
   f = csv.DictReader(args.ifile, delimiter='\t')
   logger.info('start processing file %s' % args.ifile.name)
   records = [r for r in f]
@@ -33,39 +33,47 @@ class Recorder(core.Core):
 
   def __init__(self, out_stream=None, study_label=None,
                host=None, user=None, passwd=None,
-               keep_tokens=1, batch_size=1000, logger=None):
+               keep_tokens=1, batch_size=1000, logger=None, workers=0):
     super(Recorder, self).__init__(host, user, passwd, keep_tokens=keep_tokens,
-                                   study_label=study_label, logger=logger)
+                                   study_label=study_label, logger=logger,
+                                   workers=workers)
     self.batch_size = batch_size
     self.preloaded_sources = {}
     self.preloaded_enrollments = {}
     self.preloaded_enrolled_inds = {}
 
   def record(self, records, otsv, rtsv, blocking_validation):
-    def records_by_chunk(batch_size, records):
-      offset = 0
-      while len(records[offset:]) > 0:
-        yield records[offset:offset+batch_size]
-        offset += batch_size
-    if len(records) == 0:
+    """
+    Import records, which can be any iterable: they are checked and
+    saved one chunk at a time.
+    """
+    first, records = core.peek(records)
+    if first is None:
       msg = 'No records are going to be imported'
       self.logger.critical(msg)
       raise core.ImporterValidationError(msg)
-    study = self.find_study(records)
-    self.preload_individuals()
+    self.study_label = first['study']
+    study = self.get_study(self.study_label)
     self.preload_enrollments(study)
-    records, bad_records = self.do_consistency_checks(records)
-    for br in bad_records:
-      rtsv.writerow(br)
-    if blocking_validation and len(bad_records) >= 1:
-      raise core.ImporterValidationError('%d invalid records' % len(bad_records))
-    for i, c in enumerate(records_by_chunk(self.batch_size, records)):
-      self.logger.info('start processing chunk %d' % i)
-      self.process_chunk(otsv, c, study)
-      self.logger.info('done processing chunk %d' % i)
-
-  def preload_individuals(self):
-    self.preload_by_type('individuals', self.kb.Individual,
+    self.seen_labels = core.SpillableKeySet(logger=self.logger)
+    executor = self.make_executor(
+      self.workers, lambda w, c, out: w.process_chunk(out, c, study), otsv
+      )
+    pipeline = core.ChunkPipeline(
+      self.do_consistency_checks,
+      lambda c: self.process_chunk(otsv, c, study),
+      rtsv, self.batch_size, self.logger, blocking_validation,
+      executor=executor
+      )
+    try:
+      stats = pipeline.run(records)
+    finally:
+      self.seen_labels.close()
+    self.logger.info('imported %(good)d of %(records)d records' % stats)
+
+  def preload_individuals(self, records):
+    self.preload_by_keys(self.kb.Individual, 'vid',
+                         [r.get('source') for r in records],
                          self.preloaded_sources)
 
   def preload_enrollments(self, study):
@@ -83,17 +91,17 @@ class Recorder(core.Core):
     self.logger.info('preloaded %d enrollments' %
                      len(self.preloaded_enrollments))
 
-  def do_consistency_checks(self, records):
+  def do_consistency_checks(self, records, offset=0):
     def check_illegal_values(label, values):
       matched_values = [v for v in values if v in label]
       return matched_values
+    self.preload_individuals(records)
     self.logger.info('starting consistency checks')
-    k_map = {}
     good_records = []
     bad_records = []
     mandatory_fields = ['label', 'study', 'source']
     illegal_values = [':']
-    for i, r in enumerate(records):
+    for i, r in enumerate(records, offset):
       reject = 'Rejecting import of row %d: ' % i
       if self.missing_fields(mandatory_fields, r):
         f = 'missing mandatory field'
@@ -102,6 +110,13 @@ class Recorder(core.Core):
         bad_rec['error'] = f
         bad_records.append(bad_rec)
         continue
+      if r['study'] != self.study_label:
+        f = 'all records should have the same study label'
+        self.logger.error(reject + f)
+        bad_rec = copy.deepcopy(r)
+        bad_rec['error'] = f
+        bad_records.append(bad_rec)
+        continue
       matched_illegal_values = check_illegal_values(r['label'], illegal_values)
       if len(matched_illegal_values):
         msg = 'found illegal value(s) %r in label %s' % (matched_illegal_values,
@@ -125,7 +140,7 @@ class Recorder(core.Core):
         bad_rec['error'] = f
         bad_records.append(bad_rec)
         continue
-      if r['label'] in k_map:
+      if r['label'] in self.seen_labels:
         f = 'duplicate label %s in this batch' % r['label']
         self.logger.error(reject + f)
         bad_rec = copy.deepcopy(r)
@@ -139,7 +154,7 @@ class Recorder(core.Core):
         bad_rec['error'] = f
         bad_records.append(bad_rec)
         continue
-      k_map[r['label']] = r
+      self.seen_labels.add(r['label'])
       good_records.append(r)
     self.logger.info('done with consistency checks')
     return good_records, bad_records
@@ -176,12 +191,11 @@ def make_parser(parser):
 def implementation(logger, host, user, passwd, args, close_handles):
   recorder = Recorder(args.study,
                       host=host, user=user, passwd=passwd,
-                      logger=logger)
+                      logger=logger, workers=getattr(args, 'workers', 0))
   logger.info('start processing file %s' % args.ifile.name)
   f = csv.DictReader(args.ifile, delimiter='\t')
-  records = [r for r in f]
   canonizer = core.RecordCanonizer(["study"], args)
-  canonizer.canonize_list(records)
+  records = canonizer.canonize_stream(f)
   o = csv.DictWriter(args.ofile,
                      fieldnames=['study', 'label', 'type', 'vid'],
                      delimiter='\t', lineterminator=os.linesep)
@@ -79,6 +79,8 @@ class Recorder(core.Core):
                        (len(self.known_enrollments), self.default_study.label))
 
   def dump_out(self):
+    if not self.individuals_to_be_saved:
+      return
     self.logger.debug('\tthere are %s records to save' %
                       len(self.individuals_to_be_saved))
     self.kb.save_array(self.individuals_to_be_saved)
@@ -271,7 +273,7 @@ def implementation(logger, host, user, passwd, args, close_handles):
       recorder.logger.critical(msg)
       raise core.ImporterValidationError(msg)
     by_label = make_ind_by_label(records)
-    import_pedigree(recorder, by_label.itervalues())
+    import_pedigree(recorder, by_label.itervalues(), args.batch_size)
     recorder.clean_up()
   finally:
     close_handles(args)
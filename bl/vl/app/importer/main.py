@@ -86,6 +86,16 @@ class App(object):
                         help='break if there is at least one invalid record')
     parser.add_argument('-K', '--keep-tokens', type=int,
                         default=1, help='OMERO tokens for open session')
+    parser.add_argument('--preload-cache', metavar="FILE",
+                        help='local cache of preloaded objects, shared '
+                        'across runs (only used by some importers)')
+    parser.add_argument('--workers', type=int, metavar="INT", default=0,
+                        help='n. of chunks saved concurrently, each on its '
+                        'own OMERO session (only used by some importers, '
+                        'default: save chunks one at a time)')
+    parser.add_argument('--share-actions', action='store_true',
+                        help='link records with identical provenance to '
+                        'the same action (only used by some importers)')
     subparsers = parser.add_subparsers()
     for k, h, addp, impl in self.supported_submodules:
       subparser = subparsers.add_parser(k, help=h)
@@ -52,11 +52,72 @@ info must be listed in the tab-separated input file.  For instance::
   ...
 """
 import os, time, csv, json, copy
+import itertools as it
+from operator import itemgetter
 
+from bl.vl.utils.external_sort import ExternalSorter, RUN_SIZE
 import core
 from version import version
 
 
+CONSISTENT_FIELDS = ['maker', 'model', 'release', 'study']
+
+
+class MarkersSetBuilder(object):
+  """
+  Collect marker definitions from a stream of records in bounded
+  memory: markers are sorted by index, and labels by themselves, with
+  an external sort.
+  """
+
+  def __init__(self, run_size=RUN_SIZE, tmp_dir=None):
+    self.markers = ExternalSorter(key=itemgetter(2), run_size=run_size,
+                                  tmp_dir=tmp_dir)
+    self.labels = ExternalSorter(run_size=run_size, tmp_dir=tmp_dir)
+
+  def __len__(self):
+    return len(self.markers)
+
+  def add(self, r):
+    permutation = r['allele_flip'] if 'allele_flip' in r else r['permutation']
+    self.markers.add((r['label'], r['mask'], r['index'], permutation,
+                      r.get('op_vid')))
+    self.labels.add(r['label'])
+
+  def check(self):
+    """
+    Raise ValueError if marker labels or indices are not unique.
+    """
+    previous = None
+    for label in self.labels:
+      if label == previous:
+        raise ValueError('duplicate marker label %r' % label)
+      previous = label
+    previous = None
+    for m in self.markers:
+      if m[2] == previous:
+        raise ValueError('duplicate marker index %d' % m[2])
+      previous = m[2]
+
+  def stream(self, op_vid):
+    """
+    Yield marker records sorted by index, with op_vid as the default
+    op_vid.
+    """
+    for label, mask, index, permutation, vid in self.markers:
+      yield {
+        'label': label,
+        'mask': mask,
+        'index': index,
+        'permutation': permutation,
+        'op_vid': vid or op_vid,
+        }
+
+  def close(self):
+    self.markers.close()
+    self.labels.close()
+
+
 class Recorder(core.Core):
   
   def __init__(self, study_label, host=None, user=None, passwd=None,
@@ -67,33 +128,49 @@ class Recorder(core.Core):
     self.action_setup_conf = action_setup_conf
     self.operator = operator
 
-  def record(self, records, otsv, rtsv):
-    if len(records) == 0:
-      self.logger.warn('no records')
-      return
-    good_records, bad_records = self.do_consistency_checks(records)
-    for br in bad_records:
-      rtsv.writerow(br)
-    if len(good_records) != len(records):
-      msg = 'cannot process an incomplete markers_set definition'
-      self.logger.critical(msg)
-      raise ValueError(msg)
-    else:
-      records = good_records
-    study = self.find_study(records)
-    action = self.find_action(study)
-    label, maker, model, release = self.find_markers_set_label(records)
-    N = len(records)
-    def stream():
-      for r in records:
-        if r.has_key('allele_flip'):
-          r['permutation'] = r['allele_flip']
-        if not r.has_key('op_vid'):
-          r['op_vid'] = action.id
-        #yield r['label'], r['mask'], r['index'], r['permutation']
-        yield r
-    mset = self.kb.genomics.create_markers_array(label, maker, model, release,
-                                                 stream(), action)
+  def record(self, records, otsv, rtsv, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Import a markers set definition from a stream of records.
+    Records are checked and sorted by index as they are read, then
+    streamed to the markers array table: the whole set is never held
+    in memory.
+    """
+    builder = MarkersSetBuilder(run_size=run_size, tmp_dir=tmp_dir)
+    try:
+      first, n_bad = None, 0
+      for i, r in enumerate(records):
+        if first is None:
+          first = r
+        f = self.check_record(r, first)
+        if f:
+          self.logger.error('Rejecting import of row %d: %s' % (i, f))
+          bad_rec = copy.deepcopy(r)
+          bad_rec['error'] = f
+          rtsv.writerow(bad_rec)
+          n_bad += 1
+          continue
+        builder.add(r)
+      if first is None:
+        self.logger.warn('no records')
+        return
+      if n_bad:
+        msg = 'cannot process an incomplete markers_set definition'
+        self.logger.critical(msg)
+        raise ValueError(msg)
+      self.logger.info('checking %d markers' % len(builder))
+      try:
+        builder.check()
+      except ValueError as e:
+        self.logger.critical(str(e))
+        raise
+      study = self.find_study([first])
+      action = self.find_action(study)
+      label, maker, model, release = self.find_markers_set_label([first])
+      mset = self.kb.genomics.create_markers_array(
+        label, maker, model, release, builder.stream(action.id), action
+        )
+    finally:
+      builder.close()
     otsv.writerow({
       'study': study.label,
       'label': mset.label,
@@ -122,45 +199,15 @@ class Recorder(core.Core):
     action = self.kb.factory.create(self.kb.Action, conf)
     return action.save()
 
-  def do_consistency_checks(self, records):
-    good_records = []
-    bad_records = []
-    maker = records[0]['maker']
-    model = records[0]['model']
-    release = records[0]['release']
-    study = records[0]['study']
-    for i, r in enumerate(records):
-      reject = 'Rejecting import of row %d: ' % i
-      if r['maker'] != maker:
-        f = 'inconsistent maker'
-        self.logger.error(reject + f)
-        bad_rec = copy.deepcopy(r)
-        bad_rec['error'] = f
-        bad_records.append(bad_rec)
-        continue
-      if r['model'] != model:
-        f = 'inconsistent model'
-        self.logger.error(reject + f)
-        bad_rec = copy.deepcopy(r)
-        bad_rec['error'] = f
-        bad_records.append(bad_rec)
-        continue
-      if r['release'] != release:
-        f = 'inconsistent release'
-        self.logger.error(reject + f)
-        bad_rec = copy.deepcopy(r)
-        bad_rec['error'] = f
-        bad_records.append(bad_rec)
-        continue
-      if r['study'] != study:
-        f = 'inconsistent study'
-        self.logger.error(reject + f)
-        bad_rec = copy.deepcopy(r)
-        bad_rec['error'] = f
-        bad_records.append(bad_rec)
-        continue
-      good_records.append(r)
-    return good_records, bad_records
+  def check_record(self, r, first):
+    """
+    Return the reason why r cannot be imported in the same markers set
+    as first, or None.
+    """
+    for k in CONSISTENT_FIELDS:
+      if r[k] != first[k]:
+        return 'inconsistent %s' % k
+    return None
 
 
 class RecordCanonizer(core.RecordCanonizer):
@@ -188,6 +235,10 @@ def make_parser(parser):
                       help="markers_set model")
   parser.add_argument('--release', metavar="STRING", required=True,
                       help="markers_set release")
+  parser.add_argument('--run-size', type=int, metavar="INT", default=RUN_SIZE,
+                      help="max number of markers sorted in memory")
+  parser.add_argument('--tmp-dir', metavar="DIR",
+                      help="directory for temporary files")
 
 
 def implementation(logger, host, user, passwd, args, close_handles):
@@ -196,19 +247,22 @@ def implementation(logger, host, user, passwd, args, close_handles):
                       host=host, user=user, passwd=passwd,
                       operator=args.operator,
                       action_setup_conf=action_setup_conf, logger=logger)
-  for m in recorder.kb.get_objects(recorder.kb.SNPMarkersSet):
-    if m.label == args.ms_label:
-      logger.error(
-        'a marker set labeled %s is already present in the kb' % args.ms_label
-        )
-      return
+  if (args.ms_label is not None and
+      recorder.kb.genomics.get_markers_array(label=args.ms_label)):
+    logger.error(
+      'a marker set labeled %s is already present in the kb' % args.ms_label
+      )
+    return
   f = csv.DictReader(args.ifile, delimiter='\t')
   logger.info('start processing file %s' % args.ifile.name)
-  records = [r for r in f]
   fields_to_canonize = ['study', 'ms_label', 'maker', 'model', 'release']
   canonizer = RecordCanonizer(fields_to_canonize, args)
-  canonizer.canonize_list(records)
-  if len(records) > 0:
+  records = canonizer.canonize_stream(f)
+  try:
+    first = records.next()
+  except StopIteration:
+    logger.info('empty file')
+  else:
     o = csv.DictWriter(args.ofile,
                        fieldnames=['study', 'label', 'type', 'vid'],
                        delimiter='\t', lineterminator=os.linesep)
@@ -219,9 +273,8 @@ def implementation(logger, host, user, passwd, args, close_handles):
                             delimiter='\t', lineterminator=os.linesep,
                             extrasaction='ignore')
     report.writeheader()
-    recorder.record(records, o, report)
-  else:
-    logger.info('empty file')
+    recorder.record(it.chain([first], records), o, report,
+                    run_size=args.run_size, tmp_dir=args.tmp_dir)
   close_handles(args)
   logger.info('done processing file %s' % args.ifile.name)
 
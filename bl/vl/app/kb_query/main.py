@@ -28,6 +28,7 @@ SUBMOD_NAMES = [
   # "tabular",
   "markers",
   # "ehr",
+  "profile",
   ]
 SUBMODULES = [import_module("%s.%s" % (__package__, n)) for n in SUBMOD_NAMES]
 
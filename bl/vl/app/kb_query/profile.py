@@ -0,0 +1,104 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Report on KB operations recorded during a profiled run
+======================================================
+
+Run any KB tool with the ``BIOBANK_PROFILE`` environment variable set
+to a file name, e.g.::
+
+  BIOBANK_PROFILE=import.json importer ... biosample ...
+
+then print the most expensive operations with::
+
+  kb_query --operator aen profile -i import.json --top 10
+
+Output is a tsv file with the following columns::
+
+  op site count errors total_time self_time mean_time max_time items bytes
+
+self_time is total_time minus the time spent in nested instrumented
+calls (e.g., the ome_operation calls made by save): sort by it to
+avoid counting the same time twice.
+
+If more than one input file is given, stats are summed up.  With
+``--format prometheus`` the report is written in the Prometheus text
+exposition format instead.
+"""
+
+import csv
+
+from bl.vl.utils.instrumentation import Recorder
+
+
+SORT_KEYS = ['total_time', 'self_time', 'count', 'mean_time', 'max_time',
+             'items', 'bytes', 'errors']
+FIELDS = ['op', 'site', 'count', 'errors', 'total_time', 'self_time',
+          'mean_time', 'max_time', 'items', 'bytes']
+
+
+def load_recorders(fnames):
+  recorder = Recorder()
+  for fn in fnames:
+    r = Recorder.load(fn)
+    for k, s in r.stats.iteritems():
+      if k in recorder.stats:
+        recorder.stats[k].merge(s)
+      else:
+        recorder.stats[k] = s
+  return recorder
+
+
+def write_report(recorder, ofile, top=None, sort_by='total_time',
+                 by_site=False):
+  writer = csv.DictWriter(ofile, FIELDS, delimiter='\t',
+                          lineterminator='\n')
+  writer.writeheader()
+  for s in recorder.top(top, key=sort_by, by_site=by_site):
+    writer.writerow({
+      'op': s.op,
+      'site': s.site or '',
+      'count': s.count,
+      'errors': s.errors,
+      'total_time': '%.6f' % s.total_time,
+      'self_time': '%.6f' % s.self_time,
+      'mean_time': '%.6f' % s.mean_time,
+      'max_time': '%.6f' % s.max_time,
+      'items': s.items,
+      'bytes': s.bytes,
+      })
+
+
+help_doc = """
+print the top KB operations recorded in a profile file
+"""
+
+
+def make_parser(parser):
+  parser.add_argument('-i', '--ifile', metavar='FILE', nargs='+',
+                      required=True, help='profile file(s) (JSON)')
+  parser.add_argument('--top', type=int, metavar='N', default=20,
+                      help='number of operations to show, 0 for all')
+  parser.add_argument('--sort-by', choices=SORT_KEYS, default='total_time',
+                      help='sort key')
+  parser.add_argument('--by-site', action='store_true',
+                      help='break down operations by calling site')
+  parser.add_argument('--format', choices=['tsv', 'prometheus'],
+                      default='tsv', help='output format')
+
+
+def implementation(logger, host, user, passwd, args):
+  recorder = load_recorders(args.ifile)
+  logger.info('loaded %d operation records' % len(recorder.stats))
+  if args.format == 'prometheus':
+    args.ofile.write(recorder.to_prometheus())
+  else:
+    write_report(recorder, args.ofile, args.top or None, args.sort_by,
+                 args.by_site)
+  args.ofile.close()
+
+
+def do_register(registration_list):
+  registration_list.append(('profile', help_doc, make_parser,
+                            implementation))
@@ -21,15 +21,18 @@ Given the above mask canonization strategy, this tool will build a
 canonized dbSNP wrt DB and use the resulting key to populate the
 index.  In order to perform a lookup into the index, masks from each
 genotyping platform must be canonized as described above.
+
+The index is built with an external sort, so memory usage is bounded
+by --run-size; temporary files take about as much space as the input.
 """
-import shelve, csv, os, tempfile
-from cPickle import HIGHEST_PROTOCOL as HP
+import csv, os, tempfile
 
 from common import build_index_key
+from dbsnp_index import IndexBuilder, RUN_SIZE
 
 
 HELP_DOC = __doc__
-SYNC_INTERVAL = 10000  # number of input records after which we resync the db
+LOG_INTERVAL = 1000000  # number of input records between progress messages
 
 
 def make_parser(parser):
@@ -38,20 +41,25 @@ def make_parser(parser):
                       help='directory where the index file will be written')
   parser.add_argument('--reftag', metavar='STRING', required=True,
                       help='reference genome tag')
+  parser.add_argument('--run-size', type=int, metavar='INT', default=RUN_SIZE,
+                      help='max number of records sorted in memory')
+  parser.add_argument('--tmp-dir', metavar='DIR',
+                      help='directory for temporary files (default: '
+                      'output dir)')
 
 
 def main(logger, args):
-  index = None
   fd, temp_index_fn = tempfile.mkstemp(dir=args.output_dir)
   os.close(fd)
-  os.remove(temp_index_fn)
+  builder = IndexBuilder(temp_index_fn, run_size=args.run_size,
+                         tmp_dir=args.tmp_dir or args.output_dir)
   try:
-    index = shelve.open(temp_index_fn, "n", protocol=HP, writeback=True)
     with open(args.input_file) as f:
       bn = os.path.basename(args.input_file)
       logger.info("processing %r" % bn)
       reader = csv.reader(f, delimiter="\t")
       first_seq_len = None
+      i = -1
       for i, r in enumerate(reader):
         try:
           tag = r[3]
@@ -67,20 +75,25 @@ def main(logger, args):
           logger.critical(msg)
           raise ValueError(msg)
         else:
-          key = build_index_key(seq)
-          index.setdefault(key, []).append(tag)
-          if (i+1) % SYNC_INTERVAL == 0:
-            logger.info("processed %d records: syncing db" % (i+1))
-            index.sync()
+          builder.add(build_index_key(seq), tag)
+          if (i+1) % LOG_INTERVAL == 0:
+            logger.info("processed %d records" % (i+1))
       logger.info("processed %d records overall" % (i+1))
-  finally:
-    if index:
-      index.close()
-      final_output_fn = os.path.join(
-        args.output_dir, "dbsnp_index_%s_%d.db" % (args.reftag, first_seq_len)
-        )
-      os.rename(temp_index_fn, final_output_fn)
-      logger.info("index stored to: %s" % final_output_fn)
+    if first_seq_len is None:
+      msg = "%r: no records found" % bn
+      logger.critical(msg)
+      raise ValueError(msg)
+    logger.info("merging %d sorted runs" % max(len(builder.runs), 1))
+    n_keys = builder.close()
+  except:
+    builder.discard()
+    os.remove(temp_index_fn)
+    raise
+  final_output_fn = os.path.join(
+    args.output_dir, "dbsnp_index_%s_%d.db" % (args.reftag, first_seq_len)
+    )
+  os.rename(temp_index_fn, final_output_fn)
+  logger.info("index with %d keys stored to: %s" % (n_keys, final_output_fn))
 
 
 def do_register(registration_list):
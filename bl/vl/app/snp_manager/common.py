@@ -1,13 +1,22 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import csv, os
+import csv, os, string
+import itertools as it
+
+import numpy as np
 
 from bl.core.seq.utils import reverse_complement as rc
 import bl.vl.utils.snp as snp_utils
 
 
 POSSIBLE_ALLELES = frozenset(['A', 'C', 'G', 'T'])
+# complements of IUPAC nucleotide codes, for uppercase sequences
+RC_TABLE = string.maketrans('ACGTRYKMBVDHNSW', 'TGCAYRMKVBHDNSW')
+# error codes returned by process_masks, in addition to those defined
+# in bl.vl.utils.snp
+BAD_ALLELES, ALLELE_MISMATCH = 3, 4
+MASK_BLOCK_SIZE = 10000  # masks per process_masks call
 MARKER_DEF_FIELDS = ("label", "mask", "index", "allele_flip")
 MARKER_AL_FIELDS = ("marker_vid", "ref_genome", "chromosome", "pos", "strand",
                     "allele", "copies")
@@ -82,41 +91,142 @@ def check_mask(mask):
   return problem
 
 
-def process_mask(mask, allele_a, allele_b):
+def _process_mask(mask, allele_a, allele_b):
   """
-  Convert mask to top Illumina format and determine allele flip.
-
-  In biobank, the first and second allele are defined by the central
-  part of the mask as stored in the marker set table (in top format,
-  if possible). If the manufacturer provides alleles in reversed
-  order, we set the allele_flip flag to True, so that SNP calling
-  results can be correctly interpreted.
-
-  Input: SNP mask, first and second allele as provided by the manufacturer
-  Output: top SNP mask (if convertible), allele flip, problem encountered
+  Same as process_mask, but also return the error code.
   """
-  error = ""
   try:
     mask = snp_utils.split_mask(mask)
   except ValueError as e:
-    return 'None', False, "%s, setting mask to 'None'" % e
+    return ('None', False, snp_utils.BAD_MASK_FORMAT,
+            "%s, setting mask to 'None'" % e)
   orig_alleles = mask[1][:]
   if not(len(mask[1]) == 2 and set(mask[1]) <= POSSIBLE_ALLELES):
-    return 'None', False, "bad alleles %r, setting mask to 'None'" % (mask[1],)
+    return ('None', False, BAD_ALLELES,
+            "bad alleles %r, setting mask to 'None'" % (mask[1],))
+  code, error = snp_utils.MASK_OK, ""
   try:
     mask = snp_utils.convert_to_top(mask)
   except ValueError as e:
+    code = snp_utils.UNDECIDABLE_STRAND
     error = "mask cannot be converted to top"
   else:
     if mask[1] != orig_alleles:
       allele_a, allele_b = rc((allele_a, allele_b))
     if not set(mask[1]) == set((allele_a, allele_b)):
+      code = ALLELE_MISMATCH
       error = "allele mismatch: %r != (%s, %s)" % (mask[1], allele_a, allele_b)
-  return snp_utils.join_mask(mask), mask[1] != (allele_a, allele_b), error
+  return (snp_utils.join_mask(mask), mask[1] != (allele_a, allele_b), code,
+          error)
+
+
+def process_mask(mask, allele_a, allele_b):
+  """
+  Convert mask to top Illumina format and determine allele flip.
+
+  In biobank, the first and second allele are defined by the central
+  part of the mask as stored in the marker set table (in top format,
+  if possible). If the manufacturer provides alleles in reversed
+  order, we set the allele_flip flag to True, so that SNP calling
+  results can be correctly interpreted.
+
+  Input: SNP mask, first and second allele as provided by the manufacturer
+  Output: top SNP mask (if convertible), allele flip, problem encountered
+  """
+  mask, allele_flip, _, error = _process_mask(mask, allele_a, allele_b)
+  return mask, allele_flip, error
+
+
+def _allele_codes(alleles):
+  return np.fromiter((ord(a) if len(a) == 1 else 0 for a in alleles),
+                     dtype=np.uint8, count=len(alleles))
+
+
+def process_masks(masks, alleles_a, alleles_b):
+  """
+  Vectorized version of process_mask: masks, alleles_a and alleles_b
+  are sequences of the same length.  Masks are converted to top as a
+  block (see bl.vl.utils.snp.MaskBlock); allele flips and mismatches
+  are computed with array operations on single-base alleles, and
+  with process_mask for the few records that do not fit.
+
+  Return a list of masks, a boolean array of allele flips and an int8
+  array of error codes (snp_utils.MASK_OK, snp_utils.BAD_MASK_FORMAT,
+  BAD_ALLELES, snp_utils.UNDECIDABLE_STRAND or ALLELE_MISMATCH).
+  """
+  block = snp_utils.MaskBlock(masks)
+  converted, strands, errors = block.convert_to_top()
+  out_masks = ['None'] * len(block)
+  flips = np.zeros(len(block), dtype=np.bool_)
+  x, y = np.zeros((2, len(block)), dtype=np.uint8)
+  rows = np.flatnonzero(block.biallelic())
+  x[rows], y[rows] = block.alleles(rows)
+  checked = snp_utils.IS_BASE[x] & snp_utils.IS_BASE[y]
+  errors[block.valid & ~checked] = BAD_ALLELES
+  ma, mb = _allele_codes(alleles_a), _allele_codes(alleles_b)
+  simple = checked & snp_utils.IS_BASE[ma] & snp_utils.IS_BASE[mb]
+  for i in np.flatnonzero((checked & ~simple) | block.irregular):
+    out_masks[i], flips[i], errors[i], _ = _process_mask(
+      block.masks[i], alleles_a[i], alleles_b[i]
+      )
+  rows = np.flatnonzero(simple)
+  x, y, ma, mb, strands = x[rows], y[rows], ma[rows], mb[rows], strands[rows]
+  # top alleles, or input ones if the strand is undecided
+  lo, hi = np.minimum(x, y), np.maximum(x, y)
+  bot, undecided = (strands == snp_utils.STRAND_BOT,
+                    strands == snp_utils.STRAND_UNDECIDED)
+  t1 = np.where(undecided, x, np.where(bot, snp_utils.COMPLEMENT[hi], lo))
+  t2 = np.where(undecided, y, np.where(bot, snp_utils.COMPLEMENT[lo], hi))
+  changed = (t1 != x) | (t2 != y)
+  a = np.where(changed, snp_utils.COMPLEMENT[mb], ma)
+  b = np.where(changed, snp_utils.COMPLEMENT[ma], mb)
+  mismatch = ~(((t1 == a) & (t2 == b)) | ((t1 == b) & (t2 == a)))
+  errors[rows] = np.where(undecided, snp_utils.UNDECIDABLE_STRAND,
+                          np.where(mismatch, ALLELE_MISMATCH,
+                                   snp_utils.MASK_OK))
+  flips[rows] = (t1 != a) | (t2 != b)
+  for i in rows.tolist():
+    # masks that cannot be converted are output as they are
+    out_masks[i] = converted[i] or block.masks[i]
+  return out_masks, flips, errors
+
+
+def process_mask_records(records, block_size=MASK_BLOCK_SIZE):
+  """
+  Given a stream of (label, mask, allele_a, allele_b) records, yield
+  the corresponding (label, mask, allele_flip, error) tuples, with
+  mask, allele_flip and error as returned by process_mask.  Masks
+  are processed in blocks of block_size records with process_masks.
+  """
+  records = iter(records)
+  while True:
+    block = list(it.islice(records, block_size))
+    if not block:
+      break
+    _, masks, alleles_a, alleles_b = zip(*block)
+    out_masks, flips, errors = process_masks(masks, alleles_a, alleles_b)
+    for j, r in enumerate(block):
+      if errors[j]:
+        # errors are rare: get the full message from process_mask
+        yield (r[0],) + process_mask(*r[1:])
+      else:
+        yield r[0], out_masks[j], bool(flips[j]), ""
 
 
 def build_index_key(seq):
-  return min(seq, rc(seq))
+  return min(seq, seq.translate(RC_TABLE)[::-1])
+
+
+def build_index_keys(seqs):
+  """
+  Canonize a list of (uppercase) sequences: same as calling
+  build_index_key on each of them, but the whole block is
+  complemented with a single translate call.
+  """
+  if not seqs:
+    return []
+  complements = '\n'.join(seqs).translate(RC_TABLE).split('\n')
+  return [min(s, c[::-1]) for s, c in it.izip(seqs, complements)]
 
 
 def write_mdef(stream, fo, header=True):
@@ -10,7 +10,7 @@ from contextlib import nested
 
 from bl.core.utils import NullLogger
 
-from common import process_mask, write_mdef
+from common import process_mask_records, write_mdef
 
 
 HELP_DOC = __doc__
@@ -34,11 +34,11 @@ def extract_data(fi, logger=None):
   logger.info("processing %r" % bn)
   reader = AffySNPReader(fi)
   warn_count = 0
-  for i, r in enumerate(reader):
-    label = r['Probe Set ID']
-    mask, allele_flip, error = process_mask(
-      r['Flank'], r['Allele A'], r['Allele B']
-      )
+  records = ((r['Probe Set ID'], r['Flank'], r['Allele A'], r['Allele B'])
+             for r in reader)
+  for i, (label, mask, allele_flip, error) in enumerate(
+    process_mask_records(records)
+    ):
     if error:
       logger.warn("%s: %s" % (label, error))
       warn_count += 1
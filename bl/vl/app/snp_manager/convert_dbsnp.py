@@ -23,7 +23,7 @@ import os
 
 from bl.core.seq.io import DbSnpReader
 from bl.core.utils import NullLogger
-from common import process_mask, write_mdef
+from common import process_mask_records, write_mdef
 
 
 HELP_DOC = __doc__
@@ -50,10 +50,14 @@ def extract_data(fi, mask_size, logger=None):
   logger.info("processing %r" % bn)
   reader = DbSnpReader(fi, logger=logger)
   warn_count = 0
-  for i, (label, lflank, alleles, rflank) in enumerate(reader):
-    alleles = alleles.split("/")
-    mask = build_mask(lflank, alleles, rflank, mask_size)
-    mask, allele_flip, error = process_mask(mask, alleles[0], alleles[1])
+  def iter_records():
+    for label, lflank, alleles, rflank in reader:
+      alleles = alleles.split("/")
+      mask = build_mask(lflank, alleles, rflank, mask_size)
+      yield label, mask, alleles[0], alleles[1]
+  for i, (label, mask, allele_flip, error) in enumerate(
+    process_mask_records(iter_records())
+    ):
     if error:
       logger.warn("%s: %s" % (label, error))
       warn_count += 1
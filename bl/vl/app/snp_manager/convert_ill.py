@@ -12,28 +12,31 @@ from bl.core.utils import NullLogger
 from bl.core.seq.utils.baseops import COMPLEMENT
 from bl.core.io.illumina import IllSNPReader
 
-from common import process_mask, write_mdef
+from common import process_mask_records, write_mdef
 
 
 HELP_DOC = __doc__
 
 
+def iter_records(reader):
+  for r in reader:
+    # alleles are the same as those extracted from the mask if strand
+    # is TOP; if strand is BOT they are their complement (NOT reversed)
+    allele_a, allele_b = r['SNP'].strip("[]").split("/")
+    if r['IlmnStrand'] == 'BOT':
+      allele_a, allele_b = COMPLEMENT[allele_a], COMPLEMENT[allele_b]
+    yield r['IlmnID'], r['TopGenomicSeq'], allele_a, allele_b
+
+
 def extract_data(fi, logger=None):
   logger = logger or NullLogger()
   bn = os.path.basename(fi.name)
   logger.info("processing %r" % bn)
   reader = IllSNPReader(fi)
   warn_count = 0
-  for i, r in enumerate(reader):
-    label = r['IlmnID']
-    # alleles are the same as those extracted from the mask if strand
-    # is TOP; if strand is BOT they are their complement (NOT reversed)
-    allele_a, allele_b = r['SNP'].strip("[]").split("/")
-    if r['IlmnStrand'] == 'BOT':
-      allele_a, allele_b = COMPLEMENT[allele_a], COMPLEMENT[allele_b]
-    mask, allele_flip, error = process_mask(
-      r['TopGenomicSeq'], allele_a, allele_b
-      )
+  for i, (label, mask, allele_flip, error) in enumerate(
+    process_mask_records(iter_records(reader))
+    ):
     if error:
       logger.warn("%s: %s" % (label, error))
       warn_count += 1
@@ -11,9 +11,13 @@ alignment info in one of the following formats:
 
 Expects single-end BWA alignment data produced by the previous steps
 in the workflow (see markers_to_fastq).
+
+With --processes N, the SAM file is split into byte ranges that start
+at the first read of a marker and converted by N worker processes;
+output (and log messages) are the same as with a single process.
 """
 
-import os
+import os, shutil, tempfile, multiprocessing
 from contextlib import nested
 
 from bl.core.seq.align.mapping import SAMMapping
@@ -27,6 +31,53 @@ HELP_DOC = __doc__
 OUTPUT_FORMATS = ["marker_alignment", "segment_extractor"]
 DEFAULT_OUTPUT_FORMAT = OUTPUT_FORMATS[0]
 DEFAULT_FLANK_SIZE = vlu_snp.SNP_FLANK_SIZE
+PARTS_PER_PROCESS = 4
+READ_BUFSIZE = 1 << 20
+
+
+class SamHit(object):
+  """
+  Provides the subset of the SAMMapping interface used by
+  SnpHitProcessor, parsing only the fields it needs.  Hits with
+  clipped alignments or without the requested tag are delegated to
+  SAMMapping.
+  """
+
+  __slots__ = ('fields', 'flag', 'tid', 'qual', '__mapping')
+
+  def __init__(self, fields):
+    self.fields = fields
+    self.flag = int(fields[1])
+    self.tid = None if fields[2] == '*' else fields[2]
+    self.qual = int(fields[4])
+    self.__mapping = None
+
+  def __full_mapping(self):
+    if self.__mapping is None:
+      self.__mapping = SAMMapping(self.fields)
+    return self.__mapping
+
+  def get_name(self):
+    return self.fields[0]
+
+  def is_mapped(self):
+    return not self.flag & 0x4
+
+  def is_on_reverse(self):
+    return bool(self.flag & 0x10)
+
+  def tag_value(self, tag):
+    prefix = '%s:i:' % tag
+    for f in self.fields[11:]:
+      if f.startswith(prefix):
+        return int(f[len(prefix):])
+    return self.__full_mapping().tag_value(tag)
+
+  def get_untrimmed_pos(self):
+    cigar = self.fields[5]
+    if 'S' in cigar or 'H' in cigar:
+      return self.__full_mapping().get_untrimmed_pos()
+    return int(self.fields[3])
 
 
 def SamReader(f):
@@ -34,7 +85,7 @@ def SamReader(f):
     line = line.strip()
     if line == "" or line.startswith("@"):
       continue
-    yield SAMMapping(line.split())
+    yield SamHit(line.split())
 
 
 class SnpHitProcessor(object):
@@ -119,14 +170,153 @@ class SnpHitProcessor(object):
     self.outf.close()
 
 
-def write_output(sam_reader, outf, reftag, outfmt, flank_size, logger=None):
+def write_output(sam_reader, outf, reftag, outfmt, flank_size, logger=None,
+                 header=True):
   logger = logger or NullLogger()
   hit_processor = SnpHitProcessor(reftag, outf, outfmt, flank_size, logger)
-  hit_processor.write_header()
-  for i, m in enumerate(sam_reader):
+  if header:
+    hit_processor.write_header()
+  count = 0
+  for m in sam_reader:
     hit_processor.process(m)
-  hit_processor.dump_current_hits()  # last pair
-  return i+1
+    count += 1
+  if hit_processor.current_id is not None:
+    hit_processor.dump_current_hits()  # last pair
+  return count
+
+
+def read_range(fn, start, end, bufsize=READ_BUFSIZE):
+  """
+  Iterate through the lines contained in the [start, end) byte range
+  of file fn (start and end must be at line boundaries).
+  """
+  with open(fn) as f:
+    f.seek(start)
+    remaining = end - start
+    tail = ''
+    while remaining > 0:
+      data = f.read(min(bufsize, remaining))
+      if not data:
+        break
+      remaining -= len(data)
+      lines = (tail + data).split('\n')
+      tail = lines.pop()
+      for l in lines:
+        yield l
+    if tail:
+      yield tail
+
+
+def split_sam(fn, n_parts, serializer=None):
+  """
+  Split SAM file fn into at most n_parts byte ranges of similar size,
+  such that all reads of a marker (i.e., with the same label in their
+  names) are in the same range.  Return a list of (start, end) pairs.
+  """
+  serializer = serializer or SeqNameSerializer()
+  def group(line):
+    if line.strip() == '' or line.startswith('@'):
+      return None
+    return serializer.deserialize(line.split('\t', 1)[0])[0]
+  size = os.path.getsize(fn)
+  bounds = [0]
+  with open(fn) as f:
+    for k in xrange(1, n_parts):
+      offset = max(bounds[-1], size * k // n_parts)
+      if offset >= size:
+        break
+      if offset == 0:
+        continue
+      f.seek(offset - 1)
+      f.readline()  # go to the start of the next line
+      pos = f.tell()
+      line = f.readline()
+      g = group(line)
+      while line and group(line) == g:
+        pos = f.tell()
+        line = f.readline()
+      if pos < size and pos > bounds[-1]:
+        bounds.append(pos)
+  bounds.append(size)
+  return zip(bounds[:-1], bounds[1:])
+
+
+class PartLogger(object):
+  """
+  Write log messages to a file, to be replayed in the main process.
+  """
+
+  def __init__(self, f):
+    self.f = f
+
+  def __log(self, level, msg):
+    self.f.write('%s\t%s\n' % (level, msg))
+
+  def debug(self, msg):
+    self.__log('debug', msg)
+
+  def info(self, msg):
+    self.__log('info', msg)
+
+  def warning(self, msg):
+    self.__log('warning', msg)
+
+  warn = warning
+
+  def error(self, msg):
+    self.__log('error', msg)
+
+  def critical(self, msg):
+    self.__log('critical', msg)
+
+
+def convert_part(args):
+  fn, start, end, reftag, outfmt, flank_size, wd = args
+  out_fn = os.path.join(wd, '%d.out' % start)
+  log_fn = os.path.join(wd, '%d.log' % start)
+  with nested(open(out_fn, 'w'), open(log_fn, 'w')) as (outf, logf):
+    count = write_output(SamReader(read_range(fn, start, end)), outf, reftag,
+                         outfmt, flank_size, logger=PartLogger(logf),
+                         header=False)
+  return out_fn, log_fn, count
+
+
+def write_output_parallel(fn, outf, reftag, outfmt, flank_size, processes,
+                          logger=None):
+  """
+  Same as write_output, with the SAM file fn converted in parallel
+  by the given number of worker processes.
+  """
+  logger = logger or NullLogger()
+  SnpHitProcessor(reftag, outf, outfmt, flank_size, logger).write_header()
+  outf.flush()
+  ranges = split_sam(fn, processes * PARTS_PER_PROCESS)
+  logger.info("converting %d parts with %d processes" %
+              (len(ranges), processes))
+  wd = tempfile.mkdtemp(prefix='bl_vl_sam_')
+  pool = multiprocessing.Pool(processes)
+  try:
+    count = 0
+    tasks = [(fn, start, end, reftag, outfmt, flank_size, wd)
+             for start, end in ranges]
+    for out_fn, log_fn, n in pool.imap(convert_part, tasks):
+      with open(log_fn) as f:
+        for line in f:
+          level, msg = line.rstrip('\n').split('\t', 1)
+          getattr(logger, level)(msg)
+      with open(out_fn) as f:
+        shutil.copyfileobj(f, outf)
+      os.remove(out_fn)
+      os.remove(log_fn)
+      count += n
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    shutil.rmtree(wd, ignore_errors=True)
+  return count
 
 
 def make_parser(parser):
@@ -143,15 +333,22 @@ def make_parser(parser):
                       default=DEFAULT_FLANK_SIZE,
                       help='size of the flanks to extract around the SNP.' +
                       ' Has no effect with marker alignment output')
+  parser.add_argument('--processes', metavar='INT', type=int, default=1,
+                      help='number of worker processes')
 
 
 def main(logger, args):
   with nested(open(args.input_file), open(args.output_file, 'w')) as (f, outf):
     bn = os.path.basename(args.input_file)
     logger.info("processing %r" % bn)
-    reader = SamReader(f)
-    count = write_output(reader, outf, args.reftag, args.output_format,
-                         args.flank_size, logger=logger)
+    if args.processes > 1:
+      count = write_output_parallel(args.input_file, outf, args.reftag,
+                                    args.output_format, args.flank_size,
+                                    args.processes, logger=logger)
+    else:
+      reader = SamReader(f)
+      count = write_output(reader, outf, args.reftag, args.output_format,
+                           args.flank_size, logger=logger)
   logger.info("SAM records processed from %r: %d" % (bn, count))
 
 
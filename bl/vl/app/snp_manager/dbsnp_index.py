@@ -0,0 +1,252 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Sorted, memory-mapped dbSNP index.
+
+An index maps fixed-length keys (canonized flanking sequences, see
+common.build_index_key) to lists of tags.  It is stored in a single
+file with the following layout::
+
+  header   MAGIC, key length, number of keys (little endian uint64)
+  keys     sorted, unique keys, key_len bytes each
+  offsets  n_keys + 1 little endian uint64 offsets into tags
+  tags     the tags of each key, one per line, in input order
+
+The index is built by IndexBuilder with an external sort: (key, tag)
+pairs are sorted in memory in runs of at most run_size pairs, runs are
+spilled to disk and merged in a single pass, so that memory usage
+does not depend on the size of the input.  Lookups are binary
+searches on the memory-mapped keys.
+
+Files written by older versions of build_index are shelves: use
+open_index to open an index file in either format.
+"""
+
+import os, struct, mmap, heapq, shelve, tempfile, shutil
+import itertools as it
+
+import numpy as np
+
+
+MAGIC = 'VLDBSNP1'
+HEADER = struct.Struct('<8sQQ')
+OFFSET_DTYPE = np.dtype('<u8')
+RUN_SIZE = 1000000  # max (key, tag) pairs sorted in memory
+
+
+def _pad(pos):
+  return (pos + 7) & ~7
+
+
+class IndexBuilder(object):
+  """
+  Build a sorted index from (key, tag) pairs added in any order.  All
+  keys must have the same length; tags cannot contain newlines.
+
+  Nothing is written to path until close is called.
+  """
+
+  def __init__(self, path, run_size=RUN_SIZE, tmp_dir=None):
+    self.path = path
+    self.run_size = run_size
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_index_', dir=tmp_dir)
+    self.key_len = None
+    self.buffer = []
+    self.runs = []
+    self.n_pairs = 0
+
+  def add(self, key, tag):
+    if self.key_len is None:
+      self.key_len = len(key)
+    elif len(key) != self.key_len:
+      raise ValueError('key %r: length is not %d' % (key, self.key_len))
+    self.buffer.append((key, self.n_pairs, tag))
+    self.n_pairs += 1
+    if len(self.buffer) >= self.run_size:
+      self.__spill()
+
+  def __spill(self):
+    self.buffer.sort()
+    fn = os.path.join(self.wd, 'run_%d' % len(self.runs))
+    with open(fn, 'w') as f:
+      for key, i, tag in self.buffer:
+        f.write('%s\t%d\t%s\n' % (key, i, tag))
+    self.runs.append(fn)
+    self.buffer = []
+
+  def __read_run(self, fn):
+    with open(fn) as f:
+      for line in f:
+        key, i, tag = line.rstrip('\n').split('\t', 2)
+        yield key, int(i), tag
+
+  def __sorted_pairs(self):
+    if not self.runs:
+      self.buffer.sort()
+      return iter(self.buffer)
+    if self.buffer:
+      self.__spill()
+    return heapq.merge(*[self.__read_run(fn) for fn in self.runs])
+
+  def discard(self):
+    shutil.rmtree(self.wd, ignore_errors=True)
+    self.buffer = []
+
+  def close(self):
+    """
+    Merge all runs and write the index to path.  Return the number
+    of distinct keys.
+    """
+    try:
+      key_len = self.key_len or 0
+      keys_fn, offsets_fn, tags_fn = [os.path.join(self.wd, n) for n in
+                                      ('keys', 'offsets', 'tags')]
+      n_keys = 0
+      with open(keys_fn, 'wb') as kf, open(offsets_fn, 'wb') as of, \
+           open(tags_fn, 'wb') as tf:
+        offset = 0
+        for key, group in it.groupby(self.__sorted_pairs(), lambda p: p[0]):
+          kf.write(key)
+          of.write(struct.pack('<Q', offset))
+          for _, _, tag in group:
+            tf.write(tag)
+            tf.write('\n')
+            offset += len(tag) + 1
+          n_keys += 1
+        of.write(struct.pack('<Q', offset))
+      with open(self.path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, key_len, n_keys))
+        for fn in keys_fn, offsets_fn, tags_fn:
+          f.write('\0' * (_pad(f.tell()) - f.tell()))
+          with open(fn, 'rb') as part:
+            shutil.copyfileobj(part, f)
+      return n_keys
+    finally:
+      self.discard()
+
+
+class SortedIndex(object):
+  """
+  Read-only access to an index written by IndexBuilder.  Supports
+  the parts of the mapping interface used on shelve indexes: get,
+  __getitem__, __contains__, __len__, iteritems and close.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.__f = open(path, 'rb')
+    magic, self.key_len, self.n_keys = HEADER.unpack(
+      self.__f.read(HEADER.size)
+      )
+    if magic != MAGIC:
+      self.__f.close()
+      raise ValueError('%r: not a sorted index file' % path)
+    keys_pos = _pad(HEADER.size)
+    offsets_pos = _pad(keys_pos + self.key_len * self.n_keys)
+    self.tags_pos = _pad(offsets_pos + OFFSET_DTYPE.itemsize *
+                         (self.n_keys + 1))
+    self.__mm = mmap.mmap(self.__f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.n_keys:
+      self.keys = np.frombuffer(self.__mm, dtype='S%d' % self.key_len,
+                                count=self.n_keys, offset=keys_pos)
+    else:
+      self.keys = np.empty(0, dtype='S1')
+    self.offsets = np.frombuffer(self.__mm, dtype=OFFSET_DTYPE,
+                                 count=self.n_keys + 1, offset=offsets_pos)
+
+  def __len__(self):
+    return self.n_keys
+
+  def __tags(self, i):
+    start = self.tags_pos + int(self.offsets[i])
+    end = self.tags_pos + int(self.offsets[i + 1])
+    return self.__mm[start:end - 1].split('\n')
+
+  def find(self, keys):
+    """
+    Return the positions of keys in the index (-1 for missing keys).
+
+    Keys are sorted before being searched for, so that the index is
+    scanned in order, like in a merge, touching each page of the
+    mapped file at most once.
+    """
+    keys = list(keys)
+    if not self.n_keys or not keys:
+      return np.zeros(len(keys), dtype=np.int64) - 1
+    # longer keys would be truncated by the conversion
+    found = np.fromiter((len(k) == self.key_len for k in keys),
+                        dtype=np.bool_, count=len(keys))
+    keys = np.asarray(keys, dtype=self.keys.dtype)
+    order = np.argsort(keys, kind='mergesort')
+    pos = np.empty(len(keys), dtype=np.int64)
+    pos[order] = np.searchsorted(self.keys, keys[order])
+    found &= pos < self.n_keys
+    found[found] = self.keys[pos[found]] == keys[found]
+    return np.where(found, pos, -1)
+
+  def get_many(self, keys, default=None):
+    """
+    Return a list with the tags of each key in keys (default for
+    missing keys).
+    """
+    pos = self.find(keys)
+    res = [default] * len(pos)
+    for j in np.argsort(pos, kind='mergesort'):
+      if pos[j] >= 0:
+        res[j] = self.__tags(pos[j])
+    return res
+
+  def get(self, key, default=None):
+    if len(key) != self.key_len or not self.n_keys:
+      return default
+    i = int(self.keys.searchsorted(key))
+    if i < self.n_keys and self.keys[i] == key:
+      return self.__tags(i)
+    return default
+
+  def __getitem__(self, key):
+    tags = self.get(key)
+    if tags is None:
+      raise KeyError(key)
+    return tags
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def iteritems(self):
+    for i in xrange(self.n_keys):
+      yield self.keys[i], self.__tags(i)
+
+  def close(self):
+    self.keys = self.offsets = None
+    self.__mm.close()
+    self.__f.close()
+
+
+def get_many(index, keys, default=None):
+  """
+  Look up a list of keys in index, as returned by open_index.
+  """
+  if isinstance(index, SortedIndex):
+    return index.get_many(keys, default)
+  tags = dict((k, index.get(k, default)) for k in sorted(set(keys)))
+  return [tags[k] for k in keys]
+
+
+def is_sorted_index(path):
+  # some dbm backends add an extension to the shelve file name
+  if not os.path.isfile(path):
+    return False
+  with open(path, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+def open_index(path):
+  """
+  Open a dbSNP index file for reading, either a sorted index or a
+  shelve written by older versions of build_index.
+  """
+  if is_sorted_index(path):
+    return SortedIndex(path)
+  return shelve.open(path, 'r')
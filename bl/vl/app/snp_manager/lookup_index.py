@@ -8,12 +8,15 @@ database (see build_index) to get the true rs label; output a new
 marker definitions file with the true rs label and the extended mask.
 """
 
-import shelve, csv
+import csv, os, hashlib, tempfile, shutil
+import itertools as it
 from contextlib import nested
-from common import MARKER_DEF_FIELDS, SeqNameSerializer, build_index_key
+from common import MARKER_DEF_FIELDS, SeqNameSerializer, build_index_keys
+from dbsnp_index import open_index, get_many, IndexBuilder, SortedIndex
 
 
 HELP_DOC = __doc__
+BLOCK_SIZE = 100000  # number of sequences looked up at a time
 
 
 class Status(object):
@@ -31,10 +34,9 @@ def build_mask(seq, alleles):
   return "%s[%s]%s" % (seq[:snp_pos], alleles, seq[snp_pos+1:])
 
 
-def get_extracted_seqs(fn):
+def read_extracted_seqs(fn):
   with open(fn) as f:
     reader = csv.reader(f, delimiter="\t")
-    data = {}
     serializer = SeqNameSerializer()
     for r in reader:
       try:
@@ -42,8 +44,57 @@ def get_extracted_seqs(fn):
         seq = r[-1].upper()
       except IndexError:
         raise ValueError("%r: bad input format" % fn)
-      data[label] = (seq, alleles)
-    return data
+      yield label, seq, alleles
+
+
+def label_key(label):
+  return hashlib.md5(label).hexdigest()
+
+
+def lookup_extracted_seqs(fn, index, out_fn, block_size=BLOCK_SIZE,
+                          tmp_dir=None):
+  """
+  Look up the sequences in fn, block_size at a time, and write the
+  results to out_fn, a sorted index (see dbsnp_index) that maps the
+  label_key of each label to tab-separated label, extended mask and
+  tags.  Results are sorted on disk, so that memory usage does not
+  depend on the number of sequences.
+  """
+  builder = IndexBuilder(out_fn, run_size=block_size, tmp_dir=tmp_dir)
+  try:
+    records = read_extracted_seqs(fn)
+    while True:
+      block = list(it.islice(records, block_size))
+      if not block:
+        break
+      keys = build_index_keys([seq for _, seq, _ in block])
+      for (label, seq, alleles), tags in it.izip(block, get_many(index, keys,
+                                                                 [])):
+        builder.add(label_key(label),
+                    "\t".join([label, build_mask(seq, alleles)] + tags))
+  except:
+    builder.discard()
+    raise
+  return builder.close()
+
+
+def get_lookup_results(results, labels):
+  """
+  Return the (extended_mask, tags) of each label in labels, as
+  written by lookup_extracted_seqs to results (None for labels that
+  have not been looked up).  As with a dictionary, the last result
+  for a label wins.
+  """
+  res = []
+  for label, entries in it.izip(labels, results.get_many(
+      [label_key(l) for l in labels], [])):
+    found = None
+    for e in entries:
+      e = e.split("\t")
+      if e[0] == label:
+        found = (e[1], e[2:])
+    res.append(found)
+  return res
 
 
 def get_sort_idx(fn):
@@ -60,12 +111,17 @@ def get_sort_idx(fn):
 
 def write_output(logger, args):
   serializer = SeqNameSerializer()
-  index = None
+  index = results = None
   fields = MARKER_DEF_FIELDS + ("status", "extended_mask")
+  wd = tempfile.mkdtemp(prefix="bl_vl_lookup_",
+                        dir=os.path.dirname(os.path.abspath(args.output_file)))
   try:
-    index = shelve.open(args.index_file, "r")
-    logger.info("getting extracted sequences")
-    extracted_seqs = get_extracted_seqs(args.input_file)
+    index = open_index(args.index_file)
+    logger.info("looking up extracted sequences against %r" % args.index_file)
+    results_fn = os.path.join(wd, "results")
+    lookup_extracted_seqs(args.input_file, index, results_fn,
+                          args.block_size, wd)
+    results = SortedIndex(results_fn)
     if args.align_file:
       logger.info("getting sorting order from %r" % (args.align_file))
       idx_map = get_sort_idx(args.align_file)
@@ -74,48 +130,56 @@ def write_output(logger, args):
     with nested(open(args.orig_file), open(args.output_file,'w')) as (f, outf):
       outf.write("\t".join(fields)+"\n")
       reader = csv.DictReader(f, delimiter="\t")
-      logger.info("looking up against %r" % args.index_file)
-      for i, r in enumerate(reader):
-        label = r['label']
-        old_rs_label = r['rs_label']
-        mask = r['mask']
-        try:
-          seq, alleles = extracted_seqs[label]
-        except KeyError:
-          rs_label = extended_mask = 'None'
-          status = Status.NO_INFO
-        else:
-          extended_mask = build_mask(seq, alleles)
-          key = build_index_key(seq)
-          tags = index.get(key, [])
-          n_matches = len(tags)
-          if n_matches != 1:
-            logger.warning("%r maps to %d tags: %r" % (label, n_matches, tags))
-            rs_label = 'None'
-            status = Status.NO_MATCH if n_matches == 0 else Status.MULTI_MATCH
+      logger.info("writing %r" % args.output_file)
+      i = -1
+      while True:
+        block = list(it.islice(reader, args.block_size))
+        if not block:
+          break
+        found = get_lookup_results(results, [r['label'] for r in block])
+        for r, res in it.izip(block, found):
+          i += 1
+          label = r['label']
+          old_rs_label = r['rs_label']
+          mask = r['mask']
+          if res is None:
+            rs_label = extended_mask = 'None'
+            status = Status.NO_INFO
           else:
-            rs_label, _, _, _ = serializer.deserialize(tags[0])
-            if old_rs_label == "None":
-              status = Status.ADDED
+            extended_mask, tags = res
+            n_matches = len(tags)
+            if n_matches != 1:
+              logger.warning("%r maps to %d tags: %r" %
+                             (label, n_matches, tags))
+              rs_label = 'None'
+              status = (Status.NO_MATCH if n_matches == 0
+                        else Status.MULTI_MATCH)
             else:
-              status = (Status.CONFIRMED if rs_label == old_rs_label
-                        else Status.REPLACED)
-        if rs_label == 'None':
-          rs_label = label
-        out_r = [label, rs_label, mask, r['allele_a'], r['allele_b'],
-                 status, extended_mask]
-        if args.align_file:
-          try:
-            idx = idx_map[label]
-          except KeyError:
-            max_idx += 1
-            idx = max_idx
-          out_r.append(str(idx))
-        outf.write("%s\n" % "\t".join(out_r))
+              rs_label, _, _, _ = serializer.deserialize(tags[0])
+              if old_rs_label == "None":
+                status = Status.ADDED
+              else:
+                status = (Status.CONFIRMED if rs_label == old_rs_label
+                          else Status.REPLACED)
+          if rs_label == 'None':
+            rs_label = label
+          out_r = [label, rs_label, mask, r['allele_a'], r['allele_b'],
+                   status, extended_mask]
+          if args.align_file:
+            try:
+              idx = idx_map[label]
+            except KeyError:
+              max_idx += 1
+              idx = max_idx
+            out_r.append(str(idx))
+          outf.write("%s\n" % "\t".join(out_r))
       logger.info("processed %d records overall" % (i+1))
   finally:
     if index:
       index.close()
+    if results:
+      results.close()
+    shutil.rmtree(wd, ignore_errors=True)
 
 
 def make_parser(parser):
@@ -129,6 +193,10 @@ def make_parser(parser):
                       help="dbSNP index file")
   parser.add_argument("--align-file", metavar="FILE",
                       help="marker alignments file (if provided, adds index)")
+  parser.add_argument("--block-size", type=int, metavar="INT",
+                      default=BLOCK_SIZE,
+                      help="number of sequences (and records) processed "
+                      "at a time")
 
 
 def main(logger, args):
@@ -0,0 +1,123 @@
+"""
+Array-backed dependency graph.
+
+A compact, read-only representation of the dependency graph, stored
+as a numpy .npz file: node hashes (as computed by ome_hash), VIDs and
+classes, plus the edges in compressed sparse row form.  It can be
+built offline (see utils/ome_to_graph) from the node and edge CSV
+files written by the bulk loader and traversed without touching
+OMERO or Neo4j.
+"""
+
+import csv, os, tempfile
+
+import numpy as np
+
+
+class Adjacency(object):
+
+    def __init__(self, hashes, vids, klasses, sources, dests):
+        """
+        sources and dests are arrays of node indices: edge i goes
+        from sources[i] to dests[i].
+        """
+        self.hashes = np.asarray(hashes, dtype=np.int64)
+        self.vids = np.asarray(vids)
+        self.klasses = np.asarray(klasses)
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.dests = np.asarray(dests, dtype=np.int32)
+        self.__order = np.argsort(self.hashes, kind='mergesort')
+        self.__sorted_hashes = self.hashes[self.__order]
+        self.__build_csr()
+
+    def __build_csr(self):
+        # edges are traversed in both directions, as in the pygraph
+        # driver
+        n = len(self.hashes)
+        heads = np.concatenate([self.sources, self.dests])
+        tails = np.concatenate([self.dests, self.sources])
+        order = np.argsort(heads, kind='mergesort')
+        self.indices = tails[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(heads, minlength=n), out=self.indptr[1:])
+
+    @property
+    def n_nodes(self):
+        return len(self.hashes)
+
+    @property
+    def n_edges(self):
+        return len(self.sources)
+
+    def index(self, node_hash):
+        i = np.searchsorted(self.__sorted_hashes, node_hash)
+        if i < len(self.__sorted_hashes) and \
+           self.__sorted_hashes[i] == node_hash:
+            return self.__order[i]
+        raise KeyError(node_hash)
+
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def connected(self, node_hash, klass=None):
+        """
+        Return the indices of the nodes connected to node_hash,
+        including the node itself, optionally restricted to nodes of
+        class klass.
+        """
+        start = self.index(node_hash)
+        seen = np.zeros(self.n_nodes, dtype=np.bool_)
+        seen[start] = True
+        frontier = np.array([start])
+        while len(frontier):
+            nxt = np.concatenate([self.neighbors(i) for i in frontier])
+            nxt = np.unique(nxt[~seen[nxt]])
+            seen[nxt] = True
+            frontier = nxt
+        res = np.nonzero(seen)[0]
+        if klass is not None:
+            res = res[self.klasses[res] == klass]
+        return res
+
+    def save(self, path):
+        d = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=d, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, hashes=self.hashes, vids=self.vids,
+                     klasses=self.klasses, sources=self.sources,
+                     dests=self.dests)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        d = np.load(path)
+        return cls(d['hashes'], d['vids'], d['klasses'], d['sources'],
+                   d['dests'])
+
+    @classmethod
+    def from_csv(cls, nodes_fn, edges_fn):
+        """
+        Build from the nodes and edges CSV files written by the bulk
+        loader.  Edges whose ends are not among the nodes are skipped.
+        """
+        hashes, vids, klasses, position = [], [], [], {}
+        with open(nodes_fn) as f:
+            for r in csv.DictReader(f):
+                h = int(r['obj_hash'])
+                if h in position:
+                    continue
+                position[h] = len(hashes)
+                hashes.append(h)
+                vids.append(r['obj_id'])
+                klasses.append(r['obj_class'])
+        sources, dests = [], []
+        with open(edges_fn) as f:
+            for r in csv.DictReader(f):
+                try:
+                    s = position[int(r['source'])]
+                    d = position[int(r['dest'])]
+                except KeyError:
+                    continue
+                sources.append(s)
+                dests.append(d)
+        return cls(hashes, vids, klasses, sources, dests)
@@ -0,0 +1,209 @@
+"""
+Batched processing of graph events.
+
+Messages consumed from the events queue are buffered and applied to
+the graph in batches.  A batch is split in segments by messages that
+remove or modify existing nodes and edges; within a segment node
+creations (deduplicated by node hash) are applied first, then edge
+and collection item creations, each group with a single call to the
+bulk handler if one is available.  This keeps the semantics of serial
+processing, since creations never depend on later events.
+
+Successfully applied messages are acknowledged with a single
+multiple ack per segment, up to the last message of the segment that
+has not already been settled on its own (acking a delivery tag twice
+is a channel error).  If a bulk call fails, the group is
+processed again one message at a time, and failing messages are
+rejected as in serial processing.  If the graph can't be reached,
+all messages not yet acknowledged are requeued, so that delivery is
+'at least once': node and edge creation are idempotent.
+
+Messages can carry a (session, seq) stamp, assigned by the sender.
+Once a batch has been processed, the highest sequence number settled
+for each session is available via pop_watermarks, to be published
+back to the senders.
+"""
+
+import time
+
+from bl.vl.graph.errors import MissingEdgeError, GraphConnectionError
+from bl.vl.utils import get_logger
+
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+# events that can be moved ahead of other creation events, in the
+# order they are applied within a segment
+CREATION_ACTIONS = ('NODE_CREATE', 'EDGE_CREATE', 'COLLECTION_ITEM_CREATE')
+
+
+def node_hash(data):
+    return data['details']['obj_hash']
+
+
+def split_segments(messages):
+    """
+    Split (delivery_tag, data) messages in segments of creation events
+    separated by other events.  Return a list of (action, messages)
+    pairs, where action is None for creation segments.
+    """
+    segments, current = [], []
+    for m in messages:
+        if m[1]['action'] in CREATION_ACTIONS:
+            current.append(m)
+        else:
+            if current:
+                segments.append((None, current))
+                current = []
+            segments.append((m[1]['action'], [m]))
+    if current:
+        segments.append((None, current))
+    return segments
+
+
+class EventsBatch(object):
+
+    def __init__(self, actions, bulk_actions=None, logger=None,
+                 batch_size=BATCH_SIZE):
+        """
+        actions maps each event action to a function that applies a
+        single event, bulk_actions maps (creation) event actions to a
+        function that applies a list of events.
+        """
+        self.actions = actions
+        self.bulk_actions = bulk_actions or {}
+        self.logger = logger or get_logger('events-batch')
+        self.batch_size = batch_size
+        self.messages = []
+        self.stamps = {}
+        self.watermarks = {}
+        self.settled = set()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def is_full(self):
+        return len(self.messages) >= self.batch_size
+
+    def reset_stats(self):
+        self.stats = {
+            'messages': 0,
+            'batches': 0,
+            'bulk_calls': 0,
+            'single_calls': 0,
+            'duplicates': 0,
+            'fallbacks': 0,
+            'requeued': 0,
+            'time': 0.0,
+            }
+
+    def add(self, delivery_tag, data, stamp=None):
+        """
+        Buffer a message.  stamp, if given, is a dictionary with the
+        'session' and 'seq' of the message.  Return True if the batch
+        is full.
+        """
+        self.messages.append((delivery_tag, data))
+        if stamp and 'session' in stamp:
+            session = stamp['session']
+            self.stamps[session] = max(self.stamps.get(session, 0),
+                                       stamp['seq'])
+        return self.is_full
+
+    def pop_watermarks(self):
+        watermarks, self.watermarks = self.watermarks, {}
+        return watermarks
+
+    def flush(self, channel):
+        if not self.messages:
+            return 0
+        messages, self.messages = self.messages, []
+        stamps, self.stamps = self.stamps, {}
+        self.settled = set()
+        start = time.time()
+        try:
+            for action, segment in split_segments(messages):
+                if action is None:
+                    self.__apply_creations(channel, segment)
+                else:
+                    self.__apply_one(channel, *segment[0])
+        except GraphConnectionError, gre:
+            self.logger.error(gre.message)
+            self.logger.error('requeuing pending messages')
+            pending = [tag for tag, _ in messages if tag not in self.settled]
+            if pending:
+                channel.basic_nack(delivery_tag=pending[-1], multiple=True)
+            self.stats['requeued'] += len(pending)
+        else:
+            for session, seq in stamps.iteritems():
+                self.watermarks[session] = max(self.watermarks.get(session, 0),
+                                               seq)
+        self.stats['messages'] += len(messages)
+        self.stats['batches'] += 1
+        self.stats['time'] += time.time() - start
+        self.logger.debug('processed %d messages in %.3fs' %
+                          (len(messages), time.time() - start))
+        return len(messages)
+
+    def __apply_creations(self, channel, segment):
+        groups = dict((a, []) for a in CREATION_ACTIONS)
+        seen_nodes = set()
+        for tag, data in segment:
+            if data['action'] == 'NODE_CREATE':
+                h = node_hash(data)
+                if h in seen_nodes:
+                    self.stats['duplicates'] += 1
+                    continue
+                seen_nodes.add(h)
+            groups[data['action']].append((tag, data))
+        for a in CREATION_ACTIONS:
+            group = groups[a]
+            if not group:
+                continue
+            bulk = self.bulk_actions.get(a)
+            if bulk is None or len(group) == 1:
+                for tag, data in group:
+                    self.__apply_one(channel, tag, data, ack=False)
+                continue
+            try:
+                bulk([data for _, data in group])
+                self.stats['bulk_calls'] += 1
+            except GraphConnectionError:
+                raise
+            except Exception, e:
+                self.logger.warning('bulk %s failed (%s), applying %d events '
+                                    'one at a time' % (a, e, len(group)))
+                self.stats['fallbacks'] += 1
+                for tag, data in group:
+                    self.__apply_one(channel, tag, data, ack=False)
+        # settles all messages not already acked or nacked
+        pending = [tag for tag, _ in segment if tag not in self.settled]
+        if pending:
+            channel.basic_ack(delivery_tag=pending[-1], multiple=True)
+            self.settled.update(pending)
+
+    def __apply_one(self, channel, tag, data, ack=True):
+        # with ack=False, successfully applied messages are left to
+        # the multiple ack that closes the segment
+        try:
+            self.actions[data['action']](data)
+            self.stats['single_calls'] += 1
+            if ack:
+                channel.basic_ack(delivery_tag=tag)
+                self.settled.add(tag)
+        except MissingEdgeError:
+            # In Neo4J, if one of the nodes connected by an edge is
+            # deleted, the edge is automatically deleted as well. Log
+            # the event as warning, send an ack and continue
+            self.logger.warning('Unable to find edge for message %r, sending ack for message' % data)
+            channel.basic_ack(delivery_tag=tag)
+            self.settled.add(tag)
+        except GraphConnectionError:
+            raise
+        except Exception, e:
+            self.logger.exception(e)
+            channel.basic_nack(delivery_tag=tag)
+            self.settled.add(tag)
@@ -103,6 +103,10 @@ class PygraphDriver(object):
         else:
             return [self.objects_map_by_id[k] for k in st.keys()]
 
+    def wait_for(self, seq=None, timeout=None):
+        # the graph is built from OMERO data, nothing to wait for
+        return
+
     def create_node(self, obj):
         pass
 
@@ -3,11 +3,11 @@ from bulbs.property import String
 from bulbs.neo4jserver import Graph, Config
 from bulbs.config import log as bulbs_log
 import httplib2
-import time
 from bl.vl.utils import get_logger
 from bl.vl.utils.ome_utils import ome_hash
 from bl.vl.utils.graph import build_edge_id
 import bl.vl.kb.events as events
+from bl.vl.kb.messages import WAIT_TIMEOUT
 from bl.vl.graph.errors import DependencyTreeError, MissingEdgeError,\
     MissingNodeError, GraphOutOfSyncError, GraphAuthenticationError, \
     GraphConnectionError
@@ -55,6 +55,9 @@ class Neo4JDriver(object):
         'delete_edge',
         'update_edge',
         'save_collection_item',
+        'save_nodes',
+        'save_edges',
+        'save_collection_items',
     )
 
     DIRECTION_INCOMING = 1
@@ -148,6 +151,26 @@ class Neo4JDriver(object):
             raise GraphConnectionError('Connection to Neo4j server ended unexpectedly')
         return node.eid
 
+    def save_nodes(self, nodes_conf):
+        """
+        Bulk version of save_node: each distinct node is looked up (and
+        created) once.  Return the IDs of the nodes.
+        """
+        nids = {}
+        for conf in nodes_conf:
+            if conf['obj_hash'] not in nids:
+                nids[conf['obj_hash']] = self.save_node(conf)
+        return [nids[conf['obj_hash']] for conf in nodes_conf]
+
+    def __get_nodes_by_hash__(self, nodes_hash):
+        nodes = {}
+        for h in set(nodes_hash):
+            node = self.__get_node_by_hash__(h)
+            if not node:
+                raise MissingNodeError('No node with hash %s' % h)
+            nodes[h] = node
+        return nodes
+
     def create_edge(self, act, source, dest):
         event = events.build_event(events.EdgeCreationEvent, {'bl_act': act,
                                                               'bl_src_obj': source,
@@ -170,6 +193,38 @@ class Neo4JDriver(object):
                 raise GraphConnectionError('Connection to Neo4j server ended unexpectedly')
         return edge.eid
 
+    def save_edges(self, edges):
+        """
+        Bulk version of save_edge, edges is a list of (action_conf,
+        source_hash, dest_hash) tuples.  Nodes shared by more than one
+        edge are looked up once, and edges between the same pair of
+        nodes are created once (with the first action_conf), as in
+        serial processing.  Return the IDs of the edges.
+        """
+        by_nodes, missing = {}, []
+        for action_conf, source_hash, dest_hash in edges:
+            key = (source_hash, dest_hash)
+            if key in by_nodes:
+                continue
+            edge = self.__get_edge_by_nodes__(source_hash, dest_hash)
+            if edge:
+                by_nodes[key] = edge.eid
+            else:
+                by_nodes[key] = None
+                missing.append((action_conf, source_hash, dest_hash))
+        nodes = self.__get_nodes_by_hash__(
+            [m[1] for m in missing] + [m[2] for m in missing]
+        )
+        for action_conf, source_hash, dest_hash in missing:
+            try:
+                edge = self.graph.produces.create(nodes[source_hash],
+                                                  nodes[dest_hash],
+                                                  self.__encode_conf__(action_conf))
+            except httplib2.socket.error:
+                raise GraphConnectionError('Connection to Neo4j server ended unexpectedly')
+            by_nodes[(source_hash, dest_hash)] = edge.eid
+        return [by_nodes[(s, d)] for _, s, d in edges]
+
     def create_collection_item(self, item, collection):
         event = events.build_event(events.CollectionItemCreationEvent,
                                    {'item_obj' : item, 'coll_obj': collection})
@@ -188,6 +243,27 @@ class Neo4JDriver(object):
             raise GraphConnectionError('Connection to Neo4j server ended unexpectedly')
         return edge.eid
 
+    def save_collection_items(self, items):
+        """
+        Bulk version of save_collection_item, items is a list of
+        (item_hash, collection_hash) pairs.  Repeated pairs are created
+        once.  Return the IDs of the edges.
+        """
+        nodes = self.__get_nodes_by_hash__([i for i, _ in items] +
+                                           [c for _, c in items])
+        eids = {}
+        for key in items:
+            if key in eids:
+                continue
+            item_hash, collection_hash = key
+            try:
+                edge = self.graph.collected_in.create(nodes[item_hash],
+                                                      nodes[collection_hash])
+            except httplib2.socket.error:
+                raise GraphConnectionError('Connection to Neo4j server ended unexpectedly')
+            eids[key] = edge.eid
+        return [eids[key] for key in items]
+
     def destroy_node(self, obj):
         event = events.build_event(events.NodeDeletionEvent, {'bl_obj': obj})
         self.kb.events_sender.send_event(event)
@@ -257,19 +333,15 @@ class Neo4JDriver(object):
             return self.kb.get_by_vid(getattr(self.kb, obj_info['object_type']),
                                       obj_info['object_id'])
 
-    def __check_queue_status__(self, wait_interval, max_attempts):
-        attempts_count = 0
+    def wait_for(self, seq=None, timeout=WAIT_TIMEOUT):
+        """
+        Wait until the events sent by this KB session, up to seq (by
+        default, the last one sent), have been applied to the graph.
+        """
         if self.kb and self.kb.events_sender:
-            while attempts_count < max_attempts:
-                self.logger.debug('Checking queue status, attempt %d/%d' % (attempts_count + 1,
-                                                                            max_attempts))
-                if not self.kb.events_sender.is_queue_empty:
-                    attempts_count += 1
-                    time.sleep(wait_interval)
-                    self.logger.debug('Sleep for %d seconds' % wait_interval)
-                else:
-                    return
-            raise GraphOutOfSyncError('Queue is not empty, graph could be out of sync')
+            if not self.kb.events_sender.wait_for(seq, timeout):
+                raise GraphOutOfSyncError('Events not applied after %.1f seconds, '
+                                          'graph could be out of sync' % timeout)
         else:
             raise DependencyTreeError('No proper events handler configured, unable to check queue status')
 
@@ -307,8 +379,8 @@ class Neo4JDriver(object):
                                for cn in connected])
 
     def get_connected_infos(self, obj, aklass=None, direction=DIRECTION_BOTH, query_depth=None,
-                            wait_interval=5, max_attempts=3):
-        self.__check_queue_status__(wait_interval, max_attempts)
+                            timeout=WAIT_TIMEOUT):
+        self.wait_for(timeout=timeout)
         obj_node = self.__get_node__(obj)
         if not obj_node:
             raise DependencyTreeError('Unable to retrieve a node for object %s:%s' %
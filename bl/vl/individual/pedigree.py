@@ -19,72 +19,134 @@ INDIVIDUAL_DEFINITION_DOC = """
 MAX_COMPLEXITY=19
 
 
-def import_pedigree(recorder, istream):
+class PedigreeCycleError(ValueError):
+  pass
+
+
+def _find_cycle(family, index, n_parents, start):
+  # every individual left with n_parents > 0 has at least one parent
+  # in the same state, so following those parents must loop
+  path, pos = [], {}
+  n = start
+  while n not in pos:
+    pos[n] = len(path)
+    path.append(n)
+    i = family[n]
+    n = [index[p] for p in (i.father, i.mother)
+         if p is not None and p in index and n_parents[index[p]] > 0][0]
+  cycle = path[pos[n]:] + [n]
+  return [family[k].id for k in cycle]
+
+
+def generations(family):
+  """
+  Sort individuals by generation, so that parents always come before
+  their children.
+
+  Generation 0 contains all individuals with no parents in family,
+  generation k all individuals whose parents are in generations < k,
+  with at least one of them in generation k-1.  Parents that are not
+  in family are ignored.  Generations are computed in a single pass
+  over the parent-child links (Kahn's algorithm).
+
+  :param family: a list of individuals
+  :type  family: list
+
+  :rtype: list of lists of individuals, one for each generation
+
+  %s
+
+  """ % INDIVIDUAL_DEFINITION_DOC
+  members, index = [], {}
+  for i in family:
+    if i not in index:
+      index[i] = len(members)
+      members.append(i)
+  n_parents = [0] * len(members)
+  children = [[] for _ in members]
+  for n, i in enumerate(members):
+    for p in i.father, i.mother:
+      if p is not None and p in index:
+        n_parents[n] += 1
+        children[index[p]].append(n)
+  gens = []
+  current = [n for n, c in enumerate(n_parents) if c == 0]
+  n_sorted = 0
+  while current:
+    gens.append([members[n] for n in current])
+    n_sorted += len(current)
+    next_gen = []
+    for n in current:
+      for k in children[n]:
+        n_parents[k] -= 1
+        if n_parents[k] == 0:
+          next_gen.append(k)
+    current = next_gen
+  if n_sorted < len(members):
+    left = [n for n, c in enumerate(n_parents) if c > 0]
+    cycle = _find_cycle(members, index, n_parents, left[0])
+    raise PedigreeCycleError(
+      '%d individual(s) are their own ancestors or descend from one, e.g., '
+      '%s (child -> parent)' % (len(left), ' -> '.join(map(str, cycle)))
+      )
+  return gens
+
+
+def schedule(family, batch_size=None):
+  """
+  Yield (generation, batch) pairs, where batch is a list of at most
+  batch_size individuals (no limit if batch_size is None) from the
+  given generation, as computed by generations.
+  """
+  for depth, gen in enumerate(generations(family)):
+    step = batch_size or len(gen)
+    for start in xrange(0, len(gen), step):
+      yield depth, gen[start:start+step]
+
+
+def import_pedigree(recorder, istream, batch_size=None):
   """
   Given a stream of individuals it will manage the flow so that it is
   guaranteed that parents are recorded before their children.
 
+  Individuals are recorded one generation at a time (see
+  generations), in batches of at most batch_size individuals, and
+  recorder.dump_out is called at the end of each batch.
+
   :param recorder: a recorder object
   :type recorder: an object that presents a method with signature
-                  .record(label, gender, father, mother) FIXME also a method
-                  .retrieve(label)
+                  .record(label, gender, father, mother), a method
+                  .retrieve(label) and a method .dump_out()
 
   :param istream: the stream of individuals that should be imported
   :type istream:  an iterator of individuals I.
 
+  :param batch_size: maximum number of individuals saved at a time
+  :type batch_size: integer or None (no limit)
+
   %s
 
   """ % INDIVIDUAL_DEFINITION_DOC
-
-  family = []
+  family = list(istream)
+  members = set(family)
+  dangling = set(p for i in family for p in (i.father, i.mother)
+                 if p is not None and p not in members)
+  if dangling:
+    raise ValueError('there are %d dangling individual IDs: %s' %
+                     (len(dangling), list(dangling)))
   by_id = {}
-  for i in istream:
-    family.append(i)
-    by_id[i.id] = (i, None)
   def register(x):
     i = recorder.retrieve(x.id)
     if not i:
-      father = None if x.father is None else by_id[x.father.id][1]
-      mother = None if x.mother is None else by_id[x.mother.id][1]
+      father = None if x.father is None else by_id[x.father.id]
+      mother = None if x.mother is None else by_id[x.mother.id]
       i = recorder.record(x.id, x.gender, father, mother)
-    by_id[x.id] = (x, i)
+    by_id[x.id] = i
 
-  founders, non_founders, dangling, couples, children = analyze(family)
-  if dangling:
-    raise ValueError('there are %d dangling individual IDs: %s' %
-                     (len(dangling), dangling))
-  visited = {}
-  kids = {}
-  couples_by_partner = {}
-
-  for c in couples:
-    visited[c] = False
-    kids[c] = children[c[0]].intersection(children[c[1]])
-    couples_by_partner.setdefault(c[0], set()).add(c)
-    couples_by_partner.setdefault(c[1], set()).add(c)
-
-  wave = []
-  for f in founders:
-    register(f)
-    for c1 in couples_by_partner.get(f.id, []):
-      if visited[c1]:
-        wave.append(c1)
-      else:
-        visited[c1] = True
-
-  while wave:
-    # FIXME this is a dirty trick...
+  for depth, batch in schedule(family, batch_size):
+    for x in batch:
+      register(x)
     recorder.dump_out()
-    new_wave = []
-    for c in  wave:
-      for k in kids[c]:
-        register(k)
-        for c1 in couples_by_partner.get(k.id, []):
-          if visited[c1]:
-            new_wave.append(c1)
-          else:
-            visited[c1] = True
-    wave = new_wave
 
 
 def analyze(family):
@@ -163,12 +225,168 @@ def compute_bit_complexity(family, genotyped):
 
   """ % INDIVIDUAL_DEFINITION_DOC
   founders, non_founders, dangling, couples, children = analyze(family)
-  not_gt_couples = filter(lambda c : not (genotyped[c[0].id]
-                                          or genotyped[c[1].id]),
+  not_gt_couples = filter(lambda c: not _is_genotyped_couple(c, genotyped),
                           couples)
   return 2*len(non_founders) - len(founders) - len(not_gt_couples)
 
 
+def _is_genotyped_couple(couple, genotyped):
+  # partners that are not in the family are None
+  return any(genotyped[p.id] for p in couple if p is not None)
+
+
+class PedigreeIndex(object):
+  """
+  Parent-child links and genotyped status of a set of individuals,
+  indexed by position (self.individuals[n] is individual n).
+
+  Only individuals in the index are considered: in particular,
+  parents are the ones that are in children as keys, like in
+  up_propagate_front.
+
+  :param individuals: the individuals, including all those that are
+                      keys or members of children
+  :type  individuals: iterable
+
+  :param children: children sets indexed by individual, as returned
+                   by analyze
+  :type  children: dict
+
+  :param genotyped: the genotyped status of all the individuals
+  :type genotyped: a dict like object that returns the genotyped
+                   status (bool) when indexed by individual.id
+  """
+
+  def __init__(self, individuals, children, genotyped):
+    self.individuals = list(set(individuals))
+    self.position = dict((i, n) for n, i in enumerate(self.individuals))
+    self.children = [[self.position[k] for k in children.get(i, ())]
+                     for i in self.individuals]
+    self.parents = [tuple(self.position[p] if p in children else None
+                          for p in (i.father, i.mother))
+                    for i in self.individuals]
+    self.genotyped = [bool(genotyped[i.id]) for i in self.individuals]
+
+  @classmethod
+  def from_children(cls, children, genotyped, seeds=()):
+    individuals = set(seeds).union(children, *children.itervalues())
+    return cls(individuals, children, genotyped)
+
+  def __len__(self):
+    return len(self.individuals)
+
+
+class BitComplexityTracker(object):
+  """
+  Keep track of the bit complexity (see compute_bit_complexity) of a
+  family while individuals, given by their position in index, are
+  added to or removed from it.
+
+  Each update only looks at the individual and its children, so
+  growing a family one individual at a time costs time proportional
+  to the number of parent-child links involved rather than to the
+  size of the family.
+
+  :param index: the individuals that can be added
+  :type  index: PedigreeIndex
+
+  :param family: positions of the initial members
+  :type  family: iterable
+  """
+
+  def __init__(self, index, family=()):
+    self.index = index
+    self.members = set()
+    self.n_founders = 0
+    self.n_non_founders = 0
+    self.couples = {}  # couple -> number of children in the family
+    self.n_not_gt_couples = 0
+    for n in family:
+      self.add(n)
+
+  @property
+  def complexity(self):
+    return 2*self.n_non_founders - self.n_founders - self.n_not_gt_couples
+
+  def individuals(self):
+    return [self.index.individuals[n] for n in self.members]
+
+  def __len__(self):
+    return len(self.members)
+
+  def __contains__(self, n):
+    return n in self.members
+
+  def snapshot(self):
+    return (set(self.members), dict(self.couples), self.n_founders,
+            self.n_non_founders, self.n_not_gt_couples)
+
+  def restore(self, state):
+    """
+    Go back to a state returned by snapshot: much faster than
+    removing all individuals added since then, one by one.
+    """
+    members, couples, self.n_founders, self.n_non_founders, \
+      self.n_not_gt_couples = state
+    self.members, self.couples = set(members), dict(couples)
+
+  def __couple(self, n):
+    # None for founders, as in analyze
+    father, mother = self.index.parents[n]
+    if father not in self.members:
+      father = None
+    if mother not in self.members:
+      mother = None
+    if father is None and mother is None:
+      return None
+    return (father, mother)
+
+  def __link(self, couple, delta):
+    if couple is None:
+      self.n_founders += delta
+      return
+    self.n_non_founders += delta
+    c = self.couples.get(couple, 0)
+    if c + delta == 0:
+      del self.couples[couple]
+    else:
+      self.couples[couple] = c + delta
+    if c == 0 or c + delta == 0:
+      genotyped = self.index.genotyped
+      if not any(genotyped[p] for p in couple if p is not None):
+        self.n_not_gt_couples += delta
+
+  def __update(self, n, update_members):
+    kids = [k for k in self.index.children[n] if k in self.members]
+    for k in kids:
+      self.__link(self.__couple(k), -1)
+    update_members(n)
+    for k in kids:
+      self.__link(self.__couple(k), 1)
+
+  def add(self, n):
+    if n in self.members:
+      return
+    self.__update(n, self.members.add)
+    self.__link(self.__couple(n), 1)
+
+  def remove(self, n):
+    if n not in self.members:
+      return
+    self.__link(self.__couple(n), -1)
+    self.__update(n, self.members.discard)
+
+
+def _relatives(i, children):
+  # children and parents of i, the latter only if they are in the
+  # family children was computed on
+  for k in children.get(i, ()):
+    yield k
+  for p in i.father, i.mother:
+    if p is not None and p in children:
+      yield p
+
+
 def down_propagate_front(family, children):
   down_front = [children.get(ind, set()) for ind in family]
   down_front = set().union(*down_front)
@@ -186,16 +404,14 @@ def up_propagate_front(family, children):
 
 
 def propagate_family_helper(family, children):
-  # FIXME, remove tail recursion
-  pre_size = len(family)
-  down_front = down_propagate_front(family, children)
-  family = family.union(down_front)
-  up_front = up_propagate_front(family, children)
-  family = family.union(up_front)
-  if len(family) > pre_size:
-    return propagate_family_helper(family, children)
-  else:
-    return family
+  family = set(family)
+  stack = list(family)
+  while stack:
+    for k in _relatives(stack.pop(), children):
+      if k not in family:
+        family.add(k)
+        stack.append(k)
+  return family
 
 
 def propagate_family(family, children):
@@ -217,12 +433,17 @@ def split_disjoint(family, children):
   return splits
 
 
-def grow_family(seeds, children, genotyped, max_complexity=MAX_COMPLEXITY):
+def grow_family(seeds, children, genotyped, max_complexity=MAX_COMPLEXITY,
+                index=None):
   """
   Will grow family, following two ways parental relationships, from
   the list of seeds up to the largest possible complexity lower equal
   to the assigned max_complexity.
 
+  At each step, all children of the current family are added,
+  followed by all parents of the resulting one; the step is undone,
+  and growth stops, if the bit complexity exceeds max_complexity.
+
   :param seeds: initial group of individuals, it should be a family,
                 possibly composed by a single individual
   :type  seeds: list of individuals
@@ -233,25 +454,38 @@ def grow_family(seeds, children, genotyped, max_complexity=MAX_COMPLEXITY):
 
   :param max_complexity: the maximal acceptable bit complexity
   :type max_complexity: integer, default %d
+
+  :param index: an index of the individuals that can be reached from
+                seeds, built from the same children and genotyped
+                (built on the fly if None)
+  :type index: PedigreeIndex
   :rtype: a list with the resulting family
   """ % MAX_COMPLEXITY
 
-  family = set(seeds)
-  bc = 0
-  delta_size = len(family)
-  while delta_size > 0:
-    down_front = down_propagate_front(family, children)
-    new_fam = family.union(down_front)
-    up_front = up_propagate_front(new_fam, children)
-    new_fam = new_fam.union(up_front)
-    # FIXME: to compute bit_complexity at each cycle is rather stupid,
-    # since it could be computed incrementally.
-    delta_size = len(new_fam) - len(family)
-    bc = compute_bit_complexity(list(new_fam), genotyped)
-    if bc > max_complexity:
+  if index is None:
+    index = PedigreeIndex.from_children(children, genotyped, seeds)
+  family = BitComplexityTracker(index, [index.position[i] for i in seeds])
+  # only the individuals added by the last step can have relatives
+  # that are not in the family yet
+  front = set(family.members)
+  while front:
+    state = family.snapshot()
+    added = []
+    down_front = set(k for n in front for k in index.children[n]
+                     if k not in family)
+    for k in down_front:
+      family.add(k)
+      added.append(k)
+    for n in list(front) + added:
+      for p in index.parents[n]:
+        if p is not None and p not in family:
+          family.add(p)
+          added.append(p)
+    if family.complexity > max_complexity:
+      family.restore(state)
       break
-    family = new_fam
-  return list(family)
+    front = set(added)
+  return family.individuals()
 
 
 def split_family(family, genotyped, max_complexity=MAX_COMPLEXITY):
@@ -298,15 +532,13 @@ def split_family(family, genotyped, max_complexity=MAX_COMPLEXITY):
   # trivial implementation: sort on number of children
   def number_of_children(i):
     return len(children.get(i, []))
+  index = PedigreeIndex(family, children, genotyped)
   fams = []
-  while len(non_founders_not_genotyped) > 0:
-    non_founders_not_genotyped = sorted(non_founders_not_genotyped,
-                                        key=number_of_children)
-    i = non_founders_not_genotyped[0]
-    f = grow_family([i], children, genotyped, max_complexity)
-    cbn1 = compute_bit_complexity(f, genotyped)
-    non_founders_not_genotyped = list(set(non_founders_not_genotyped) -
-                                      set(f))
-    cbn = compute_bit_complexity(f, genotyped)
+  covered = set()
+  for i in sorted(non_founders_not_genotyped, key=number_of_children):
+    if i in covered:
+      continue
+    f = grow_family([i], children, genotyped, max_complexity, index)
+    covered.update(f)
     fams.append(f)
   return fams
@@ -0,0 +1,270 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Local columnar copies of OMERO tables.
+
+A :class:`ColumnStore` keeps read-only copies of whole tables on the
+local file system, one file per column: fixed size columns are saved
+as ``.npy`` files and memory mapped when read, while string columns
+are saved as a heap of concatenated values plus an array of offsets.
+Opening a copy does not read any data, so large tables (e.g., markers
+set definitions) are available as soon as they are opened, and all
+processes on the same host share the same pages.
+
+Each copy lives in a directory named after the *signature* of the
+table it was built from, i.e., the id of the table's OriginalFile,
+its modification time and its number of rows: a copy is valid if and
+only if a directory for the current signature exists.  Copies are
+written to a temporary directory and renamed into place, so that
+concurrent readers never see a partial copy.
+"""
+
+import os, mmap, json, shutil, tempfile
+import itertools as it
+
+import numpy as np
+
+
+META_FN = 'meta.json'
+TMP_PREFIX = '.tmp-'
+
+
+def signature_name(signature):
+  return '-'.join(str(int(x)) for x in signature)
+
+
+class StringColumn(object):
+  """
+  A column of strings stored as a single heap: value i is
+  heap[starts[i]:ends[i]].  Indexing with an integer returns a
+  string; indexing with a slice or an array of indices returns
+  another StringColumn sharing the same heap.
+  """
+
+  def __init__(self, heap, starts, ends, dtype):
+    self.heap = heap
+    self.starts = starts
+    self.ends = ends
+    self.dtype = np.dtype(dtype)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def __getitem__(self, i):
+    if isinstance(i, (int, long, np.integer)):
+      return self.heap[self.starts[i]:self.ends[i]]
+    return StringColumn(self.heap, self.starts[i], self.ends[i], self.dtype)
+
+  def __iter__(self):
+    return iter(self.tolist())
+
+  def __eq__(self, value):
+    lengths = self.ends - self.starts
+    sel = np.flatnonzero(lengths == len(value))
+    res = np.zeros(len(self), dtype=np.bool_)
+    if len(value) == 0 or len(sel) == 0:
+      res[sel] = True
+      return res
+    heap = np.frombuffer(self.heap, dtype=np.uint8)
+    pos = self.starts[sel][:, np.newaxis] + np.arange(len(value))
+    v = np.frombuffer(value, dtype=np.uint8)
+    res[sel] = (heap[pos] == v).all(axis=1)
+    return res
+
+  def __ne__(self, value):
+    return ~(self == value)
+
+  def tolist(self):
+    heap = self.heap
+    return [heap[s:e] for s, e in zip(self.starts.tolist(),
+                                      self.ends.tolist())]
+
+  def asarray(self):
+    return np.array(self.tolist(), dtype=self.dtype)
+
+
+class ColumnTable(object):
+  """
+  Read-only columns of a table.  Indexing with a column name returns
+  the column (a numpy array or a :class:`StringColumn`); indexing with
+  an integer returns the corresponding row as a dictionary; indexing
+  with a slice or an array of indices returns another ColumnTable.
+
+  path is the directory that holds the table copy, if any: other
+  files derived from the copy (e.g., indices) can be saved there and
+  will be removed together with it.
+  """
+
+  def __init__(self, dtype, columns, signature=None, path=None):
+    self.dtype = np.dtype(dtype)
+    self.columns = columns
+    self.signature = signature
+    self.path = path
+
+  @property
+  def col_names(self):
+    return list(self.dtype.names)
+
+  def __len__(self):
+    return len(self.columns[self.dtype.names[0]]) if self.columns else 0
+
+  def __getitem__(self, k):
+    if isinstance(k, basestring):
+      return self.columns[k]
+    if isinstance(k, (int, long, np.integer)):
+      return dict((n, c[k]) for n, c in self.columns.iteritems())
+    return ColumnTable(self.dtype,
+                       dict((n, c[k]) for n, c in self.columns.iteritems()),
+                       self.signature, self.path)
+
+  def __iter__(self):
+    names = self.dtype.names
+    cols = [self.columns[n] for n in names]
+    for values in it.izip(*cols):
+      yield dict(zip(names, values))
+
+  def to_records(self):
+    """
+    Return the table contents as a numpy record array.
+    """
+    records = np.zeros(len(self), dtype=self.dtype)
+    for n, c in self.columns.iteritems():
+      records[n] = c.asarray() if isinstance(c, StringColumn) else c
+    return records
+
+
+class ColumnStore(object):
+
+  def __init__(self, root):
+    self.root = root
+
+  def table_dir(self, table_name):
+    return os.path.join(self.root, table_name)
+
+  def path(self, table_name, signature):
+    return os.path.join(self.table_dir(table_name), signature_name(signature))
+
+  def open(self, table_name, signature):
+    """
+    Return the copy of table_name built for signature, or None if
+    there is no such copy.
+    """
+    path = self.path(table_name, signature)
+    try:
+      with open(os.path.join(path, META_FN)) as f:
+        meta = json.load(f)
+    except (IOError, ValueError):
+      return None
+    if meta['signature'] != list(signature):
+      return None
+    fields = [(str(n), str(t), tuple(s)) for n, t, s in meta['fields']]
+    columns = {}
+    for n, t, s in fields:
+      fn = os.path.join(path, n)
+      if np.dtype(t).kind == 'S':
+        offsets = np.load(fn + '.offsets.npy', mmap_mode='r')
+        columns[n] = StringColumn(self.__map_heap(fn + '.heap'),
+                                  offsets[:-1], offsets[1:], t)
+      else:
+        columns[n] = np.load(fn + '.npy', mmap_mode='r')
+    return ColumnTable(fields, columns, tuple(signature), path)
+
+  @staticmethod
+  def __map_heap(fn):
+    if os.path.getsize(fn) == 0:
+      return ''
+    with open(fn, 'rb') as f:
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def build(self, table_name, signature, dtype, batches):
+    """
+    Build the copy of table_name for signature from batches, an
+    iterable of numpy record arrays with the given dtype, and return
+    it.  Copies built for other signatures are removed.
+    """
+    dtype = np.dtype(dtype)
+    n_rows = int(signature[-1])
+    d = self.table_dir(table_name)
+    if not os.path.isdir(d):
+      try:
+        os.makedirs(d)
+      except OSError:
+        if not os.path.isdir(d):
+          raise
+    wd = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=d)
+    try:
+      self.__write(wd, signature, dtype, n_rows, batches)
+      try:
+        os.rename(wd, self.path(table_name, signature))
+      except OSError:
+        # another process has published the same copy
+        shutil.rmtree(wd, ignore_errors=True)
+    except:
+      shutil.rmtree(wd, ignore_errors=True)
+      raise
+    self.remove(table_name, keep=signature)
+    return self.open(table_name, signature)
+
+  def __write(self, wd, signature, dtype, n_rows, batches):
+    fields = []
+    writers = {}
+    for n in dtype.names:
+      t = dtype.fields[n][0]
+      fn = os.path.join(wd, n)
+      if t.kind == 'S':
+        writers[n] = (
+          open(fn + '.heap', 'wb'),
+          np.lib.format.open_memmap(fn + '.offsets.npy', mode='w+',
+                                    dtype=np.int64, shape=(n_rows + 1,))
+          )
+        writers[n][1][0] = 0
+      else:
+        writers[n] = np.lib.format.open_memmap(
+          fn + '.npy', mode='w+', dtype=t.base, shape=(n_rows,) + t.shape
+          )
+      fields.append([n, t.base.str, list(t.shape)])
+    try:
+      offset = 0
+      for b in batches:
+        m = min(len(b), n_rows - offset)
+        for n in dtype.names:
+          if dtype.fields[n][0].kind == 'S':
+            heap, offsets = writers[n]
+            values = b[n][:m].tolist()
+            lengths = np.fromiter((len(v) for v in values), dtype=np.int64,
+                                  count=m)
+            offsets[offset+1:offset+m+1] = (offsets[offset] +
+                                            np.cumsum(lengths))
+            heap.write(''.join(values))
+          else:
+            writers[n][offset:offset+m] = b[n][:m]
+        offset += m
+        if offset >= n_rows:
+          break
+      if offset < n_rows:
+        raise ValueError('expected %d rows, got %d' % (n_rows, offset))
+    finally:
+      for w in writers.itervalues():
+        if isinstance(w, tuple):
+          w[0].close()
+          w[1].flush()
+        else:
+          w.flush()
+    writers.clear()
+    with open(os.path.join(wd, META_FN), 'w') as f:
+      json.dump({'signature': list(signature), 'fields': fields}, f)
+
+  def remove(self, table_name, keep=None):
+    """
+    Remove all copies of table_name, except the one for the keep
+    signature.  Processes that are using a removed copy can keep
+    reading it until they close it.
+    """
+    d = self.table_dir(table_name)
+    if not os.path.isdir(d):
+      return
+    keep = signature_name(keep) if keep is not None else None
+    for name in os.listdir(d):
+      if name != keep and not name.startswith(TMP_PREFIX):
+        shutil.rmtree(os.path.join(d, name), ignore_errors=True)
@@ -95,7 +95,7 @@ class GenomicsAdapter(object):
         self.kb = kb
 
     def create_markers_array(self, label, maker, model, release, rows, 
-                             action):
+                             action, batch_size=BATCH_SIZE):
         """
         Create a new (SNP)MarkersSet object and associate to it all
         the markers information contained in rows.  Rows could be
@@ -103,7 +103,8 @@ class GenomicsAdapter(object):
         self.MSET_TABLE_COLS_DTYPE or a stream of dict records each of
         which should be consistent with self.MSET_TABLE_COLS. The
         order of markers array records exactly the one given in
-        stream.
+        stream.  Streams are consumed, and appended to the table, in
+        batches of batch_size records.
 
         FIXME: confusedly enough, this currently returns a SNPMarkersSet
         """
@@ -116,7 +117,7 @@ class GenomicsAdapter(object):
                                          marray.id)
         N = len(self._fill_markers_array_table(MSET_TABLE_NAME, marray.id,
                                                rows, avid,
-                                               batch_size=BATCH_SIZE))
+                                               batch_size=batch_size))
         #FIXME we are actually considering only SNP gdo.
         self._create_markers_array_table(GDO_TABLE_NAME, GDO_TABLE_COLS(N),
                                          marray.id)
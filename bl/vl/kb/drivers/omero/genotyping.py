@@ -24,6 +24,7 @@ if the Illumina strand detection algorithm yields a result (see
 :func:`~bl.vl.utils.snp.convert_to_top`).
 """
 
+import os
 import itertools as it
 from operator import itemgetter
 from collections import Counter
@@ -32,9 +33,10 @@ import numpy as np
 
 import bl.vl.utils as vlu
 import bl.vl.utils.snp as vlu_snp
-import bl.vl.utils.np_ext as np_ext
+from bl.vl.utils.external_sort import ExternalSorter
 
 from utils import assign_vid, make_unique_key
+from position_index import PositionIndex
 import wrapper as wp
 
 
@@ -115,15 +117,20 @@ class SNPMarkersSet(wp.OmeroWrapper):
       for i in indices:
         assert (beg_chr, beg_pos) <= ms.markers[i].position < (end_chr, end_pos)
     """
+    return SNPMarkersSet.define_ranges_selector(mset, [gc_range],
+                                                closed_interval)
+
+  @staticmethod
+  def define_ranges_selector(mset, gc_ranges, closed_interval=True):
+    """
+    Like :meth:`define_range_selector`, but return the sorted indices
+    of the markers of mset that are contained in any of the provided
+    gc_ranges.  All ranges are looked up at once in the position
+    index of mset (see :meth:`get_position_index`).
+    """
     if not mset.has_aligns():
       raise ValueError('aligns vector has not been loaded')
-    beg, end = gc_range
-    global_pos = mset.aligns['global_pos']
-    idx = mset.markers['index']
-    low_gpos = SNPMarkersSet.compute_global_position(beg)
-    high_gpos = SNPMarkersSet.compute_global_position(end)
-    sel = (low_gpos <= global_pos) &  (global_pos <= high_gpos)
-    return idx[sel]
+    return mset.get_position_index().select(gc_ranges, closed_interval)
 
   @staticmethod
   def intersect(mset1, mset2):
@@ -146,9 +153,7 @@ class SNPMarkersSet(wp.OmeroWrapper):
       raise ValueError('both mset should be aligned')
     if mset1.ref_genome != mset2.ref_genome:
       raise ValueError('msets should be aligned to the same ref_genome')
-    gpos1 = mset1.aligns['global_pos']
-    gpos2 = mset2.aligns['global_pos']
-    return np_ext.index_intersect(gpos1, gpos2)
+    return mset1.get_position_index().intersect(mset2.get_position_index())
 
   def __preprocess_conf__(self, conf):
     if not 'snpMarkersSetUK' in conf:
@@ -213,29 +218,77 @@ class SNPMarkersSet(wp.OmeroWrapper):
                        'allele_on_reference' : mali['allele']})
     return Marker(**kwargs)
 
-  def load_markers(self, batch_size=1000):
+  def load_markers(self, batch_size=1000, cached=True):
     """
     Read marker info from the marker set table and store it in the
     markers attribute.
+
+    If cached is True, markers are read from a memory-mapped local
+    copy of the table, which is built on first use and shared by all
+    processes on the same host (see
+    :meth:`GenotypingAdapter.get_cached_snp_markers_set_table`).
     """
-    data = self.proxy.gadpt.read_snp_markers_set(self.id, batch_size=batch_size)
+    if cached:
+      data = self.proxy.gadpt.get_cached_snp_markers_set_table(
+        MSET_TABLE, self.id, batch_size=batch_size
+        )
+    else:
+      data = self.proxy.gadpt.read_snp_markers_set(self.id,
+                                                   batch_size=batch_size)
     self.__set_markers(data)
 
-  def load_alignments(self, ref_genome, batch_size=1000):
+  def load_alignments(self, ref_genome, batch_size=1000, cached=True):
     """
-    Load marker alignment info wrt ``ref_genome``.
+    Load marker alignment info wrt ``ref_genome``.  See
+    :meth:`load_markers` for the meaning of cached.
     """
     if not self.has_markers():
       raise ValueError('markers vector has not been reloaded')
-    selector = "(ref_genome == '%s')" % ref_genome
-    aligns = self.proxy.gadpt.read_snp_markers_set_alignments(
-      self.id, selector=selector, batch_size=batch_size
-      )
+    if cached:
+      aligns = self.proxy.gadpt.get_cached_snp_markers_set_table(
+        ALIGN_TABLE, self.id, batch_size=batch_size
+        )
+      sel = np.flatnonzero(aligns['ref_genome'] == ref_genome)
+      if len(sel) < len(aligns):
+        aligns = aligns[sel]
+    else:
+      selector = "(ref_genome == '%s')" % ref_genome
+      aligns = self.proxy.gadpt.read_snp_markers_set_alignments(
+        self.id, selector=selector, batch_size=batch_size
+        )
     assert len(aligns) >= len(self)
     if len(aligns) > len(self):
       aligns = aligns[:len(self)]
     self.bare_setattr('aligns', aligns)
     self.bare_setattr('ref_genome', ref_genome)
+    self.bare_setattr('position_index', None)
+
+  def get_position_index(self):
+    """
+    Return the :class:`~position_index.PositionIndex` of the loaded
+    alignments.  The index is built on first use; if alignments come
+    from a local table copy (see :meth:`load_markers`), it is saved
+    next to the copy and reused by later loads.
+    """
+    if not self.has_aligns():
+      raise ValueError('aligns vector has not been loaded')
+    index = self.bare_getattr('position_index')
+    if index is not None:
+      return index
+    path = getattr(self.aligns, 'path', None)
+    if path is not None:
+      path = os.path.join(path, 'position_index.%s.npz' % self.ref_genome)
+      index = PositionIndex.load(path, len(self.aligns))
+    if index is None:
+      index = PositionIndex.build(self.aligns['global_pos'],
+                                  self.markers['index'][:len(self.aligns)])
+      if path is not None:
+        try:
+          index.save(path)
+        except (IOError, OSError):
+          pass  # the table copy has been removed in the meantime
+    self.bare_setattr('position_index', index)
+    return index
 
   def get_markers_iterator(self, indices = None):
     if not self.has_markers():
@@ -322,6 +375,15 @@ class GenotypingAdapter(object):
     table_name = self.snp_markers_set_table_name(table_name_root, set_vid)
     return self.kb.get_table_rows(table_name, selector, batch_size=batch_size)
 
+  def get_cached_snp_markers_set_table(self, table_name_root, set_vid,
+                                       batch_size=BATCH_SIZE):
+    """
+    Return a read-only local copy of a SNPMarkersSet table, as
+    returned by the knowledge base get_cached_table method.
+    """
+    table_name = self.snp_markers_set_table_name(table_name_root, set_vid)
+    return self.kb.get_cached_table(table_name, batch_size=batch_size)
+
   def create_snp_markers_set_tables(self, set_vid, N):
     """
     Create all tables needed by a SNPMarkersSet.
@@ -351,10 +413,10 @@ class GenotypingAdapter(object):
         x['op_vid'] = op_vid
         N[0] += 1
         yield x
-    i_s = mod_stream()
-    by_idx_s = iter(sorted(i_s, key=itemgetter('index')))  # uses memory
-    self._fill_snp_markers_set_table(MSET_TABLE, set_vid, by_idx_s,
-                                     batch_size=batch_size)
+    with ExternalSorter(key=itemgetter('index')) as by_idx_s:
+      by_idx_s.extend(mod_stream())
+      self._fill_snp_markers_set_table(MSET_TABLE, set_vid, iter(by_idx_s),
+                                       batch_size=batch_size)
     return N[0]
 
   def read_snp_markers_set(self, set_vid, selector=None, batch_size=BATCH_SIZE):
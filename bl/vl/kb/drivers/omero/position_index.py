@@ -0,0 +1,136 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Genome position indices for markers sets.
+
+A :class:`PositionIndex` keeps the global positions (see
+SNPMarkersSet.compute_global_position) of the markers of a set,
+sorted, together with the corresponding row numbers and marker
+indices, plus the offset of the first marker of each chromosome.
+Markers that fall within any number of genome ranges are found with a
+single vectorized binary search, and two sets are intersected by
+position without sorting.  Markers with a negative global position
+(multiple or ambiguous alignments) are not indexed.
+
+Indices are persisted as ``.npz`` files that record the number of
+markers they were built from.
+"""
+
+import os, tempfile
+
+import numpy as np
+
+
+MAX_GENOME_LEN = 10**10
+N_CHROMOSOMES = 26
+
+
+def global_position(chrom, pos):
+  return np.asarray(chrom, dtype=np.int64) * MAX_GENOME_LEN + pos
+
+
+class PositionIndex(object):
+
+  def __init__(self, gpos, rows, indices, n_markers):
+    self.gpos = gpos
+    self.rows = rows
+    self.indices = indices
+    self.n_markers = n_markers
+    self.chrom_offsets = np.searchsorted(
+      gpos, global_position(np.arange(N_CHROMOSOMES + 2), 0)
+      )
+
+  @classmethod
+  def build(cls, global_pos, indices):
+    """
+    Build the index from the global positions and the indices of all
+    markers of a set, in table order.
+    """
+    global_pos = np.asarray(global_pos, dtype=np.int64)
+    rows = np.flatnonzero(global_pos >= 0)
+    order = np.argsort(global_pos[rows], kind='mergesort')
+    rows = rows[order]
+    return cls(global_pos[rows], rows,
+               np.asarray(indices, dtype=np.int64)[rows], len(global_pos))
+
+  def __len__(self):
+    return len(self.gpos)
+
+  def chromosome(self, chrom):
+    """
+    Return the row numbers of the markers that align to chrom, sorted
+    by position.
+    """
+    return self.rows[self.chrom_offsets[chrom]:self.chrom_offsets[chrom+1]]
+
+  def __lookup(self, gc_ranges, closed_interval):
+    if len(gc_ranges) == 0:
+      return np.empty(0, dtype=np.int64)
+    bounds = np.asarray(gc_ranges, dtype=np.int64).reshape(-1, 4)
+    lo = np.searchsorted(self.gpos, global_position(bounds[:, 0],
+                                                    bounds[:, 1]), 'left')
+    hi = np.searchsorted(self.gpos, global_position(bounds[:, 2],
+                                                    bounds[:, 3]),
+                         'right' if closed_interval else 'left')
+    lengths = np.maximum(hi - lo, 0)
+    # concatenate [lo[i]:hi[i]] for all ranges
+    starts = np.cumsum(lengths) - lengths
+    return (np.arange(lengths.sum()) - np.repeat(starts, lengths) +
+            np.repeat(lo, lengths))
+
+  def select(self, gc_ranges, closed_interval=True):
+    """
+    Return the sorted indices of the markers that fall within any of
+    the gc_ranges, each a ((begin_chrom, begin_pos), (end_chrom,
+    end_pos)) tuple.
+    """
+    return np.unique(self.indices[self.__lookup(gc_ranges, closed_interval)])
+
+  def select_rows(self, gc_ranges, closed_interval=True):
+    """
+    Like :meth:`select`, but return row numbers.
+    """
+    return np.unique(self.rows[self.__lookup(gc_ranges, closed_interval)])
+
+  def intersect(self, other):
+    """
+    Return a pair of equal length arrays with the row numbers, in self
+    and other, of the markers that align to the same position, in
+    position order.
+    """
+    if len(self) == 0 or len(other) == 0:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pos = np.searchsorted(other.gpos, self.gpos)
+    pos[pos == len(other)] = 0
+    match = other.gpos[pos] == self.gpos
+    return self.rows[match], other.rows[pos[match]]
+
+  @classmethod
+  def load(cls, path, n_markers=None):
+    """
+    Load an index from path.  Return None if there is no usable index,
+    or if it was built from a number of markers other than n_markers.
+    """
+    if not os.path.exists(path):
+      return None
+    try:
+      with open(path, 'rb') as f:
+        d = np.load(f)
+        meta = d['meta']
+        gpos, rows, indices = d['gpos'], d['rows'], d['indices']
+    except (IOError, ValueError, KeyError):
+      return None
+    if n_markers is not None and int(meta[0]) != n_markers:
+      return None
+    return cls(gpos, rows, indices, int(meta[0]))
+
+  def save(self, path):
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+    fd, tmp = tempfile.mkstemp(dir=d or '.')
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, meta=np.array([self.n_markers], dtype=np.int64),
+               gpos=self.gpos, rows=self.rows, indices=self.indices)
+    os.rename(tmp, path)
@@ -6,6 +6,7 @@ from importlib import import_module
 
 # This is actually used in the metaclass magic
 import omero.model as om
+import omero.rtypes as ort
 
 import bl.vl.utils as vlu
 import bl.vl.kb.config as blconf
@@ -14,7 +15,7 @@ from bl.vl.kb.dependency import DependencyTree
 from bl.vl.kb import mimetypes
 
 from proxy_core import ProxyCore
-from wrapper import ObjectFactory, MetaWrapper
+from wrapper import ObjectFactory, MetaWrapper, link_fields, set_field_cache
 import action
 import vessels
 import objects_collections
@@ -96,8 +97,35 @@ class Proxy(ProxyCore):
 
   # High level ops
   # ==============
-  def find_all_by_query(self, query, params):
-    return super(Proxy, self).find_all_by_query(query, params, self.factory)
+  def find_all_by_query(self, query, params, offset=None, limit=None):
+    return super(Proxy, self).find_all_by_query(query, params, self.factory,
+                                                offset, limit)
+
+  def preload_link_vids(self, objects, batch_size=240):
+    """
+    Read the vids of the unloaded objects linked to objects, with one
+    projection query per type and batch of ids, and store them in the
+    (cached) wrappers of the linked objects, so that reading the vid
+    of a link, e.g., to serialize it by vid, needs no further query.
+    """
+    fields, links = {}, {}
+    for o in objects:
+      klass = type(o)
+      if klass not in fields:
+        fields[klass] = link_fields(klass)
+      for name in fields[klass]:
+        v = getattr(o.ome_obj, name)
+        if v is not None and not v.loaded:
+          links.setdefault(KOK[type(v)], {})[v.id.val] = v
+    for klass, by_id in links.iteritems():
+      ids = by_id.keys()
+      for i in xrange(0, len(ids), batch_size):
+        query = 'select o.id, o.vid from %s o where o.id in (%s)' % (
+          klass.get_ome_table(), ','.join(map(str, ids[i:i+batch_size])))
+        res = self.ome_operation('getQueryService', 'projection', query, None)
+        for r in res or []:
+          set_field_cache(self.factory.wrap(by_id[ort.unwrap(r[0])]),
+                          {'vid': ort.unwrap(r[1])})
 
   def get_by_vid(self, klass, vid):
     query = "from %s o where o.vid = :vid" % klass.get_ome_table()
@@ -107,32 +135,48 @@ class Proxy(ProxyCore):
       raise ValueError("%d kb objects map to %s" % (len(res), vid))
     return res[0]
 
-  def get_by_field(self, klass, field_name, values, batch_size=240):
+  def get_by_field(self, klass, field_name, values, batch_size=240,
+                   fields=None):
     """
     FIXME returns a dictionary that map all v in values
     for which exists an object o of class klass such that o.field_name == v
     to o.
+
+    If fields (a list of field names, e.g., ['id', 'vid']) is given,
+    objects are not loaded: each v is mapped to a tuple with the
+    (unwrapped) values of fields instead.
     """
+    def in_clause(values):
+      quote = lambda x: x.replace("'", "''") if isinstance(x, basestring) else x
+      return ','.join(map(lambda x: "'%s'" % quote(x), values))
     def get_by_field_helper(values):
       template = "from %s o where o.{} in (%s)".format(field_name)
-      query = template % (klass.get_ome_table(),
-                          ','.join(map(lambda x: "'%s'" % x, values)))
+      query = template % (klass.get_ome_table(), in_clause(values))
       params = {}
       res = self.find_all_by_query(query, params)
       return dict(map(lambda o: (getattr(o, field_name), o), res))
+    def project_by_field_helper(values):
+      select = ', '.join('o.%s' % f for f in [field_name] + list(fields))
+      query = 'select %s from %s o where o.%s in (%s)' % (
+        select, klass.get_ome_table(), field_name, in_clause(values))
+      res = self.ome_operation('getQueryService', 'projection', query, None)
+      return dict((ort.unwrap(r[0]), tuple(ort.unwrap(x) for x in r[1:]))
+                  for r in res or [])
     def values_by_chunk():
       offset = 0
       while len(values[offset:]) > 0:
         yield values[offset:offset+batch_size]
         offset += batch_size
 
+    values = list(values)
+    helper = project_by_field_helper if fields else get_by_field_helper
     if len(values) == 0:
       return {}
     if batch_size == 0:
-      return get_by_field_helper(values)
+      return helper(values)
     else:
       return reduce(lambda x, y: x.update(y) or x,
-                    map(get_by_field_helper, values_by_chunk()))
+                    map(helper, values_by_chunk()))
 
   def get_by_vids(self, klass, vids, batch_size=240):
     """
@@ -470,47 +514,65 @@ class Proxy(ProxyCore):
     rows = self.get_ehr_records(selector)
     return rows
 
-  def __build_ehr_selector(self, individual_id, timestamp, action_id,
-                           grouper_id, valid, archetype, field, field_value):
-    selector = []
+  def __build_ehr_conditions(self, individual_id, timestamp, action_id,
+                             grouper_id, valid, archetype, field,
+                             field_value):
+    conditions = []
     if individual_id:
-      selector.append('(i_vid == "%s")' % individual_id)
+      conditions.append(('i_vid', individual_id))
     if timestamp:
-      selector.append('(timestamp == %d)' % timestamp)
+      conditions.append(('timestamp', timestamp))
     if action_id:
-      selector.append('(a_vid == "%s")' % action_id)
+      conditions.append(('a_vid', action_id))
     if grouper_id:
-      selector.append('(g_vid == "%s")' % grouper_id)
+      conditions.append(('g_vid', grouper_id))
     if not valid is None:
-      selector.append('(valid == %s)' % valid)
+      conditions.append(('valid', valid))
     if archetype:
-      selector.append('(archetype == "%s")' % archetype)
+      conditions.append(('archetype', archetype))
     if field :
-      selector.append('(field == "%s")' % field)
+      conditions.append(('field', field))
     if not field_value is None:
       ftype, fval, defval = self.eadpt.FIELD_TYPE_ENCODING_TABLE[type(field_value).__name__]
-      selector.append('(type == "%s")' % ftype)
-      if ftype == 'str':
-        selector.append('(%s == "%s")' % (fval, field_value))
+      conditions.append(('type', ftype))
+      conditions.append((fval, field_value))
+    return conditions
+
+  def __build_ehr_selector(self, conditions):
+    selector = []
+    for k, v in conditions:
+      if isinstance(v, basestring):
+        selector.append('(%s == "%s")' % (k, v))
       else:
-        selector.append('(%s == %s)' % (fval, field_value))
+        selector.append('(%s == %s)' % (k, v))
     return ' & '.join(selector)
 
+  def __set_ehr_records_validity(self, conditions, valid):
+    update_items = {'valid' : valid}
+    if conditions and conditions[0][0] == 'i_vid':
+      # use the i_vid index rather than scanning the whole table
+      self.update_table_rows(self.eadpt.EAV_EHR_TABLE, None, update_items,
+                             key_col='i_vid', keys=[conditions[0][1]],
+                             filters=dict(conditions[1:]))
+    else:
+      selector = self.__build_ehr_selector(conditions)
+      self.update_table_rows(self.eadpt.EAV_EHR_TABLE, selector, update_items)
+
   def invalidate_ehr_records(self, individual_id, timestamp = None,
                              action_id = None, grouper_id = None,
                              archetype = None, field = None, field_value = None):
-    selector = self.__build_ehr_selector(individual_id, timestamp, action_id,
-                                         grouper_id, True, archetype, field,
-                                         field_value)
-    self.update_table_rows(self.eadpt.EAV_EHR_TABLE, selector, {'valid' : False})
+    conditions = self.__build_ehr_conditions(individual_id, timestamp,
+                                             action_id, grouper_id, True,
+                                             archetype, field, field_value)
+    self.__set_ehr_records_validity(conditions, False)
 
   def validate_ehr_records(self, individual_id, timestamp = None,
                              action_id = None, grouper_id = None,
                              archetype = None, field = None, field_value = None):
-    selector = self.__build_ehr_selector(individual_id, timestamp, action_id,
-                                         grouper_id, False, archetype, field,
-                                         field_value)
-    self.update_table_rows(self.eadpt.EAV_EHR_TABLE, selector, {'valid' : True})
+    conditions = self.__build_ehr_conditions(individual_id, timestamp,
+                                             action_id, grouper_id, False,
+                                             archetype, field, field_value)
+    self.__set_ehr_records_validity(conditions, True)
 
   def get_ehr_iterator(self, selector='(valid == True)'):
     # FIXME this is a quick and dirty implementation.
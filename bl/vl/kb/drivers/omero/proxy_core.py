@@ -3,6 +3,7 @@
 
 from bl.vl.utils import get_logger
 
+import os
 import itertools as it
 import numpy as np
 
@@ -15,9 +16,15 @@ import omero_Tables_ice
 import omero_SharedResources_ice
 
 import bl.vl.kb as kb
-from bl.vl.utils.ome_utils import ome_hash
+from bl.vl.utils.ome_utils import ome_hash, ome_table_index_dir, \
+  ome_table_cache_dir
+from bl.vl.utils.instrumentation import instrumented
 
 from wrapper import ome_wrap
+from table_cache import TableCache
+from table_writer import TableWriter, QUEUE_SIZE
+from table_index import TableIndex
+from column_store import ColumnStore
 
 
 BATCH_SIZE = 5000
@@ -120,6 +127,7 @@ class ProxyCore(object):
   def __init__(self, host, user, passwd, group=None, session_keep_tokens=1,
                check_ome_version=True):
     self.logger = get_logger('bl.vl.kb.drivers.omero.proxy_core')
+    self.host = host
     self.user = user
     self.passwd = passwd
     self.group_name = group
@@ -129,6 +137,11 @@ class ProxyCore(object):
     self.session_keep_tokens = session_keep_tokens
     self.transaction_tokens = 0
     self.current_session = None
+    self.table_cache = TableCache(convert_to_numpy_record_type,
+                                  logger=self.logger)
+    self.table_indices = {}
+    self.column_store = ColumnStore(os.path.join(ome_table_cache_dir(), host))
+    self.column_tables = {}
     if check_ome_version:
         self.__check_omero_version()
 
@@ -157,6 +170,7 @@ class ProxyCore(object):
 
   def disconnect(self):
     if self.transaction_tokens <= 0:
+      self.table_cache.clear()
       self.client.closeSession()
       self.current_session = None
       self.transaction_tokens = 0
@@ -174,6 +188,8 @@ class ProxyCore(object):
       params.add(k, conf[k])
     return params
 
+  @instrumented(detail=lambda self, operation, action, *args:
+                '%s.%s' % (operation, action))
   def ome_operation(self, operation, action, *action_args):
     session = self.connect()
     # try:
@@ -190,7 +206,14 @@ class ProxyCore(object):
     #   self.disconnect()
     return result
 
-  def find_all_by_query(self, query, params, factory):
+  @instrumented(payload='result')
+  def find_all_by_query(self, query, params, factory, offset=None,
+                        limit=None):
+    """
+    If limit is not None, return at most limit results, starting from
+    the one at offset (the query should sort results for paging to be
+    consistent).
+    """
     if params:
       xpars = {}
       for k,v in params.iteritems():
@@ -198,6 +221,9 @@ class ProxyCore(object):
       pars = self.ome_query_params(xpars)
     else:
       pars = None
+    if limit is not None:
+      pars = pars or osp.ParametersI()
+      pars.page(offset or 0, limit)
     result = self.ome_operation("getQueryService", "findAllByQuery",
                                 query, pars)
     return [] if result is None else [factory.wrap(r) for r in result]
@@ -226,6 +252,7 @@ class ProxyCore(object):
     o.ome_obj = res
     o.proxy = self
 
+  @instrumented()
   def save(self, obj):
     """
     Save and return a KB object.
@@ -246,6 +273,7 @@ class ProxyCore(object):
     obj.__dump_to_graph__(obj_update)
     return obj
 
+  @instrumented(payload=1)
   def save_array(self, array):
     """
     Save and return an array of KB objects.
@@ -266,6 +294,7 @@ class ProxyCore(object):
       o.__dump_to_graph__(u)
     return array
 
+  @instrumented()
   def delete(self, kb_obj):
     """
     Delete a KB object.
@@ -309,6 +338,7 @@ class ProxyCore(object):
   #     raise ValueError('get_table: cannot resolve %s' % table_name)
   #   return
 
+  @instrumented()
   def delete_table(self, table_name):
     """
     This method only removes the OriginalFile table entry from database.
@@ -321,12 +351,17 @@ class ProxyCore(object):
     """
     # try:
     self.connect()
+    self.table_cache.invalidate(table_name)
+    for key_col in self.__indexed_columns(table_name):
+      self.table_indices.pop((table_name, key_col)).remove()
+    self.__drop_cached_table(table_name)
     ofiles = self._list_table_copies(table_name)
     for o in ofiles:
       self.ome_operation('getUpdateService' , 'deleteObject', o)
     # finally:
     #   self.disconnect()
 
+  @instrumented()
   def table_exists(self, table_name):
     # try:
     ofiles = self._list_table_copies(table_name)
@@ -334,11 +369,14 @@ class ProxyCore(object):
       # self.disconnect()
     return len(ofiles) > 0
 
+  @instrumented()
   def get_number_of_rows(self, table_name):
     "returns the number of rows of table table_name"
-    session = self.connect()
-    table = self._get_table(session, table_name)
-    return table.getNumberOfRows()
+    h = self._open_table(table_name)
+    try:
+      return h.table.getNumberOfRows()
+    finally:
+      self._close_table(h)
 
   @staticmethod
   def _load_columns(table, records):
@@ -347,6 +385,7 @@ class ProxyCore(object):
       c.values = records[c.name].tolist()
     return columns
     
+  @instrumented(payload=2)
   def store_as_a_table(self, table_name, records, batch_size=10000):
     """
     Creates a new omero table called table_name and store in it the
@@ -364,27 +403,30 @@ class ProxyCore(object):
                                        records[offset: offset + batch_size]))
       offset += batch_size
     
+  @instrumented(payload='result')
   def read_whole_table(self, table_name, batch_size=10000):
     """
     Reads all data contained in the omero table called table_name and
     return result as a numpy records array.
     """
-    session = self.connect()
-    table = self._get_table(session, table_name)
-    n_rows = table.getNumberOfRows()
-    columns = table.getHeaders()
-    dtype = [(c.name, convert_type(c)) for c in columns]
-    records = np.zeros(n_rows, dtype=dtype)
-    offset = 0
-    while offset < n_rows:
-      next_offset = offset + batch_size
-      data = table.read(range(len(columns)), offset, next_offset)
-      block = records[offset:next_offset]
-      for c in data.columns:
-        block[c.name] = c.values
-      offset = next_offset
+    h = self._open_table(table_name)
+    try:
+      table = h.table
+      n_rows = table.getNumberOfRows()
+      records = np.zeros(n_rows, dtype=h.dtype)
+      offset = 0
+      while offset < n_rows:
+        next_offset = offset + batch_size
+        data = table.read(range(len(h.headers)), offset, next_offset)
+        block = records[offset:next_offset]
+        for c in data.columns:
+          block[c.name] = c.values
+        offset = next_offset
+    finally:
+      self._close_table(h)
     return records
     
+  @instrumented()
   def create_table(self, table_name, fields):
     ofields = [self.OME_TABLE_COLUMN[f[0]](*f[1:]) for f in fields]
     return self._create_table(table_name, ofields)
@@ -413,25 +455,42 @@ class ProxyCore(object):
       raise ValueError("failed to retrieve table '%s'" % table_name)
     return t
 
-  def get_table_rows_iterator(self, table_name, batch_size=100):
-    # TODO add error checking
-    def iter_on_rows(t, n_cols):
-      i, N = 0, t.getNumberOfRows()
-      while i < N:
-        j = min(N, i + batch_size)
-        v = t.read(range(n_cols), i, j)
-        Z = convert_coordinates_to_np(v)
-        for k in range(j - i):
-          yield Z[k]
-        i = j
-      # self.disconnect()  # this closes the connect() below
+  def _open_table(self, table_name):
+    """
+    Return a cached handle for table_name. The handle must be given
+    back with _close_table when done.
+    """
     s = self.connect()
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    return iter_on_rows(t, len(col_objs))
+    return self.table_cache.acquire(s, table_name, self._get_table)
 
-  def __convert_col_names_to_indices(self, table, col_names):
-    col_objs = table.getHeaders()
+  def _close_table(self, handle):
+    self.table_cache.release(handle)
+
+  def get_table_cache_stats(self):
+    """
+    Return a dictionary with table handle cache hit/miss counts and
+    latencies (in seconds).
+    """
+    return self.table_cache.get_stats()
+
+  def get_table_rows_iterator(self, table_name, batch_size=100):
+    # TODO add error checking
+    def iter_on_rows(h):
+      try:
+        t, n_cols = h.table, len(h.headers)
+        i, N = 0, t.getNumberOfRows()
+        while i < N:
+          j = min(N, i + batch_size)
+          v = t.read(range(n_cols), i, j)
+          Z = convert_coordinates_to_np(v)
+          for k in range(j - i):
+            yield Z[k]
+          i = j
+      finally:
+        self._close_table(h)
+    return iter_on_rows(self._open_table(table_name))
+
+  def __convert_col_names_to_indices(self, col_objs, col_names):
     if col_names:
       col_numbers = []
       by_name = dict(((c.name, i) for i, c in enumerate(col_objs)))
@@ -444,6 +503,7 @@ class ProxyCore(object):
       col_numbers = range(len(col_objs))
     return col_numbers
 
+  @instrumented(payload='result')
   def get_table_rows(self, table_name, selector=None, col_names=None,
                      batch_size=BATCH_SIZE):
     """
@@ -451,35 +511,36 @@ class ProxyCore(object):
     the latter case, it is interpreted as an 'or' condition between
     the list elements.
     """
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    if selector is None:
-      res = self.__get_table_rows_bulk(t, col_numbers, batch_size)      
-    else:
-      res = self.__get_table_rows_selected(t, selector, col_numbers,
-                                           batch_size)
-    # finally:
-    #   self.disconnect()
+    h = self._open_table(table_name)
+    try:
+      t = h.table
+      col_numbers = self.__convert_col_names_to_indices(h.headers, col_names)
+      if selector is None:
+        res = self.__get_table_rows_bulk(t, col_numbers, batch_size)
+      else:
+        res = self.__get_table_rows_selected(t, selector, col_numbers,
+                                             batch_size)
+    finally:
+      self._close_table(h)
     return res
 
+  @instrumented(payload='result')
   def get_table_rows_by_indices(self, table_name, indices=None, col_names=None,
                                 batch_size=BATCH_SIZE):
     """
     indices must be either None or a list of integer values.
     """
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    if indices is None:
-      res = self.__get_table_rows_bulk(t, col_numbers, batch_size)      
-    else:
-      res = self.__get_table_rows_by_indices(t, indices, col_numbers,
-                                             batch_size)
-    # finally:
-    #   self.disconnect()
+    h = self._open_table(table_name)
+    try:
+      t = h.table
+      col_numbers = self.__convert_col_names_to_indices(h.headers, col_names)
+      if indices is None:
+        res = self.__get_table_rows_bulk(t, col_numbers, batch_size)
+      else:
+        res = self.__get_table_rows_by_indices(t, indices, col_numbers,
+                                               batch_size)
+    finally:
+      self._close_table(h)
     return res
 
   def __get_table_rows_by_indices(self, table, row_indices, col_numbers,
@@ -520,66 +581,102 @@ class ProxyCore(object):
       row_read += batch_size
     return np.concatenate(tuple(res)) if res else []
 
+  @instrumented(payload='result')
   def get_table_slice(self, table_name, row_numbers, col_names=None,
                       batch_size=BATCH_SIZE):
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    res = self.__get_table_rows_slice(t, row_numbers, col_numbers, batch_size)
-    # finally:
-    #   self.disconnect()
+    h = self._open_table(table_name)
+    try:
+      col_numbers = self.__convert_col_names_to_indices(h.headers, col_names)
+      res = self.__get_table_rows_slice(h.table, row_numbers, col_numbers,
+                                        batch_size)
+    finally:
+      self._close_table(h)
     return res
   
+  @instrumented()
   def get_table_headers(self, table_name):
-    col_objs = None
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    # finally:
-    #   self.disconnect()
-    if col_objs:
-      return convert_to_numpy_record_type(col_objs)
+    h = self._open_table(table_name)
+    self._close_table(h)
+    if h.headers:
+      return list(h.dtype)
 
+  @instrumented()
   def add_table_row(self, table_name, row):
     if hasattr(row, 'dtype'):
       dtype = row.dtype
       row = dict([(k, convert_from_numpy(row[k])) for k in dtype.names])
-    return self.add_table_rows_from_stream(table_name, iter([row]), 10)
+    indices = self.__extend_table(table_name, self.__load_batch, iter([row]),
+                                  batch_size=10)
+    self.__update_table_indices(table_name, indices, lambda k: [row[k]])
+    return indices
+
+  def open_table_writer(self, table_name, batch_size=BATCH_SIZE,
+                        queue_size=QUEUE_SIZE):
+    """
+    Return a pipelined :class:`TableWriter` on table_name. The caller
+    is responsible for calling its close (or abort) method.
+    """
+    h = self._open_table(table_name)
+    return TableWriter(h.table, h.headers, batch_size=batch_size,
+                       queue_size=queue_size, logger=self.logger,
+                       on_close=lambda w: self._close_table(h))
 
+  @instrumented(payload=2)
   def add_table_rows(self, table_name, rows, batch_size=BATCH_SIZE):
-    dtype = rows.dtype
-    def stream(rows):
-      for r in rows:
-        yield dict([(k, convert_from_numpy(r[k])) for k in dtype.names])
-    return self.add_table_rows_from_stream(table_name, stream(rows),
-                                           batch_size=batch_size)
+    writer = self.open_table_writer(table_name, batch_size)
+    try:
+      writer.write(rows)
+      indices = writer.close()
+    except:
+      writer.abort()
+      raise
+    self.__update_table_indices(table_name, indices, lambda k: rows[k])
+    return indices
 
+  @instrumented(payload='result')
   def add_table_rows_from_stream(self, table_name, stream,
                                  batch_size=BATCH_SIZE):
-    return self.__extend_table(table_name, self.__load_batch, stream,
-                               batch_size=batch_size)
+    keys = dict((k, []) for k in self.__indexed_columns(table_name))
+    if keys:
+      stream = self.__tee_keys(stream, keys)
+    writer = self.open_table_writer(table_name, batch_size)
+    try:
+      writer.write_stream(stream)
+      indices = writer.close()
+    except:
+      writer.abort()
+      raise
+    self.__update_table_indices(table_name, indices, keys.get)
+    return indices
+
+  @staticmethod
+  def __tee_keys(stream, keys):
+    for r in stream:
+      for k, v in keys.iteritems():
+        v.append(r[k])
+      yield r
 
   def __extend_table(self, table_name, batch_loader, records_stream,
                      batch_size=BATCH_SIZE):
-    s = self.connect()
     indices = []
-    # try:
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    batch = batch_loader(records_stream, col_objs, batch_size)
-    # First index of the new batch of rows is the number of rows
-    # already stored into the table
-    first_index = t.getNumberOfRows()
-    while batch:
-      t.addData(batch)
-      indices.extend(range(first_index, t.getNumberOfRows()))
-      col_objs = t.getHeaders()
+    h = self._open_table(table_name)
+    try:
+      t = h.table
+      # column objects are filled in place by the batch loader, so we
+      # use private copies of the cached headers
+      col_objs = h.new_columns()
       batch = batch_loader(records_stream, col_objs, batch_size)
+      # First index of the new batch of rows is the number of rows
+      # already stored into the table
       first_index = t.getNumberOfRows()
-    # finally:
-    #   self.disconnect()
+      while batch:
+        t.addData(batch)
+        last_index = t.getNumberOfRows()
+        indices.extend(range(first_index, last_index))
+        batch = batch_loader(records_stream, col_objs, batch_size)
+        first_index = last_index
+    finally:
+      self._close_table(h)
     return indices
 
   def __load_batch(self, records_stream, col_objs, chunk_size):
@@ -593,47 +690,240 @@ class ProxyCore(object):
       o.values = v[o.name]
     return col_objs
 
-  def update_table_row(self, table_name, selector, row):
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if not len(idxs) == 1:
-      raise ValueError('selector %s does not yield a single row' % selector)
-    self.logger.debug('\tselected idx: %s' % idxs)
-    data = t.readCoordinates(idxs)
-    self.__update_data_contents(data, row)
-    t.update(data)
-    # finally:
-    #   self.disconnect()
+  @instrumented()
+  def update_table_row(self, table_name, selector, row, key_col=None,
+                       key=None):
+    """
+    Update the single row selected either by selector or, if key_col
+    is given, by its key value (see update_table_rows).
+    """
+    h = self._open_table(table_name)
+    try:
+      t = h.table
+      idxs = self.__select_rows(h, selector, None, key_col,
+                                None if key_col is None else [key])
+      self.logger.debug('\tselector %s results in %s' % (selector, idxs))
+      if not len(idxs) == 1:
+        raise ValueError('selector %s does not yield a single row' % selector)
+      self.logger.debug('\tselected idx: %s' % idxs)
+      data = t.readCoordinates(idxs)
+      self.__update_data_contents(data, row)
+      t.update(data)
+      self.__drop_table_indices(
+        table_name, row.dtype.names if hasattr(row, 'dtype') else row
+        )
+      self.__drop_cached_table(table_name)
+    finally:
+      self._close_table(h)
+
+  @instrumented()
+  def update_table_rows(self, table_name, selector, update_items,
+                        row_indices=None, key_col=None, keys=None,
+                        filters=None):
+    """
+    Set the columns listed in update_items to the given values on the
+    selected rows.
+
+    Rows are selected with a where clause (selector), with a list of
+    row numbers (row_indices) or with a list of values of the key_col
+    column (keys). Key lookups go through the key_col index of the
+    table (see create_table_index), which is built on first use.
+    filters is an optional dictionary of column values that the rows
+    selected by row_indices or keys must also match.
+    """
+    h = self._open_table(table_name)
+    try:
+      t = h.table
+      idxs = self.__select_rows(h, selector, row_indices, key_col, keys)
+      self.logger.debug('\tselector %s results in %s' % (selector, idxs))
+      if len(idxs) == 0:
+        self.logger.debug('\tno rows to update')
+        return
+      data = t.readCoordinates(idxs)
+      if filters:
+        data = self.__filter_data(data, filters)
+        if len(data.rowNumbers) == 0:
+          self.logger.debug('\tno rows to update')
+          return
+      cols = [c.name for c in data.columns]
+      for x in update_items.keys():
+        if x not in cols:
+          raise ValueError('%s is not a valid field for table %s' %
+                           (x, table_name))
+      for dc in data.columns:
+        if dc.name in update_items.keys():
+          for x in range(0, len(dc.values)):
+            self.logger.debug(
+              '\tcolumn :%s  -> setting value to %s (old value %s)' %
+              (dc.name, update_items[dc.name], dc.values[x]))
+            dc.values[x] = update_items[dc.name]
+      self.logger.debug('\trecords have been modified')
+      t.update(data)
+      self.__drop_table_indices(table_name, update_items)
+      self.__drop_cached_table(table_name)
+      self.logger.debug('\tdata update complete')
+    finally:
+      self._close_table(h)
+
+  def __select_rows(self, handle, selector, row_indices, key_col, keys):
+    if row_indices is not None:
+      return list(row_indices)
+    if keys is not None:
+      if key_col is None:
+        raise ValueError('a key column is needed to select rows by key')
+      return self.__sync_table_index(handle, key_col).lookup(keys).tolist()
+    if selector is None:
+      raise ValueError('no row selection criteria')
+    t = handle.table
+    return t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
 
-  def update_table_rows(self, table_name, selector, update_items):
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if len(idxs) == 0:
-      self.logger.debug('\tno rows to update') 
+  @staticmethod
+  def __filter_data(data, filters):
+    by_name = dict((c.name, c) for c in data.columns)
+    for k in filters:
+      if k not in by_name:
+        raise ValueError('%s not in table' % k)
+    mask = [all(by_name[k].values[i] == v for k, v in filters.iteritems())
+            for i in xrange(len(data.rowNumbers))]
+    data.rowNumbers = list(it.compress(data.rowNumbers, mask))
+    for c in data.columns:
+      c.values = list(it.compress(c.values, mask))
+    return data
+
+  #-- key column indices
+
+  def __table_index_path(self, table_name, key_col):
+    return os.path.join(ome_table_index_dir(), self.host,
+                        '%s.%s.idx.npz' % (table_name, key_col))
+
+  def __indexed_columns(self, table_name):
+    return [k for (t, k) in self.table_indices if t == table_name]
+
+  def __sync_table_index(self, handle, key_col, batch_size=BATCH_SIZE):
+    idx = self.table_indices.get((handle.name, key_col))
+    if idx is None:
+      if key_col not in handle.col_names:
+        raise ValueError('%s not in table' % key_col)
+      idx = TableIndex(handle.name, key_col,
+                       self.__table_index_path(handle.name, key_col))
+      idx.load()
+      self.table_indices[(handle.name, key_col)] = idx
+    t = handle.table
+    if handle.file_id is None:
+      handle.file_id = t.getOriginalFile().id.val
+    n_rows = t.getNumberOfRows()
+    if idx.file_id != handle.file_id or idx.n_rows > n_rows:
+      self.logger.debug('rebuilding %s index on %s' % (key_col, handle.name))
+      idx.reset(handle.file_id)
+    col_number = handle.col_names.index(key_col)
+    while idx.n_rows < n_rows:
+      start = idx.n_rows
+      d = t.read([col_number], start, min(n_rows, start + batch_size))
+      values = d.columns[0].values
+      if not values:
+        break
+      idx.add(values, np.arange(start, start + len(values)))
+    if idx.dirty:
+      idx.save()
+    return idx
+
+  def __update_table_indices(self, table_name, indices, get_keys):
+    if not indices:
       return
-    data = t.readCoordinates(idxs)
-    cols = [c.name for c in data.columns]
-    for x in update_items.keys():
-      if x not in cols:
-        raise ValueError('%s is not a valid field for table %s' % (x, table_name))
-    for dc in data.columns:
-      if dc.name in update_items.keys():
-        for x in range(0, len(dc.values)):
-          self.logger.debug(
-            '\tcolumn :%s  -> setting value to %s (old value %s)' % 
-            (dc.name, update_items[dc.name], dc.values[x]))
-          dc.values[x] = update_items[dc.name]
-    self.logger.debug('\trecords have been modified')
-    t.update(data)
-    self.logger.debug('\tdata update complete')
-    # finally:
-    #   self.disconnect()
+    # indices are row number ranges, that include rows appended by
+    # other sessions between our batches: in that case (or if someone
+    # else appended rows before us) the index is left to the next sync
+    contiguous = indices[-1] - indices[0] + 1 == len(indices)
+    for key_col in self.__indexed_columns(table_name):
+      idx = self.table_indices[(table_name, key_col)]
+      keys = get_keys(key_col)
+      if (contiguous and keys is not None and len(keys) == len(indices)
+          and idx.n_rows == indices[0]):
+        idx.add(keys, indices)
+
+  def __drop_table_indices(self, table_name, columns):
+    # indices on updated key columns are rebuilt by the next sync
+    for key_col in self.__indexed_columns(table_name):
+      if key_col in columns:
+        self.table_indices.pop((table_name, key_col)).remove()
+
+  def create_table_index(self, table_name, key_col):
+    """
+    Build (or load and bring up to date) the index on the key_col
+    column of table_name. The index is kept up to date on appends
+    done through this proxy.
+    """
+    h = self._open_table(table_name)
+    try:
+      self.__sync_table_index(h, key_col)
+    finally:
+      self._close_table(h)
+
+  @instrumented(payload='result')
+  def lookup_table_rows(self, table_name, key_col, keys):
+    """
+    Return the sorted row numbers of the rows of table_name whose
+    key_col value is in keys.
+    """
+    h = self._open_table(table_name)
+    try:
+      return self.__sync_table_index(h, key_col).lookup(keys).tolist()
+    finally:
+      self._close_table(h)
+
+  #-- local columnar copies
+
+  def __table_signature(self, handle):
+    t = handle.table
+    if handle.file_id is None:
+      handle.file_id = t.getOriginalFile().id.val
+    ofile = self.ome_operation('getQueryService', 'get', 'OriginalFile',
+                               handle.file_id)
+    mtime = ort.unwrap(ofile.getMtime()) or 0
+    return (handle.file_id, mtime, t.getNumberOfRows())
+
+  @staticmethod
+  def __iter_table_batches(table, n_cols, n_rows, batch_size):
+    row_read = 0
+    while row_read < n_rows:
+      d = table.read(range(n_cols), row_read,
+                     min(n_rows, row_read + batch_size))
+      if not d:
+        break
+      yield convert_coordinates_to_np(d)
+      row_read += batch_size
+
+  def __drop_cached_table(self, table_name):
+    self.column_tables.pop(table_name, None)
+    self.column_store.remove(table_name)
+
+  @instrumented()
+  def get_cached_table(self, table_name, batch_size=BATCH_SIZE):
+    """
+    Return a read-only local copy of table_name as a
+    :class:`~column_store.ColumnTable`.
+
+    The copy is built on first use and rebuilt whenever the number
+    of rows or the modification time of the table change.  Copies
+    are stored under ome_table_cache_dir() and memory mapped, so
+    they are shared by all processes running on the same host.
+    """
+    h = self._open_table(table_name)
+    try:
+      signature = self.__table_signature(h)
+      ct = self.column_tables.get(table_name)
+      if ct is None or ct.signature != signature:
+        ct = self.column_store.open(table_name, signature)
+        if ct is None:
+          self.logger.debug('building local copy of %s' % table_name)
+          batches = self.__iter_table_batches(h.table, len(h.headers),
+                                              signature[-1], batch_size)
+          ct = self.column_store.build(table_name, signature, h.dtype,
+                                       batches)
+        self.column_tables[table_name] = ct
+    finally:
+      self._close_table(h)
+    return ct
 
   def __update_data_contents(self, data, row):
     assert len(data.rowNumbers) == 1
@@ -0,0 +1,136 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Per-session cache of open OMERO table handles.
+
+Opening a table requires an OriginalFile lookup, a call to the shared
+resources service and a getHeaders() round trip.  The cache keeps the
+handle (and its column headers) open for as long as the session that
+created it is alive, so that consecutive operations on the same table
+(e.g., streaming appends) only pay that price once.
+
+Handles are reference counted: a handle that is not in use and has
+not been touched for more than ``idle_timeout`` seconds is closed
+during the next cache access.
+"""
+
+import time, copy
+
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class TableHandle(object):
+
+  def __init__(self, name, table, headers, dtype):
+    self.name = name
+    self.table = table
+    self.headers = headers
+    self.dtype = dtype
+    self.file_id = None
+    self.refcount = 0
+    self.last_used = time.time()
+
+  @property
+  def col_names(self):
+    return [c.name for c in self.headers]
+
+  def new_columns(self):
+    """
+    Return fresh column objects, safe to be filled with values.
+    """
+    return [copy.copy(c) for c in self.headers]
+
+
+class TableCache(object):
+  """
+  Cache of :class:`TableHandle` objects keyed by table name.
+
+  ``dtype_builder`` is a function that maps a list of table headers
+  to a numpy record type description.
+  """
+
+  def __init__(self, dtype_builder, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+               logger=None):
+    self.dtype_builder = dtype_builder
+    self.idle_timeout = idle_timeout
+    self.logger = logger
+    self.session = None
+    self.handles = {}
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.stats = {
+      'hits': 0,
+      'misses': 0,
+      'evictions': 0,
+      'hit_time': 0.0,
+      'open_time': 0.0,
+      }
+
+  def get_stats(self):
+    stats = self.stats.copy()
+    stats['open_handles'] = len(self.handles)
+    stats['hit_latency'] = (stats['hit_time'] / stats['hits']
+                            if stats['hits'] else 0.0)
+    stats['open_latency'] = (stats['open_time'] / stats['misses']
+                             if stats['misses'] else 0.0)
+    return stats
+
+  def acquire(self, session, table_name, opener):
+    """
+    Return the handle for table_name, opening the table with
+    opener(session, table_name) if it is not cached.  Every call must
+    be matched by a call to :meth:`release`.
+    """
+    start = time.time()
+    if session is not self.session:
+      # handles opened by another session are no longer usable
+      self.clear()
+      self.session = session
+    self.expire(start)
+    h = self.handles.get(table_name)
+    if h is None:
+      table = opener(session, table_name)
+      headers = table.getHeaders()
+      h = TableHandle(table_name, table, headers, self.dtype_builder(headers))
+      self.handles[table_name] = h
+      self.stats['misses'] += 1
+      self.stats['open_time'] += time.time() - start
+    else:
+      self.stats['hits'] += 1
+      self.stats['hit_time'] += time.time() - start
+    h.refcount += 1
+    h.last_used = time.time()
+    return h
+
+  def release(self, handle):
+    handle.refcount = max(0, handle.refcount - 1)
+    handle.last_used = time.time()
+
+  def invalidate(self, table_name):
+    h = self.handles.pop(table_name, None)
+    if h is not None:
+      self.__close(h)
+
+  def expire(self, now=None):
+    now = time.time() if now is None else now
+    for name, h in self.handles.items():
+      if h.refcount <= 0 and now - h.last_used > self.idle_timeout:
+        del self.handles[name]
+        self.__close(h)
+        self.stats['evictions'] += 1
+
+  def clear(self):
+    for h in self.handles.itervalues():
+      self.__close(h)
+    self.handles = {}
+    self.session = None
+
+  def __close(self, handle):
+    try:
+      handle.table.close()
+    except Exception, e:
+      if self.logger:
+        self.logger.warn('cannot close table %s: %s' % (handle.name, e))
@@ -0,0 +1,119 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Key column indices for OMERO tables.
+
+A :class:`TableIndex` keeps the values of one column of a table,
+sorted, together with the corresponding row numbers, so that the rows
+holding a given set of keys can be found with a binary search instead
+of a full table scan.  Indices are persisted as ``.npz`` sidecar files
+and record the id of the table's OriginalFile and the number of table
+rows they cover: rows appended by other clients are picked up
+incrementally, while a table that has been replaced invalidates the
+index.
+"""
+
+import os, tempfile
+
+import numpy as np
+
+
+class TableIndex(object):
+
+  def __init__(self, table_name, key_col, path=None):
+    self.table_name = table_name
+    self.key_col = key_col
+    self.path = path
+    self.reset()
+
+  def reset(self, file_id=None):
+    self.file_id = file_id
+    self.n_rows = 0
+    self.keys = None
+    self.rows = np.empty(0, dtype=np.int64)
+    self.dirty = False
+
+  def __len__(self):
+    return len(self.rows)
+
+  def add(self, keys, rows):
+    """
+    Add the (key, row) pairs to the index.  rows must be the row
+    numbers that immediately follow the ones already indexed.
+    """
+    keys = np.asarray(keys)
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(keys) != len(rows):
+      raise ValueError('keys and rows have different lengths')
+    if len(rows) == 0:
+      return
+    if rows.min() < self.n_rows:
+      raise ValueError('rows %d-%d are already indexed' %
+                       (rows.min(), self.n_rows - 1))
+    order = np.argsort(keys, kind='mergesort')
+    keys, rows = keys[order], rows[order]
+    if self.keys is None:
+      self.keys, self.rows = keys, rows
+    else:
+      if keys.dtype.itemsize > self.keys.dtype.itemsize:
+        self.keys = self.keys.astype(keys.dtype)
+      pos = np.searchsorted(self.keys, keys, side='right')
+      self.keys = np.insert(self.keys, pos, keys)
+      self.rows = np.insert(self.rows, pos, rows)
+    self.n_rows = max(self.n_rows, rows.max() + 1)
+    self.dirty = True
+
+  def lookup(self, keys):
+    """
+    Return the sorted row numbers of all rows whose key is in keys.
+    """
+    if self.keys is None or len(keys) == 0:
+      return np.empty(0, dtype=np.int64)
+    keys = np.asarray(keys)
+    lo = np.searchsorted(self.keys, keys, side='left')
+    hi = np.searchsorted(self.keys, keys, side='right')
+    found = [self.rows[l:h] for l, h in zip(lo, hi) if h > l]
+    if not found:
+      return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(found))
+
+  def load(self):
+    """
+    Load the index from its sidecar file.  Return False if there is
+    no usable sidecar.
+    """
+    if not self.path or not os.path.exists(self.path):
+      return False
+    try:
+      with open(self.path, 'rb') as f:
+        d = np.load(f)
+        meta = d['meta']
+        keys, rows = d['keys'], d['rows']
+    except (IOError, ValueError, KeyError):
+      return False
+    self.reset(int(meta[0]))
+    self.n_rows = int(meta[1])
+    if len(rows):
+      self.keys, self.rows = keys, rows
+    return True
+
+  def save(self):
+    if not self.path:
+      return
+    d = os.path.dirname(self.path)
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+    fd, tmp = tempfile.mkstemp(dir=d or '.')
+    with os.fdopen(fd, 'wb') as f:
+      np.savez(f, meta=np.array([self.file_id or -1, self.n_rows],
+                                dtype=np.int64),
+               keys=self.keys if self.keys is not None else np.empty(0),
+               rows=self.rows)
+    os.rename(tmp, self.path)
+    self.dirty = False
+
+  def remove(self):
+    self.reset()
+    if self.path and os.path.exists(self.path):
+      os.remove(self.path)
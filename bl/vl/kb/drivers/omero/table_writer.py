@@ -0,0 +1,246 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Pipelined appender for OMERO tables.
+
+A :class:`TableWriter` splits the incoming records into batches and
+runs two worker threads: the first one converts each batch into
+column payloads, the second one sends them to the server with
+addData.  Batches are handed over through bounded queues, so the
+conversion of a batch overlaps with the transfer of the previous one
+while memory usage stays limited to a few batches.  Rows are written
+in the same order they are passed to the writer.
+
+Numpy record arrays are converted column by column: scalar columns
+with a single tolist() call, array columns (e.g., GDO probs) by
+passing per-row array views, without building Python lists of
+numbers.
+"""
+
+import time, threading, copy, Queue
+import itertools as it
+
+import numpy as np
+
+
+BATCH_SIZE = 5000
+QUEUE_SIZE = 2
+
+_EOS = object()
+
+
+class TableWriterError(Exception):
+  pass
+
+
+def records_to_columns(col_objs, records):
+  """
+  Fill a copy of col_objs with the contents of records, either a
+  numpy records array or a list of dictionaries.
+  """
+  columns = [copy.copy(c) for c in col_objs]
+  if hasattr(records, 'dtype'):
+    for c in columns:
+      v = records[c.name]
+      if v.ndim > 1:
+        c.values = list(v)
+      else:
+        c.values = v.tolist()
+  else:
+    for c in columns:
+      c.values = [r[c.name] for r in records]
+  return columns
+
+
+class TableWriter(object):
+  """
+  Append records to an open table.
+
+  .. code-block:: python
+
+    writer = TableWriter(table, table.getHeaders())
+    try:
+      for block in blocks:
+        writer.write(block)
+      indices = writer.close()
+    except:
+      writer.abort()
+      raise
+
+  ``on_close`` is called (with the writer as argument) once the
+  writer has been closed or aborted.
+  """
+
+  def __init__(self, table, col_objs, batch_size=BATCH_SIZE,
+               queue_size=QUEUE_SIZE, logger=None, on_close=None):
+    self.table = table
+    self.col_objs = col_objs
+    self.batch_size = batch_size
+    self.logger = logger
+    self.on_close = on_close
+    self.indices = []
+    self.error = None
+    self.closed = False
+    self.__aborted = False
+    self.__pending = 0
+    self.__cond = threading.Condition()
+    self.__to_convert = Queue.Queue(queue_size)
+    self.__to_send = Queue.Queue(queue_size)
+    self.stats = {
+      'rows': 0,
+      'batches': 0,
+      'convert_time': 0.0,
+      'send_time': 0.0,
+      }
+    self.__start = time.time()
+    self.__threads = [
+      threading.Thread(target=self.__convert_loop, name='table-convert'),
+      threading.Thread(target=self.__send_loop, name='table-send'),
+      ]
+    for t in self.__threads:
+      t.daemon = True
+      t.start()
+
+  def write(self, records):
+    """
+    Queue records (a numpy records array or a list of dictionaries)
+    for writing.  Blocks if the pipeline is full.
+    """
+    self.__check()
+    for i in xrange(0, len(records), self.batch_size):
+      self.__put(records[i:i+self.batch_size])
+
+  def write_stream(self, stream):
+    """
+    Queue all dictionaries yielded by stream for writing.
+    """
+    self.__check()
+    while True:
+      batch = list(it.islice(stream, self.batch_size))
+      if not batch:
+        break
+      self.__put(batch)
+
+  def flush(self):
+    """
+    Wait until all queued records have been written, then return the
+    row indices of all records written so far.
+    """
+    self.__check()
+    with self.__cond:
+      while self.__pending > 0 and self.error is None:
+        self.__cond.wait(0.1)
+    self.__check()
+    return self.indices
+
+  def close(self):
+    """
+    Flush and stop the writer.  Return the row indices of all
+    written records.
+    """
+    if self.closed:
+      return self.indices
+    try:
+      indices = self.flush()
+    finally:
+      self.__shutdown()
+    if self.logger:
+      stats = self.get_stats()
+      self.logger.info('wrote %d rows in %.3fs (%.1f rows/s)' %
+                       (stats['rows'], stats['elapsed'],
+                        stats['rows_per_sec']))
+    return indices
+
+  def abort(self):
+    """
+    Drop all records that have not been sent yet and stop the
+    writer.  Rows that already reached the server are not removed.
+    """
+    if self.closed:
+      return
+    self.__aborted = True
+    for q in self.__to_convert, self.__to_send:
+      try:
+        while True:
+          q.get_nowait()
+      except Queue.Empty:
+        pass
+    self.__shutdown()
+
+  def get_stats(self):
+    stats = self.stats.copy()
+    stats['elapsed'] = time.time() - self.__start
+    stats['rows_per_sec'] = (stats['rows'] / stats['elapsed']
+                             if stats['elapsed'] > 0 else 0.0)
+    return stats
+
+  def __check(self):
+    if self.error is not None:
+      raise TableWriterError('table write failed: %s' % self.error)
+    if self.closed:
+      raise TableWriterError('writer is closed')
+
+  def __put(self, batch):
+    with self.__cond:
+      self.__pending += 1
+    self.__to_convert.put(batch)
+
+  def __done(self, n=1):
+    with self.__cond:
+      self.__pending -= n
+      self.__cond.notify_all()
+
+  def __shutdown(self):
+    self.__to_convert.put(_EOS)
+    for t in self.__threads:
+      t.join()
+    self.closed = True
+    if self.on_close:
+      self.on_close(self)
+
+  def __convert_loop(self):
+    while True:
+      batch = self.__to_convert.get()
+      if batch is _EOS:
+        self.__to_send.put(_EOS)
+        return
+      if self.error is not None or self.__aborted:
+        self.__done()
+        continue
+      start = time.time()
+      try:
+        columns = records_to_columns(self.col_objs, batch)
+      except Exception, e:
+        self.error = e
+        self.__done()
+        continue
+      self.stats['convert_time'] += time.time() - start
+      self.__to_send.put((len(batch), columns))
+
+  def __send_loop(self):
+    first_index = None
+    while True:
+      item = self.__to_send.get()
+      if item is _EOS:
+        return
+      if self.error is not None or self.__aborted:
+        self.__done()
+        continue
+      n_rows, columns = item
+      start = time.time()
+      try:
+        if first_index is None:
+          first_index = self.table.getNumberOfRows()
+        self.table.addData(columns)
+        last_index = self.table.getNumberOfRows()
+      except Exception, e:
+        self.error = e
+        self.__done()
+        continue
+      self.indices.extend(xrange(first_index, last_index))
+      first_index = last_index
+      self.stats['send_time'] += time.time() - start
+      self.stats['rows'] += n_rows
+      self.stats['batches'] += 1
+      self.__done()
@@ -43,6 +43,128 @@ def ome_wrap(v, wtype=None):
   return WRAPPING[wtype](v) if wtype else ort.wrap(v)
 
 
+# per instance cache of wrapped field values, see FieldAccessor
+FIELD_CACHE = '_field_cache'
+_MISSING = object()
+
+
+def make_to_omero(tcode):
+  """
+  Return a function(wrapper, value) that converts value to the omero
+  representation of a field of type tcode (see CoreOmeroWrapper.to_omero).
+  """
+  if isinstance(tcode, type):
+    # tcode can also be a raw omero class (e.g., om.OriginalFile)
+    def convert(w, v):
+      if v is None:
+        return v
+      if not isinstance(v, tcode):
+        raise ValueError('type(%s) != %s' % (v, tcode))
+      if issubclass(tcode, CoreOmeroWrapper) and tcode.is_enum():
+        tcode.map_enums_values(w.proxy)
+      return v.ome_obj
+    return convert
+  elif tcode in WRAPPING:
+    wrap = WRAPPING[tcode]
+    return lambda w, v: wrap(v)
+  else:
+    raise ValueError('illegal tcode value: %s' % tcode)
+
+
+def make_from_omero(tcode):
+  """
+  Return a function(wrapper, ome_value) that converts the omero value
+  of a field of type tcode (see CoreOmeroWrapper.from_omero).  Links
+  to unloaded objects are fetched from the server, unless the linked
+  object is in the proxy cache.
+  """
+  if isinstance(tcode, type):
+    def convert(w, v):
+      proxy = w.proxy
+      cached_v = proxy.get_from_cache(v)
+      if cached_v:
+        return cached_v
+      if not v.loaded:
+        v = proxy.ome_operation('getQueryService', 'find',
+                                v.__class__.__name__[:-1], v.id.val)
+        if not v:
+          return None
+      o = proxy.factory.wrap(v)
+      if not isinstance(o, tcode):
+        raise ValueError('inconsistent type result type(%s) for %s' %
+                         (type(o), tcode))
+      return o
+    return convert
+  elif tcode is TIMESTAMP:
+    return lambda w, v: vluo.rtime2time(ort.unwrap(v))
+  elif tcode in WRAPPING:
+    return lambda w, v: ort.unwrap(v)
+  else:
+    raise ValueError('illegal tcode value: %s' % tcode)
+
+
+class FieldAccessor(object):
+  """
+  Class level read accessor for a field declared in __fields__.
+
+  Converted values are cached in the instance dictionary (under
+  FIELD_CACHE), so that repeated accesses do not go through
+  __getattr__, the object factory and, for unloaded links, the query
+  service.  The cache is dropped whenever a field is set, the omero
+  object is replaced (save, reload) or the object is configured or
+  unloaded.  This is a non-data descriptor: instance attributes set
+  with bare_setattr still take precedence.
+  """
+  __slots__ = ('name', 'convert')
+
+  def __init__(self, name, tcode):
+    self.name = name
+    self.convert = make_from_omero(tcode)
+
+  def __get__(self, obj, klass=None):
+    if obj is None:
+      return self
+    d = obj.__dict__
+    cache = d.get(FIELD_CACHE)
+    if cache is None:
+      cache = d[FIELD_CACHE] = {}
+    else:
+      v = cache.get(self.name, _MISSING)
+      if v is not _MISSING:
+        return v
+    v = getattr(d['ome_obj'], self.name)
+    if v is not None:
+      v = self.convert(obj, v)
+    cache[self.name] = v
+    return v
+
+
+def drop_field_cache(obj):
+  obj.__dict__.pop(FIELD_CACHE, None)
+
+
+def set_field_cache(obj, values):
+  """
+  Store already converted field values (e.g., read with a projection
+  query) in the field cache of obj.
+  """
+  obj.__dict__.setdefault(FIELD_CACHE, {}).update(values)
+
+
+def link_fields(klass):
+  """
+  Return the names of the fields of klass, including inherited ones,
+  that link to (non enum) wrapped objects.
+  """
+  names = []
+  for k in klass.__mro__:
+    for name, t in k.__dict__.get('__fields__', {}).iteritems():
+      if (isinstance(t[0], type) and issubclass(t[0], CoreOmeroWrapper)
+          and not t[0].is_enum()):
+        names.append(name)
+  return names
+
+
 class CoreOmeroWrapper(object):
 
   OME_TABLE = None
@@ -97,6 +219,8 @@ class CoreOmeroWrapper(object):
 
   def __setattr__(self, name, v):
     if hasattr(self, name):
+      if name == 'ome_obj':
+        drop_field_cache(self)
       super(CoreOmeroWrapper, self).__setattr__(name, v)
     else:
       raise AttributeError('object %s has no attribute %s' %
@@ -148,6 +272,7 @@ class CoreOmeroWrapper(object):
     pass
 
   def unload(self):
+    drop_field_cache(self)
     self.ome_obj.unload()
 
   def save(self):
@@ -235,35 +360,43 @@ class MetaWrapper(type):
     return to_conf
 
   @classmethod
-  def make_setter(cls, base, fields):
+  def make_setter(cls, base, converters):
     def setter(self, k, v):
-      if k in fields:
-        setattr(self.ome_obj, k, self.to_omero(fields[k][0], v))
+      convert = converters.get(k)
+      if convert is not None:
+        setattr(self.ome_obj, k, convert(self, v))
+        # unique keys must be computed from the new field values
+        drop_field_cache(self)
         self.__update_constraints__()
       else:
         base.__setattr__(self, k, v)
     return setter
 
   @classmethod
-  def make_getter(cls, base, fields):
+  def make_getter(cls, base, accessors):
     def getter(self, k):
-      if k in fields:
-        v = getattr(self.ome_obj, k)
-        if v is None:
-          return None
-        if isinstance(fields[k][0], type):
-          cached_v = self.proxy.get_from_cache(v)
-          if cached_v:
-            return cached_v
-          elif not v.loaded:
-            v = self.proxy.ome_operation('getQueryService', 'find',
-                                         v.__class__.__name__[:-1],
-                                         v.id.val)
-        return self.from_omero(fields[k][0], v) if v else None
+      accessor = accessors.get(k)
+      if accessor is not None:
+        return accessor.__get__(self)
       else:
         return base.__getattr__(self, k)
     return getter
 
+  @classmethod
+  def compile_accessors(cls, klass, fields, converters, accessors):
+    """
+    Fill converters and accessors with the precomputed to_omero
+    converters and the FieldAccessor of each field, and install
+    accessors as class attributes, unless the name is already taken
+    by something else (e.g., a method) in klass or its bases.
+    """
+    for k, t in fields.iteritems():
+      converters[k] = make_to_omero(t[0])
+      accessors[k] = FieldAccessor(k, t[0])
+      current = getattr(klass, k, _MISSING)
+      if current is _MISSING or isinstance(current, FieldAccessor):
+        setattr(klass, k, accessors[k])
+
   def __new__(meta, name, bases, attrs):
     if not attrs.has_key('__fields__'):
       attrs['__fields__'] = []
@@ -273,10 +406,9 @@ class MetaWrapper(type):
                                                         attrs['__fields__'])
     attrs['__to_conf__'] = MetaWrapper.make_to_conf(bases[0],
                                                     attrs['__fields__'])
-    attrs['__setattr__'] = MetaWrapper.make_setter(bases[0],
-                                                   attrs['__fields__'])
-    attrs['__getattr__'] = MetaWrapper.make_getter(bases[0],
-                                                   attrs['__fields__'])
+    converters, accessors = {}, {}
+    attrs['__setattr__'] = MetaWrapper.make_setter(bases[0], converters)
+    attrs['__getattr__'] = MetaWrapper.make_getter(bases[0], accessors)
     klass = type.__new__(meta, name, bases, attrs)
     if klass.OME_TABLE:
       meta.__KNOWN_OME_KLASSES__[klass.get_ome_type()] = klass
@@ -284,6 +416,8 @@ class MetaWrapper(type):
       for k in fields:
         if fields[k][0] == SELF_TYPE:
           fields[k] = (klass,) + fields[k][1:]
+    MetaWrapper.compile_accessors(klass, attrs['__fields__'], converters,
+                                  accessors)
     if klass.is_enum():
       enums = []
       for l in klass.__enums__:
@@ -369,6 +503,7 @@ class OmeroWrapper(CoreOmeroWrapper):
   def configure(self, conf):
     conf = self.__preprocess_conf__(conf)
     self.__config__(self.ome_obj, conf)
+    drop_field_cache(self)
 
   def to_conf(self):
     conf = {}
@@ -1,9 +1,50 @@
+import os, json, time, uuid, atexit, threading, weakref
+
 import bl.vl.utils.messages as msgconf
 if msgconf.messages_engine_enabled():
     import pika
     from pika.exceptions import ConnectionClosed, ChannelClosed, \
         AMQPConnectionError
+    PUBLISH_ERRORS = (ConnectionClosed, ChannelClosed, AMQPConnectionError)
+else:
+    PUBLISH_ERRORS = ()
 from bl.vl.utils import get_logger
+from bl.vl.utils.instrumentation import instrumented
+
+
+# events are published in batches of (at most) BATCH_SIZE, buffered
+# events are flushed at least every FLUSH_INTERVAL seconds
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_BACKLOG = 100000
+# max number of seconds readers wait for their own events to be
+# applied to the graph, see EventsSender.wait_for
+WAIT_TIMEOUT = 15.0
+WAIT_STEP = 0.5
+# watermark queues are not tied to a connection, so that watermarks
+# published while the sender is reconnecting are not lost: the broker
+# deletes them after WATERMARK_QUEUE_TTL seconds without consumers
+WATERMARK_QUEUE_TTL = 600
+
+
+def watermark_routing_key(queue, session_id):
+    return '%s.watermark.%s' % (queue, session_id)
+
+
+def watermark_queue_name(queue, session_id):
+    return '%s.watermarks.%s' % (queue, session_id)
+
+
+# senders still alive at exit are closed, so that buffered events are
+# published; a weak set does not keep unused senders alive
+_LIVE_SENDERS = weakref.WeakSet()
+
+
+def _close_senders():
+    for sender in list(_LIVE_SENDERS):
+        sender.close()
+
+atexit.register(_close_senders)
 
 
 def get_events_sender(logger=None):
@@ -13,12 +54,17 @@ def get_events_sender(logger=None):
                             msgconf.messages_engine_username(),
                             msgconf.messages_engine_password(),
                             msgconf.messages_engine_queue(),
-                            logger)
+                            logger,
+                            msgconf.messages_engine_batch_size() or BATCH_SIZE,
+                            msgconf.messages_engine_flush_interval() or
+                            FLUSH_INTERVAL,
+                            msgconf.messages_engine_spool_file())
     else:
         return None
 
 
-def get_events_consumer(logger=None, consumer_callback=None, close_action=None):
+def get_events_consumer(logger=None, consumer_callback=None, close_action=None,
+                        prefetch_count=None):
     return EventsConsumer(msgconf.messages_engine_host(),
                           msgconf.messages_engine_port(),
                           msgconf.messages_engine_username(),
@@ -26,7 +72,8 @@ def get_events_consumer(logger=None, consumer_callback=None, close_action=None):
                           msgconf.messages_engine_queue(),
                           consumer_callback,
                           close_action,
-                          logger)
+                          logger,
+                          prefetch_count)
 
 
 class MessagesEngineConfigurationError(Exception):
@@ -71,11 +118,13 @@ class MessagesHandler(object):
             self.conn_params.credentials = credentials
         return self.conn_params
 
+    def _open_connection(self):
+        return pika.BlockingConnection(self._get_connection_params())
+
     def connect(self):
         if not self.connection:
-            conn_params = self._get_connection_params()
             try:
-                self.connection = pika.BlockingConnection(conn_params)
+                self.connection = self._open_connection()
             except ConnectionClosed:
                 if not self.user or not self.password:
                     msg = 'Unable to connect to RabbitMQ, authentication required'
@@ -86,7 +135,7 @@ class MessagesHandler(object):
                 msg = 'Error while connecting to RabbitMQ server, unable to contact the server'
                 raise MessageEngineConnectionError(msg)
             self.channel = self.connection.channel()
-            self._setup_network()
+            self._setup_network(self.channel)
             self.logger.info('connection established')
         else:
             self.logger.debug('connection object already exists')
@@ -117,21 +166,27 @@ class MessagesHandler(object):
         )
         return frame
 
-    def _setup_network(self):
-        params = self._get_connection_params()
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-        channel.exchange_declare(
-            exchange=self.exchange_name,
-            type='topic',
-            durable=True
-        )
-        self._declare_queue(channel)
-        channel.queue_bind(
-            self.queue,
-            self.exchange_name,
-            routing_key='%s.graph.#' % self.queue
-        )
+    def _setup_network(self, channel=None):
+        # without a channel, use a temporary connection
+        connection = None
+        if not channel:
+            connection = self._open_connection()
+            channel = connection.channel()
+        try:
+            channel.exchange_declare(
+                exchange=self.exchange_name,
+                type='topic',
+                durable=True
+            )
+            self._declare_queue(channel)
+            channel.queue_bind(
+                self.queue,
+                self.exchange_name,
+                routing_key='%s.graph.#' % self.queue
+            )
+        finally:
+            if connection:
+                connection.close()
 
     @property
     def is_queue_empty(self):
@@ -148,48 +203,400 @@ class MessagesHandler(object):
         self.disconnect()
 
 
+class EventsSpool(object):
+    """
+    Local, append-only storage for events that could not be published.
+    Each line of the spool file is a JSON-encoded [routing_key, body,
+    headers] list.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        if os.path.exists(self.path):
+            self.count = len(self.read())
+
+    def __len__(self):
+        return self.count
+
+    def append(self, records):
+        with open(self.path, 'a') as f:
+            for r in records:
+                f.write('%s\n' % json.dumps(r))
+            f.flush()
+            os.fsync(f.fileno())
+        self.count += len(records)
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [tuple(json.loads(l)) for l in f if l.strip()]
+
+    def replace(self, records):
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            for r in records:
+                f.write('%s\n' % json.dumps(r))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.count = len(records)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.count = 0
+
+
 class EventsSender(MessagesHandler):
+    """
+    Buffered events publisher.
+
+    Events are buffered in memory and published in batches, either
+    when batch_size events are waiting or flush_interval seconds after
+    the first one has been buffered.  Each batch is published within
+    an AMQP transaction, so that the broker acknowledges it with a
+    single round trip.  If the broker can't be reached, events are
+    appended to spool_file (if given) and published, in order, before
+    the next batch.  Without a spool file, undelivered events are kept
+    in memory and the error is raised; once max_backlog events are
+    waiting, send_event refuses new events (raising the error) until
+    the broker can be reached again.
+
+    Each event is stamped with a sequence number, unique within the
+    sender's session.  After applying a batch, the graph manager
+    publishes the highest sequence number it has applied for each
+    session (the session's watermark): wait_for uses it to block until
+    the events sent so far are visible in the graph.  Watermarks are
+    read from a per session queue, over a connection of their own, so
+    that waiting does not block other threads sending events.  If the
+    sender stays disconnected for more than WATERMARK_QUEUE_TTL
+    seconds, the queue expires and the watermarks published in the
+    meantime are lost: wait_for then only returns True once further
+    events have been applied.
+    """
 
     def __init__(self, host, port=None, user=None, password=None,
-                 queue=None, logger=None):
+                 queue=None, logger=None, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, spool_file=None,
+                 max_backlog=MAX_BACKLOG):
         super(EventsSender, self).__init__(host, port, user, password,
                                            queue, logger)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.spool = EventsSpool(spool_file) if spool_file else None
+        self.buffer = []
+        self.lock = threading.RLock()
+        self.flush_timer = None
+        self.session_id = uuid.uuid4().hex
+        self.seq = 0
+        self.watermark = 0
+        self.wait_lock = threading.Lock()
+        self.watermark_connection = None
+        self.watermark_channel = None
+        self.watermark_queue = watermark_queue_name(self.queue,
+                                                    self.session_id)
+        self.reset_stats()
+        _LIVE_SENDERS.add(self)
+
+    def reset_stats(self):
+        self.stats = {
+            'events': 0,
+            'published': 0,
+            'batches': 0,
+            'failures': 0,
+            'spooled': 0,
+            'publish_time': 0.0,
+            'max_latency': 0.0,
+            'waits': 0,
+            'wait_timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+            }
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['buffered'] = len(self.buffer)
+            stats['spool_backlog'] = len(self.spool) if self.spool else 0
+            stats['backlog'] = stats['buffered'] + stats['spool_backlog']
+            stats['mean_latency'] = (stats['publish_time'] / stats['batches']
+                                     if stats['batches'] else 0.0)
+            stats['seq'] = self.seq
+            stats['watermark'] = self.watermark
+        return stats
+
+    def _message_properties(self, headers):
+        return pika.BasicProperties(
+            delivery_mode=2,  # persistent messages
+            content_type='text/plain',
+            headers=headers
+        )
 
-    def send_event(self, event):
+    def connect(self):
         if not self.connection:
-            self.connect()
+            super(EventsSender, self).connect()
+            # bind before publishing, so that no watermark can be missed
+            self._declare_watermark_queue(self.channel)
+            self.channel.tx_select()
+
+    def _declare_watermark_queue(self, channel):
+        channel.queue_declare(
+            self.watermark_queue,
+            durable=False,
+            exclusive=False,
+            auto_delete=False,
+            arguments={'x-expires': 1000 * WATERMARK_QUEUE_TTL}
+        )
+        channel.queue_bind(
+            self.watermark_queue,
+            self.exchange_name,
+            routing_key=watermark_routing_key(self.queue, self.session_id)
+        )
+
+    def disconnect(self):
         try:
-            self.channel.basic_publish(
-                exchange=self.exchange_name,
-                routing_key='%s.%s' % (self.queue, event.event_type),
-                body=event.msg,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # persistent messages
-                    content_type='text/plain'
+            super(EventsSender, self).disconnect()
+        except PUBLISH_ERRORS:
+            pass
+        finally:
+            self.channel = None
+            self.connection = None
+
+    def _disconnect_watermarks(self):
+        if self.watermark_connection:
+            try:
+                self.watermark_connection.close()
+            except PUBLISH_ERRORS:
+                pass
+            finally:
+                self.watermark_connection = None
+                self.watermark_channel = None
+
+    def send_event(self, event):
+        with self.lock:
+            if len(self.buffer) >= self.max_backlog:
+                # raises if the broker is still unreachable
+                self.flush()
+            self.seq += 1
+            self.buffer.append(('%s.%s' % (self.queue, event.event_type),
+                                event.msg,
+                                {'session': self.session_id, 'seq': self.seq}))
+            self.stats['events'] += 1
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+            else:
+                self.__schedule_flush()
+
+    def flush(self):
+        """
+        Publish all pending events.  Return the number of published
+        events.
+        """
+        with self.lock:
+            self.__cancel_flush()
+            n = 0
+            try:
+                n += self.__drain_spool()
+                while self.buffer:
+                    batch = self.buffer[:self.batch_size]
+                    self._publish_batch(batch)
+                    del self.buffer[:len(batch)]
+                    n += len(batch)
+            except MessageEngineConnectionError:
+                self.stats['failures'] += 1
+                self.disconnect()
+                if self.spool is not None:
+                    self.logger.warning('unable to publish %d events, spooling'
+                                        % len(self.buffer))
+                    self.spool.append(self.buffer)
+                    self.stats['spooled'] += len(self.buffer)
+                    self.buffer = []
+                else:
+                    self.__schedule_flush()
+                    raise
+            return n
+
+    def close(self):
+        try:
+            self.flush()
+        except MessageEngineConnectionError, e:
+            self.logger.error('undelivered events: %s' % e)
+        finally:
+            self.disconnect()
+            with self.wait_lock:
+                self._disconnect_watermarks()
+
+    def __del__(self):
+        if hasattr(self, 'lock'):
+            self.close()
+
+    @property
+    def is_queue_empty(self):
+        self.flush()
+        if self.spool and len(self.spool):
+            return False
+        return super(EventsSender, self).is_queue_empty
+
+    @instrumented('publish_events', payload=1)
+    def _publish_batch(self, batch):
+        self.connect()
+        start = time.time()
+        try:
+            for routing_key, body, headers in batch:
+                self.channel.basic_publish(
+                    exchange=self.exchange_name,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=self._message_properties(headers)
                 )
-            )
-        except ChannelClosed:
+            self.channel.tx_commit()
+        except PUBLISH_ERRORS:
+            msg = 'Connection to RabbitMQ server closed unexpectedly'
+            raise MessageEngineConnectionError(msg)
+        elapsed = time.time() - start
+        self.stats['published'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['publish_time'] += elapsed
+        self.stats['max_latency'] = max(self.stats['max_latency'], elapsed)
+        self.logger.debug('published %d events in %.3fs' %
+                          (len(batch), elapsed))
+
+    def wait_for(self, seq=None, timeout=WAIT_TIMEOUT):
+        """
+        Block until the graph manager has applied all events sent in
+        this session up to seq (by default, the last one).  Return
+        False if this does not happen within timeout seconds.
+        """
+        # the send lock is only held to flush and to update the state:
+        # polling is serialized by wait_lock
+        with self.lock:
+            seq = self.seq if seq is None else seq
+            if seq <= self.watermark:
+                return True
+            if self.buffer and self.buffer[0][2]['seq'] <= seq:
+                self.flush()
+            self.stats['waits'] += 1
+        start = time.time()
+        try:
+            with self.wait_lock:
+                while self.watermark < seq:
+                    if time.time() - start >= timeout:
+                        with self.lock:
+                            self.stats['wait_timeouts'] += 1
+                        self.logger.warning('event %d not applied after %.1fs '
+                                            '(watermark: %d)' %
+                                            (seq, timeout, self.watermark))
+                        return False
+                    body = self._next_watermark(WAIT_STEP)
+                    if body:
+                        self.__update_watermark(body)
+                return True
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.stats['wait_time'] += elapsed
+                self.stats['max_wait'] = max(self.stats['max_wait'], elapsed)
+
+    def _next_watermark(self, inactivity_timeout):
+        # called with wait_lock held
+        try:
+            if not self.watermark_connection:
+                self.watermark_connection = self._open_connection()
+                self.watermark_channel = self.watermark_connection.channel()
+                self._declare_watermark_queue(self.watermark_channel)
+            for method, properties, body in self.watermark_channel.consume(
+                    self.watermark_queue, no_ack=True,
+                    inactivity_timeout=inactivity_timeout):
+                return body
+        except PUBLISH_ERRORS:
+            self._disconnect_watermarks()
             msg = 'Connection to RabbitMQ server closed unexpectedly'
             raise MessageEngineConnectionError(msg)
 
+    def __update_watermark(self, body):
+        wm = json.loads(body)
+        if wm.get('session') == self.session_id:
+            with self.lock:
+                self.watermark = max(self.watermark, wm['seq'])
+
+    def __drain_spool(self):
+        if not self.spool or not len(self.spool):
+            return 0
+        records = self.spool.read()
+        self.logger.info('publishing %d spooled events' % len(records))
+        n = 0
+        try:
+            while n < len(records):
+                batch = records[n:n + self.batch_size]
+                self._publish_batch(batch)
+                n += len(batch)
+        finally:
+            if n == len(records):
+                self.spool.clear()
+            elif n:
+                self.spool.replace(records[n:])
+        return n
+
+    def __timed_flush(self):
+        with self.lock:
+            self.flush_timer = None
+            try:
+                self.flush()
+            except MessageEngineConnectionError, e:
+                self.logger.warning('delayed flush failed: %s' % e)
+
+    def __schedule_flush(self):
+        if self.flush_interval and self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.flush_interval,
+                                               self.__timed_flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def __cancel_flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
 
 class EventsConsumer(MessagesHandler):
 
     def __init__(self, host, port=None, user=None, password=None,
                  queue=None, consumer_callback=None,
-                 on_close_extra_action=None, logger=None):
+                 on_close_extra_action=None, logger=None,
+                 prefetch_count=None):
         super(EventsConsumer, self).__init__(host, port, user, password,
                                              queue, logger)
         self.consumer_callback = consumer_callback
         self.close_extra_action = on_close_extra_action
+        self.prefetch_count = prefetch_count
 
     def _on_connect(self, connection):
         connection.channel(self._on_channel_open)
 
     def _on_channel_open(self, channel):
         self.channel = channel
+        if self.prefetch_count:
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.channel.basic_consume(self.consumer_callback, self.queue)
 
+    def add_timeout(self, delay, callback):
+        return self.connection.add_timeout(delay, callback)
+
+    def publish_watermarks(self, watermarks):
+        """
+        Notify senders of the highest sequence number applied, for
+        each session in watermarks.
+        """
+        for session_id, seq in watermarks.iteritems():
+            self.channel.basic_publish(
+                exchange=self.exchange_name,
+                routing_key=watermark_routing_key(self.queue, session_id),
+                body=json.dumps({'session': session_id, 'seq': seq})
+            )
+
     def _on_close(self, *args):
         self.connection.ioloop.stop()
 
@@ -10,6 +10,7 @@ from bl.vl.kb.serialize.reference import Reference
 from bl.vl.kb.serialize.utils import is_a_kb_object, dewrap, sort_by_dependency
 from bl.vl.kb.serialize.utils import get_attribute, get_field_descriptor
 from bl.vl.kb.serialize.utils import UnknownKey, UnresolvedDependency
+from bl.vl.kb.serialize.dump import dependency_levels
 from bl.vl.kb.drivers.omero.data_samples import DataObject
 from bl.vl.kb.drivers.omero.genotyping import SNPMarkersSet
 
@@ -121,6 +122,21 @@ class ObjectsLimbo(object):
                 gr.add_edge((j, i))
         return sort_by_dependency(gr, sort=True)
 
+    def get_object_oids_by_level(self):
+        """
+        Return the object oids as a list of dependency levels: objects
+        in a level only refer to objects in previous levels.  Oids are
+        sorted by type within each level.
+        """
+        levels = dependency_levels(dict(
+            (oid, o.get_internal_references())
+            for oid, o in self.objects.iteritems()))
+        by_level = [[] for _ in xrange(1 + max(levels.values() or [-1]))]
+        for oid, l in levels.iteritems():
+            by_level[l].append(oid)
+        key = lambda oid: (self.objects[oid].type.OME_TABLE, oid)
+        return [sorted(oids, key=key) for oids in by_level]
+
 def deserialize_streams(kb, streams, logger=None):
     """Deserialize objects contained in streams, an iterable of yaml
        encoded stream(s) to a iterator of KB objects not yet saved in
@@ -0,0 +1,290 @@
+"""
+Stream KB objects to chunk files
+================================
+
+:func:`dump_objects` dumps all objects selected by a list of HQL
+queries to a directory of chunk files that can be restored with
+``restore_from_yaml --chunks-directory``, without ever holding the
+whole KB in memory:
+
+ 1. objects are read in pages (see the offset and limit arguments of
+    find_all_by_query) by a pool of worker processes, each with its
+    own KB connection, and serialized with references by vid
+    (``{'by_vid': vid}``) to temporary part files; the vids of linked
+    objects are read with one query per type, and the KB object cache
+    is cleared after each page;
+
+ 2. the parent process sorts objects by dependency level: level 0
+    objects do not refer to other dumped objects, level n objects
+    only refer to objects of lower levels;
+
+ 3. workers split each part file by level into chunk files named
+    ``<base>.<level>.<part>``, so that restoring chunks in name order
+    never refers to an object that has not been restored yet (the
+    same layout produced by split_yaml_dump).
+
+Chunks are written as YAML (with the libyaml emitter, if available)
+or in a binary format, a sequence of length-prefixed marshal records,
+and are optionally gzip compressed.  Use :func:`load_chunk` to read
+any of them back.
+
+.. code-block:: python
+
+    queries = [('from Individual o order by o.id', None),
+               ('from Action o order by o.id', None)]
+    dump_objects((host, user, passwd), queries, 'dump_dir', processes=4)
+"""
+
+import os, gzip, struct, marshal, shutil, tempfile, logging, multiprocessing
+
+import yaml
+try:
+    from yaml import CDumper as YamlDumper, CBaseLoader as YamlLoader
+except ImportError:
+    from yaml import Dumper as YamlDumper, BaseLoader as YamlLoader
+
+from bl.vl.utils import decode_dict
+from bl.vl.kb.serialize.serializer import Serializer
+
+
+FORMATS = ['yaml', 'binary']
+BINARY_EXT = '.bin'
+GZIP_EXT = '.gz'
+PAGE_SIZE = 5000
+HEADER = struct.Struct('<I')
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RecordSerializer(Serializer):
+    """
+    Collects serialized objects as (oid, definition) records, where
+    definition is what write_yaml would dump for oid.
+    """
+    def __init__(self, logger):
+        super(RecordSerializer, self).__init__(logger)
+        self.records = []
+
+    def serialize(self, oid, klass, conf, vid):
+        obj_def = {'type': klass, 'configuration': conf}
+        if vid is not None:
+            obj_def['vid'] = vid
+        self.records.append((str(oid), decode_dict(obj_def)))
+
+
+def references(obj_def):
+    """
+    Return the vids of the objects referred to by obj_def.
+    """
+    return tuple(v['by_vid'] for v in obj_def['configuration'].itervalues()
+                 if isinstance(v, dict) and 'by_vid' in v)
+
+
+def dependency_levels(deps):
+    """
+    Return a dictionary that maps each vid in deps to its dependency
+    level.  deps maps vids to the vids they refer to; references to
+    vids that are not in deps are ignored.
+    """
+    levels = {}
+    for root in deps:
+        if root in levels:
+            continue
+        stack, visiting = [(root, iter(deps[root]))], set([root])
+        while stack:
+            vid, refs = stack[-1]
+            for r in refs:
+                if r in deps and r not in levels:
+                    if r in visiting:
+                        raise ValueError('circular reference to %s' % r)
+                    visiting.add(r)
+                    stack.append((r, iter(deps[r])))
+                    break
+            else:
+                stack.pop()
+                visiting.discard(vid)
+                levels[vid] = 1 + max([levels[r] for r in deps[vid]
+                                       if r in deps] or [-1])
+    return levels
+
+
+def chunk_format(path):
+    name = path[:-len(GZIP_EXT)] if path.endswith(GZIP_EXT) else path
+    return 'binary' if name.endswith(BINARY_EXT) else 'yaml'
+
+
+def chunk_name(base_name, level, part, fmt, compress):
+    return '%s.%04d.%06d%s%s' % (base_name, level, part,
+                                 BINARY_EXT if fmt == 'binary' else '',
+                                 GZIP_EXT if compress else '')
+
+
+def open_chunk(path, mode='rb'):
+    if path.endswith(GZIP_EXT):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def write_records(f, records, fmt):
+    if fmt == 'binary':
+        for r in records:
+            data = marshal.dumps(r)
+            f.write(HEADER.pack(len(data)))
+            f.write(data)
+    else:
+        yaml.dump(dict(records), f, Dumper=YamlDumper,
+                  default_flow_style=False)
+
+
+def read_records(f, fmt):
+    if fmt == 'binary':
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                break
+            yield marshal.loads(f.read(HEADER.unpack(header)[0]))
+    else:
+        loader = YamlLoader(f)
+        try:
+            data = loader.get_data()
+        finally:
+            loader.dispose()
+        for r in (data or {}).iteritems():
+            yield r
+
+
+def load_chunk(path):
+    """
+    Return the {oid: definition} dictionary stored in a chunk file (a
+    YAML file such as those produced by dump_to_yaml and
+    split_yaml_dump, or a chunk written by :func:`dump_objects`).
+    """
+    with open_chunk(path) as f:
+        return dict(read_records(f, chunk_format(path)))
+
+
+#-- worker processes
+
+_KB = None
+
+
+def _init_worker(kb_args):
+    global _KB
+    from bl.vl.kb import KnowledgeBase as KB
+    _KB = KB(driver='omero')(*kb_args)
+
+
+def dump_page(args):
+    """
+    Serialize a page of the objects selected by query to part_fn.
+    Return part_fn and the list of (vid, references) of the objects.
+    """
+    query, params, offset, limit, part_fn = args
+    try:
+        objects = _KB.find_all_by_query(query, params, offset=offset,
+                                        limit=limit)
+        # links are serialized by vid: read them all at once
+        _KB.preload_link_vids(objects)
+        engine = RecordSerializer(LOGGER)
+        for o in objects:
+            o.serialize(engine, shallow=True)
+    finally:
+        # wrapped objects are kept in the KB object cache
+        _KB.clear_cache()
+    with open(part_fn, 'wb') as f:
+        write_records(f, engine.records, 'binary')
+    return part_fn, [(oid, references(d)) for oid, d in engine.records]
+
+
+def write_part_chunks(args):
+    """
+    Split the records of a part file into chunk files by dependency
+    level and remove it.  levels lists the level of each record, None
+    for records that must be skipped.  Return the names of the chunk
+    files and the number of records written.
+    """
+    part_fn, part, levels, out_dir, base_name, fmt, compress = args
+    by_level = {}
+    with open(part_fn, 'rb') as f:
+        for r, l in zip(read_records(f, 'binary'), levels):
+            if l is not None:
+                by_level.setdefault(l, []).append(r)
+    os.remove(part_fn)
+    names = []
+    for l, records in sorted(by_level.iteritems()):
+        name = chunk_name(base_name, l, part, fmt, compress)
+        with open_chunk(os.path.join(out_dir, name), 'wb') as f:
+            write_records(f, records, fmt)
+        names.append(name)
+    return names, sum(len(v) for v in by_level.itervalues())
+
+
+def _iter_pages(pool, processes, queries, page_size, wd):
+    part = 0
+    for query, params in queries:
+        offset, done = 0, False
+        while not done:
+            # one page per worker at a time: stop at the first short page
+            tasks = []
+            for _ in xrange(processes):
+                tasks.append((query, params, offset, page_size,
+                              os.path.join(wd, 'part.%06d' % part)))
+                offset += page_size
+                part += 1
+            for part_fn, refs in pool.imap(dump_page, tasks):
+                done = done or len(refs) < page_size
+                yield part_fn, refs
+
+
+def dump_objects(kb_args, queries, out_dir, base_name='dump', fmt='yaml',
+                 compress=True, processes=1, page_size=PAGE_SIZE,
+                 logger=None):
+    """
+    Dump the objects selected by queries, a list of (query, params)
+    pairs, to chunk files in out_dir.  Queries should order objects
+    (e.g., by id) for paging to be consistent.  kb_args are the
+    (host, user, passwd) arguments used by each worker process to
+    connect to the KB.  Return the number of objects dumped.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('unknown format %r' % fmt)
+    logger = logger or LOGGER
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    wd = tempfile.mkdtemp(prefix='.parts-', dir=out_dir)
+    pool = multiprocessing.Pool(processes, _init_worker, (kb_args,))
+    try:
+        deps, parts = {}, []
+        for part_fn, refs in _iter_pages(pool, processes, queries,
+                                         page_size, wd):
+            vids = []
+            for vid, r in refs:
+                if vid in deps:  # already selected by another query
+                    vids.append(None)
+                else:
+                    deps[vid] = r
+                    vids.append(vid)
+            parts.append((part_fn, vids))
+            logger.info('%d objects read' % len(deps))
+        external = set(r for refs in deps.itervalues() for r in refs
+                       if r not in deps)
+        if external:
+            logger.warning('%d referenced objects are not in the dump' %
+                           len(external))
+        levels = dependency_levels(deps)
+        deps.clear()
+        tasks = [(part_fn, i, [levels.get(v) for v in vids], out_dir,
+                  base_name, fmt, compress)
+                 for i, (part_fn, vids) in enumerate(parts)]
+        n_objects = 0
+        for _, n in pool.imap(write_part_chunks, tasks):
+            n_objects += n
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(wd, ignore_errors=True)
+    logger.info('%d objects dumped to %s' % (n_objects, out_dir))
+    return n_objects
@@ -0,0 +1,206 @@
+"""
+Restore deserialized objects to the KB
+======================================
+
+:class:`RestoreEngine` saves the objects collected by an
+:class:`~bl.vl.kb.serialize.deserialize.ObjectsLimbo` one dependency
+level at a time (see ObjectsLimbo.get_object_oids_by_level): objects
+of the same level do not refer to each other, so each level is split
+into batches of objects of the same type that are saved concurrently,
+each batch with one of the KB sessions given to the engine.
+
+External references (by vid or by label) are resolved before saving,
+with one bulk query per type and batch of values.
+
+If a checkpoint file is given, the (oid, vid) pairs of saved objects
+are appended to it after each batch.  Restoring the same objects
+again with the same checkpoint skips the objects that have already
+been saved, looking them up by vid instead.
+
+.. code-block:: python
+
+    limbo = ObjectsLimbo(kb, logger)
+    for ref, conf in load_chunk('dump.yml').iteritems():
+        limbo.add_object(ref, conf)
+    kbs = [kb] + [KB(driver='omero')(host, user, passwd) for _ in range(3)]
+    with RestoreEngine(kbs, logger, checkpoint='dump.ckpt') as engine:
+        engine.restore(limbo)
+"""
+
+import os, sys, json, threading, Queue
+import itertools as it
+
+from bl.vl.kb import KBError
+from bl.vl.kb.serialize.reference import Reference
+
+
+BATCH_SIZE = 500
+LOOKUP_BATCH_SIZE = 1000
+# objects that can be shared by different dumps (e.g., studies):
+# failing to save one because it already exists is not an error
+SHARED_TYPES = frozenset(['Study', 'Device'])
+
+
+def is_shared_type(otype):
+    return any(getattr(k, 'OME_TABLE', None) in SHARED_TYPES
+               for k in otype.__mro__)
+
+
+class Checkpoint(object):
+    """
+    Persistent record of saved objects, as lines of JSON encoded lists
+    of [oid, vid] pairs.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.saved = {}
+        self.lock = threading.Lock()
+        self.f = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.saved.update(json.loads(line))
+                    except ValueError:
+                        pass  # a line truncated by a crash
+        self.f = open(path, 'a')
+
+    def __contains__(self, oid):
+        return oid in self.saved
+
+    def add(self, pairs):
+        with self.lock:
+            self.saved.update(pairs)
+            if self.f is not None:
+                self.f.write(json.dumps(pairs) + '\n')
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class RestoreEngine(object):
+
+    def __init__(self, kbs, logger, batch_size=BATCH_SIZE, checkpoint=None,
+                 lookup_batch_size=LOOKUP_BATCH_SIZE):
+        """
+        kbs is a list of KB objects, each with its own session: the
+        first one is also used to create objects and to resolve
+        references.
+        """
+        self.kbs = kbs
+        self.kb = kbs[0]
+        self.logger = logger
+        self.batch_size = batch_size
+        self.lookup_batch_size = lookup_batch_size
+        self.checkpoint = Checkpoint(checkpoint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.checkpoint.close()
+
+    def get_by_field(self, klass, field_name, values):
+        return self.kb.get_by_field(klass, field_name, values,
+                                    batch_size=self.lookup_batch_size)
+
+    def restore(self, limbo):
+        """
+        Save all objects in limbo.  Return the number of objects saved.
+        """
+        Reference.resolve_external_references(self.get_by_field)
+        self.__resolve_saved(limbo)
+        n_saved = 0
+        levels = limbo.get_object_oids_by_level()
+        for i, oids in enumerate(levels):
+            batches = self.__make_batches(limbo, oids)
+            n = sum(len(b[1]) for b in batches)
+            self.logger.info('level %d/%d: saving %d objects in %d batches' %
+                             (i + 1, len(levels), n, len(batches)))
+            self.__run(batches)
+            n_saved += n
+        self.logger.info('%d objects saved' % n_saved)
+        return n_saved
+
+    def __resolve_saved(self, limbo):
+        by_type = {}
+        for oid, o in limbo.objects.iteritems():
+            if oid in self.checkpoint:
+                by_type.setdefault(o.type, []).append(oid)
+        for otype, oids in by_type.iteritems():
+            self.logger.info('%d %s objects already saved' %
+                             (len(oids), otype.OME_TABLE))
+            vids = [self.checkpoint.saved[oid] for oid in oids]
+            objs = self.get_by_field(otype, 'vid', vids)
+            for oid, vid in it.izip(oids, vids):
+                if vid not in objs:
+                    raise KBError('%s (%s) is in the checkpoint, but not in the KB'
+                                  % (oid, vid))
+                limbo.objects[oid].object = objs[vid]
+                Reference.resolve_internal_reference(oid, objs[vid])
+
+    def __make_batches(self, limbo, oids):
+        batches = []
+        grouped = it.groupby(oids, lambda oid: limbo.objects[oid].type)
+        for otype, group in grouped:
+            objs = []
+            for oid in group:
+                if oid in self.checkpoint:
+                    continue
+                o = limbo.objects[oid].create(self.kb.factory)
+                Reference.resolve_internal_reference(oid, o)
+                objs.append((oid, o))
+            for i in xrange(0, len(objs), self.batch_size):
+                batches.append((otype, objs[i:i+self.batch_size]))
+        return batches
+
+    def __save_batch(self, kb, otype, objs):
+        if is_shared_type(otype):
+            saved = []
+            for oid, o in objs:
+                try:
+                    kb.save(o)
+                    saved.append((oid, o))
+                except KBError:
+                    self.logger.debug('Object %s::%s already exists, ignoring'
+                                      % (otype.OME_TABLE, oid))
+        else:
+            kb.save_array([o for _, o in objs])
+            saved = objs
+        self.checkpoint.add([(oid, o.vid) for oid, o in saved])
+
+    def __run(self, batches):
+        if len(self.kbs) == 1 or len(batches) < 2:
+            for otype, objs in batches:
+                self.__save_batch(self.kb, otype, objs)
+            return
+        queue, errors = Queue.Queue(), []
+        for b in batches:
+            queue.put(b)
+        def work(kb):
+            while not errors:
+                try:
+                    otype, objs = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.__save_batch(kb, otype, objs)
+                except Exception:
+                    errors.append(sys.exc_info())
+        threads = [threading.Thread(target=work, args=(kb,))
+                   for kb in self.kbs[:len(batches)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
@@ -0,0 +1,114 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+External Sort
+=============
+
+Sort streams of records that do not fit in memory.  Records are
+sorted in memory in runs of at most run_size records; runs are
+pickled to temporary files and merged when the sorted records are
+read, so that memory usage does not depend on the number of records.
+For instance::
+
+  with ExternalSorter(key=itemgetter('index')) as sorter:
+    sorter.extend(records)
+    for r in sorter:
+      process(r)
+"""
+
+# DEV NOTE: this module must NOT use other OMERO.biobank modules.
+
+import os, heapq, shutil, tempfile
+import cPickle
+from cPickle import HIGHEST_PROTOCOL as HP
+
+
+RUN_SIZE = 100000  # max records sorted in memory
+
+
+class ExternalSorter(object):
+  """
+  Sort picklable records by key(record) (by the records themselves if
+  key is None).  The sort is stable.
+
+  Sorted records can be read any number of times by iterating over
+  the sorter; records cannot be added after the first read.  Call
+  close (or use the sorter as a context manager) to remove temporary
+  files.
+  """
+
+  def __init__(self, key=None, run_size=RUN_SIZE, tmp_dir=None):
+    self.key = key
+    self.run_size = run_size
+    self.tmp_dir = tmp_dir
+    self.wd = None
+    self.buffer = []
+    self.runs = []
+    self.n_records = 0
+    self.sorted = False
+
+  def __len__(self):
+    return self.n_records
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def add(self, record):
+    if self.sorted:
+      raise ValueError('cannot add records to a sorted stream')
+    k = record if self.key is None else self.key(record)
+    # the record counter makes the sort stable and records are never
+    # compared to each other
+    self.buffer.append((k, self.n_records, record))
+    self.n_records += 1
+    if len(self.buffer) >= self.run_size:
+      self.__spill()
+
+  def extend(self, records):
+    for r in records:
+      self.add(r)
+
+  def __spill(self):
+    if self.wd is None:
+      self.wd = tempfile.mkdtemp(prefix='bl_vl_sort_', dir=self.tmp_dir)
+    self.buffer.sort()
+    fn = os.path.join(self.wd, 'run_%d' % len(self.runs))
+    with open(fn, 'wb') as f:
+      for item in self.buffer:
+        cPickle.dump(item, f, HP)
+    self.runs.append(fn)
+    self.buffer = []
+
+  @staticmethod
+  def __read_run(fn):
+    with open(fn, 'rb') as f:
+      while True:
+        try:
+          yield cPickle.load(f)
+        except EOFError:
+          break
+
+  def __iter__(self):
+    if not self.sorted:
+      if self.runs and self.buffer:
+        self.__spill()
+      else:
+        self.buffer.sort()
+      self.sorted = True
+    if self.runs:
+      items = heapq.merge(*[self.__read_run(fn) for fn in self.runs])
+    else:
+      items = iter(self.buffer)
+    for _, _, record in items:
+      yield record
+
+  def close(self):
+    if self.wd is not None:
+      shutil.rmtree(self.wd, ignore_errors=True)
+      self.wd = None
+    self.buffer = []
+    self.runs = []
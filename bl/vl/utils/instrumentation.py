@@ -0,0 +1,356 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Operation instrumentation
+=========================
+
+Lightweight recording of call counts, latency histograms and payload
+sizes for KB operations.  Functions decorated with
+:func:`instrumented` are timed whenever recording is enabled, either
+programmatically:
+
+.. code-block:: python
+
+  import bl.vl.utils.instrumentation as instr
+
+  recorder = instr.enable()
+  ... # use the KB
+  recorder.dump('profile.json')
+
+or by setting the ``BIOBANK_PROFILE`` environment variable to the path
+of a file where the collected data will be written at exit (and/or
+``BIOBANK_STATSD`` to the ``host[:port]`` of a statsd daemon).  Each
+call is tagged with the module and function that called into the
+instrumented layer.  Instrumented calls can be nested (e.g., save
+calls ome_operation): besides its total time, each operation records
+its self time, i.e., the time not spent in nested instrumented calls,
+so that self times add up to the actual time spent in the KB layer.
+Collected data can be exported as JSON (see the ``profile``
+subcommand of ``kb_query``), in Prometheus text format or sent, event
+by event, to a statsd daemon via :class:`StatsdSink`.
+
+When recording is disabled the overhead is a single global lookup per
+call.
+"""
+
+# DEV NOTE: this module must NOT use other OMERO.biobank modules.
+
+import os, sys, time, json, socket, atexit, functools, threading
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+PROMETHEUS_PREFIX = 'biobank_kb_operation'
+STATSD_PREFIX = 'biobank.kb'
+SKIP_MODULE_PREFIXES = ('bl.vl.kb.drivers', __name__)
+
+
+class OperationStats(object):
+
+  def __init__(self, op, site=None):
+    self.op = op
+    self.site = site
+    self.count = 0
+    self.errors = 0
+    self.total_time = 0.0
+    self.self_time = 0.0
+    self.min_time = None
+    self.max_time = 0.0
+    self.items = 0
+    self.bytes = 0
+    self.buckets = [0] * len(BUCKETS)
+
+  @property
+  def mean_time(self):
+    return self.total_time / self.count if self.count else 0.0
+
+  def add(self, elapsed, items=0, nbytes=0, ok=True, self_time=None):
+    self.count += 1
+    if not ok:
+      self.errors += 1
+    self.total_time += elapsed
+    self.self_time += elapsed if self_time is None else self_time
+    if self.min_time is None or elapsed < self.min_time:
+      self.min_time = elapsed
+    self.max_time = max(self.max_time, elapsed)
+    self.items += items
+    self.bytes += nbytes
+    for i, b in enumerate(BUCKETS):
+      if elapsed <= b:
+        self.buckets[i] += 1
+        break
+
+  def merge(self, other):
+    self.count += other.count
+    self.errors += other.errors
+    self.total_time += other.total_time
+    self.self_time += other.self_time
+    if other.min_time is not None:
+      self.min_time = (other.min_time if self.min_time is None
+                       else min(self.min_time, other.min_time))
+    self.max_time = max(self.max_time, other.max_time)
+    self.items += other.items
+    self.bytes += other.bytes
+    self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+  def to_dict(self):
+    return {
+      'op': self.op,
+      'site': self.site,
+      'count': self.count,
+      'errors': self.errors,
+      'total_time': self.total_time,
+      'self_time': self.self_time,
+      'min_time': self.min_time,
+      'max_time': self.max_time,
+      'items': self.items,
+      'bytes': self.bytes,
+      'buckets': self.buckets,
+      }
+
+  @classmethod
+  def from_dict(cls, d):
+    s = cls(d['op'], d.get('site'))
+    for k in ('count', 'errors', 'total_time', 'min_time', 'max_time',
+              'items', 'bytes', 'buckets'):
+      setattr(s, k, d[k])
+    # profiles written before self times were recorded
+    s.self_time = d.get('self_time', s.total_time)
+    return s
+
+
+class Recorder(object):
+  """
+  Collects :class:`OperationStats` keyed by (operation, call site).
+  Operations can be recorded from several threads.
+  """
+
+  def __init__(self, sinks=None):
+    self.stats = {}
+    self.sinks = sinks or []
+    self.start_time = time.time()
+    self.lock = threading.Lock()
+
+  def record(self, op, elapsed, items=0, nbytes=0, site=None, ok=True,
+             self_time=None):
+    key = (op, site)
+    with self.lock:
+      s = self.stats.get(key)
+      if s is None:
+        s = self.stats[key] = OperationStats(op, site)
+      s.add(elapsed, items, nbytes, ok, self_time)
+    for sink in self.sinks:
+      sink.emit(op, elapsed, items, nbytes, ok)
+
+  def reset(self):
+    with self.lock:
+      self.stats = {}
+      self.start_time = time.time()
+
+  def snapshot(self):
+    """
+    Return a copy of the stats collected so far.
+    """
+    with self.lock:
+      return [OperationStats.from_dict(s.to_dict())
+              for s in self.stats.itervalues()]
+
+  def by_operation(self):
+    """
+    Return stats aggregated over all call sites.
+    """
+    res = {}
+    for s in self.snapshot():
+      if s.op not in res:
+        res[s.op] = OperationStats(s.op)
+      res[s.op].merge(s)
+    return res
+
+  def top(self, n=None, key='total_time', by_site=False):
+    stats = self.snapshot() if by_site else self.by_operation().values()
+    stats.sort(key=lambda s: getattr(s, key), reverse=True)
+    return stats[:n] if n else stats
+
+  def dump(self, fname):
+    stats = self.snapshot()
+    with open(fname, 'w') as f:
+      json.dump({
+        'start_time': self.start_time,
+        'end_time': time.time(),
+        'pid': os.getpid(),
+        'stats': [s.to_dict() for s in stats],
+        }, f, indent=1)
+
+  @classmethod
+  def load(cls, fname):
+    with open(fname) as f:
+      d = json.load(f)
+    rec = cls()
+    rec.start_time = d.get('start_time', rec.start_time)
+    for x in d['stats']:
+      s = OperationStats.from_dict(x)
+      rec.stats[(s.op, s.site)] = s
+    return rec
+
+  def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+    name = '%s_seconds' % prefix
+    lines = [
+      '# HELP %s KB operation latency' % name,
+      '# TYPE %s histogram' % name,
+      ]
+    ops = self.by_operation()
+    for op in sorted(ops):
+      s = ops[op]
+      cumulative = 0
+      for b, c in zip(BUCKETS, s.buckets):
+        cumulative += c
+        le = '+Inf' if b == float('inf') else repr(b)
+        lines.append('%s_bucket{op="%s",le="%s"} %d' % (name, op, le,
+                                                        cumulative))
+      lines.append('%s_sum{op="%s"} %f' % (name, op, s.total_time))
+      lines.append('%s_count{op="%s"} %d' % (name, op, s.count))
+    for counter, help_text in (('errors', 'failed KB operations'),
+                               ('items', 'items moved by KB operations'),
+                               ('bytes', 'bytes moved by KB operations')):
+      cname = '%s_%s_total' % (prefix, counter)
+      lines.append('# HELP %s %s' % (cname, help_text))
+      lines.append('# TYPE %s counter' % cname)
+      for op in sorted(ops):
+        lines.append('%s{op="%s"} %d' % (cname, op,
+                                         getattr(ops[op], counter)))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+  """
+  Send each recorded event to a statsd daemon over UDP.
+  """
+
+  def __init__(self, host='localhost', port=8125, prefix=STATSD_PREFIX):
+    self.address = (host, port)
+    self.prefix = prefix
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def emit(self, op, elapsed, items, nbytes, ok):
+    name = '%s.%s' % (self.prefix, op.replace('[', '.').rstrip(']'))
+    msg = ['%s:%d|ms' % (name, int(1000 * elapsed))]
+    if items:
+      msg.append('%s.items:%d|c' % (name, items))
+    if nbytes:
+      msg.append('%s.bytes:%d|c' % (name, nbytes))
+    if not ok:
+      msg.append('%s.errors:1|c' % name)
+    try:
+      self.socket.sendto('\n'.join(msg), self.address)
+    except socket.error:
+      pass
+
+
+_RECORDER = None
+# per thread stack of the time spent in nested instrumented calls
+_NESTING = threading.local()
+
+
+def enable(recorder=None):
+  global _RECORDER
+  _RECORDER = recorder or Recorder()
+  return _RECORDER
+
+
+def disable():
+  global _RECORDER
+  recorder, _RECORDER = _RECORDER, None
+  return recorder
+
+
+def get_recorder():
+  return _RECORDER
+
+
+def payload_size(obj):
+  """
+  Return an (items, bytes) estimate of the size of obj.
+  """
+  if obj is None:
+    return 0, 0
+  if hasattr(obj, 'nbytes'):
+    return len(obj) if obj.ndim else 1, obj.nbytes
+  if isinstance(obj, basestring):
+    return 1, len(obj)
+  try:
+    return len(obj), 0
+  except TypeError:
+    return 1, 0
+
+
+def call_site(depth=2):
+  f = sys._getframe(depth)
+  while f is not None:
+    module = f.f_globals.get('__name__', '')
+    if not module.startswith(SKIP_MODULE_PREFIXES):
+      return '%s:%s' % (module, f.f_code.co_name)
+    f = f.f_back
+  return None
+
+
+def instrumented(name=None, payload=None, detail=None):
+  """
+  Decorator that records calls to the decorated function.
+
+  payload selects what is measured as the operation payload: None
+  (nothing), 'result' or the index of a positional argument. detail
+  is an optional function of the call arguments whose return value is
+  appended, in square brackets, to the operation name.
+  """
+  def decorator(f):
+    op = name or f.__name__
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      recorder = _RECORDER
+      if recorder is None:
+        return f(*args, **kwargs)
+      stack = getattr(_NESTING, 'stack', None)
+      if stack is None:
+        stack = _NESTING.stack = []
+      stack.append(0.0)
+      start = time.time()
+      result, ok = None, False
+      try:
+        result = f(*args, **kwargs)
+        ok = True
+        return result
+      finally:
+        elapsed = time.time() - start
+        self_time = elapsed - stack.pop()
+        if stack:
+          stack[-1] += elapsed
+        items, nbytes = 0, 0
+        if payload == 'result':
+          items, nbytes = payload_size(result)
+        elif payload is not None and payload < len(args):
+          items, nbytes = payload_size(args[payload])
+        full_name = op if detail is None else '%s[%s]' % (op, detail(*args))
+        recorder.record(full_name, elapsed, items, nbytes, call_site(), ok,
+                        self_time)
+    return wrapper
+  return decorator
+
+
+def _dump_at_exit(fname):
+  if _RECORDER is not None:
+    _RECORDER.dump(fname)
+
+
+def _statsd_sink_from_env(value):
+  host, port = value.rsplit(':', 1) if ':' in value else (value, 8125)
+  return StatsdSink(host, int(port))
+
+
+if os.environ.get('BIOBANK_PROFILE') or os.environ.get('BIOBANK_STATSD'):
+  enable()
+  if os.environ.get('BIOBANK_STATSD'):
+    _RECORDER.sinks.append(_statsd_sink_from_env(os.environ['BIOBANK_STATSD']))
+  if os.environ.get('BIOBANK_PROFILE'):
+    atexit.register(_dump_at_exit, os.environ['BIOBANK_PROFILE'])
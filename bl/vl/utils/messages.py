@@ -66,3 +66,27 @@ def messages_engine_password():
             return getattr(blconf, var)
         except AttributeError:
             raise ValueError("Cant't find config value for %s" % var)
+
+
+def messages_engine_batch_size():
+    var = 'MESSAGES_QUEUE_ENGINE_BATCH_SIZE'
+    try:
+        return int(_get_env_variable(var) or 0) or None
+    except ValueError:
+        return getattr(blconf, var, None)
+
+
+def messages_engine_flush_interval():
+    var = 'MESSAGES_QUEUE_ENGINE_FLUSH_INTERVAL'
+    try:
+        return float(_get_env_variable(var) or 0) or None
+    except ValueError:
+        return getattr(blconf, var, None)
+
+
+def messages_engine_spool_file():
+    var = 'MESSAGES_QUEUE_ENGINE_SPOOL_FILE'
+    try:
+        return _get_env_variable(var)
+    except ValueError:
+        return getattr(blconf, var, None)
@@ -1,7 +1,7 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import hashlib
+import hashlib, os
 import omero
 # DO NOT DELETE import omero.model, removing this import will result
 # in a blocking error
@@ -49,3 +49,17 @@ def ome_user():
 
 def ome_passwd():
   return _get_env_variable('OME_PASSWD')
+
+
+def ome_table_index_dir():
+  try:
+    return _get_env_variable('OME_TABLE_INDEX_DIR')
+  except ValueError:
+    return os.path.join(os.path.expanduser('~'), '.biobank', 'table_indices')
+
+
+def ome_table_cache_dir():
+  try:
+    return _get_env_variable('OME_TABLE_CACHE_DIR')
+  except ValueError:
+    return os.path.join(os.path.expanduser('~'), '.biobank', 'table_cache')
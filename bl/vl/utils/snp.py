@@ -1,9 +1,11 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import re
+import re, string
 import itertools as it
 
+import numpy as np
+
 from bl.core.seq.utils import reverse_complement as rc
 
 
@@ -26,6 +28,44 @@ SNP_FLANK_SIZE = 125
 SNP_MASK_SIZE = 2*SNP_FLANK_SIZE+1
 
 
+# strand codes, see MaskBlock
+STRAND_UNDECIDED, STRAND_TOP, STRAND_BOT = 0, 1, 2
+STRAND_CODES = {'TOP': STRAND_TOP, 'BOT': STRAND_BOT}
+
+# error codes, see MaskBlock
+MASK_OK, BAD_MASK_FORMAT, UNDECIDABLE_STRAND = 0, 1, 2
+
+WALK_STEP = 16  # flanking pairs compared at a time by MaskBlock
+
+
+def _byte_set(chars):
+  table = np.zeros(256, dtype=np.bool_)
+  table[[ord(c) for c in chars]] = True
+  return table
+
+
+def _strand_tables():
+  alleles = np.zeros((256, 256), dtype=np.int8)
+  flanks = np.zeros((256, 256), dtype=np.int8)
+  for s, strand in UNAMBIGUOUS.iteritems():
+    if len(s) == 2:
+      for l, r in it.permutations(s):
+        alleles[ord(l), ord(r)] = STRAND_CODES[strand]
+        flanks[ord(l), ord(r)] = STRAND_TOP if l in 'AT' else STRAND_BOT
+  return alleles, flanks
+
+
+IS_LETTER = _byte_set(string.ascii_letters)
+IS_BASE = _byte_set('ACGT')
+# masks made only of these characters are reverse complemented with
+# RC_MASK_TABLE rather than with rc
+IS_SAFE = _byte_set('ACGTN[/]')
+RC_MASK_TABLE = string.maketrans('ACGTN[/]', 'TGCAN]/[')
+COMPLEMENT = np.fromstring(string.maketrans('ACGT', 'TGCA'), dtype=np.uint8)
+# strand decided by a pair of alleles / by a (left, right) flanking pair
+ALLELE_STRAND, FLANK_STRAND = _strand_tables()
+
+
 def split_mask(mask):
   m = MASK_PATTERN.match(mask)
   try:
@@ -35,6 +75,12 @@ def split_mask(mask):
   else:
     return (lflank, tuple(alleles.split("/")), rflank)
 
+def split_masks(masks):
+  """
+  Split a sequence of masks, see MaskBlock.split.
+  """
+  return MaskBlock(masks).split()
+
 def approx_equal_masks(a_mask, b_mask, width=10):
   def check_flank(a_flank, b_flank, width, right):
     w = min([len(a_flank), len(b_flank), width])
@@ -76,6 +122,19 @@ def _identify_strand(lflank, alleles, rflank):
   return strand
 
 
+def _to_top(mask, toupper=True):
+  lflank, alleles, rflank = mask
+  alleles = tuple(sorted(alleles))
+  if toupper:
+    lflank, rflank = lflank.upper(), rflank.upper()
+    alleles = tuple(_.upper() for _ in alleles)
+  strand = _identify_strand(lflank, alleles, rflank)
+  mask = (lflank, alleles, rflank)
+  if strand == 'BOT':
+    mask = rc_mask(mask)
+  return strand, mask
+
+
 def convert_to_top(mask, toupper=True):
   """
   Convert a mask with format LeftFlank[AlleleA/AlleleB]RightFlank to
@@ -91,19 +150,179 @@ def convert_to_top(mask, toupper=True):
   Illumina, Inc., "TOP/BOT" Strand and "A/B" Allele, technical note, 2006.
   """
   if isinstance(mask, basestring):
-    lflank, alleles, rflank = split_mask(mask)
+    mask = split_mask(mask)
     rebuild_str = True
   else:
-    lflank, alleles, rflank = mask
     rebuild_str = False
-  alleles = tuple(sorted(alleles))
-  if toupper:
-    lflank, rflank = lflank.upper(), rflank.upper()
-    alleles = tuple(_.upper() for _ in alleles)
-  strand = _identify_strand(lflank, alleles, rflank)
-  mask = (lflank, alleles, rflank)
-  if strand == 'BOT':
-    mask = rc_mask(mask)
+  _, mask = _to_top(mask, toupper=toupper)
   if rebuild_str:
     mask = join_mask(mask)
   return mask
+
+
+def convert_to_top_many(masks, toupper=True):
+  """
+  Convert a sequence of masks (strings) to the TOP strand, see
+  MaskBlock.convert_to_top.  Return a list with the converted masks
+  (None where conversion failed) and an int8 array of error codes.
+  """
+  converted, _, errors = MaskBlock(masks).convert_to_top(toupper=toupper)
+  return converted, errors
+
+
+class MaskBlock(object):
+  """
+  A block of masks (strings), stored as a single byte array so that
+  they can be parsed and converted to the TOP strand with array
+  operations instead of one mask at a time.
+
+  Results are the same as those of split_mask and convert_to_top.
+  Masks that are not handled by the array operations (those
+  containing newlines, with alleles other than two single
+  characters, or with flanks containing characters other than
+  'ACGTN') are passed to the scalar functions.
+  """
+
+  def __init__(self, masks):
+    self.masks = list(masks)
+    lengths = np.fromiter(it.imap(len, self.masks), dtype=np.int64,
+                          count=len(self.masks))
+    # each mask is followed by a newline
+    self.ends = np.cumsum(lengths + 1) - 1
+    self.starts = self.ends - lengths
+    self.text = '\n'.join(self.masks) + '\n'
+    self.data = np.fromstring(self.text, dtype=np.uint8)
+    self.irregular = np.fromiter(('\n' in m for m in self.masks),
+                                 dtype=np.bool_, count=len(self.masks))
+    self.__parse()
+
+  def __len__(self):
+    return len(self.masks)
+
+  def __count(self, flags):
+    """
+    Count flagged bytes in each mask.
+    """
+    pos = np.flatnonzero(flags)
+    return pos.searchsorted(self.ends) - pos.searchsorted(self.starts)
+
+  def __parse(self):
+    # a mask matches MASK_PATTERN iff its first non-letter is '[', its
+    # last non-letter is ']', there is no other ']' and flanks and
+    # alleles are not empty.  The newline after each mask is a
+    # non-letter, so first and last non-letters always exist.
+    data = self.data
+    nonletters = np.flatnonzero(~IS_LETTER[data])
+    self.lbr = nonletters[np.searchsorted(nonletters, self.starts)]
+    self.rbr = nonletters[np.searchsorted(nonletters, self.ends) - 1]
+    self.valid = ((self.lbr > self.starts) & (self.rbr < self.ends - 1) &
+                  (self.rbr > self.lbr + 1) &
+                  (data[self.lbr] == ord('[')) & (data[self.rbr] == ord(']')) &
+                  (self.__count(data == ord(']')) == 1) & ~self.irregular)
+
+  def biallelic(self):
+    """
+    Return a boolean array flagging valid masks whose alleles are two
+    single characters.
+    """
+    res = np.zeros(len(self), dtype=np.bool_)
+    rows = np.flatnonzero(self.valid & (self.rbr == self.lbr + 4))
+    res[rows] = self.data[self.lbr[rows] + 2] == ord('/')
+    return res
+
+  def alleles(self, rows):
+    """
+    Return the first and second alleles, as byte arrays, of the given
+    biallelic masks.
+    """
+    return self.data[self.lbr[rows] + 1], self.data[self.lbr[rows] + 3]
+
+  def split(self):
+    """
+    Return a list with the output of split_mask for each mask (None
+    for masks that cannot be split).
+    """
+    splits = [None] * len(self)
+    rows = np.flatnonzero(self.valid)
+    for i, l, r in it.izip(rows.tolist(), (self.lbr - self.starts)[rows],
+                           (self.rbr - self.starts)[rows]):
+      m = self.masks[i]
+      splits[i] = (m[:l], tuple(m[l+1:r].split('/')), m[r+1:])
+    for i in np.flatnonzero(self.irregular):
+      try:
+        splits[i] = split_mask(self.masks[i])
+      except ValueError:
+        pass
+    return splits
+
+  def __walk_flanks(self, data, rows):
+    """
+    Vectorized version of the flank walk in _identify_strand:
+    flanking pairs are compared WALK_STEP at a time, moving away from
+    the SNP, for the masks whose strand is still undecided.
+    """
+    strands = np.zeros(len(rows), dtype=np.int8)
+    left, right = self.lbr[rows] - 1, self.rbr[rows] + 1
+    n_pairs = np.minimum(left + 1 - self.starts[rows], self.ends[rows] - right)
+    todo = np.arange(len(rows))
+    k = 0
+    while len(todo):
+      steps = np.arange(k, k + WALK_STEP)
+      in_range = steps < n_pairs[todo, None]
+      lpos = np.where(in_range, left[todo, None] - steps, 0)
+      rpos = np.where(in_range, right[todo, None] + steps, 0)
+      codes = np.where(in_range, FLANK_STRAND[data[lpos], data[rpos]], 0)
+      found = codes[np.arange(len(todo)), (codes != 0).argmax(axis=1)]
+      strands[todo] = found
+      k += WALK_STEP
+      todo = todo[(found == STRAND_UNDECIDED) & (n_pairs[todo] > k)]
+    return strands
+
+  def convert_to_top(self, toupper=True):
+    """
+    Convert all masks to the TOP strand.  Return a list with the
+    converted masks (None where conversion failed), an int8 array of
+    strand codes (STRAND_TOP, STRAND_BOT or STRAND_UNDECIDED) of the
+    input masks and an int8 array of error codes (MASK_OK,
+    BAD_MASK_FORMAT or UNDECIDABLE_STRAND).
+    """
+    n = len(self)
+    converted = [None] * n
+    strands = np.zeros(n, dtype=np.int8)
+    errors = np.where(self.valid, MASK_OK, BAD_MASK_FORMAT).astype(np.int8)
+    data = np.fromstring(self.text.upper() if toupper else self.text,
+                         dtype=np.uint8)
+    fast = self.biallelic() & (self.__count(~IS_SAFE[data]) == 0)
+    rows = np.flatnonzero(fast)
+    # like convert_to_top, sort alleles before converting them to uppercase
+    swap = np.greater(*self.alleles(rows))
+    a, b = data[self.lbr[rows] + 1], data[self.lbr[rows] + 3]
+    lo, hi = np.where(swap, b, a), np.where(swap, a, b)
+    data[self.lbr[rows] + 1], data[self.lbr[rows] + 3] = lo, hi
+    strands[rows] = ALLELE_STRAND[lo, hi]
+    walk = rows[strands[rows] == STRAND_UNDECIDED]
+    strands[walk] = self.__walk_flanks(data, walk)
+    errors[rows[strands[rows] == STRAND_UNDECIDED]] = UNDECIDABLE_STRAND
+    top = data.tostring()
+    bot = top.translate(RC_MASK_TABLE)[::-1]
+    size = len(top)
+    for i, strand, s, e in it.izip(rows.tolist(), strands[rows].tolist(),
+                                   self.starts[rows].tolist(),
+                                   self.ends[rows].tolist()):
+      if strand == STRAND_TOP:
+        converted[i] = top[s:e]
+      elif strand == STRAND_BOT:
+        converted[i] = bot[size-e:size-s]
+    for i in np.flatnonzero((self.valid | self.irregular) & ~fast):
+      try:
+        mask = split_mask(self.masks[i])
+      except ValueError:
+        continue
+      try:
+        strand, mask = _to_top(mask, toupper=toupper)
+      except ValueError:
+        errors[i] = UNDECIDABLE_STRAND
+      else:
+        strands[i], errors[i] = STRAND_CODES[strand], MASK_OK
+        converted[i] = join_mask(mask)
+    return converted, strands, errors
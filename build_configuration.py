@@ -77,6 +77,24 @@ CONFIG_VALUES = [
         'kb_config_value': 'MESSAGES_QUEUE_ENGINE_PASSWORD',
         'type': str,
         'default': None,
+        },
+    {
+        'ome_config_value': 'omero.biobank.messages_queue.batch_size',
+        'kb_config_value': 'MESSAGES_QUEUE_ENGINE_BATCH_SIZE',
+        'type': int,
+        'default': None,
+        },
+    {
+        'ome_config_value': 'omero.biobank.messages_queue.flush_interval',
+        'kb_config_value': 'MESSAGES_QUEUE_ENGINE_FLUSH_INTERVAL',
+        'type': float,
+        'default': None,
+        },
+    {
+        'ome_config_value': 'omero.biobank.messages_queue.spool_file',
+        'kb_config_value': 'MESSAGES_QUEUE_ENGINE_SPOOL_FILE',
+        'type': str,
+        'default': None,
         }
     ]
 
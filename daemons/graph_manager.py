@@ -1,9 +1,9 @@
 from bl.vl.kb.messages import get_events_consumer, MessagesEngineAuthenticationError, \
     MessageEngineConnectionError
 from bl.vl.graph import build_driver
-from bl.vl.graph.errors import MissingEdgeError, GraphAuthenticationError, \
-    GraphConnectionError
+from bl.vl.graph.errors import GraphAuthenticationError
 from bl.vl.kb.events import decode_event, InvalidMessageError
+from bl.vl.graph.batch import EventsBatch, BATCH_SIZE, FLUSH_INTERVAL
 import sys
 import logging
 import argparse
@@ -18,7 +18,8 @@ class GraphManagerDaemon(object):
     LOG_MAX_SIZE = 100*1024*1024
     LOG_BACKUP_COUNT = 3
 
-    def __init__(self, log_file, log_level, pid_file):
+    def __init__(self, log_file, log_level, pid_file, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, prefetch_count=None):
         self.actions_mapping = {
             'NODE_CREATE': self.create_node,
             'EDGE_CREATE': self.create_edge,
@@ -34,14 +35,30 @@ class GraphManagerDaemon(object):
         else:
             self.logger = self.__get_logger(log_file, log_level)
         self.pid_file = pid_file
+        self.flush_interval = flush_interval
+        self.flush_scheduled = False
+        self.channel = None
 
         try:
             self.messages_consumer = get_events_consumer(self.logger, self.consume_message,
-                                                         self.destroy_pid)
+                                                         self.destroy_pid,
+                                                         prefetch_count or batch_size)
             self.graph_driver = build_driver()
         except GraphAuthenticationError, gr_auth_error:
             self.logger.critical(gr_auth_error.message)
             sys.exit(gr_auth_error.message)
+        self.batch = EventsBatch(self.actions_mapping, self.get_bulk_actions(),
+                                 self.logger, batch_size)
+
+    def get_bulk_actions(self):
+        bulk_actions = {}
+        if hasattr(self.graph_driver, 'save_nodes'):
+            bulk_actions['NODE_CREATE'] = self.create_nodes
+        if hasattr(self.graph_driver, 'save_edges'):
+            bulk_actions['EDGE_CREATE'] = self.create_edges
+        if hasattr(self.graph_driver, 'save_collection_items'):
+            bulk_actions['COLLECTION_ITEM_CREATE'] = self.create_collection_items
+        return bulk_actions
 
     def check_pid_file(self):
         if os.path.isfile(self.pid_file):
@@ -76,21 +93,25 @@ class GraphManagerDaemon(object):
             self.logger.error('Invalid message %r, removing from queue' % body)
             channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
             return
-        self.logger.debug('Processing message %r' % event.data)
-        try:
-            self.actions_mapping[event.data['action']](event.data)
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-        except MissingEdgeError:
-            # In Neo4J, if one of the nodes connected by an edge is deleted, the edge is automatically
-            # deleted as well. Log the event as warning, send an ack and continue
-            self.logger.warning('Unable to find edge for message %r, sending ack for message' % event.data)
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-        except GraphConnectionError, gre:
-            self.logger.error(gre.message)
-            channel.basic_nack(delivery_tag=method.delivery_tag)
-        except Exception, e:
-            self.logger.exception(e)
-            channel.basic_nack(delivery_tag=method.delivery_tag)
+        self.logger.debug('Buffering message %r' % event.data)
+        self.channel = channel
+        if self.batch.add(method.delivery_tag, event.data, properties.headers):
+            self.flush()
+        elif not self.flush_scheduled:
+            self.messages_consumer.add_timeout(self.flush_interval, self.timed_flush)
+            self.flush_scheduled = True
+
+    def flush(self):
+        if len(self.batch):
+            self.batch.flush(self.channel)
+            self.logger.debug('Batch stats: %r' % self.batch.stats)
+            watermarks = self.batch.pop_watermarks()
+            if watermarks:
+                self.messages_consumer.publish_watermarks(watermarks)
+
+    def timed_flush(self):
+        self.flush_scheduled = False
+        self.flush()
 
     def start_consume(self):
         self.create_pid()
@@ -115,6 +136,20 @@ class GraphManagerDaemon(object):
                                           msg['dest_node'])
         self.logger.info('Saved new edge, assigned ID is %d' % eid)
 
+    def create_nodes(self, msgs):
+        nids = self.graph_driver.save_nodes([m['details'] for m in msgs])
+        self.logger.info('Saved %d new nodes' % len(nids))
+
+    def create_edges(self, msgs):
+        eids = self.graph_driver.save_edges([(m['details'], m['source_node'],
+                                              m['dest_node']) for m in msgs])
+        self.logger.info('Saved %d new edges' % len(eids))
+
+    def create_collection_items(self, msgs):
+        eids = self.graph_driver.save_collection_items(
+            [(m['item_node'], m['collection_node']) for m in msgs])
+        self.logger.info('Saved %d new collection item edges' % len(eids))
+
     def create_collection_item(self, msg):
         eid = self.graph_driver.save_collection_item(msg['item_node'],
                                                      msg['collection_node'])
@@ -143,13 +178,22 @@ def make_parser():
                         default='INFO')
     parser.add_argument('--pid-file', type=str, help='PID file',
                         default='graph_manager.pid')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='number of messages applied to the graph in a single batch')
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help='max number of seconds a message waits in a partial batch')
+    parser.add_argument('--prefetch', type=int,
+                        help='number of unacknowledged messages delivered by the '
+                             'broker (default: batch size)')
     return parser
 
 
 def main(argv):
     parser = make_parser()
     args = parser.parse_args(argv)
-    daemon = GraphManagerDaemon(args.logfile, args.loglevel, args.pid_file)
+    daemon = GraphManagerDaemon(args.logfile, args.loglevel, args.pid_file,
+                                args.batch_size, args.flush_interval,
+                                args.prefetch)
     daemon.check_pid_file()
     daemon.start_consume()
 
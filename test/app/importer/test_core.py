@@ -1,8 +1,8 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import unittest, copy
-from itertools import izip
+import os, unittest, copy, tempfile, shutil, time, threading, random
+from itertools import izip, count
 
 import bl.vl.app.importer.core as core
 
@@ -51,10 +51,355 @@ class TestRecordCanonizer(unittest.TestCase):
         self.assertEqual(r1[f], r2[f])
 
 
+class Report(object):
+
+  def __init__(self):
+    self.rows = []
+
+  def writerow(self, r):
+    self.rows.append(r)
+
+
+class TestChunkPipeline(unittest.TestCase):
+
+  def setUp(self):
+    self.saved = []
+    self.report = Report()
+    self.seen = core.SpillableKeySet(max_keys=4)
+
+  def tearDown(self):
+    self.seen.close()
+
+  def check(self, chunk, offset):
+    good, bad = [], []
+    for i, r in enumerate(chunk, offset):
+      if r['label'] in self.seen:
+        r = copy.deepcopy(r)
+        r['error'] = 'duplicate label in row %d' % i
+        bad.append(r)
+      else:
+        self.seen.add(r['label'])
+        good.append(r)
+    return good, bad
+
+  def records(self, labels):
+    return ({'label': l} for l in labels)
+
+  def pipeline(self, blocking=False):
+    return core.ChunkPipeline(self.check, self.saved.append, self.report, 3,
+                              blocking_validation=blocking)
+
+  def test_records_by_chunk(self):
+    chunks = list(core.records_by_chunk(3, xrange(8)))
+    self.assertEqual(chunks, [[0, 1, 2], [3, 4, 5], [6, 7]])
+    self.assertEqual(list(core.records_by_chunk(3, [])), [])
+
+  def test_key_set(self):
+    for i in xrange(10):
+      self.seen.add(('A', 'L%d' % i))
+    self.assertEqual(len(self.seen), 10)
+    self.assertTrue(self.seen.n_spilled > 0)
+    for i in xrange(10):
+      self.assertTrue(('A', 'L%d' % i) in self.seen)
+    self.assertFalse(('A', 'L10') in self.seen)
+
+  def test_run(self):
+    labels = ['L%d' % i for i in xrange(10)] + ['L2', 'L10']
+    stats = self.pipeline().run(self.records(labels))
+    self.assertEqual(stats, {'records': 12, 'good': 11, 'bad': 1,
+                             'chunks': 4})
+    self.assertEqual([len(c) for c in self.saved], [3, 3, 3, 2])
+    self.assertEqual([r['label'] for c in self.saved for r in c],
+                     labels[:10] + ['L10'])
+    self.assertEqual(self.report.rows,
+                     [{'label': 'L2', 'error': 'duplicate label in row 10'}])
+
+  def test_blocking(self):
+    labels = ['L0', 'L1', 'L2', 'L3', 'L1']
+    self.assertRaises(core.ImporterValidationError,
+                      self.pipeline(True).run, self.records(labels))
+    self.assertEqual(self.saved, [])
+    self.assertEqual(len(self.report.rows), 1)
+    self.seen.close()
+    self.seen = core.SpillableKeySet()
+    stats = self.pipeline(True).run(self.records(labels[:4]))
+    self.assertEqual(stats['good'], 4)
+    self.assertEqual([len(c) for c in self.saved], [3, 1])
+
+  def test_errors(self):
+    self.assertRaises(core.ImporterValidationError, self.pipeline().run, [])
+    def broken():
+      for i in count():
+        if i == 5:
+          raise ValueError('bad input')
+        yield {'label': 'L%d' % i}
+    self.assertRaises(ValueError, self.pipeline().run, broken())
+    self.assertEqual(len(self.saved), 1)
+
+
+class Worker(object):
+
+  def __init__(self, log):
+    self.log = log
+
+  def save(self, chunk, out):
+    time.sleep(random.random() * 0.01)
+    for r in chunk:
+      if r['label'] == 'BAD':
+        raise ValueError('bad record')
+      self.log.append((r['key'], r['label']))
+      out.writerow({'label': r['label'], 'worker': id(self)})
+
+
+class TestChunkExecutor(unittest.TestCase):
+
+  def setUp(self):
+    self.log = []
+    self.out = Report()
+    self.workers = [Worker(self.log) for _ in xrange(4)]
+
+  def executor(self, **kwargs):
+    return core.ChunkExecutor(self.workers, lambda w, c, out: w.save(c, out),
+                              self.out, **kwargs)
+
+  def chunks(self, n, size=3):
+    return [[{'key': 'K%d' % ((i * size + j) % 5),
+              'label': 'L%d' % (i * size + j)} for j in xrange(size)]
+            for i in xrange(n)]
+
+  def test_ordered_output(self):
+    ex = self.executor()
+    chunks = self.chunks(20)
+    for c in chunks:
+      ex.submit(c)
+    ex.join()
+    self.assertEqual([r['label'] for r in self.out.rows],
+                     [r['label'] for c in chunks for r in c])
+    self.assertTrue(len(set(r['worker'] for r in self.out.rows)) > 1)
+
+  def test_keys(self):
+    ex = self.executor(chunk_keys=lambda c: [r['key'] for r in c])
+    chunks = self.chunks(20)
+    for c in chunks:
+      ex.submit(c)
+    ex.join()
+    for k in ('K%d' % i for i in xrange(5)):
+      labels = [l for key, l in self.log if key == k]
+      expected = [r['label'] for c in chunks for r in c if r['key'] == k]
+      self.assertEqual(labels, expected)
+
+  def test_error(self):
+    ex = self.executor(max_pending=2)
+    chunks = self.chunks(10)
+    chunks[3][1]['label'] = 'BAD'
+    def run():
+      try:
+        for c in chunks:
+          ex.submit(c)
+        ex.join()
+      finally:
+        ex.close()
+    self.assertRaises(ValueError, run)
+    labels = [r['label'] for r in self.out.rows]
+    self.assertFalse('BAD' in labels)
+    expected = [r['label'] for c in chunks for r in c]
+    self.assertEqual(labels[:9], expected[:9])
+    self.assertEqual(labels, sorted(labels, key=expected.index))
+
+
+class FakeOmeObj(object):
+
+  def __init__(self, id_=None):
+    self.id = id_
+    self.unloaded = 0
+
+  def unload(self):
+    self.unloaded += 1
+
+
+class FakeRType(object):
+
+  def __init__(self, val):
+    self._val = val
+
+
+class FakeObject(object):
+
+  def __init__(self, conf=None):
+    self.conf = conf
+    self.ome_obj = FakeOmeObj()
+
+  def unload(self):
+    self.ome_obj.unload()
+
+
+class FakeFactory(object):
+
+  def create(self, klass, conf):
+    return klass(conf)
+
+
+class FakeActionKB(object):
+
+  def __init__(self):
+    self.factory = FakeFactory()
+    self.saved = []
+    self.ids = count(1)
+    self.devices = []
+
+  def save_array(self, objs):
+    assert len(set(map(id, objs))) == len(objs)
+    for o in objs:
+      o.ome_obj.id = FakeRType(self.ids.next())
+    self.saved.append(len(objs))
+
+  def get_device(self, label):
+    self.devices.append(label)
+    return None
+
+  def create_device(self, label, maker, model, release):
+    o = FakeObject()
+    o.ome_obj.id = FakeRType(self.ids.next())
+    return o
+
+
+class TestActionFactory(unittest.TestCase):
+
+  def setUp(self):
+    self.kb = FakeActionKB()
+    self.setup, self.device, self.study = [
+      FakeObject() for _ in xrange(3)
+      ]
+    self.kb.save_array([self.setup, self.device, self.study])
+    self.sources = [FakeObject() for _ in xrange(3)]
+    self.kb.save_array(self.sources)
+
+  def create_all(self, f):
+    return [f.create(FakeObject, self.setup, self.device, 'IMPORT',
+                     self.study, self.sources[i % 3] if i % 2 else None)
+            for i in xrange(10)]
+
+  def test_not_shared(self):
+    f = core.ActionFactory(self.kb, 'op', batch_size=4)
+    actions = self.create_all(f)
+    self.assertEqual(len(set(map(id, actions))), 10)
+    self.assertEqual(f.save(), actions)
+    self.assertEqual(self.kb.saved[-3:], [4, 4, 2])
+
+  def test_shared(self):
+    f = core.ActionFactory(self.kb, 'op', shared=True)
+    actions = self.create_all(f)
+    # one action without a target, one for each source
+    self.assertEqual(len(set(map(id, actions))), 4)
+    self.assertTrue(actions[1] is actions[7])
+    self.assertFalse(actions[1] is actions[3])
+    self.assertEqual(f.stats, {'requested': 10, 'created': 4})
+    saved = f.save(unload=True)
+    self.assertEqual(len(saved), 4)
+    self.assertEqual([a.ome_obj.unloaded for a in saved], [1, 1, 1, 1])
+    # actions are not shared across saves
+    self.assertFalse(self.create_all(f)[0] is actions[0])
+
+  def core(self, kb):
+    c = core.Core.__new__(core.Core)
+    c.kb = kb
+    c.lock = threading.RLock()
+    c.logger = core.NullLogger()
+    c.memo = {}
+    return c
+
+  def test_memoized_lookups(self):
+    c = self.core(self.kb)
+    devices = [c.get_device('dev', 'CRS4', 'IMPORT', '0') for _ in xrange(3)]
+    self.assertEqual(self.kb.devices, ['dev'])
+    self.assertTrue(devices[0] is devices[2])
+    # lookups are not shared across importers
+    other_kb = FakeActionKB()
+    other = self.core(other_kb)
+    self.assertFalse(other.get_device('dev', 'CRS4', 'IMPORT', '0') is
+                     devices[0])
+    self.assertEqual(other_kb.devices, ['dev'])
+
+
+class FakeKlass(object):
+
+  @classmethod
+  def get_ome_table(cls):
+    return 'Tube'
+
+
+class FakeKB(object):
+
+  def __init__(self, labels):
+    self.labels = labels
+    self.queries = []
+
+  def get_by_field(self, klass, field_name, values, batch_size=240,
+                   fields=None):
+    self.queries.append(sorted(values))
+    return dict((v, (i, 'V%d' % i)) for i, v in enumerate(self.labels)
+                if v in values)
+
+
+class TestPreload(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.kb = FakeKB(['T%d' % i for i in xrange(10)])
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def core(self, cache=None):
+    c = core.Core.__new__(core.Core)
+    c.kb = self.kb
+    c.logger = core.NullLogger()
+    c.preload_cache = cache and core.PreloadCache(cache, 'test')
+    return c
+
+  def test_preload_by_keys(self):
+    c = self.core()
+    preloaded = {}
+    c.preload_by_keys(FakeKlass, 'label', ['T1', 'T2', 'X', None],
+                      preloaded, fields=['id', 'vid'])
+    self.assertEqual(preloaded, {'T1': (1, 'V1'), 'T2': (2, 'V2')})
+    c.preload_by_keys(FakeKlass, 'label', ['T2', 'T3'], preloaded,
+                      fields=['id', 'vid'])
+    self.assertEqual(self.kb.queries, [['T1', 'T2', 'X'], ['T3']])
+    self.assertEqual(len(preloaded), 3)
+
+  def test_cache(self):
+    path = os.path.join(self.wd, 'cache')
+    c = self.core(path)
+    c.preload_by_keys(FakeKlass, 'label', ['T1', 'X'], {}, ['id', 'vid'])
+    c.close_preload_cache()
+    c = self.core(path)
+    preloaded = {}
+    c.preload_by_keys(FakeKlass, 'label', ['T1', 'X'], preloaded,
+                      ['id', 'vid'])
+    c.close_preload_cache()
+    self.assertEqual(preloaded, {'T1': (1, 'V1')})
+    # missing keys are always looked up
+    self.assertEqual(self.kb.queries, [['T1', 'X'], ['X']])
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestRecordCanonizer('test_canonize'))
   suite.addTest(TestRecordCanonizer('test_canonize_list'))
+  suite.addTest(TestChunkPipeline('test_records_by_chunk'))
+  suite.addTest(TestChunkPipeline('test_key_set'))
+  suite.addTest(TestChunkPipeline('test_run'))
+  suite.addTest(TestChunkPipeline('test_blocking'))
+  suite.addTest(TestChunkPipeline('test_errors'))
+  suite.addTest(TestChunkExecutor('test_ordered_output'))
+  suite.addTest(TestChunkExecutor('test_keys'))
+  suite.addTest(TestChunkExecutor('test_error'))
+  suite.addTest(TestPreload('test_preload_by_keys'))
+  suite.addTest(TestPreload('test_cache'))
+  suite.addTest(TestActionFactory('test_not_shared'))
+  suite.addTest(TestActionFactory('test_shared'))
+  suite.addTest(TestActionFactory('test_memoized_lookups'))
   return suite
 
 
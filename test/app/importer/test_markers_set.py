@@ -0,0 +1,131 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, random
+
+import bl.vl.app.importer.core as core
+from bl.vl.app.importer.markers_set import MarkersSetBuilder, Recorder
+
+
+def make_records(n, seed=0):
+  rnd = random.Random(seed)
+  records = [{
+    'study': 'S', 'ms_label': 'MS', 'maker': 'CRS4', 'model': 'M',
+    'release': 'R', 'label': 'SNP%d' % i, 'mask': 'AC[A/G]GT',
+    'index': i, 'allele_flip': bool(i % 2),
+    } for i in xrange(n)]
+  rnd.shuffle(records)
+  return records
+
+
+class FakeObject(object):
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+  def get_ome_table(self):
+    return 'SNPMarkersSet'
+
+
+class FakeGenomics(object):
+
+  def create_markers_array(self, label, maker, model, release, rows, action):
+    self.rows = list(rows)
+    return FakeObject(label=label, id='V0MSET')
+
+
+class FakeWriter(object):
+
+  def __init__(self):
+    self.rows = []
+
+  def writerow(self, r):
+    self.rows.append(r)
+
+
+class TestMarkersSetBuilder(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def build(self, records):
+    builder = MarkersSetBuilder(run_size=16, tmp_dir=self.wd)
+    for r in records:
+      builder.add(r)
+    return builder
+
+  def test_stream(self):
+    records = make_records(100)
+    records[0]['op_vid'] = 'V0OP'
+    builder = self.build(records)
+    builder.check()
+    rows = list(builder.stream('V0ACTION'))
+    builder.close()
+    self.assertEqual(os.listdir(self.wd), [])
+    self.assertEqual([r['index'] for r in rows], range(100))
+    for r in rows:
+      self.assertEqual(r['label'], 'SNP%d' % r['index'])
+      self.assertEqual(r['permutation'], bool(r['index'] % 2))
+      exp_op_vid = 'V0OP' if r['index'] == records[0]['index'] else 'V0ACTION'
+      self.assertEqual(r['op_vid'], exp_op_vid)
+
+  def test_duplicates(self):
+    for k, v in ('label', 'SNP3'), ('index', 3):
+      records = make_records(100)
+      records[7][k] = v
+      builder = self.build(records)
+      self.assertRaises(ValueError, builder.check)
+      builder.close()
+
+
+class TestRecorder(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.recorder = Recorder.__new__(Recorder)
+    self.recorder.logger = core.NullLogger()
+    self.recorder.kb = FakeObject(genomics=FakeGenomics())
+    self.recorder.find_study = lambda records: FakeObject(label='S')
+    self.recorder.find_action = lambda study: FakeObject(id='V0ACTION')
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_record(self):
+    otsv, rtsv = FakeWriter(), FakeWriter()
+    self.recorder.record(iter(make_records(100)), otsv, rtsv, run_size=16,
+                         tmp_dir=self.wd)
+    rows = self.recorder.kb.genomics.rows
+    self.assertEqual([r['index'] for r in rows], range(100))
+    self.assertEqual(otsv.rows, [{'study': 'S', 'label': 'MS',
+                                  'type': 'SNPMarkersSet', 'vid': 'V0MSET'}])
+    self.assertEqual(rtsv.rows, [])
+    self.assertEqual(os.listdir(self.wd), [])
+
+  def test_inconsistent(self):
+    records = make_records(100)
+    records[5]['maker'] = 'FOO'
+    otsv, rtsv = FakeWriter(), FakeWriter()
+    self.assertRaises(ValueError, self.recorder.record, iter(records), otsv,
+                      rtsv, run_size=16, tmp_dir=self.wd)
+    self.assertEqual(len(rtsv.rows), 1)
+    self.assertEqual(rtsv.rows[0]['error'], 'inconsistent maker')
+    self.assertEqual(otsv.rows, [])
+    self.assertEqual(os.listdir(self.wd), [])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestMarkersSetBuilder('test_stream'))
+  suite.addTest(TestMarkersSetBuilder('test_duplicates'))
+  suite.addTest(TestRecorder('test_record'))
+  suite.addTest(TestRecorder('test_inconsistent'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
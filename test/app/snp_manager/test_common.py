@@ -1,29 +1,30 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import sys, unittest
+import sys, unittest, random
 import bl.vl.app.snp_manager.common as common
 
 
 NOT_CONVERTIBLE = "CAAA[C/G]AATG"
 IN_TOP = "GTAT[A/C]AAAA"
 IN_TOP_RC = 'TTTT[G/T]ATAC'
+PROCESS_MASK_CASES = [
+  (("XYZ", "A", "C"), ("None", False)),
+  (("ACTG[A/C/T]GTGA", "A", "C"), ("None", False)),
+  (("ACTG[A/Z]GTGA", "A", "Z"), ("None", False)),
+  ((NOT_CONVERTIBLE, "C", "G"), (NOT_CONVERTIBLE, False)),
+  ((NOT_CONVERTIBLE, "G", "C"), (NOT_CONVERTIBLE, True)),
+  ((IN_TOP, "A", "C"), (IN_TOP, False)),
+  ((IN_TOP, "C", "A"), (IN_TOP, True)),
+  ((IN_TOP_RC, "G", "T"), (IN_TOP, False)),
+  ((IN_TOP_RC, "T", "G"), (IN_TOP, True)),
+  ]
 
 
 class TestProcessMask(unittest.TestCase):
 
   def setUp(self):
-    self.cases = [
-      (("XYZ", "A", "C"), ("None", False)),
-      (("ACTG[A/C/T]GTGA", "A", "C"), ("None", False)),
-      (("ACTG[A/Z]GTGA", "A", "Z"), ("None", False)),
-      ((NOT_CONVERTIBLE, "C", "G"), (NOT_CONVERTIBLE, False)),
-      ((NOT_CONVERTIBLE, "G", "C"), (NOT_CONVERTIBLE, True)),
-      ((IN_TOP, "A", "C"), (IN_TOP, False)),
-      ((IN_TOP, "C", "A"), (IN_TOP, True)),
-      ((IN_TOP_RC, "G", "T"), (IN_TOP, False)),
-      ((IN_TOP_RC, "T", "G"), (IN_TOP, True)),
-      ]
+    self.cases = PROCESS_MASK_CASES
 
   def runTest(self):
     sys.stderr.write("\n")
@@ -34,9 +35,56 @@ class TestProcessMask(unittest.TestCase):
       sys.stderr.write("%s\n" % (error or "(no error)"))
 
 
+class TestProcessMasks(unittest.TestCase):
+
+  def runTest(self):
+    rnd = random.Random(0)
+    bases = 'ACGT'
+    args = []
+    for _ in xrange(2000):
+      flanks = [''.join(rnd.choice(rnd.choice(['AT', 'CG', bases]))
+                        for _ in xrange(rnd.randint(1, 6))) for _ in 0, 1]
+      alleles = rnd.sample(bases, rnd.choice([2, 2, 2, 3]))
+      allele_a, allele_b = rnd.sample(bases, 2)
+      if rnd.random() < 0.5:
+        allele_a, allele_b = alleles[:2]
+      args.append(("%s[%s]%s" % (flanks[0], "/".join(alleles), flanks[1]),
+                   allele_a, allele_b))
+    args.extend(a for a, _ in PROCESS_MASK_CASES)
+    args.extend([
+      ("acgt[A/G]tcga", "A", "G"),
+      ("ACGN[C/T]NTGA", "T", "C"),
+      ("ACGT[A/G]TCGA\n", "A", "G"),
+      ("ACGT[T/G]TCGA", "-", "AT"),
+      ("ACGT[A/-]TCGA", "A", "-"),
+      ])
+    exp = [common.process_mask(*a) for a in args]
+    records = [("m%d" % i,) + a for i, a in enumerate(args)]
+    for block_size in 1, 7, 5000:
+      res = list(common.process_mask_records(records, block_size=block_size))
+      self.assertEqual(res, [(r[0],) + e for r, e in zip(records, exp)])
+    masks, flips, errors = common.process_masks(*zip(*args))
+    self.assertEqual(masks, [e[0] for e in exp])
+    self.assertEqual(list(flips), [e[1] for e in exp])
+    self.assertEqual(list(errors != 0), [bool(e[2]) for e in exp])
+
+
+class TestBuildIndexKeys(unittest.TestCase):
+
+  def runTest(self):
+    seqs = ["ACGTTGCA", "TTTTAAAC", "GGGGCCCN", "CTAGRYKM"]
+    exp_keys = ["ACGTTGCA", "GTTTAAAA", "GGGGCCCN", "CTAGRYKM"]
+    for s, k in zip(seqs, exp_keys):
+      self.assertEqual(common.build_index_key(s), k)
+    self.assertEqual(common.build_index_keys(seqs), exp_keys)
+    self.assertEqual(common.build_index_keys([]), [])
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestProcessMask("runTest"))
+  suite.addTest(TestProcessMasks("runTest"))
+  suite.addTest(TestBuildIndexKeys("runTest"))
   return suite
 
 
@@ -0,0 +1,53 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest
+from cStringIO import StringIO
+
+from bl.vl.app.snp_manager.common import SeqNameSerializer
+from bl.vl.app.snp_manager.convert_sam import SamReader, write_output, \
+  write_output_parallel, split_sam, read_range, OUTPUT_FORMATS
+
+
+D = os.path.dirname(os.path.abspath(__file__))
+SAM_FN = os.path.join(D, os.pardir, os.pardir, 'tools', 'snp_manager',
+                      'reads.sam')
+
+
+class TestConvertSam(unittest.TestCase):
+
+  def label(self, line):
+    return SeqNameSerializer().deserialize(line.split('\t', 1)[0])[0]
+
+  def test_split(self):
+    with open(SAM_FN) as f:
+      lines = f.read().splitlines()
+    ranges = split_sam(SAM_FN, 7)
+    self.assertTrue(1 < len(ranges) <= 7)
+    self.assertEqual(ranges[0][0], 0)
+    self.assertEqual(ranges[-1][1], os.path.getsize(SAM_FN))
+    parts = [list(read_range(SAM_FN, s, e)) for s, e in ranges]
+    self.assertEqual(sum(parts, []), lines)
+    for p, q in zip(parts, parts[1:]):
+      self.assertNotEqual(self.label(p[-1]), self.label(q[0]))
+
+  def test_parallel(self):
+    for outfmt in OUTPUT_FORMATS:
+      serial, parallel = StringIO(), StringIO()
+      with open(SAM_FN) as f:
+        n = write_output(SamReader(f), serial, 'hg18', outfmt, 125)
+      self.assertEqual(write_output_parallel(SAM_FN, parallel, 'hg18',
+                                             outfmt, 125, 2), n)
+      self.assertEqual(parallel.getvalue(), serial.getvalue())
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestConvertSam('test_split'))
+  suite.addTest(TestConvertSam('test_parallel'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
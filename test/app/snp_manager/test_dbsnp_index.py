@@ -0,0 +1,95 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, shelve, random
+
+from bl.vl.app.snp_manager.dbsnp_index import IndexBuilder, SortedIndex, \
+  open_index, get_many
+
+
+KEY_LEN = 11
+
+
+def random_seq(rnd, n=KEY_LEN):
+  return ''.join(rnd.choice('ACGT') for _ in xrange(n))
+
+
+class TestDbSnpIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    rnd = random.Random(0)
+    keys = [random_seq(rnd) for _ in xrange(200)]
+    self.pairs = [(rnd.choice(keys), 'rs%d|A|5|AC' % i) for i in xrange(500)]
+    self.expected = {}
+    for k, tag in self.pairs:
+      self.expected.setdefault(k, []).append(tag)
+    self.missing = [random_seq(rnd) for _ in xrange(50)]
+    self.missing = [k for k in self.missing if k not in self.expected]
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def build(self, pairs, run_size):
+    fn = os.path.join(self.wd, 'index_%d.db' % run_size)
+    builder = IndexBuilder(fn, run_size=run_size, tmp_dir=self.wd)
+    for k, tag in pairs:
+      builder.add(k, tag)
+    self.assertEqual(builder.close(), len(set(k for k, _ in pairs)))
+    self.assertEqual(os.listdir(self.wd), [os.path.basename(fn)])
+    return fn
+
+  def test_build(self):
+    for run_size in 1000, 64:
+      index = SortedIndex(self.build(self.pairs, run_size))
+      self.assertEqual(len(index), len(self.expected))
+      self.assertEqual(dict(index.iteritems()), self.expected)
+      for k, tags in self.expected.iteritems():
+        self.assertEqual(index[k], tags)
+      for k in self.missing + ['', 'A' * (KEY_LEN + 1)]:
+        self.assertTrue(index.get(k) is None)
+        self.assertFalse(k in index)
+      index.close()
+      os.remove(index.path)
+
+  def test_get_many(self):
+    index = open_index(self.build(self.pairs, 100))
+    keys = self.missing[:5] + sorted(self.expected)[::-7]
+    self.assertEqual(index.get_many(keys, []),
+                     [self.expected.get(k, []) for k in keys])
+    self.assertEqual(index.get_many([]), [])
+    index.close()
+
+  def test_empty(self):
+    index = SortedIndex(self.build([], 10))
+    self.assertEqual(len(index), 0)
+    self.assertTrue(index.get('A' * KEY_LEN) is None)
+    self.assertEqual(list(index.iteritems()), [])
+    index.close()
+
+  def test_shelve(self):
+    fn = os.path.join(self.wd, 'index.shelve')
+    db = shelve.open(fn, 'n')
+    db.update(self.expected)
+    db.close()
+    index = open_index(fn)
+    k = self.pairs[0][0]
+    self.assertEqual(index.get(k), self.expected[k])
+    keys = self.missing[:5] + sorted(self.expected)[::-7]
+    self.assertEqual(get_many(index, keys, []),
+                     [self.expected.get(k, []) for k in keys])
+    index.close()
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestDbSnpIndex('test_build'))
+  suite.addTest(TestDbSnpIndex('test_get_many'))
+  suite.addTest(TestDbSnpIndex('test_empty'))
+  suite.addTest(TestDbSnpIndex('test_shelve'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
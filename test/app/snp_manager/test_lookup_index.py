@@ -0,0 +1,65 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil
+
+from bl.vl.app.snp_manager.common import build_index_key
+from bl.vl.app.snp_manager.dbsnp_index import IndexBuilder, SortedIndex
+from bl.vl.app.snp_manager.lookup_index import lookup_extracted_seqs, \
+  get_lookup_results, build_mask
+
+
+SEQS = [
+  ('M1', 'ACGTAAACC', 'AC'),
+  ('M2', 'TTGCCGTAC', 'AG'),
+  ('M3', 'GGGAATGGA', 'CT'),
+  ('M1', 'CCATGACGT', 'AG'),  # the last result for a label wins
+  ]
+
+
+class TestLookupIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.extracted_fn = os.path.join(self.wd, 'extracted.tsv')
+    with open(self.extracted_fn, 'w') as f:
+      for i, (label, seq, alleles) in enumerate(SEQS):
+        f.write('chr1\t%d\t%d\t%s|A|4|%s\t0\t+\t%s\n' %
+                (i, i + len(seq), label, alleles, seq.lower()))
+    self.index_fn = os.path.join(self.wd, 'index.db')
+    builder = IndexBuilder(self.index_fn, tmp_dir=self.wd)
+    builder.add(build_index_key(SEQS[1][1]), 'rs2|A|4|AG')
+    builder.add(build_index_key(SEQS[3][1]), 'rs1|A|4|AG')
+    builder.add(build_index_key(SEQS[3][1]), 'rs11|A|4|AG')
+    builder.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_lookup(self):
+    index = SortedIndex(self.index_fn)
+    results_fn = os.path.join(self.wd, 'results')
+    for block_size in 1, 2, 10:
+      lookup_extracted_seqs(self.extracted_fn, index, results_fn,
+                            block_size, self.wd)
+      results = SortedIndex(results_fn)
+      found = get_lookup_results(results, ['M1', 'M2', 'M3', 'M4'])
+      results.close()
+      self.assertEqual(found, [
+        (build_mask(SEQS[3][1], 'AG'), ['rs1|A|4|AG', 'rs11|A|4|AG']),
+        (build_mask(SEQS[1][1], 'AG'), ['rs2|A|4|AG']),
+        (build_mask(SEQS[2][1], 'CT'), []),
+        None,
+        ])
+    index.close()
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestLookupIndex('test_lookup'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
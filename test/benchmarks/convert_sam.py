@@ -0,0 +1,130 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+SAM conversion throughput
+=========================
+
+Write a synthetic SAM file with the alignments of N markers (two
+reads per marker, one per allele, as produced by markers_to_fastq and
+BWA), convert it with snp_manager convert_sam using each number of
+processes in ``--processes`` and write throughput as JSON::
+
+  python convert_sam.py -N 1000000 --processes 1 2 4 8
+
+About 5% of the reads are unmapped and 5% have two alignments.
+"""
+
+import os, sys, time, json, random, shutil, tempfile, argparse
+
+from bl.vl.app.snp_manager.common import SeqNameSerializer
+from bl.vl.app.snp_manager.convert_sam import SamReader, write_output, \
+  write_output_parallel, DEFAULT_FLANK_SIZE
+
+
+READ_LEN = 2 * DEFAULT_FLANK_SIZE + 1
+
+
+def write_sam(fn, n, seed):
+  rnd = random.Random(seed)
+  serializer = SeqNameSerializer()
+  seq = ''.join(rnd.choice('ACGT') for _ in xrange(READ_LEN))
+  qual = '~' * READ_LEN
+  n_lines = 0
+  with open(fn, 'w') as f:
+    for c in xrange(1, 23):
+      f.write('@SQ\tSN:chr%d\tLN:250000000\n' % c)
+    for i in xrange(n):
+      chrom = 'chr%d' % rnd.randint(1, 22)
+      pos = rnd.randint(1, 249000000)
+      for allele in 'AB':
+        name = serializer.serialize('SNP%d' % i, allele, DEFAULT_FLANK_SIZE,
+                                    'AG')
+        x = rnd.random()
+        if x < 0.05:
+          hits = [(4, '*', 0, 0, '*', '')]
+        else:
+          hits = [(0, chrom, pos, 37, '%dM' % READ_LEN, '\tNM:i:0')]
+          if x > 0.95:
+            hits.append((16, chrom, pos + 1000, 0, '%dM' % READ_LEN,
+                         '\tNM:i:1'))
+        for flag, tid, p, mapq, cigar, tags in hits:
+          f.write('%s\t%d\t%s\t%d\t%d\t%s\t*\t0\t0\t%s\t%s%s\n' % (
+            name, flag, tid, p, mapq, cigar, seq, qual, tags
+            ))
+          n_lines += 1
+  return n_lines
+
+
+def run(sam_fn, out_fn, processes, repeat):
+  times = []
+  for _ in xrange(repeat):
+    start = time.time()
+    with open(out_fn, 'w') as outf:
+      if processes > 1:
+        write_output_parallel(sam_fn, outf, 'hg18', 'marker_alignment',
+                              DEFAULT_FLANK_SIZE, processes)
+      else:
+        with open(sam_fn) as f:
+          write_output(SamReader(f), outf, 'hg18', 'marker_alignment',
+                       DEFAULT_FLANK_SIZE)
+    times.append(time.time() - start)
+  return times
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='convert_sam benchmark')
+  parser.add_argument('-N', '--markers', type=int, default=200000,
+                      help='number of markers')
+  parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4],
+                      help='numbers of processes to try')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs per number of processes')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  wd = tempfile.mkdtemp(prefix='bl_vl_bench_')
+  try:
+    sam_fn = os.path.join(wd, 'reads.sam')
+    n_lines = write_sam(sam_fn, args.markers, args.seed)
+    results = {
+      'timestamp': time.time(),
+      'params': {
+        'markers': args.markers,
+        'lines': n_lines,
+        'bytes': os.path.getsize(sam_fn),
+        'repeat': args.repeat,
+        },
+      'processes': {},
+      }
+    outputs = {}
+    for p in args.processes:
+      out_fn = os.path.join(wd, 'out_%d.tsv' % p)
+      times = run(sam_fn, out_fn, p, args.repeat)
+      results['processes'][p] = {
+        'times': times,
+        'min': min(times),
+        'lines_per_second': n_lines / min(times),
+        }
+      with open(out_fn) as f:
+        outputs[p] = hash(f.read())
+      sys.stderr.write('%2d processes: %.0f lines/s\n' %
+                       (p, results['processes'][p]['lines_per_second']))
+    assert len(set(outputs.itervalues())) == 1, 'outputs differ'
+  finally:
+    shutil.rmtree(wd)
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
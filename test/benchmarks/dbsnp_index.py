@@ -0,0 +1,143 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+dbSNP index build and lookup
+============================
+
+Build a dbSNP index (see snp_manager build_index) from N synthetic
+(key, tag) records, both as a shelve (as done by older versions of
+build_index) and as a sorted index, then look up M keys (half of
+them missing) one at a time and, for the sorted index, in a single
+batch; write timings and file sizes as JSON::
+
+  python dbsnp_index.py -N 1000000 -M 100000 --key-len 251
+"""
+
+import os, sys, time, json, random, shelve, shutil, tempfile, argparse
+from cPickle import HIGHEST_PROTOCOL as HP
+
+from bl.vl.app.snp_manager.dbsnp_index import IndexBuilder, SortedIndex
+
+
+SYNC_INTERVAL = 10000
+
+
+def make_records(n, key_len, seed):
+  rnd = random.Random(seed)
+  # about 1% of the keys are shared by two records
+  keys = [''.join(rnd.choice('ACGT') for _ in xrange(key_len))
+          for _ in xrange(n - n // 100)]
+  keys.extend(rnd.sample(keys, n // 100))
+  rnd.shuffle(keys)
+  return [(k, 'rs%d|A|%d|AG' % (i, key_len // 2)) for i, k in enumerate(keys)]
+
+
+def build_shelve(records, fn):
+  index = shelve.open(fn, 'n', protocol=HP, writeback=True)
+  for i, (key, tag) in enumerate(records):
+    index.setdefault(key, []).append(tag)
+    if (i + 1) % SYNC_INTERVAL == 0:
+      index.sync()
+  index.close()
+
+
+def build_sorted(records, fn, run_size):
+  builder = IndexBuilder(fn, run_size=run_size, tmp_dir=os.path.dirname(fn))
+  for key, tag in records:
+    builder.add(key, tag)
+  builder.close()
+
+
+def file_size(fn):
+  # dbm backends may add extensions to the shelve file name
+  d, bn = os.path.split(fn)
+  return sum(os.path.getsize(os.path.join(d, n)) for n in os.listdir(d)
+             if n.startswith(bn))
+
+
+def timed(f, *args):
+  start = time.time()
+  res = f(*args)
+  return time.time() - start, res
+
+
+def lookup_one_by_one(index, keys):
+  return sum(1 for k in keys if index.get(k) is not None)
+
+
+def lookup_batch(index, keys):
+  return sum(1 for tags in index.get_many(keys) if tags is not None)
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='dbSNP index benchmark')
+  parser.add_argument('-N', '--records', type=int, default=100000,
+                      help='number of index records')
+  parser.add_argument('-M', '--lookups', type=int, default=10000,
+                      help='number of lookups')
+  parser.add_argument('--key-len', type=int, default=251,
+                      help='key (flanking sequence) length')
+  parser.add_argument('--run-size', type=int, default=1000000,
+                      help='sorted index run size')
+  parser.add_argument('--skip-shelve', action='store_true',
+                      help='do not build the shelve index')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  records = make_records(args.records, args.key_len, args.seed)
+  rnd = random.Random(args.seed + 1)
+  keys = [k for k, _ in rnd.sample(records, args.lookups // 2)]
+  keys.extend(''.join(rnd.choice('ACGT') for _ in xrange(args.key_len))
+              for _ in xrange(args.lookups - len(keys)))
+  rnd.shuffle(keys)
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'records': args.records,
+      'lookups': args.lookups,
+      'key_len': args.key_len,
+      'run_size': args.run_size,
+      },
+    }
+  wd = tempfile.mkdtemp(prefix='bl_vl_bench_')
+  try:
+    if not args.skip_shelve:
+      fn = os.path.join(wd, 'shelve.db')
+      build_time, _ = timed(build_shelve, records, fn)
+      index = shelve.open(fn, 'r')
+      lookup_time, hits = timed(lookup_one_by_one, index, keys)
+      index.close()
+      results['shelve'] = {'build': build_time, 'size': file_size(fn),
+                           'lookup': lookup_time, 'hits': hits}
+    fn = os.path.join(wd, 'sorted.db')
+    build_time, _ = timed(build_sorted, records, fn, args.run_size)
+    index = SortedIndex(fn)
+    lookup_time, hits = timed(lookup_one_by_one, index, keys)
+    batch_time, _ = timed(lookup_batch, index, keys)
+    index.close()
+    results['sorted'] = {'build': build_time, 'size': file_size(fn),
+                         'lookup': lookup_time, 'batch_lookup': batch_time,
+                         'hits': hits}
+  finally:
+    shutil.rmtree(wd)
+  for k in 'shelve', 'sorted':
+    if k in results:
+      sys.stderr.write('%-6s: build %.2fs, lookup %.2fs, %d bytes\n' % (
+        k, results[k]['build'], results[k]['lookup'], results[k]['size']
+        ))
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,667 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+In-process stand-in for an OMERO server.
+
+:class:`FakeClient` mimics the parts of ``omero.client`` used by
+ProxyCore: sessions, the query, update, admin and config services and
+the shared resources (tables) service.  Model objects are kept in
+memory and indexed in a sqlite database, which is used to answer the
+HQL subset issued by Proxy and its adapters::
+
+  [select x] from Klass x
+    [join fetch x.field as y ...]
+    [where x.field[.field...] = :param | 'literal' | number
+       [and x.field in (v1, v2, ...) ...] [and x.id > ...]]
+    [order by x.id]
+
+Paging parameters (offset and limit) are honoured.  Projections
+(``select x.f1, x.f2 from Klass x ...``) can select fields of the root
+object.
+
+Sessions can be used from several threads.  Setting
+``FakeClient.LATENCY`` (in seconds) delays each call to the query and
+update services, to simulate the round trip to a remote server.
+
+Tables are stored as HDF5 files through PyTables, which is what the
+OMERO tables service uses server side, so getWhereList conditions
+have the same syntax.
+
+Use :func:`install` to make ``omero.client`` point to the fake one:
+
+.. code-block:: python
+
+  import fake_omero
+  fake_omero.install()
+  kb = KB(driver='omero')('fake-host', 'root', 'romeo')
+
+The OMERO Python bindings (model classes and rtypes) and PyTables are
+still needed.
+"""
+
+import os, re, copy, json, time, shutil, sqlite3, tempfile, threading
+from functools import wraps
+
+import numpy as np
+import tables
+
+import omero
+import omero.model
+import omero.rtypes as ort
+import omero_Tables_ice
+import omero_SharedResources_ice
+from omero_version import omero_version
+
+
+QUERY_RE = re.compile(
+  r'''^\s*(?:select\s+(?P<select>\w+)\s+)?
+  from\s+(?P<klass>\w+)\s+(?:as\s+)?(?P<alias>\w+)
+  (?P<joins>(?:\s+(?:left\s+(?:outer\s+)?)?join\s+fetch\s+[\w.]+\s+as\s+\w+)*)
+  (?:\s+where\s+(?P<where>.*?))?
+  (?:\s+order\s+by\s+\w+\.id)?\s*$''', re.I | re.S | re.X)
+PROJECTION_RE = re.compile(r'^\s*select\s+(\w+\.\w+(?:\s*,\s*\w+\.\w+)*)\s+'
+                           r'(from\s.*)$', re.I | re.S)
+JOIN_RE = re.compile(r'join\s+fetch\s+(\w+)\.(\w+)\s+as\s+(\w+)', re.I)
+AND_RE = re.compile(r'\s+and\s+', re.I)
+COND_RE = re.compile(r'^\(?\s*([\w.]+)\s*(=|>|in)\s*(.+?)\s*\)?$', re.I | re.S)
+VALUE_RE = re.compile(
+  r"'((?:[^']|'')*)'|\"([^\"]*)\"|:(\w+)|(-?\d+\.\d*)|(-?\d+)|(true|false)",
+  re.I)
+
+SKIPPED_FIELDS = frozenset(['_id', '_details', '_loaded', '_version'])
+
+
+class FakeQueryError(Exception):
+  pass
+
+
+def class_names(ome_obj):
+  names = []
+  for k in type(ome_obj).__mro__:
+    if k is omero.model.IObject:
+      break
+    name = k.__name__[:-1] if k.__name__.endswith('I') else k.__name__
+    if name not in names:
+      names.append(name)
+  return names
+
+
+def unwrap_value(v):
+  if isinstance(v, omero.RType):
+    v = ort.unwrap(v)
+  if isinstance(v, bool):
+    return int(v)
+  if isinstance(v, unicode):
+    return v.encode('utf-8')
+  return v
+
+
+def synchronized(method):
+  @wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.lock:
+      return method(self, *args, **kwargs)
+  return wrapper
+
+
+class FakeDatabase(object):
+  """
+  Object store shared by all sessions opened on the same host.
+  """
+
+  def __init__(self, data_dir=None):
+    self.data_dir = data_dir or tempfile.mkdtemp(prefix='fake_omero_')
+    self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+    self.conn.executescript("""
+    CREATE TABLE klasses (id INTEGER, klass TEXT);
+    CREATE INDEX klasses_idx ON klasses (klass, id);
+    CREATE TABLE fields (id INTEGER, name TEXT, value, ref INTEGER);
+    CREATE INDEX fields_value_idx ON fields (name, value);
+    CREATE INDEX fields_id_idx ON fields (id, name);
+    CREATE INDEX fields_ref_idx ON fields (ref, value);
+    """)
+    self.objects = {}
+    self.next_id = 1
+    self.n_queries = 0
+    self.lock = threading.RLock()
+
+  def close(self):
+    self.conn.close()
+    shutil.rmtree(self.data_dir, ignore_errors=True)
+
+  #-- storage
+
+  @synchronized
+  def save(self, ome_obj):
+    if ome_obj.id is None:
+      ome_obj.id = ort.rlong(self.next_id)
+      self.next_id += 1
+    oid = ome_obj.id.val
+    self.objects[oid] = ome_obj
+    rows = []
+    for k, v in ome_obj.__dict__.items():
+      if not k.startswith('_') or k in SKIPPED_FIELDS or v is None:
+        continue
+      if isinstance(v, omero.model.IObject):
+        if v.id is None:
+          self.save(v)
+        elif v.id.val in self.objects and v is not self.objects[v.id.val]:
+          # keep references pointing to the stored instances
+          if v.isLoaded():
+            setattr(ome_obj, k, self.objects[v.id.val])
+        rows.append((oid, k[1:], v.id.val, 1))
+      elif isinstance(v, omero.RType):
+        rows.append((oid, k[1:], unwrap_value(v), 0))
+    c = self.conn
+    c.execute('DELETE FROM fields WHERE id = ?', (oid,))
+    c.execute('DELETE FROM klasses WHERE id = ?', (oid,))
+    c.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)', rows)
+    c.executemany('INSERT INTO klasses VALUES (?, ?)',
+                  [(oid, n) for n in class_names(ome_obj)])
+    return ome_obj
+
+  @synchronized
+  def delete(self, ome_obj):
+    if ome_obj.id is None or ome_obj.id.val not in self.objects:
+      raise omero.ApiUsageException(message='object is not persistent')
+    oid = ome_obj.id.val
+    refs = self.conn.execute(
+      'SELECT COUNT(*) FROM fields WHERE ref = 1 AND value = ?',
+      (oid,)).fetchone()[0]
+    if refs:
+      raise omero.ValidationException(
+        message='object %d is referenced by %d objects' % (oid, refs))
+    del self.objects[oid]
+    self.conn.execute('DELETE FROM fields WHERE id = ?', (oid,))
+    self.conn.execute('DELETE FROM klasses WHERE id = ?', (oid,))
+
+  @synchronized
+  def get(self, oid):
+    o = self.objects.get(oid)
+    return None if o is None else copy.copy(o)
+
+  #-- queries
+
+  @synchronized
+  def select_ids(self, klass, conditions=(), joins=()):
+    """
+    Return the ids of the objects of class klass that satisfy
+    conditions, a list of (path, values) pairs where path is a list
+    of field names relative to the root object; a (path, '>', value)
+    triple selects objects whose path is greater than value.  joins is a list of
+    paths that must resolve to existing objects.
+    """
+    from_sql, join_args, where, where_args = ['klasses k'], [], [], []
+    counter = [0]
+    def ref(expr, field):
+      counter[0] += 1
+      a = 'j%d' % counter[0]
+      from_sql.append('JOIN fields %s ON %s.id = %s AND %s.name = ?' %
+                      (a, a, expr, a))
+      join_args.append(field)
+      return '%s.value' % a
+    where.append('k.klass = ?')
+    where_args.append(klass)
+    for path in joins:
+      expr = 'k.id'
+      for f in path:
+        expr = ref(expr, f)
+    for cond in conditions:
+      path, values = cond[0], cond[-1]
+      expr = 'k.id'
+      for f in path[:-1]:
+        expr = ref(expr, f)
+      target = expr if path[-1] == 'id' else ref(expr, path[-1])
+      if len(cond) == 3 and cond[1] == '>':
+        where.append('%s > ?' % target)
+        where_args.append(values[0])
+      else:
+        where.append('%s IN (%s)' % (target, ','.join('?' * len(values))))
+        where_args.extend(values)
+    sql = 'SELECT DISTINCT k.id FROM %s WHERE %s ORDER BY k.id' % (
+      ' '.join(from_sql), ' AND '.join(where))
+    self.n_queries += 1
+    return [r[0] for r in self.conn.execute(sql, join_args + where_args)]
+
+  @synchronized
+  def query(self, hql, params):
+    m = QUERY_RE.match(hql)
+    if not m:
+      raise FakeQueryError('unsupported query: %r' % hql)
+    alias = m.group('alias')
+    if m.group('select') and m.group('select') != alias:
+      raise FakeQueryError('can only select the root object: %r' % hql)
+    paths = {alias: []}
+    joins = []
+    for parent, field, a in JOIN_RE.findall(m.group('joins') or ''):
+      paths[a] = paths[parent] + [field]
+      joins.append(paths[a])
+    conditions = []
+    if m.group('where'):
+      for cond in AND_RE.split(m.group('where').strip()):
+        cm = COND_RE.match(cond.strip())
+        if not cm:
+          raise FakeQueryError('unsupported condition: %r' % cond)
+        lhs, op, rhs = cm.groups()
+        lhs = lhs.split('.')
+        if lhs[0] not in paths:
+          raise FakeQueryError('unknown alias %s in %r' % (lhs[0], hql))
+        conditions.append((paths[lhs[0]] + lhs[1:], op,
+                           self.__parse_values(rhs, params)))
+    ids = self.select_ids(m.group('klass'), conditions, joins)
+    page = getattr(params, 'theFilter', None)
+    if page is not None and page.limit is not None:
+      offset = unwrap_value(page.offset) or 0
+      ids = ids[offset:offset + unwrap_value(page.limit)]
+    return [self.get(i) for i in ids]
+
+  @synchronized
+  def projection(self, hql, params):
+    m = PROJECTION_RE.match(hql)
+    if not m:
+      raise FakeQueryError('unsupported projection: %r' % hql)
+    paths = [p.strip().split('.') for p in m.group(1).split(',')]
+    rows = []
+    for o in self.query(m.group(2), params):
+      rows.append([getattr(o, '_%s' % f, None) for _, f in paths])
+    return rows
+
+  @synchronized
+  def find_by_example(self, example):
+    conditions = []
+    for k, v in example.__dict__.items():
+      if (k.startswith('_') and k not in SKIPPED_FIELDS and
+          isinstance(v, omero.RType)):
+        conditions.append(([k[1:]], [unwrap_value(v)]))
+    klass = class_names(example)[0]
+    ids = self.select_ids(klass, conditions)
+    if not ids and hasattr(example, '_value'):
+      # enumerations are pre-loaded by a real server
+      return copy.copy(self.save(copy.copy(example)))
+    return self.get(ids[0]) if ids else None
+
+  @staticmethod
+  def __parse_values(rhs, params):
+    values = []
+    for s1, s2, par, fl, integer, boolean in VALUE_RE.findall(rhs):
+      if par:
+        v = unwrap_value(params.map[par]) if params else None
+        values.extend(v if isinstance(v, list) else [v])
+      elif fl:
+        values.append(float(fl))
+      elif integer:
+        values.append(int(integer))
+      elif boolean:
+        values.append(int(boolean.lower() == 'true'))
+      else:
+        values.append(s1.replace("''", "'") if s1 or not s2 else s2)
+    return values
+
+
+class FakeQueryService(object):
+
+  def __init__(self, db):
+    self.db = db
+
+  def findAllByQuery(self, query, params, ctx=None):
+    return self.db.query(query, params)
+
+  def findByQuery(self, query, params, ctx=None):
+    res = self.db.query(query, params)
+    if len(res) > 1:
+      raise omero.ApiUsageException(
+        message='query returned %d objects' % len(res))
+    return res[0] if res else None
+
+  def find(self, klass, oid, ctx=None):
+    ids = self.db.select_ids(klass, [(['id'], [oid])])
+    return self.db.get(ids[0]) if ids else None
+
+  def get(self, klass, oid, ctx=None):
+    res = self.find(klass, oid)
+    if res is None:
+      raise omero.ValidationException(
+        message='no %s with id %d' % (klass, oid))
+    return res
+
+  def findAllByString(self, klass, field, value, case_sensitive, filter_,
+                      ctx=None):
+    ids = self.db.select_ids(klass, [([field], [value])])
+    return [self.db.get(i) for i in ids]
+
+  def findByString(self, klass, field, value, ctx=None):
+    ids = self.db.select_ids(klass, [([field], [value])])
+    return self.db.get(ids[0]) if ids else None
+
+  def findByExample(self, example, ctx=None):
+    return self.db.find_by_example(example)
+
+  def projection(self, query, params, ctx=None):
+    return self.db.projection(query, params)
+
+
+class FakeUpdateService(object):
+
+  def __init__(self, db):
+    self.db = db
+
+  def saveAndReturnObject(self, obj, ctx=None):
+    return copy.copy(self.db.save(obj))
+
+  def saveObject(self, obj, ctx=None):
+    self.db.save(obj)
+
+  def saveAndReturnArray(self, objs, ctx=None):
+    return [copy.copy(self.db.save(o)) for o in objs]
+
+  def saveArray(self, objs, ctx=None):
+    for o in objs:
+      self.db.save(o)
+
+  def deleteObject(self, obj, ctx=None):
+    self.db.delete(obj)
+
+
+class FakeAdminService(object):
+
+  def lookupGroup(self, name, ctx=None):
+    g = omero.model.ExperimenterGroupI()
+    g.name = ort.rstring(name)
+    return g
+
+
+class FakeConfigService(object):
+
+  def __init__(self, db):
+    self.values = {
+      'omero.version': omero_version,
+      'omero.data.dir': db.data_dir,
+      }
+
+  def getConfigValue(self, key, ctx=None):
+    return self.values.get(key)
+
+
+#-- tables --------------------------------------------------------------------
+
+COLUMN_TYPES = [
+  (omero.grid.LongColumn, lambda c: 'i8'),
+  (omero.grid.DoubleColumn, lambda c: 'f8'),
+  (omero.grid.BoolColumn, lambda c: '?'),
+  (omero.grid.StringColumn, lambda c: 'S%d' % c.size),
+  (omero.grid.FloatArrayColumn, lambda c: ('f4', (c.size,))),
+  (omero.grid.DoubleArrayColumn, lambda c: ('f8', (c.size,))),
+  (omero.grid.LongArrayColumn, lambda c: ('i8', (c.size,))),
+  ]
+
+
+def column_type(col):
+  for i, (klass, dtype) in enumerate(COLUMN_TYPES):
+    if isinstance(col, klass):
+      return i, dtype(col)
+  raise ValueError('unsupported column type %s' % type(col))
+
+
+def make_column(type_index, name, description, size):
+  klass = COLUMN_TYPES[type_index][0]
+  if klass in (omero.grid.LongColumn, omero.grid.DoubleColumn,
+               omero.grid.BoolColumn):
+    return klass(name, description, None)
+  return klass(name, description, size, None)
+
+
+class FakeTableBackend(object):
+  """
+  A PyTables table holding the data of one OMERO table.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.h5 = tables.open_file(path, 'a')
+    self.table = self.h5.root.data if '/data' in self.h5 else None
+
+  def initialize(self, columns):
+    if self.table is not None:
+      raise omero.ApiUsageException(message='table already initialized')
+    meta, dtype = [], []
+    for c in columns:
+      i, t = column_type(c)
+      meta.append((i, c.name, c.description, getattr(c, 'size', None)))
+      dtype.append((c.name,) + (t if isinstance(t, tuple) else (t,)))
+    self.table = self.h5.create_table('/', 'data', np.dtype(dtype))
+    self.table.attrs.omero_columns = json.dumps(meta)
+    self.h5.flush()
+
+  def headers(self):
+    return [make_column(*m)
+            for m in json.loads(self.table.attrs.omero_columns)]
+
+  def to_data(self, records, col_numbers, row_numbers):
+    headers = self.headers()
+    data = omero.grid.Data()
+    data.rowNumbers = list(row_numbers)
+    data.columns = []
+    for i in col_numbers:
+      c = headers[i]
+      v = records[c.name]
+      c.values = list(v) if v.ndim > 1 else v.tolist()
+      data.columns.append(c)
+    return data
+
+  def from_columns(self, columns):
+    n = len(columns[0].values)
+    records = np.zeros(n, dtype=self.table.dtype)
+    for c in columns:
+      records[c.name] = c.values
+    return records
+
+  def close(self):
+    self.h5.close()
+
+
+class FakeTable(object):
+
+  def __init__(self, backend, ofile):
+    self.backend = backend
+    self.ofile = ofile
+
+  def __table(self):
+    if self.backend.table is None:
+      raise omero.ApiUsageException(message='table not initialized')
+    return self.backend.table
+
+  def initialize(self, columns, ctx=None):
+    self.backend.initialize(columns)
+
+  def getOriginalFile(self, ctx=None):
+    return self.ofile
+
+  def getHeaders(self, ctx=None):
+    return self.backend.headers()
+
+  def getNumberOfRows(self, ctx=None):
+    return self.__table().nrows
+
+  def addData(self, columns, ctx=None):
+    t = self.__table()
+    t.append(self.backend.from_columns(columns))
+    t.flush()
+
+  def read(self, col_numbers, start, stop, ctx=None):
+    t = self.__table()
+    stop = min(stop, t.nrows)
+    return self.backend.to_data(t.read(start, stop), col_numbers,
+                                xrange(start, stop))
+
+  def readCoordinates(self, row_numbers, ctx=None):
+    t = self.__table()
+    return self.backend.to_data(t.read_coordinates(row_numbers),
+                                range(len(t.colnames)), row_numbers)
+
+  def slice(self, col_numbers, row_numbers, ctx=None):
+    t = self.__table()
+    if not row_numbers:
+      row_numbers = range(t.nrows)
+    return self.backend.to_data(t.read_coordinates(row_numbers),
+                                col_numbers, row_numbers)
+
+  def getWhereList(self, condition, variables, start, stop, step, ctx=None):
+    t = self.__table()
+    return t.get_where_list(condition, variables or None, start=start,
+                            stop=stop, step=step or None).tolist()
+
+  def update(self, data, ctx=None):
+    t = self.__table()
+    t.modify_coordinates(data.rowNumbers,
+                         self.backend.from_columns(data.columns))
+    t.flush()
+
+  def close(self, ctx=None):
+    pass
+
+
+class FakeRepositories(object):
+
+  def __init__(self, db):
+    repo = omero.model.OriginalFileI()
+    repo.id = ort.rlong(0)
+    repo.name = ort.rstring('fake-repository')
+    self.descriptions = [repo]
+
+
+class FakeSharedResources(object):
+
+  def __init__(self, db, backends):
+    self.db = db
+    self.backends = backends
+
+  def repositories(self, ctx=None):
+    return FakeRepositories(self.db)
+
+  def __backend(self, ofile):
+    oid = ofile.id.val
+    if oid not in self.backends:
+      path = os.path.join(self.db.data_dir, '%d.h5' % oid)
+      self.backends[oid] = FakeTableBackend(path)
+    return self.backends[oid]
+
+  def newTable(self, repo_id, name, ctx=None):
+    ofile = omero.model.OriginalFileI()
+    ofile.name = ort.rstring(name)
+    ofile.path = ort.rstring(self.db.data_dir)
+    ofile.mimetype = ort.rstring('OMERO.tables')
+    ofile = copy.copy(self.db.save(ofile))
+    return FakeTable(self.__backend(ofile), ofile)
+
+  def openTable(self, ofile, ctx=None):
+    if ofile is None or ofile.id.val not in self.db.objects:
+      return None
+    return FakeTable(self.__backend(ofile), ofile)
+
+
+#-- sessions ------------------------------------------------------------------
+
+class Remote(object):
+  """
+  Delay each call to the wrapped service by latency seconds.
+  """
+
+  def __init__(self, service, latency):
+    self.service = service
+    self.latency = latency
+
+  def __getattr__(self, name):
+    attr = getattr(self.service, name)
+    if not self.latency or not callable(attr):
+      return attr
+    def call(*args, **kwargs):
+      time.sleep(self.latency)
+      return attr(*args, **kwargs)
+    return call
+
+
+class FakeSession(object):
+
+  def __init__(self, client):
+    self.client = client
+    self.db = client.db
+
+  def getQueryService(self):
+    return Remote(FakeQueryService(self.db), self.client.LATENCY)
+
+  def getUpdateService(self):
+    return Remote(FakeUpdateService(self.db), self.client.LATENCY)
+
+  def getAdminService(self):
+    return FakeAdminService()
+
+  def getConfigService(self):
+    return FakeConfigService(self.db)
+
+  def setSecurityContext(self, ctx):
+    pass
+
+  def sharedResources(self):
+    return FakeSharedResources(self.db, self.client.backends)
+
+
+class FakeClient(object):
+  """
+  Drop-in replacement for omero.client.  All clients created for the
+  same host share the same data.
+  """
+
+  DATABASES = {}
+  BACKENDS = {}
+  LATENCY = 0.0
+
+  def __init__(self, host='localhost', *args, **kwargs):
+    self.host = host
+    if host not in self.DATABASES:
+      self.DATABASES[host] = FakeDatabase()
+      self.BACKENDS[host] = {}
+    self.db = self.DATABASES[host]
+    self.backends = self.BACKENDS[host]
+    self.n_sessions = 0
+
+  def createSession(self, user=None, passwd=None):
+    self.n_sessions += 1
+    return FakeSession(self)
+
+  def closeSession(self):
+    pass
+
+  def enableKeepAlive(self, timeout):
+    pass
+
+  def startKeepAlive(self):
+    pass
+
+  def stopKeepAlive(self):
+    pass
+
+  @classmethod
+  def reset(cls, host=None):
+    """
+    Drop all data stored for host (all hosts if None).
+    """
+    hosts = [host] if host else cls.DATABASES.keys()
+    for h in hosts:
+      for b in cls.BACKENDS.pop(h, {}).itervalues():
+        b.close()
+      db = cls.DATABASES.pop(h, None)
+      if db:
+        db.close()
+
+
+_REAL_CLIENT = omero.client
+
+
+def install():
+  omero.client = FakeClient
+
+
+def uninstall():
+  omero.client = _REAL_CLIENT
+  FakeClient.reset()
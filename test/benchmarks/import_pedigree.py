@@ -0,0 +1,129 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Pedigree import scheduling
+==========================
+
+Build synthetic multi-generation pedigrees and time the scheduling
+of their import, i.e., finding an order in which parents are saved
+before their children, and write timings as JSON::
+
+  python import_pedigree.py -N 10000 --generations 5 10 20 \\
+    --batch-size 1000
+
+Each individual in generation k gets a father and a mother from
+random earlier generations (at least one of them from generation
+k-1), so generations have different sizes and parents are spread
+across many levels.  Two schedulers are compared:
+
+* ``filter``: repeatedly scan the remaining individuals for those
+  whose parents have all been saved (one wave per scan)
+* ``kahn``: :func:`bl.vl.individual.pedigree.schedule`
+
+For each one, the number of batches (i.e., of save_array calls made
+by the individual importer) is also reported.
+"""
+
+import sys, time, json, random, argparse
+
+from bl.vl.individual import IndividualStub as Individual
+from bl.vl.individual.pedigree import schedule
+
+
+def make_pedigree(n, n_generations, seed=None):
+  rnd = random.Random(seed)
+  size = max(1, n // n_generations)
+  gens = []
+  for g in xrange(n_generations):
+    gen = []
+    for k in xrange(size):
+      father = mother = None
+      if g:
+        father = rnd.choice(gens[-1])
+        mother = rnd.choice(gens[rnd.randint(0, g - 1)])
+      gen.append(Individual('I%d_%d' % (g, k), rnd.choice(['male', 'female']),
+                            father, mother))
+    gens.append(gen)
+  family = [i for gen in gens for i in gen]
+  rnd.shuffle(family)
+  return family
+
+
+def filter_schedule(family, batch_size):
+  saved = set()
+  remaining = list(family)
+  while remaining:
+    wave = [i for i in remaining
+            if (i.father is None or i.father in saved) and
+               (i.mother is None or i.mother in saved)]
+    wave_set = set(wave)
+    remaining = [i for i in remaining if i not in wave_set]
+    for start in xrange(0, len(wave), batch_size):
+      yield wave[start:start+batch_size]
+    saved.update(wave)
+
+
+def kahn_schedule(family, batch_size):
+  for _, batch in schedule(family, batch_size):
+    yield batch
+
+
+SCHEDULERS = [('filter', filter_schedule), ('kahn', kahn_schedule)]
+
+
+def run(family, scheduler, batch_size, repeat):
+  times = []
+  for _ in xrange(repeat):
+    start = time.time()
+    n_batches = sum(1 for _ in scheduler(family, batch_size))
+    times.append(time.time() - start)
+  return {'times': times, 'min': min(times),
+          'mean': sum(times) / len(times), 'batches': n_batches}
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='pedigree import scheduling '
+                                   'benchmark')
+  parser.add_argument('-N', '--individuals', type=int, metavar='N',
+                      default=10000, help='number of individuals')
+  parser.add_argument('--generations', type=int, nargs='+',
+                      default=[5, 10, 20], help='numbers of generations')
+  parser.add_argument('--batch-size', type=int, default=1000,
+                      help='max individuals per save_array call')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs per configuration')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'individuals': args.individuals,
+      'batch_size': args.batch_size,
+      'repeat': args.repeat,
+      },
+    'generations': {},
+    }
+  for g in args.generations:
+    family = make_pedigree(args.individuals, g, args.seed)
+    res = results['generations'][g] = {}
+    for name, scheduler in SCHEDULERS:
+      res[name] = run(family, scheduler, args.batch_size, args.repeat)
+      sys.stderr.write('%3d generations, %-6s: min %.4fs, %d batches\n' %
+                       (g, name, res[name]['min'], res[name]['batches']))
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
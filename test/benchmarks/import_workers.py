@@ -0,0 +1,124 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Concurrent importer chunks
+==========================
+
+Save N individuals in chunks of ``--batch-size`` records with the
+importer's ChunkExecutor, for each number of workers in ``--workers``
+(each worker has its own session on the fake OMERO server), and write
+timings as JSON::
+
+  python import_workers.py -N 2000 --batch-size 100 --latency 5 \\
+    --workers 1 2 4 8
+
+``--latency`` (in milliseconds) is added to each call to the query
+and update services, to simulate a remote server: with no latency,
+all work is done in-process and workers only compete for the GIL.
+"""
+
+import sys, time, json, argparse
+
+import fake_omero
+from run_benchmarks import HOST, USER, PASSWD, Fixture, connect
+
+from bl.vl.kb import KnowledgeBase as KB
+from bl.vl.app.importer.core import ChunkExecutor, records_by_chunk
+
+
+class Worker(object):
+
+  def __init__(self, action):
+    self.kb = KB(driver='omero')(HOST, USER, PASSWD)
+    self.action = action
+
+  def save_chunk(self, chunk, out):
+    kb = self.kb
+    inds = [kb.factory.create(kb.Individual, {
+      'gender': kb.Gender.MALE if r % 2 else kb.Gender.FEMALE,
+      'action': self.action,
+      }) for r in chunk]
+    kb.save_array(inds)
+    for r, i in zip(chunk, inds):
+      out.writerow({'label': r, 'vid': i.id})
+
+
+class Output(object):
+
+  def __init__(self):
+    self.rows = []
+
+  def writerow(self, row):
+    self.rows.append(row)
+
+
+def run(args, n_workers):
+  times = []
+  for _ in xrange(args.repeat):
+    kb = connect()
+    fx = Fixture(kb, args.individuals, 0, 0)
+    workers = [Worker(fx.action) for _ in xrange(n_workers)]
+    out = Output()
+    executor = ChunkExecutor(workers, lambda w, c, o: w.save_chunk(c, o), out)
+    start = time.time()
+    for c in records_by_chunk(args.batch_size, xrange(args.individuals)):
+      executor.submit(c)
+    executor.join()
+    times.append(time.time() - start)
+    assert [r['label'] for r in out.rows] == range(args.individuals)
+    kb.disconnect()
+  sys.stderr.write('%2d workers: min %.4fs mean %.4fs\n' %
+                   (n_workers, min(times), sum(times) / len(times)))
+  return {'times': times, 'min': min(times),
+          'mean': sum(times) / len(times)}
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='importer workers benchmark')
+  parser.add_argument('-N', '--individuals', type=int, metavar='N',
+                      default=2000, help='number of individuals')
+  parser.add_argument('--batch-size', type=int, default=100,
+                      help='records per chunk')
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                      help='numbers of workers to try')
+  parser.add_argument('--latency', type=float, default=5.0,
+                      help='simulated latency (ms) per service call')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs per number of workers')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  fake_omero.FakeClient.LATENCY = args.latency / 1000.
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'individuals': args.individuals,
+      'batch_size': args.batch_size,
+      'latency': args.latency,
+      'repeat': args.repeat,
+      },
+    'workers': {},
+    }
+  try:
+    for n in args.workers:
+      results['workers'][n] = run(args, n)
+  finally:
+    fake_omero.uninstall()
+  base = results['workers'][args.workers[0]]['min']
+  for n in args.workers:
+    results['workers'][n]['speedup'] = base / results['workers'][n]['min']
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,99 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Mask processing throughput
+==========================
+
+Process N random SNP masks (as done by snp_manager convert_affy,
+convert_ill and convert_dbsnp) one at a time with process_mask and in
+blocks with process_mask_records, check that results are the same and
+write timings as JSON::
+
+  python process_masks.py -N 1000000 --flank-size 100
+
+A fraction of the masks (``--low-complexity``) has flanks made of a
+single base pair (A/T or C/G), whose strand is decided late or not at
+all.
+"""
+
+import sys, time, json, random, argparse
+
+from bl.vl.app.snp_manager.common import process_mask, process_mask_records, \
+  MASK_BLOCK_SIZE
+
+
+def make_records(n, flank_size, low_complexity, seed):
+  rnd = random.Random(seed)
+  records = []
+  for i in xrange(n):
+    bases = rnd.choice(['AT', 'CG']) if rnd.random() < low_complexity \
+            else 'ACGT'
+    lflank, rflank = [''.join(rnd.choice(bases) for _ in xrange(flank_size))
+                      for _ in 0, 1]
+    alleles = sorted(rnd.sample('ACGT', 2))
+    mask = '%s[%s]%s' % (lflank, '/'.join(alleles), rflank)
+    if rnd.random() < 0.5:
+      alleles.reverse()
+    records.append(('SNP%d' % i, mask, alleles[0], alleles[1]))
+  return records
+
+
+def run_scalar(records):
+  return [(r[0],) + process_mask(*r[1:]) for r in records]
+
+
+def run_blocks(records, block_size):
+  return list(process_mask_records(records, block_size=block_size))
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='process_mask benchmark')
+  parser.add_argument('-N', '--masks', type=int, default=100000,
+                      help='number of masks')
+  parser.add_argument('--flank-size', type=int, default=100,
+                      help='flank size')
+  parser.add_argument('--low-complexity', type=float, default=0.2,
+                      help='fraction of masks with low complexity flanks')
+  parser.add_argument('--block-size', type=int, default=MASK_BLOCK_SIZE,
+                      help='masks per block')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  records = make_records(args.masks, args.flank_size, args.low_complexity,
+                         args.seed)
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'masks': args.masks,
+      'flank_size': args.flank_size,
+      'low_complexity': args.low_complexity,
+      'block_size': args.block_size,
+      },
+    }
+  start = time.time()
+  scalar = run_scalar(records)
+  results['scalar'] = time.time() - start
+  start = time.time()
+  blocks = run_blocks(records, args.block_size)
+  results['blocks'] = time.time() - start
+  assert blocks == scalar, 'results differ'
+  results['errors'] = sum(1 for r in scalar if r[-1])
+  sys.stderr.write('scalar: %.2fs, blocks: %.2fs\n' % (
+    results['scalar'], results['blocks']
+    ))
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
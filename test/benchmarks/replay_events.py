@@ -0,0 +1,226 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Replay a recorded graph events log
+==================================
+
+Apply the events stored in a log file to a graph driver, first one
+message at a time (as the graph_manager daemon used to do) and then
+in batches, and write timings as JSON::
+
+  python replay_events.py -i events.log --batch-size 500 --latency 2
+
+Log files have one JSON-encoded [routing_key, body, ...] list per
+line, which is also the format of the EventsSender spool file, so the
+spool of a sender configured with an unreachable broker can be used
+as a recording.  With ``--generate N`` a synthetic log is written instead,
+mimicking the events sent by a save_array of N objects produced by a
+single action.
+
+By default events are applied to an in-memory graph that sleeps
+``--latency`` milliseconds per driver call, to simulate a round trip
+to a remote server; with ``--driver neo4j`` the configured Neo4j
+server is used (and modified!).
+"""
+
+import sys, time, json, random, argparse
+
+from bl.vl.graph.batch import EventsBatch, BATCH_SIZE
+from bl.vl.graph.errors import MissingNodeError
+
+
+class ReplayChannel(object):
+
+  def __init__(self):
+    self.acks = 0
+    self.nacks = 0
+
+  def basic_ack(self, delivery_tag, multiple=False):
+    self.acks += 1
+
+  def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+    self.nacks += 1
+
+
+class MemoryGraph(object):
+
+  def __init__(self, latency=0.0):
+    self.latency = latency
+    self.nodes = set()
+    self.edges = {}
+    self.calls = 0
+
+  def __round_trip(self):
+    self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def save_node(self, conf):
+    self.__round_trip()
+    self.nodes.add(conf['obj_hash'])
+
+  def save_nodes(self, nodes_conf):
+    self.__round_trip()
+    self.nodes.update(c['obj_hash'] for c in nodes_conf)
+
+  def save_edge(self, action_conf, source_hash, dest_hash):
+    self.save_edges([(action_conf, source_hash, dest_hash)])
+
+  def save_edges(self, edges):
+    self.__round_trip()
+    for action_conf, source_hash, dest_hash in edges:
+      for h in source_hash, dest_hash:
+        if h not in self.nodes:
+          raise MissingNodeError('No node with hash %s' % h)
+      self.edges[action_conf['edge_id']] = action_conf['act_hash']
+
+  def save_collection_item(self, item_hash, collection_hash):
+    self.save_collection_items([(item_hash, collection_hash)])
+
+  def save_collection_items(self, items):
+    self.__round_trip()
+    for item_hash, collection_hash in items:
+      self.edges['%s_%s' % (item_hash, collection_hash)] = None
+
+  def delete_node(self, node_hash):
+    self.__round_trip()
+    self.nodes.discard(node_hash)
+
+  def delete_edge(self, edge_id):
+    self.__round_trip()
+    self.edges.pop(edge_id, None)
+
+  def delete_edges(self, edge_hash):
+    self.__round_trip()
+    for k, v in self.edges.items():
+      if v == edge_hash:
+        del self.edges[k]
+
+
+def make_actions(graph, bulk=True):
+  actions = {
+    'NODE_CREATE': lambda m: graph.save_node(m['details']),
+    'EDGE_CREATE': lambda m: graph.save_edge(m['details'], m['source_node'],
+                                             m['dest_node']),
+    'COLLECTION_ITEM_CREATE': lambda m: graph.save_collection_item(
+      m['item_node'], m['collection_node']),
+    'NODE_DELETE': lambda m: graph.delete_node(m['target']),
+    'EDGE_DELETE': lambda m: graph.delete_edge(m['target']),
+    'EDGES_DELETE': lambda m: graph.delete_edges(m['target']),
+    }
+  if not bulk:
+    return actions, None
+  bulk_actions = {
+    'NODE_CREATE': lambda msgs: graph.save_nodes(
+      [m['details'] for m in msgs]),
+    'EDGE_CREATE': lambda msgs: graph.save_edges(
+      [(m['details'], m['source_node'], m['dest_node']) for m in msgs]),
+    'COLLECTION_ITEM_CREATE': lambda msgs: graph.save_collection_items(
+      [(m['item_node'], m['collection_node']) for m in msgs]),
+    }
+  return actions, bulk_actions
+
+
+def generate_log(n, fo):
+  source = random.randint(1, 2**62)
+  fo.write('%s\n' % json.dumps(['q.graph.node.create', json.dumps({
+    'action': 'NODE_CREATE',
+    'details': {'obj_class': 'Study', 'obj_id': 'V0', 'obj_hash': source},
+    })]))
+  for i in xrange(n):
+    h = source + i + 1
+    node = {'action': 'NODE_CREATE',
+            'details': {'obj_class': 'Individual', 'obj_id': 'V%d' % h,
+                        'obj_hash': h}}
+    edge = {'action': 'EDGE_CREATE',
+            'details': {'edge_id': '%d_%d' % (source, h),
+                        'act_type': 'Action', 'act_id': 'A0',
+                        'act_hash': source - 1},
+            'source_node': source, 'dest_node': h}
+    fo.write('%s\n' % json.dumps(['q.graph.node.create', json.dumps(node)]))
+    fo.write('%s\n' % json.dumps(['q.graph.edge.create', json.dumps(edge)]))
+
+
+def load_log(fname):
+  with open(fname) as f:
+    return [json.loads(json.loads(l)[1]) for l in f if l.strip()]
+
+
+def build_graph(args):
+  if args.driver == 'neo4j':
+    from bl.vl.graph import build_driver
+    return build_driver()
+  return MemoryGraph(args.latency / 1000.)
+
+
+def replay(messages, graph, batch_size, bulk):
+  actions, bulk_actions = make_actions(graph, bulk)
+  batch = EventsBatch(actions, bulk_actions, batch_size=batch_size)
+  channel = ReplayChannel()
+  start = time.time()
+  for i, m in enumerate(messages):
+    if batch.add(i + 1, m):
+      batch.flush(channel)
+  batch.flush(channel)
+  elapsed = time.time() - start
+  return {
+    'time': elapsed,
+    'messages_per_second': len(messages) / elapsed if elapsed else None,
+    'acks': channel.acks,
+    'nacks': channel.nacks,
+    'stats': batch.stats,
+    }
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='replay a graph events log')
+  parser.add_argument('-i', '--ifile', metavar='FILE',
+                      help='events log file')
+  parser.add_argument('--generate', type=int, metavar='N',
+                      help='write a synthetic log for N objects to IFILE '
+                      'and exit')
+  parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                      help='batch size')
+  parser.add_argument('--driver', choices=['memory', 'neo4j'],
+                      default='memory', help='graph driver')
+  parser.add_argument('--latency', type=float, default=1.0,
+                      help='simulated latency (ms) per call, memory driver')
+  parser.add_argument('--skip-serial', action='store_true',
+                      help='do not replay the log one message at a time')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  parser = make_parser()
+  args = parser.parse_args(argv)
+  if not args.ifile:
+    parser.error('no log file specified')
+  if args.generate:
+    with open(args.ifile, 'w') as fo:
+      generate_log(args.generate, fo)
+    return
+  messages = load_log(args.ifile)
+  results = {
+    'timestamp': time.time(),
+    'log': args.ifile,
+    'messages': len(messages),
+    'driver': args.driver,
+    'latency': args.latency,
+    }
+  if not args.skip_serial:
+    results['serial'] = replay(messages, build_graph(args), 1, False)
+  results['batched'] = replay(messages, build_graph(args), args.batch_size,
+                              True)
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
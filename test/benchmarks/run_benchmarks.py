@@ -0,0 +1,258 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+End-to-end KB benchmarks
+========================
+
+Run a set of parameterized scenarios against an in-process OMERO
+stand-in (see :mod:`fake_omero`) and write timings as JSON::
+
+  python run_benchmarks.py -N 1000 -M 50 -K 10000 -o results.json
+
+Scenarios are:
+
+* ``save_individuals``: save N individuals with a single save_array
+* ``get_by_vids``: fetch the N individuals back by VID
+* ``get_objects``: load all individuals
+* ``get_connected``: build the dependency tree and walk it from the
+  root action
+* ``markers_set``: create a markers set with K markers
+* ``gdo_write``: add M genotype data objects (K markers each)
+* ``gdo_read``: read back the M GDOs, one by one and via the iterator
+
+Each scenario is run ``--repeat`` times on a fresh database; min and
+mean wall clock times are reported together with the number of
+queries answered by the fake server.  Results obtained with the
+stand-in are only comparable with each other: use them to measure the
+effect of changes to the client side code (batching, caching, etc.).
+"""
+
+import os, sys, time, json, argparse, platform
+
+os.environ.setdefault('GRAPH_ENGINE_DRIVER', 'pygraph')
+os.environ.setdefault('MESSAGES_QUEUE_ENGINE_ENABLED', 'NONE')
+
+import numpy as np
+
+import fake_omero
+fake_omero.install()
+
+from bl.vl.kb import KnowledgeBase as KB
+from bl.vl.kb.dependency import DependencyTree
+from bl.vl.kb.drivers.omero.genomics import MSET_TABLE_COLS_DTYPE
+
+
+HOST, USER, PASSWD = 'fake-host', 'root', 'romeo'
+SCENARIOS = ['save_individuals', 'get_by_vids', 'get_objects',
+             'get_connected', 'markers_set', 'gdo_write', 'gdo_read']
+
+
+class Fixture(object):
+
+  def __init__(self, kb, n_individuals, n_samples, n_markers):
+    self.kb = kb
+    self.n_individuals = n_individuals
+    self.n_samples = n_samples
+    self.n_markers = n_markers
+    self.individuals = []
+    self.mset = None
+    self.data_samples = []
+    self.data_objects = []
+    self.action = self.create_action()
+
+  def create_action(self):
+    kb = self.kb
+    tag = '%f' % time.time()
+    study = kb.factory.create(kb.Study, {'label': 'bench-%s' % tag}).save()
+    device = kb.factory.create(kb.Device, {
+      'label': 'bench-dev-%s' % tag, 'maker': 'CRS4', 'model': 'bench',
+      'release': tag,
+      }).save()
+    asetup = kb.factory.create(kb.ActionSetup, {
+      'label': 'bench-setup-%s' % tag, 'conf': '{}',
+      }).save()
+    return kb.factory.create(kb.Action, {
+      'setup': asetup, 'device': device, 'context': study,
+      'actionCategory': kb.ActionCategory.IMPORT,
+      'operator': 'Alfred E. Neumann',
+      }).save()
+
+  def make_individuals(self):
+    kb = self.kb
+    return [kb.factory.create(kb.Individual, {
+      'gender': kb.Gender.MALE if i % 2 else kb.Gender.FEMALE,
+      'action': self.action,
+      }) for i in xrange(self.n_individuals)]
+
+  def make_markers(self):
+    vid = self.action.id
+    return np.array([('M%d' % i, i, 'AC[A/G]GT', False, vid)
+                     for i in xrange(self.n_markers)],
+                    dtype=MSET_TABLE_COLS_DTYPE)
+
+  def make_data_samples(self):
+    kb = self.kb
+    samples = []
+    for i in xrange(self.n_samples):
+      ind = self.individuals[i % len(self.individuals)]
+      action = kb.factory.create(kb.ActionOnIndividual, {
+        'setup': self.action.setup, 'device': self.action.device,
+        'context': self.action.context, 'target': ind,
+        'actionCategory': kb.ActionCategory.MEASUREMENT,
+        'operator': 'Alfred E. Neumann',
+        }).save()
+      samples.append(kb.factory.create(kb.GenotypeDataSample, {
+        'label': 'bench-gds-%d-%f' % (i, time.time()),
+        'status': kb.DataSampleStatus.USABLE,
+        'action': action,
+        'snpMarkersSet': self.mset,
+        }).save())
+    return samples
+
+  @staticmethod
+  def make_gdo_data(n):
+    probs = 0.5 * np.cast[np.float32](np.random.random((2, n)))
+    confs = np.cast[np.float32](np.random.random(n))
+    return probs, confs
+
+
+def save_individuals(fx):
+  fx.individuals = fx.kb.save_array(fx.make_individuals())
+
+
+def get_by_vids(fx):
+  vids = [i.id for i in fx.individuals]
+  res = fx.kb.get_by_vids(fx.kb.Individual, vids)
+  assert len(res) == len(vids)
+
+
+def get_objects(fx):
+  res = fx.kb.get_objects(fx.kb.Individual)
+  assert len(res) >= len(fx.individuals)
+
+
+def get_connected(fx):
+  dt = DependencyTree(fx.kb)
+  dt.get_connected(fx.action)
+
+
+def markers_set(fx):
+  tag = '%f' % time.time()
+  fx.mset = fx.kb.genomics.create_markers_array(
+    'bench-ms-%s' % tag, 'CRS4', 'bench', tag, fx.make_markers(), fx.action
+    )
+
+
+def gdo_write(fx):
+  fx.data_samples = fx.make_data_samples()
+  fx.data_objects = []
+  for ds in fx.data_samples:
+    probs, confs = fx.make_gdo_data(fx.n_markers)
+    fx.data_objects.append(
+      fx.kb.genomics.add_gdo_data_object(fx.action, ds, probs, confs)
+      )
+
+
+def gdo_read(fx):
+  genomics = fx.kb.genomics
+  for do in fx.data_objects:
+    set_vid, vid, row_index = genomics.parse_gdo_path(do.path)
+    genomics.get_gdo(fx.mset, vid, row_index)
+  n = sum(1 for _ in genomics.get_gdo_iterator(fx.mset))
+  assert n == len(fx.data_objects)
+
+
+# scenario -> (function, scenarios that must run first)
+SETUP = {
+  'save_individuals': (save_individuals, []),
+  'get_by_vids': (get_by_vids, ['save_individuals']),
+  'get_objects': (get_objects, ['save_individuals']),
+  'get_connected': (get_connected, ['save_individuals']),
+  'markers_set': (markers_set, []),
+  'gdo_write': (gdo_write, ['save_individuals', 'markers_set']),
+  'gdo_read': (gdo_read, ['save_individuals', 'markers_set', 'gdo_write']),
+  }
+
+
+def connect():
+  fake_omero.FakeClient.reset(HOST)
+  return KB(driver='omero')(HOST, USER, PASSWD)
+
+
+def queries_count():
+  db = fake_omero.FakeClient.DATABASES.get(HOST)
+  return db.n_queries if db else 0
+
+
+def run_scenario(name, args, logger):
+  func, deps = SETUP[name]
+  times, queries = [], []
+  for _ in xrange(args.repeat):
+    kb = connect()
+    fx = Fixture(kb, args.individuals, args.samples, args.markers)
+    for d in deps:
+      SETUP[d][0](fx)
+    q0 = queries_count()
+    start = time.time()
+    func(fx)
+    times.append(time.time() - start)
+    queries.append(queries_count() - q0)
+    kb.disconnect()
+  logger.write('%-18s min %.4fs mean %.4fs\n' %
+               (name, min(times), sum(times) / len(times)))
+  return {
+    'times': times,
+    'min': min(times),
+    'mean': sum(times) / len(times),
+    'queries': queries[-1],
+    }
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='run KB benchmarks')
+  parser.add_argument('-N', '--individuals', type=int, metavar='N',
+                      default=1000, help='number of individuals')
+  parser.add_argument('-M', '--samples', type=int, metavar='M',
+                      default=20, help='number of genotype data samples')
+  parser.add_argument('-K', '--markers', type=int, metavar='K',
+                      default=1000, help='number of markers')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of runs per scenario')
+  parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                      default=SCENARIOS, metavar='SCENARIO',
+                      help='scenarios to run (default: all)')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  parser = make_parser()
+  args = parser.parse_args(argv)
+  results = {
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'params': {
+      'individuals': args.individuals,
+      'samples': args.samples,
+      'markers': args.markers,
+      'repeat': args.repeat,
+      },
+    'scenarios': {},
+    }
+  try:
+    for name in args.scenarios:
+      results['scenarios'][name] = run_scenario(name, args, sys.stderr)
+  finally:
+    fake_omero.uninstall()
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
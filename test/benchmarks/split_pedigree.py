@@ -0,0 +1,90 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Pedigree splitting
+==================
+
+Split synthetic pedigrees (see :mod:`import_pedigree`) into families
+whose bit complexity is within the limits of linkage tools, as done
+before running them, and write timings as JSON::
+
+  python split_pedigree.py -N 50000 --generations 10 --genotyped 0.3
+
+Timings are reported separately for the analysis of the pedigree,
+the search for disjoint families and the splitting of the families
+that are too complex.
+"""
+
+import sys, time, json, random, argparse
+
+import bl.vl.individual.pedigree as ped
+from import_pedigree import make_pedigree
+
+
+def run(family, genotyped, max_complexity):
+  res = {}
+  start = time.time()
+  founders, non_founders, dangling, couples, children = ped.analyze(family)
+  res['analyze'] = time.time() - start
+  start = time.time()
+  splits = ped.split_disjoint(family, children)
+  res['split_disjoint'] = time.time() - start
+  start = time.time()
+  fams = []
+  for f in splits:
+    if ped.compute_bit_complexity(f, genotyped) > max_complexity:
+      fams.extend(ped.split_family(f, genotyped, max_complexity))
+    else:
+      fams.append(f)
+  res['split_family'] = time.time() - start
+  res['total'] = res['analyze'] + res['split_disjoint'] + res['split_family']
+  res['disjoint_families'] = len(splits)
+  res['families'] = len(fams)
+  res['max_family_size'] = max(len(f) for f in fams)
+  return res
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='pedigree splitting benchmark')
+  parser.add_argument('-N', '--individuals', type=int, metavar='N',
+                      default=50000, help='number of individuals')
+  parser.add_argument('--generations', type=int, default=10,
+                      help='number of generations')
+  parser.add_argument('--genotyped', type=float, default=0.3,
+                      help='fraction of genotyped individuals')
+  parser.add_argument('--max-complexity', type=int,
+                      default=ped.MAX_COMPLEXITY, help='max bit complexity')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  family = make_pedigree(args.individuals, args.generations, args.seed)
+  rnd = random.Random(args.seed)
+  genotyped = dict((i.id, rnd.random() < args.genotyped) for i in family)
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'individuals': len(family),
+      'generations': args.generations,
+      'genotyped': args.genotyped,
+      'max_complexity': args.max_complexity,
+      },
+    'results': run(family, genotyped, args.max_complexity),
+    }
+  sys.stderr.write('%(total).2fs, %(families)d families\n' %
+                   results['results'])
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
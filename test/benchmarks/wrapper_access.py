@@ -0,0 +1,143 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Wrapper field access
+====================
+
+Time attribute access on KB objects loaded from the fake OMERO server
+(see :mod:`fake_omero`) and write the cost per access, in ns, as
+JSON::
+
+  python wrapper_access.py -N 960 --passes 20
+
+Access patterns are:
+
+* ``well.slot``: an INT field
+* ``well.container.barcode``: a link followed by a STRING field
+* ``individual.gender``: an enum link
+* ``gds.action.target``: two links
+* ``action.vid``: a VID field
+
+``cold`` timings drop the field cache (see wrapper.FieldAccessor) of
+the objects in the list before each pass, so that the first step of
+each access converts the omero value again (wrapping linked objects
+and, for unloaded links, querying the server); ``warm`` timings reuse
+the cached values.
+"""
+
+import sys, time, json, argparse
+
+import fake_omero
+from run_benchmarks import Fixture, connect, markers_set
+
+from bl.vl.kb.drivers.omero.wrapper import drop_field_cache
+
+
+PATTERNS = [
+  ('well.slot', 'wells', lambda w: w.slot),
+  ('well.container.barcode', 'wells', lambda w: w.container.barcode),
+  ('individual.gender', 'individuals', lambda i: i.gender),
+  ('gds.action.target', 'data_samples', lambda d: d.action.target),
+  ('action.vid', 'actions', lambda a: a.vid),
+  ]
+
+
+def make_wells(fx, n):
+  kb = fx.kb
+  wells = []
+  for p in xrange(0, n, 96):
+    plate = kb.factory.create(kb.TiterPlate, {
+      'label': 'bench-plate-%d-%f' % (p, time.time()),
+      'barcode': 'BC%06d' % p,
+      'rows': 8, 'columns': 12,
+      'status': kb.ContainerStatus.READY,
+      'action': fx.action,
+      }).save()
+    wells.extend(kb.factory.create(kb.PlateWell, {
+      'slot': s + 1, 'container': plate,
+      'content': kb.VesselContent.DNA,
+      'status': kb.VesselStatus.CONTENTUSABLE,
+      'currentVolume': 1.0, 'initialVolume': 1.0,
+      'action': fx.action,
+      }) for s in xrange(min(96, n - p)))
+  return kb.save_array(wells)
+
+
+def load_objects(fx, n):
+  kb = fx.kb
+  fx.individuals = kb.save_array(fx.make_individuals())
+  make_wells(fx, n)
+  markers_set(fx)
+  fx.make_data_samples()
+  kb.clear_cache()
+  objects = {
+    'wells': kb.get_objects(kb.PlateWell),
+    'individuals': kb.get_objects(kb.Individual),
+    'data_samples': kb.get_objects(kb.GenotypeDataSample),
+    }
+  objects['actions'] = [d.action for d in objects['data_samples']]
+  return objects
+
+
+def time_pattern(objects, func, passes, cold):
+  times = []
+  for _ in xrange(passes):
+    if cold:
+      for o in objects:
+        drop_field_cache(o)
+    start = time.time()
+    for o in objects:
+      func(o)
+    times.append(time.time() - start)
+  return 1e9 * min(times) / len(objects)
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='wrapper access benchmark')
+  parser.add_argument('-N', '--objects', type=int, metavar='N',
+                      default=960, help='number of wells and individuals')
+  parser.add_argument('-M', '--samples', type=int, metavar='M',
+                      default=100, help='number of genotype data samples')
+  parser.add_argument('--passes', type=int, default=20,
+                      help='number of passes over the objects')
+  parser.add_argument('-o', '--ofile', metavar='FILE',
+                      help='output file (JSON), default: stdout')
+  return parser
+
+
+def main(argv):
+  args = make_parser().parse_args(argv)
+  results = {
+    'timestamp': time.time(),
+    'params': {
+      'objects': args.objects,
+      'samples': args.samples,
+      'passes': args.passes,
+      },
+    'patterns': {},
+    }
+  try:
+    kb = connect()
+    fx = Fixture(kb, args.objects, args.samples, 10)
+    objects = load_objects(fx, args.objects)
+    for name, kind, func in PATTERNS:
+      res = dict((k, time_pattern(objects[kind], func, args.passes,
+                                  k == 'cold'))
+                 for k in ('cold', 'warm'))
+      results['patterns'][name] = res
+      sys.stderr.write('%-24s cold %9.1f ns warm %7.1f ns\n' %
+                       (name, res['cold'], res['warm']))
+    kb.disconnect()
+  finally:
+    fake_omero.uninstall()
+  if args.ofile:
+    with open(args.ofile, 'w') as f:
+      json.dump(results, f, indent=1)
+  else:
+    json.dump(results, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,73 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, csv
+
+from bl.vl.graph.adjacency import Adjacency
+
+
+NODES = [(10, 'Study', 'V0'), (11, 'Individual', 'V1'),
+         (12, 'Individual', 'V2'), (13, 'Vessel', 'V3'),
+         (14, 'Vessel', 'V4'), (20, 'Individual', 'V5')]
+EDGES = [(10, 11), (10, 12), (11, 13), (12, 14), (99, 20)]
+
+
+class TestAdjacency(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.nodes_fn = os.path.join(self.wd, 'nodes.csv')
+    self.edges_fn = os.path.join(self.wd, 'edges.csv')
+    with open(self.nodes_fn, 'w') as f:
+      w = csv.writer(f, lineterminator='\n')
+      w.writerow(['obj_hash', 'obj_class', 'obj_id'])
+      w.writerows(NODES)
+    with open(self.edges_fn, 'w') as f:
+      w = csv.writer(f, lineterminator='\n')
+      w.writerow(['edge_id', 'source', 'dest', 'act_type', 'act_id',
+                  'act_hash'])
+      for s, d in EDGES:
+        w.writerow(['%s::%s' % (s, d), s, d, 'Action', 'A', 0])
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def vids(self, adj, idx):
+    return sorted(adj.vids[idx])
+
+  def test_from_csv(self):
+    adj = Adjacency.from_csv(self.nodes_fn, self.edges_fn)
+    self.assertEqual(adj.n_nodes, len(NODES))
+    self.assertEqual(adj.n_edges, len(EDGES) - 1)
+    self.assertEqual(adj.vids[adj.index(13)], 'V3')
+    self.assertRaises(KeyError, adj.index, 99)
+
+  def test_connected(self):
+    adj = Adjacency.from_csv(self.nodes_fn, self.edges_fn)
+    self.assertEqual(self.vids(adj, adj.connected(13)),
+                     ['V0', 'V1', 'V2', 'V3', 'V4'])
+    self.assertEqual(self.vids(adj, adj.connected(10, 'Vessel')),
+                     ['V3', 'V4'])
+    self.assertEqual(self.vids(adj, adj.connected(20)), ['V5'])
+
+  def test_save_load(self):
+    adj = Adjacency.from_csv(self.nodes_fn, self.edges_fn)
+    path = os.path.join(self.wd, 'graph.npz')
+    adj.save(path)
+    other = Adjacency.load(path)
+    self.assertEqual(other.n_nodes, adj.n_nodes)
+    self.assertEqual(self.vids(other, other.connected(11, 'Individual')),
+                     ['V1', 'V2'])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestAdjacency('test_from_csv'))
+  suite.addTest(TestAdjacency('test_connected'))
+  suite.addTest(TestAdjacency('test_save_load'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
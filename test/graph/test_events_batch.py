@@ -0,0 +1,197 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+from bl.vl.graph.batch import EventsBatch, split_segments
+from bl.vl.graph.errors import MissingNodeError, GraphConnectionError
+
+
+def node_msg(h):
+  return {'action': 'NODE_CREATE',
+          'details': {'obj_class': 'Individual', 'obj_id': 'V%d' % h,
+                      'obj_hash': h}}
+
+
+def edge_msg(src, dest):
+  return {'action': 'EDGE_CREATE',
+          'details': {'edge_id': '%d_%d' % (src, dest), 'act_type': 'Action',
+                      'act_id': 'A%d' % dest, 'act_hash': 100 + dest},
+          'source_node': src, 'dest_node': dest}
+
+
+def delete_msg(h):
+  return {'action': 'NODE_DELETE', 'target': h}
+
+
+class FakeChannel(object):
+
+  def __init__(self):
+    self.acks = []
+    self.nacks = []
+
+  def basic_ack(self, delivery_tag, multiple=False):
+    self.acks.append((delivery_tag, multiple))
+
+  def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+    self.nacks.append((delivery_tag, multiple))
+
+
+class FakeGraph(object):
+
+  def __init__(self):
+    self.nodes = set()
+    self.edges = set()
+    self.calls = []
+    self.down = False
+
+  def save_node(self, msg):
+    self.__call('save_node')
+    self.nodes.add(msg['details']['obj_hash'])
+
+  def save_nodes(self, msgs):
+    self.__call('save_nodes')
+    self.nodes.update(m['details']['obj_hash'] for m in msgs)
+
+  def save_edge(self, msg):
+    self.__call('save_edge')
+    if not set([msg['source_node'], msg['dest_node']]) <= self.nodes:
+      raise MissingNodeError('missing node')
+    self.edges.add((msg['source_node'], msg['dest_node']))
+
+  def save_edges(self, msgs):
+    self.__call('save_edges')
+    for m in msgs:
+      if not set([m['source_node'], m['dest_node']]) <= self.nodes:
+        raise MissingNodeError('missing node')
+    self.edges.update((m['source_node'], m['dest_node']) for m in msgs)
+
+  def delete_node(self, msg):
+    self.__call('delete_node')
+    self.nodes.discard(msg['target'])
+
+  def __call(self, name):
+    if self.down:
+      raise GraphConnectionError('graph down')
+    self.calls.append(name)
+
+
+def make_batch(graph, bulk=True, batch_size=100):
+  actions = {
+    'NODE_CREATE': graph.save_node,
+    'EDGE_CREATE': graph.save_edge,
+    'NODE_DELETE': graph.delete_node,
+    }
+  bulk_actions = {
+    'NODE_CREATE': graph.save_nodes,
+    'EDGE_CREATE': graph.save_edges,
+    } if bulk else None
+  return EventsBatch(actions, bulk_actions, batch_size=batch_size)
+
+
+class TestEventsBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.graph = FakeGraph()
+    self.channel = FakeChannel()
+
+  def add_all(self, batch, msgs):
+    for i, m in enumerate(msgs):
+      batch.add(i + 1, m)
+
+  def test_segments(self):
+    msgs = [(1, node_msg(1)), (2, edge_msg(0, 1)), (3, delete_msg(1)),
+            (4, node_msg(2))]
+    segments = split_segments(msgs)
+    self.assertEqual([a for a, _ in segments], [None, 'NODE_DELETE', None])
+    self.assertEqual([len(s) for _, s in segments], [2, 1, 1])
+
+  def test_bulk(self):
+    batch = make_batch(self.graph)
+    msgs = [node_msg(0)]
+    for i in xrange(1, 50):
+      msgs.extend([node_msg(i), node_msg(i - 1), edge_msg(i - 1, i)])
+    self.add_all(batch, msgs)
+    self.assertEqual(batch.flush(self.channel), len(msgs))
+    self.assertEqual(self.graph.calls, ['save_nodes', 'save_edges'])
+    self.assertEqual(len(self.graph.nodes), 50)
+    self.assertEqual(len(self.graph.edges), 49)
+    self.assertEqual(self.channel.acks, [(len(msgs), True)])
+    self.assertEqual(batch.stats['duplicates'], 49)
+
+  def test_ordering(self):
+    batch = make_batch(self.graph)
+    msgs = [node_msg(1), node_msg(2), delete_msg(1), node_msg(1),
+            node_msg(3)]
+    self.add_all(batch, msgs)
+    batch.flush(self.channel)
+    self.assertEqual(self.graph.calls,
+                     ['save_nodes', 'delete_node', 'save_nodes'])
+    self.assertEqual(self.graph.nodes, set([1, 2, 3]))
+    self.assertEqual(self.channel.acks, [(2, True), (3, False), (5, True)])
+
+  def test_fallback(self):
+    batch = make_batch(self.graph)
+    msgs = [node_msg(1), node_msg(2), edge_msg(1, 2), edge_msg(2, 9),
+            edge_msg(2, 1)]
+    self.add_all(batch, msgs)
+    batch.flush(self.channel)
+    self.assertEqual(self.graph.edges, set([(1, 2), (2, 1)]))
+    self.assertEqual(self.channel.nacks, [(4, False)])
+    self.assertEqual(self.channel.acks, [(5, True)])
+    self.assertEqual(batch.stats['fallbacks'], 1)
+
+  def test_last_message_fails(self):
+    batch = make_batch(self.graph)
+    msgs = [node_msg(1), node_msg(2), edge_msg(1, 2), edge_msg(2, 9)]
+    self.add_all(batch, msgs)
+    batch.flush(self.channel)
+    self.assertEqual(self.channel.nacks, [(4, False)])
+    self.assertEqual(self.channel.acks, [(3, True)])
+    self.channel = FakeChannel()
+    batch = make_batch(self.graph, bulk=False)
+    self.add_all(batch, [edge_msg(1, 9)])
+    batch.flush(self.channel)
+    self.assertEqual(self.channel.nacks, [(1, False)])
+    self.assertEqual(self.channel.acks, [])
+
+  def test_connection_error(self):
+    batch = make_batch(self.graph, bulk=False)
+    self.add_all(batch, [node_msg(1), node_msg(2)])
+    self.graph.down = True
+    batch.flush(self.channel)
+    self.assertEqual(self.channel.acks, [])
+    self.assertEqual(self.channel.nacks, [(2, True)])
+    self.assertEqual(batch.stats['requeued'], 2)
+    self.assertEqual(len(batch), 0)
+
+  def test_watermarks(self):
+    batch = make_batch(self.graph)
+    for i in xrange(5):
+      batch.add(i + 1, node_msg(i), {'session': 'a', 'seq': i + 1})
+    batch.add(6, node_msg(5), {'session': 'b', 'seq': 1})
+    batch.add(7, node_msg(6))
+    batch.flush(self.channel)
+    self.assertEqual(batch.pop_watermarks(), {'a': 5, 'b': 1})
+    self.assertEqual(batch.pop_watermarks(), {})
+    self.graph.down = True
+    batch.add(8, node_msg(7), {'session': 'a', 'seq': 6})
+    batch.flush(self.channel)
+    self.assertEqual(batch.pop_watermarks(), {})
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestEventsBatch('test_segments'))
+  suite.addTest(TestEventsBatch('test_bulk'))
+  suite.addTest(TestEventsBatch('test_ordering'))
+  suite.addTest(TestEventsBatch('test_fallback'))
+  suite.addTest(TestEventsBatch('test_last_message_fails'))
+  suite.addTest(TestEventsBatch('test_connection_error'))
+  suite.addTest(TestEventsBatch('test_watermarks'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
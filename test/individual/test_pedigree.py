@@ -13,14 +13,20 @@ DATA_DIR = os.path.join(D, "data")
 
 class Recorder(object):
   def __init__(self):
-    pass
+    self.saved = set()
+    self.pending = []
+    self.batches = []
   def retrieve(self, i_label):
     return None
   def record(self, label, gender, father, mother):
-    print 'recording %s[%s]' % (label, gender)
-    return True
+    for p in father, mother:
+      assert p is None or p in self.saved
+    self.pending.append(label)
+    return label
   def dump_out(self):
-    print 'dumping out'
+    self.saved.update(self.pending)
+    self.batches.append(len(self.pending))
+    self.pending = []
 
 
 def read_ped_file(pedfile):
@@ -108,7 +114,48 @@ class TestPedigree(unittest.TestCase):
       reader = csv.DictReader(f, delimiter='\t')
       records = [r for r in reader]
     by_label = make_ind_by_label(records)
-    ped.import_pedigree(Recorder(), by_label.itervalues())
+    # the test data includes an individual that is its own mother
+    self.assertRaises(ped.PedigreeCycleError, ped.import_pedigree,
+                      Recorder(), by_label.itervalues())
+    records = [r for r in records if r['label'] not in (r['father'],
+                                                        r['mother'])]
+    by_label = make_ind_by_label(records)
+    recorder = Recorder()
+    ped.import_pedigree(recorder, by_label.itervalues())
+    self.assertEqual(len(recorder.saved), len(by_label))
+    recorder = Recorder()
+    ped.import_pedigree(recorder, by_label.itervalues(), batch_size=2)
+    self.assertEqual(len(recorder.saved), len(by_label))
+    self.assertTrue(max(recorder.batches) <= 2)
+
+  def test_generations(self):
+    family, genotyped = read_ped_file(os.path.join(DATA_DIR, 'ped_soup.ped'))
+    gens = ped.generations(family)
+    self.assertEqual(sum(map(len, gens)), len(family))
+    depth = {}
+    for d, g in enumerate(gens):
+      for i in g:
+        depth[i] = d
+    for i in family:
+      parents = [depth[p] for p in (i.father, i.mother) if p is not None]
+      self.assertEqual(depth[i], max(parents) + 1 if parents else 0)
+    batches = list(ped.schedule(family, 100))
+    self.assertTrue(max(len(b) for _, b in batches) <= 100)
+    self.assertEqual([d for d, _ in batches], sorted(d for d, _ in batches))
+
+  def test_cycle(self):
+    a = Individual('a', 'male', None, None)
+    b = Individual('b', 'female', a, None)
+    c = Individual('c', 'male', b, None)
+    d = Individual('d', 'male', c, None)
+    a.father = c
+    try:
+      ped.generations([a, b, c, d])
+    except ped.PedigreeCycleError, e:
+      self.assertTrue('4 individual(s)' in str(e))
+      self.assertTrue('a -> c -> b -> a' in str(e))
+    else:
+      self.fail('cycle not detected')
 
   def test_compute_bit_complexity(self):
     for cb, fname in manifest_reader():
@@ -116,6 +163,24 @@ class TestPedigree(unittest.TestCase):
       cbn = ped.compute_bit_complexity(family, genotyped)
       self.assertEqual(cb, cbn)
 
+  def test_complexity_tracker(self):
+    for cb, fname in manifest_reader():
+      family, genotyped = read_ped_file(os.path.join(DATA_DIR, fname))
+      founders, non_founders, dangling, couples, children = ped.analyze(family)
+      index = ped.PedigreeIndex(family, children, genotyped)
+      tracker = ped.BitComplexityTracker(index)
+      for i in family:
+        tracker.add(index.position[i])
+        self.assertEqual(tracker.complexity,
+                         ped.compute_bit_complexity(tracker.individuals(),
+                                                    genotyped))
+      self.assertEqual(tracker.complexity, cb)
+      for i in family[::2]:
+        tracker.remove(index.position[i])
+      self.assertEqual(tracker.complexity,
+                       ped.compute_bit_complexity(tracker.individuals(),
+                                                  genotyped))
+
   def test_grow_family(self):
     for cb, fname in manifest_reader():
       family, genotyped = read_ped_file(os.path.join(DATA_DIR, fname))
@@ -167,7 +232,10 @@ def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestPedigree('test_analyze'))
   suite.addTest(TestPedigree('test_import_pedigree'))
+  suite.addTest(TestPedigree('test_generations'))
+  suite.addTest(TestPedigree('test_cycle'))
   suite.addTest(TestPedigree('test_compute_bit_complexity'))
+  suite.addTest(TestPedigree('test_complexity_tracker'))
   suite.addTest(TestPedigree('test_grow_family'))
   suite.addTest(TestPedigree('test_propagate_family'))
   suite.addTest(TestPedigree('test_split_disjoint'))
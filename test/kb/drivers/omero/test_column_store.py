@@ -0,0 +1,112 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from bl.vl.kb.drivers.omero.column_store import ColumnStore, ColumnTable, \
+  StringColumn
+
+
+DTYPE = [('vid', '|S34'), ('label', '|S48'), ('index', 'i8'),
+         ('allele_flip', 'b'), ('probs', '(2,)float32')]
+
+
+def make_records(n):
+  records = np.zeros(n, dtype=DTYPE)
+  records['vid'] = ['V%032d' % i for i in xrange(n)]
+  records['label'] = ['SNP%d' % (i % 7) if i % 5 else '' for i in xrange(n)]
+  records['index'] = np.arange(n)[::-1]
+  records['allele_flip'] = np.arange(n) % 2
+  records['probs'] = np.arange(2 * n, dtype=np.float32).reshape(n, 2)
+  return records
+
+
+def batches(records, size):
+  for i in xrange(0, len(records), size):
+    yield records[i:i+size]
+
+
+class TestColumnStore(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.store = ColumnStore(os.path.join(self.wd, 'host'))
+    self.records = make_records(23)
+    self.signature = (42, 1000, len(self.records))
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def check_table(self, ct, records):
+    self.assertEqual(len(ct), len(records))
+    self.assertEqual(ct.col_names, list(records.dtype.names))
+    for n in records.dtype.names:
+      self.assertEqual(ct[n].tolist(), records[n].tolist())
+    for i in range(len(records))[:1] + range(len(records))[-1:]:
+      self.assertEqual(ct[i]['label'], records[i]['label'])
+      self.assertEqual(ct[i]['probs'].tolist(), records[i]['probs'].tolist())
+    self.assertTrue(np.array_equal(ct.to_records(), records))
+
+  def test_build(self):
+    self.assertTrue(self.store.open('t.h5', self.signature) is None)
+    ct = self.store.build('t.h5', self.signature, DTYPE,
+                          batches(self.records, 5))
+    self.assertEqual(ct.signature, self.signature)
+    self.assertTrue(isinstance(ct['vid'], StringColumn))
+    self.assertTrue(isinstance(ct['index'], np.memmap))
+    self.check_table(ct, self.records)
+    self.check_table(self.store.open('t.h5', self.signature), self.records)
+    self.assertEqual(os.listdir(self.store.table_dir('t.h5')),
+                     ['42-1000-23'])
+
+  def test_rebuild(self):
+    self.store.build('t.h5', self.signature, DTYPE, [self.records])
+    records = make_records(30)
+    signature = (42, 2000, len(records))
+    self.assertTrue(self.store.open('t.h5', signature) is None)
+    ct = self.store.build('t.h5', signature, DTYPE, batches(records, 7))
+    self.check_table(ct, records)
+    self.assertTrue(self.store.open('t.h5', self.signature) is None)
+    self.store.remove('t.h5')
+    self.assertTrue(self.store.open('t.h5', signature) is None)
+
+  def test_short_read(self):
+    self.assertRaises(ValueError, self.store.build, 't.h5',
+                      (1, 1, 30), DTYPE, [self.records])
+    self.assertEqual(os.listdir(self.store.table_dir('t.h5')), [])
+
+  def test_empty(self):
+    records = make_records(0)
+    ct = self.store.build('t.h5', (1, 1, 0), DTYPE, [])
+    self.check_table(ct, records)
+    self.assertEqual(len(ct['label'] == 'SNP1'), 0)
+
+  def test_select(self):
+    ct = self.store.build('t.h5', self.signature, DTYPE, [self.records])
+    for v in 'SNP1', 'SNP12', '':
+      self.assertEqual((ct['label'] == v).tolist(),
+                       (self.records['label'] == v).tolist())
+      self.assertEqual((ct['label'] != v).tolist(),
+                       (self.records['label'] != v).tolist())
+    sel = np.flatnonzero(ct['label'] == 'SNP3')
+    sub = ct[sel]
+    self.assertTrue(isinstance(sub, ColumnTable))
+    self.check_table(sub, self.records[sel])
+    self.check_table(sub[:2], self.records[sel][:2])
+    self.assertEqual(ct['label'][sel[0]], 'SNP3')
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestColumnStore('test_build'))
+  suite.addTest(TestColumnStore('test_rebuild'))
+  suite.addTest(TestColumnStore('test_short_read'))
+  suite.addTest(TestColumnStore('test_empty'))
+  suite.addTest(TestColumnStore('test_select'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
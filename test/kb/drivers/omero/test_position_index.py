@@ -0,0 +1,106 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from bl.vl.kb.drivers.omero.position_index import PositionIndex, \
+  global_position
+
+
+def make_global_pos(rnd, n, n_dummies):
+  chrom = rnd.randint(1, 27, n)
+  pos = rnd.choice(np.arange(1, 50 * n), n, replace=False)
+  gpos = global_position(chrom, pos)
+  gpos[rnd.choice(n, n_dummies, replace=False)] = -np.arange(1, n_dummies + 1)
+  return gpos
+
+
+class TestPositionIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.rnd = np.random.RandomState(0)
+    self.gpos = make_global_pos(self.rnd, 500, 20)
+    self.indices = np.arange(len(self.gpos)) * 2
+    self.index = PositionIndex.build(self.gpos, self.indices)
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def scan(self, gc_range, closed_interval=True):
+    beg, end = [global_position(*p) for p in gc_range]
+    if closed_interval:
+      sel = (beg <= self.gpos) & (self.gpos <= end)
+    else:
+      sel = (beg <= self.gpos) & (self.gpos < end)
+    return self.indices[sel]
+
+  def test_select(self):
+    self.assertEqual(len(self.index), 480)
+    ranges = [((1, 0), (1, 10**6)), ((3, 200), (5, 9000)),
+              ((10, 0), (9, 0)), ((26, 1), (27, 0))]
+    for r in ranges:
+      self.assertEqual(self.index.select([r]).tolist(),
+                       self.scan(r).tolist())
+    all_sel = np.unique(np.concatenate([self.scan(r) for r in ranges]))
+    self.assertEqual(self.index.select(ranges).tolist(), all_sel.tolist())
+    self.assertEqual(self.index.select(ranges[:2] * 2).tolist(),
+                     self.index.select(ranges[:2]).tolist())
+    self.assertEqual(len(self.index.select([])), 0)
+    g = self.gpos[self.gpos > 0][0]
+    r = ((g // 10**10, g % 10**10 - 5), (g // 10**10, g % 10**10))
+    self.assertTrue(self.indices[self.gpos == g][0] in
+                    self.index.select([r]))
+    self.assertFalse(self.indices[self.gpos == g][0] in
+                     self.index.select([r], closed_interval=False))
+    self.assertEqual(self.index.select([r], closed_interval=False).tolist(),
+                     self.scan(r, closed_interval=False).tolist())
+
+  def test_chromosome(self):
+    for c in 1, 7, 26:
+      rows = self.index.chromosome(c)
+      exp = np.flatnonzero((self.gpos >= 0) & (self.gpos // 10**10 == c))
+      self.assertEqual(sorted(rows.tolist()), exp.tolist())
+      self.assertTrue((np.diff(self.gpos[rows]) > 0).all())
+
+  def test_intersect(self):
+    other_gpos = make_global_pos(self.rnd, 300, 10)
+    other_gpos[:100] = self.rnd.choice(self.gpos[self.gpos > 0], 100,
+                                       replace=False)
+    other = PositionIndex.build(other_gpos, np.arange(len(other_gpos)))
+    idx1, idx2 = self.index.intersect(other)
+    common = sorted(set(self.gpos[self.gpos >= 0]) & set(other_gpos))
+    row1 = dict((g, i) for i, g in enumerate(self.gpos))
+    row2 = dict((g, i) for i, g in enumerate(other_gpos))
+    exp1, exp2 = [row1[g] for g in common], [row2[g] for g in common]
+    self.assertTrue(len(idx1) >= 100)
+    self.assertEqual(idx1.tolist(), exp1)
+    self.assertEqual(idx2.tolist(), exp2)
+    empty = PositionIndex.build([], [])
+    self.assertEqual(len(self.index.intersect(empty)[0]), 0)
+
+  def test_persistence(self):
+    path = os.path.join(self.wd, 'align', 'position_index.hg19.npz')
+    self.assertTrue(PositionIndex.load(path) is None)
+    self.index.save(path)
+    other = PositionIndex.load(path, len(self.gpos))
+    self.assertEqual(other.n_markers, len(self.gpos))
+    for a in 'gpos', 'rows', 'indices', 'chrom_offsets':
+      self.assertEqual(getattr(other, a).tolist(),
+                       getattr(self.index, a).tolist())
+    self.assertTrue(PositionIndex.load(path, len(self.gpos) - 1) is None)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestPositionIndex('test_select'))
+  suite.addTest(TestPositionIndex('test_chromosome'))
+  suite.addTest(TestPositionIndex('test_intersect'))
+  suite.addTest(TestPositionIndex('test_persistence'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,108 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+from bl.vl.kb.drivers.omero.table_cache import TableCache
+
+
+class FakeColumn(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.values = None
+
+
+class FakeTable(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.closed = False
+
+  def getHeaders(self):
+    return [FakeColumn('a'), FakeColumn('b')]
+
+  def close(self):
+    self.closed = True
+
+
+class Opener(object):
+
+  def __init__(self):
+    self.opened = []
+
+  def __call__(self, session, table_name):
+    t = FakeTable(table_name)
+    self.opened.append(t)
+    return t
+
+
+def dtype_builder(headers):
+  return [(c.name, 'i8') for c in headers]
+
+
+class TestTableCache(unittest.TestCase):
+
+  def setUp(self):
+    self.opener = Opener()
+    self.session = object()
+    self.cache = TableCache(dtype_builder, idle_timeout=10)
+
+  def test_hit_miss(self):
+    h = self.cache.acquire(self.session, 't1', self.opener)
+    self.assertEqual(h.dtype, [('a', 'i8'), ('b', 'i8')])
+    self.cache.release(h)
+    h2 = self.cache.acquire(self.session, 't1', self.opener)
+    self.cache.release(h2)
+    self.assertTrue(h is h2)
+    self.assertEqual(len(self.opener.opened), 1)
+    stats = self.cache.get_stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 1)
+    self.assertEqual(stats['open_handles'], 1)
+
+  def test_new_columns(self):
+    h = self.cache.acquire(self.session, 't1', self.opener)
+    cols = h.new_columns()
+    cols[0].values = [1, 2]
+    self.assertTrue(h.headers[0].values is None)
+    self.cache.release(h)
+
+  def test_invalidate(self):
+    h = self.cache.acquire(self.session, 't1', self.opener)
+    self.cache.release(h)
+    self.cache.invalidate('t1')
+    self.assertTrue(h.table.closed)
+    self.cache.acquire(self.session, 't1', self.opener)
+    self.assertEqual(len(self.opener.opened), 2)
+
+  def test_session_change(self):
+    h = self.cache.acquire(self.session, 't1', self.opener)
+    self.cache.release(h)
+    self.cache.acquire(object(), 't1', self.opener)
+    self.assertTrue(h.table.closed)
+    self.assertEqual(len(self.opener.opened), 2)
+
+  def test_expire(self):
+    busy = self.cache.acquire(self.session, 't1', self.opener)
+    idle = self.cache.acquire(self.session, 't2', self.opener)
+    self.cache.release(idle)
+    self.cache.expire(idle.last_used + 11)
+    self.assertTrue(idle.table.closed)
+    self.assertFalse(busy.table.closed)
+    self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestTableCache('test_hit_miss'))
+  suite.addTest(TestTableCache('test_new_columns'))
+  suite.addTest(TestTableCache('test_invalidate'))
+  suite.addTest(TestTableCache('test_session_change'))
+  suite.addTest(TestTableCache('test_expire'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,71 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil
+import numpy as np
+
+from bl.vl.kb.drivers.omero.table_index import TableIndex
+
+
+class TestTableIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.path = os.path.join(self.wd, 'host', 't.h5.i_vid.idx.npz')
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_lookup(self):
+    idx = TableIndex('t.h5', 'i_vid')
+    keys = ['V%02d' % (i % 7) for i in xrange(50)]
+    idx.add(keys[:20], range(20))
+    idx.add(keys[20:], range(20, 50))
+    self.assertEqual(idx.n_rows, 50)
+    for k in set(keys):
+      exp = [i for i, x in enumerate(keys) if x == k]
+      self.assertEqual(idx.lookup([k]).tolist(), exp)
+    exp = [i for i, x in enumerate(keys) if x in ('V01', 'V03')]
+    self.assertEqual(idx.lookup(['V03', 'V01', 'V99']).tolist(), exp)
+    self.assertEqual(len(idx.lookup(['V99'])), 0)
+
+  def test_longer_keys(self):
+    idx = TableIndex('t.h5', 'i_vid')
+    idx.add(['a', 'b'], [0, 1])
+    idx.add(['aaaa'], [2])
+    self.assertEqual(idx.lookup(['aaaa']).tolist(), [2])
+    self.assertEqual(idx.lookup(['a']).tolist(), [0])
+
+  def test_reindex(self):
+    idx = TableIndex('t.h5', 'i_vid')
+    idx.add(['a', 'b'], [0, 1])
+    self.assertRaises(ValueError, idx.add, ['c'], [1])
+
+  def test_persistence(self):
+    idx = TableIndex('t.h5', 'i_vid', self.path)
+    self.assertFalse(idx.load())
+    idx.reset(file_id=42)
+    idx.add(np.arange(10, 0, -1), np.arange(10))
+    idx.save()
+    self.assertFalse(idx.dirty)
+    other = TableIndex('t.h5', 'i_vid', self.path)
+    self.assertTrue(other.load())
+    self.assertEqual(other.file_id, 42)
+    self.assertEqual(other.n_rows, 10)
+    self.assertEqual(other.lookup([3, 10]).tolist(), [0, 7])
+    other.remove()
+    self.assertFalse(os.path.exists(self.path))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestTableIndex('test_lookup'))
+  suite.addTest(TestTableIndex('test_longer_keys'))
+  suite.addTest(TestTableIndex('test_reindex'))
+  suite.addTest(TestTableIndex('test_persistence'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
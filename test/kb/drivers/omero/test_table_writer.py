@@ -0,0 +1,111 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+import numpy as np
+
+from bl.vl.kb.drivers.omero.table_writer import TableWriter, TableWriterError
+
+
+class FakeColumn(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.values = None
+
+
+class FakeTable(object):
+
+  def __init__(self, col_names, fail_at=None):
+    self.headers = [FakeColumn(n) for n in col_names]
+    self.data = dict((n, []) for n in col_names)
+    self.n_rows = 0
+    self.fail_at = fail_at
+
+  def getHeaders(self):
+    return self.headers
+
+  def getNumberOfRows(self):
+    return self.n_rows
+
+  def addData(self, columns):
+    if self.fail_at is not None and self.n_rows >= self.fail_at:
+      raise RuntimeError('addData failed')
+    for c in columns:
+      self.data[c.name].extend(c.values)
+    self.n_rows += len(columns[0].values)
+
+
+DTYPE = [('vid', '|S16'), ('n', 'i8'), ('probs', '(2,8)float32')]
+
+
+def make_records(n):
+  records = np.zeros(n, dtype=DTYPE)
+  records['vid'] = ['V%06d' % i for i in xrange(n)]
+  records['n'] = np.arange(n)
+  records['probs'] = np.random.random((n, 2, 8))
+  return records
+
+
+class TestTableWriter(unittest.TestCase):
+
+  def test_ordered_write(self):
+    table = FakeTable(['vid', 'n', 'probs'])
+    table.n_rows = 3
+    for k in table.data:
+      table.data[k].extend([None] * 3)
+    records = make_records(103)
+    writer = TableWriter(table, table.getHeaders(), batch_size=10)
+    writer.write(records[:50])
+    writer.write(records[50:])
+    indices = writer.close()
+    self.assertEqual(indices, range(3, 106))
+    self.assertEqual(table.data['n'][3:], range(103))
+    self.assertEqual(table.data['vid'][3:], records['vid'].tolist())
+    for r, p in zip(records, table.data['probs'][3:]):
+      self.assertTrue(np.all(r['probs'] == p))
+    self.assertEqual(writer.get_stats()['rows'], 103)
+    self.assertEqual(writer.get_stats()['batches'], 11)
+    self.assertTrue(table.headers[0].values is None)
+
+  def test_stream(self):
+    table = FakeTable(['vid', 'n'])
+    stream = ({'vid': 'V%d' % i, 'n': i} for i in xrange(25))
+    writer = TableWriter(table, table.getHeaders(), batch_size=7)
+    writer.write_stream(stream)
+    self.assertEqual(writer.flush(), range(25))
+    writer.close()
+    self.assertEqual(table.data['n'], range(25))
+
+  def test_error(self):
+    table = FakeTable(['vid', 'n', 'probs'], fail_at=20)
+    writer = TableWriter(table, table.getHeaders(), batch_size=10)
+    writer.write(make_records(50))
+    self.assertRaises(TableWriterError, writer.close)
+    self.assertTrue(writer.closed)
+    self.assertEqual(table.n_rows, 20)
+
+  def test_abort(self):
+    closed = []
+    table = FakeTable(['vid', 'n', 'probs'])
+    writer = TableWriter(table, table.getHeaders(), batch_size=10,
+                         on_close=closed.append)
+    writer.write(make_records(30))
+    writer.abort()
+    self.assertTrue(writer.closed)
+    self.assertEqual(closed, [writer])
+    self.assertRaises(TableWriterError, writer.write, make_records(1))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestTableWriter('test_ordered_write'))
+  suite.addTest(TestTableWriter('test_stream'))
+  suite.addTest(TestTableWriter('test_error'))
+  suite.addTest(TestTableWriter('test_abort'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -2,7 +2,9 @@
 # END_COPYRIGHT
 
 import unittest
+import omero.model as om
 import bl.vl.kb.drivers.omero.wrapper as wp
+from bl.vl.utils.ome_utils import make_unique_key
 
 
 class Foo(wp.OmeroWrapper):
@@ -31,6 +33,52 @@ class Bar(wp.OmeroWrapper):
     return super(Bar, self).__preprocess_conf__(conf)
 
 
+class Baz(wp.OmeroWrapper):
+
+  OME_TABLE = 'Individual'
+  __fields__ = [('father', wp.SELF_TYPE, wp.OPTIONAL),
+                ('gender', wp.STRING, wp.OPTIONAL)]
+
+  def gender(self):
+    return 'overridden'
+
+
+class Qux(wp.OmeroWrapper):
+
+  OME_TABLE = 'Study'
+  __fields__ = [('label', wp.STRING, wp.REQUIRED),
+                ('labelUK', wp.STRING, wp.OPTIONAL),
+                ('file', om.OriginalFile, wp.OPTIONAL)]
+
+  def __update_constraints__(self):
+    setattr(self.ome_obj, 'labelUK',
+            self.to_omero(self.__fields__['labelUK'][0],
+                          make_unique_key(self.label)))
+
+
+class FakeFactory(object):
+
+  def __init__(self, proxy):
+    self.proxy = proxy
+    self.wrapped = 0
+
+  def wrap(self, ome_obj):
+    self.wrapped += 1
+    return Baz(ome_obj, self.proxy)
+
+
+class FakeProxy(object):
+
+  def __init__(self):
+    self.factory = FakeFactory(self)
+
+  def get_from_cache(self, ome_obj):
+    return None
+
+  def reload_object(self, o):
+    o.ome_obj = o.ome_obj
+
+
 class TestOmeroWrapper(unittest.TestCase):
 
   def test_bare_attrs(self):
@@ -44,11 +92,60 @@ class TestOmeroWrapper(unittest.TestCase):
     b = Bar(None, None)
     b.configure({})
 
+  def test_field_access(self):
+    self.assertTrue(isinstance(Bar.__dict__['label'], wp.FieldAccessor))
+    b = Bar(None, None)
+    b.configure({})
+    self.assertEqual(b.label, 'foo')
+    self.assertEqual(b.label, 'foo')
+    b.label = 'bar'
+    self.assertEqual(b.label, 'bar')
+    ome_obj = Bar(None, None).ome_obj
+    ome_obj.label = wp.ome_wrap('baz', wp.STRING)
+    b.ome_obj = ome_obj
+    self.assertEqual(b.label, 'baz')
+
+  def test_link_access(self):
+    proxy = FakeProxy()
+    father, child = Baz(None, proxy), Baz(None, proxy)
+    self.assertTrue(child.father is None)
+    child.father = father
+    self.assertEqual(proxy.factory.wrapped, 0)
+    f = child.father
+    self.assertTrue(isinstance(f, Baz))
+    self.assertTrue(child.father is f)
+    self.assertEqual(proxy.factory.wrapped, 1)
+    child.reload()
+    self.assertFalse(child.father is f)
+    self.assertEqual(proxy.factory.wrapped, 2)
+    self.assertRaises(ValueError, setattr, child, 'father', Bar(None, None))
+    self.assertEqual(child.gender(), 'overridden')
+
+  def test_update_constraints(self):
+    q = Qux(None, None)
+    q.configure({'label': 'A'})
+    q.label = 'A'
+    self.assertEqual(q.label, 'A')
+    self.assertEqual(q.labelUK, make_unique_key('A'))
+    q.label = 'B'
+    self.assertEqual(q.labelUK, make_unique_key('B'))
+
+  def test_link_fields(self):
+    self.assertEqual(wp.link_fields(Baz), ['father'])
+    self.assertEqual(wp.link_fields(Qux), [])
+    b = Bar(None, None)
+    wp.set_field_cache(b, {'label': 'cached'})
+    self.assertEqual(b.label, 'cached')
+
 
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestOmeroWrapper('test_bare_attrs'))
   suite.addTest(TestOmeroWrapper('test_recursive_preprocess_conf'))
+  suite.addTest(TestOmeroWrapper('test_field_access'))
+  suite.addTest(TestOmeroWrapper('test_link_access'))
+  suite.addTest(TestOmeroWrapper('test_update_constraints'))
+  suite.addTest(TestOmeroWrapper('test_link_fields'))
   return suite
 
 
@@ -0,0 +1,280 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, time, json, threading, weakref, gc
+
+from bl.vl.kb.messages import EventsSender, MessageEngineConnectionError, \
+  watermark_routing_key, _LIVE_SENDERS
+
+
+class FakeEvent(object):
+
+  def __init__(self, i):
+    self.event_type = 'graph.node.create'
+    self.msg = 'event-%d' % i
+
+
+class FakeBroker(object):
+
+  def __init__(self):
+    self.queue = []
+    self.commits = 0
+    self.down = False
+    self.graph_manager_running = True
+    self.bindings = {}
+    self.queues = {}
+
+  def commit(self, messages):
+    self.queue.extend((k, b) for k, b, _ in messages)
+    self.commits += 1
+    if self.graph_manager_running:
+      watermarks = {}
+      for _, _, headers in messages:
+        watermarks[headers['session']] = headers['seq']
+      for session, seq in watermarks.iteritems():
+        self.publish(watermark_routing_key('test', session),
+                     json.dumps({'session': session, 'seq': seq}))
+
+  def publish(self, routing_key, body):
+    if routing_key in self.bindings:
+      self.queues[self.bindings[routing_key]].append(body)
+
+
+class FakeFrame(object):
+
+  def __init__(self, queue):
+    self.method = self
+    self.queue = queue
+
+
+class FakeChannel(object):
+
+  def __init__(self, broker):
+    self.broker = broker
+    self.pending = []
+
+  def exchange_declare(self, **kwargs):
+    pass
+
+  def queue_declare(self, queue, **kwargs):
+    if not queue:
+      queue = 'amq.gen-%d' % len(self.broker.queues)
+    self.broker.queues.setdefault(queue, [])
+    return FakeFrame(queue)
+
+  def queue_bind(self, queue, exchange, routing_key=None):
+    if queue in self.broker.queues:
+      self.broker.bindings[routing_key] = queue
+
+  def consume(self, queue, no_ack=False, inactivity_timeout=None):
+    while True:
+      if self.broker.queues[queue]:
+        yield None, None, self.broker.queues[queue].pop(0)
+      else:
+        time.sleep(inactivity_timeout)
+        yield None, None, None
+
+  def tx_select(self):
+    pass
+
+  def basic_publish(self, exchange, routing_key, body, properties=None):
+    self.pending.append((routing_key, body, properties))
+
+  def tx_commit(self):
+    pending, self.pending = self.pending, []
+    if self.broker.down:
+      raise MessageEngineConnectionError('broker down')
+    self.broker.commit(pending)
+
+
+class FakeConnection(object):
+
+  def __init__(self, broker):
+    self.broker = broker
+
+  def channel(self):
+    return FakeChannel(self.broker)
+
+  def close(self):
+    pass
+
+
+class FakeSender(EventsSender):
+
+  def __init__(self, broker, **kwargs):
+    super(FakeSender, self).__init__('localhost', queue='test', **kwargs)
+    self.broker = broker
+
+  def _open_connection(self):
+    return FakeConnection(self.broker)
+
+  def _message_properties(self, headers):
+    return headers
+
+
+class TestEventsSender(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.broker = FakeBroker()
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_batching(self):
+    sender = FakeSender(self.broker, batch_size=10, flush_interval=None)
+    for i in xrange(25):
+      sender.send_event(FakeEvent(i))
+    self.assertEqual(len(self.broker.queue), 20)
+    self.assertEqual(self.broker.commits, 2)
+    self.assertEqual(sender.flush(), 5)
+    self.assertEqual([b for _, b in self.broker.queue],
+                     ['event-%d' % i for i in xrange(25)])
+    self.assertEqual(self.broker.queue[0][0], 'test.graph.node.create')
+    stats = sender.get_stats()
+    self.assertEqual(stats['published'], 25)
+    self.assertEqual(stats['batches'], 3)
+    self.assertEqual(stats['backlog'], 0)
+
+  def test_timed_flush(self):
+    sender = FakeSender(self.broker, batch_size=100, flush_interval=0.05)
+    for i in xrange(3):
+      sender.send_event(FakeEvent(i))
+    self.assertEqual(len(self.broker.queue), 0)
+    time.sleep(0.3)
+    self.assertEqual(len(self.broker.queue), 3)
+    self.assertEqual(self.broker.commits, 1)
+
+  def test_no_spool(self):
+    sender = FakeSender(self.broker, batch_size=5, flush_interval=None)
+    self.broker.down = True
+    for i in xrange(4):
+      sender.send_event(FakeEvent(i))
+    self.assertRaises(MessageEngineConnectionError, sender.send_event,
+                      FakeEvent(4))
+    self.assertEqual(sender.get_stats()['buffered'], 5)
+    self.broker.down = False
+    self.assertEqual(sender.flush(), 5)
+    self.assertEqual(len(self.broker.queue), 5)
+
+  def test_max_backlog(self):
+    sender = FakeSender(self.broker, batch_size=5, flush_interval=None,
+                        max_backlog=8)
+    self.broker.down = True
+    for i in xrange(4):
+      sender.send_event(FakeEvent(i))
+    for i in xrange(4, 10):
+      self.assertRaises(MessageEngineConnectionError, sender.send_event,
+                        FakeEvent(i))
+    stats = sender.get_stats()
+    self.assertEqual(stats['buffered'], 8)
+    self.assertEqual(stats['seq'], 8)
+    self.broker.down = False
+    sender.send_event(FakeEvent(8))
+    self.assertEqual(len(self.broker.queue), 8)
+    self.assertEqual(sender.flush(), 1)
+    self.assertEqual([b for _, b in self.broker.queue],
+                     ['event-%d' % i for i in xrange(9)])
+
+  def test_close_at_exit(self):
+    sender = FakeSender(self.broker, batch_size=10, flush_interval=None)
+    self.assertTrue(sender in _LIVE_SENDERS)
+    sender.send_event(FakeEvent(0))
+    ref = weakref.ref(sender)
+    del sender
+    gc.collect()
+    self.assertTrue(ref() is None)
+    self.assertEqual(len(self.broker.queue), 1)
+
+  def test_spool(self):
+    spool_file = os.path.join(self.wd, 'events.spool')
+    sender = FakeSender(self.broker, batch_size=5, flush_interval=None,
+                        spool_file=spool_file)
+    self.broker.down = True
+    for i in xrange(12):
+      sender.send_event(FakeEvent(i))
+    sender.flush()
+    stats = sender.get_stats()
+    self.assertEqual(stats['spooled'], 12)
+    self.assertEqual(stats['spool_backlog'], 12)
+    self.assertEqual(len(self.broker.queue), 0)
+    # a new sender picks up the spool left behind
+    other = FakeSender(self.broker, batch_size=5, flush_interval=None,
+                       spool_file=spool_file)
+    self.assertEqual(other.get_stats()['backlog'], 12)
+    self.broker.down = False
+    for i in xrange(12, 15):
+      other.send_event(FakeEvent(i))
+    self.assertEqual(other.flush(), 15)
+    self.assertEqual([b for _, b in self.broker.queue],
+                     ['event-%d' % i for i in xrange(15)])
+    self.assertFalse(os.path.exists(spool_file))
+
+  def test_wait_for(self):
+    sender = FakeSender(self.broker, batch_size=10, flush_interval=None)
+    self.assertTrue(sender.wait_for(timeout=0))
+    for i in xrange(25):
+      sender.send_event(FakeEvent(i))
+    self.assertEqual(sender.watermark, 0)
+    self.assertTrue(sender.wait_for(15, timeout=1))
+    self.assertEqual(sender.get_stats()['buffered'], 5)
+    self.assertTrue(sender.wait_for(timeout=1))
+    self.assertEqual(sender.watermark, 25)
+    self.broker.graph_manager_running = False
+    sender.send_event(FakeEvent(25))
+    self.assertFalse(sender.wait_for(timeout=0.1))
+    stats = sender.get_stats()
+    self.assertEqual(stats['seq'], 26)
+    self.assertEqual(stats['watermark'], 25)
+    self.assertEqual(stats['waits'], 3)
+    self.assertEqual(stats['wait_timeouts'], 1)
+
+  def test_wait_reconnect(self):
+    sender = FakeSender(self.broker, batch_size=10, flush_interval=None)
+    self.broker.graph_manager_running = False
+    for i in xrange(10):
+      sender.send_event(FakeEvent(i))
+    sender.disconnect()
+    # applied while the sender is disconnected
+    self.broker.publish(watermark_routing_key('test', sender.session_id),
+                        json.dumps({'session': sender.session_id, 'seq': 10}))
+    sender.send_event(FakeEvent(10))
+    sender.flush()
+    self.assertTrue(sender.wait_for(10, timeout=1))
+
+  def test_wait_concurrent(self):
+    sender = FakeSender(self.broker, batch_size=1, flush_interval=None)
+    self.broker.graph_manager_running = False
+    sender.send_event(FakeEvent(0))
+    waiter = threading.Thread(target=sender.wait_for, kwargs={'timeout': 2})
+    waiter.start()
+    time.sleep(0.1)
+    start = time.time()
+    for i in xrange(1, 4):
+      sender.send_event(FakeEvent(i))
+    self.assertTrue(time.time() - start < 0.5)
+    self.assertEqual(len(self.broker.queue), 4)
+    self.broker.publish(watermark_routing_key('test', sender.session_id),
+                        json.dumps({'session': sender.session_id, 'seq': 4}))
+    waiter.join()
+    self.assertEqual(sender.watermark, 4)
+    self.assertEqual(sender.get_stats()['wait_timeouts'], 0)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestEventsSender('test_batching'))
+  suite.addTest(TestEventsSender('test_timed_flush'))
+  suite.addTest(TestEventsSender('test_no_spool'))
+  suite.addTest(TestEventsSender('test_max_backlog'))
+  suite.addTest(TestEventsSender('test_close_at_exit'))
+  suite.addTest(TestEventsSender('test_spool'))
+  suite.addTest(TestEventsSender('test_wait_for'))
+  suite.addTest(TestEventsSender('test_wait_reconnect'))
+  suite.addTest(TestEventsSender('test_wait_concurrent'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
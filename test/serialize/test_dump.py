@@ -0,0 +1,139 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, logging
+
+import bl.vl.kb.serialize.dump as dump
+from bl.vl.kb.serialize.dump import RecordSerializer, references, \
+  dependency_levels, write_records, read_records, write_part_chunks, \
+  load_chunk, open_chunk, chunk_name, FORMATS
+
+
+def make_records():
+  serializer = RecordSerializer(logging.getLogger('test_dump'))
+  serializer.serialize('V01', 'Study', {'label': u'st\xe9'}, 'V01')
+  serializer.serialize('V02', 'ActionSetup', {'label': 'as', 'conf': '{}'},
+                       'V02')
+  serializer.serialize('V03', 'Action', {'setup': {'by_vid': 'V02'},
+                                         'context': {'by_vid': 'V01'},
+                                         'actionCategory': 'IMPORT'}, 'V03')
+  serializer.serialize('V04', 'Individual', {'gender': 'MALE',
+                                             'action': {'by_vid': 'V03'},
+                                             'father': {'by_vid': 'VX'}},
+                       'V04')
+  return serializer.records
+
+
+class FakeObject(object):
+
+  def __init__(self, vid, action_vid):
+    self.vid = vid
+    self.action_vid = action_vid
+
+  def serialize(self, engine, shallow=False):
+    assert shallow
+    engine.serialize(self.vid, 'Individual',
+                     {'action': engine.by_vid(self.action_vid)}, self.vid)
+
+
+class FakeKB(object):
+
+  def __init__(self, objects):
+    self.objects = objects
+    self.cache = set()
+    self.preloaded = []
+
+  def find_all_by_query(self, query, params, offset=None, limit=None):
+    res = self.objects[offset:offset+limit]
+    self.cache.update(o.vid for o in res)
+    return res
+
+  def preload_link_vids(self, objects):
+    self.preloaded.append([o.vid for o in objects])
+
+  def clear_cache(self):
+    self.cache.clear()
+
+
+class TestDump(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.records = make_records()
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_levels(self):
+    deps = dict((oid, references(d)) for oid, d in self.records)
+    self.assertEqual(sorted(deps['V03']), ['V01', 'V02'])
+    self.assertEqual(dependency_levels(deps),
+                     {'V01': 0, 'V02': 0, 'V03': 1, 'V04': 2})
+    deps['V02'] = ('V04',)
+    self.assertRaises(ValueError, dependency_levels, deps)
+
+  def test_records(self):
+    self.assertEqual(self.records[0][1]['configuration']['label'],
+                     'st\xc3\xa9')
+    for fmt in FORMATS:
+      for compress in False, True:
+        fn = os.path.join(self.wd, chunk_name('dump', 0, 1, fmt, compress))
+        with open_chunk(fn, 'wb') as f:
+          write_records(f, self.records, fmt)
+        data = load_chunk(fn)
+        self.assertEqual(sorted(data), ['V01', 'V02', 'V03', 'V04'])
+        self.assertEqual(data['V03']['configuration']['setup'],
+                         {'by_vid': 'V02'})
+        self.assertEqual(data['V04']['type'], 'Individual')
+        self.assertEqual(data['V04']['vid'], 'V04')
+    with open(os.path.join(self.wd, 'part'), 'wb') as f:
+      write_records(f, [], 'binary')
+    with open(os.path.join(self.wd, 'part'), 'rb') as f:
+      self.assertEqual(list(read_records(f, 'binary')), [])
+
+  def test_part_chunks(self):
+    part_fn = os.path.join(self.wd, 'part.000000')
+    with open(part_fn, 'wb') as f:
+      write_records(f, self.records, 'binary')
+    out_dir = os.path.join(self.wd, 'out')
+    os.mkdir(out_dir)
+    names, n = write_part_chunks((part_fn, 3, [0, 0, None, 2], out_dir,
+                                  'dump', 'yaml', True))
+    self.assertEqual(n, 3)
+    self.assertEqual(names, ['dump.0000.000003.gz', 'dump.0002.000003.gz'])
+    self.assertEqual(sorted(os.listdir(out_dir)), names)
+    self.assertFalse(os.path.exists(part_fn))
+    self.assertEqual(sorted(load_chunk(os.path.join(out_dir, names[0]))),
+                     ['V01', 'V02'])
+    self.assertEqual(load_chunk(os.path.join(out_dir, names[1])),
+                     dict(self.records[3:]))
+
+  def test_dump_page(self):
+    kb = FakeKB([FakeObject('V%02d' % i, 'VA') for i in xrange(5)])
+    dump._KB = kb
+    try:
+      part_fn = os.path.join(self.wd, 'part.000000')
+      fn, refs = dump.dump_page(('from Individual o', None, 2, 2, part_fn))
+    finally:
+      dump._KB = None
+    self.assertEqual(fn, part_fn)
+    self.assertEqual(refs, [('V02', ('VA',)), ('V03', ('VA',))])
+    self.assertEqual(kb.preloaded, [['V02', 'V03']])
+    self.assertEqual(kb.cache, set())
+    with open(part_fn, 'rb') as f:
+      self.assertEqual([oid for oid, _ in read_records(f, 'binary')],
+                       ['V02', 'V03'])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestDump('test_levels'))
+  suite.addTest(TestDump('test_records'))
+  suite.addTest(TestDump('test_part_chunks'))
+  suite.addTest(TestDump('test_dump_page'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,162 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, logging, threading
+
+from bl.vl.kb import KBError
+from bl.vl.kb.serialize.reference import Reference
+from bl.vl.kb.serialize.restore import RestoreEngine, Checkpoint
+
+
+class Study(object):
+  OME_TABLE = 'Study'
+
+
+class Individual(object):
+  OME_TABLE = 'Individual'
+
+
+class FakeObject(object):
+
+  def __init__(self, otype, conf):
+    self.type = otype
+    self.conf = conf
+    self.vid = conf['vid']
+
+
+class FakeFactory(object):
+
+  def create(self, otype, conf):
+    return FakeObject(otype, conf)
+
+
+class FakeProxy(object):
+
+  def __init__(self, otype, vid):
+    self.type = otype
+    self.vid = vid
+    self.object = None
+
+  def create(self, factory):
+    if not self.object:
+      self.object = factory.create(self.type, {'vid': self.vid})
+    return self.object
+
+
+class FakeLimbo(object):
+
+  def __init__(self, levels):
+    self.levels = levels
+    self.objects = {}
+
+  def get_object_oids_by_level(self):
+    return self.levels
+
+
+class FakeKB(object):
+
+  def __init__(self, store, fail_on=None):
+    self.factory = FakeFactory()
+    self.store = store
+    self.fail_on = fail_on
+    self.calls = []
+
+  def save(self, o):
+    if o.vid in self.store:
+      raise KBError('duplicate %s' % o.vid)
+    self.store[o.vid] = o
+
+  def save_array(self, objs):
+    self.calls.append((threading.current_thread().name,
+                       [o.vid for o in objs]))
+    for o in objs:
+      if o.vid == self.fail_on:
+        raise KBError('cannot save %s' % o.vid)
+    for o in objs:
+      self.store[o.vid] = o
+
+  def get_by_field(self, otype, field, values, batch_size=None):
+    return dict((v, self.store[v]) for v in values if v in self.store)
+
+
+def make_limbo():
+  limbo = FakeLimbo([['S1', 'S2'] + ['I%02d' % i for i in xrange(10)],
+                     ['I%02d' % i for i in xrange(10, 15)]])
+  for oid in limbo.levels[0][:2]:
+    limbo.objects[oid] = FakeProxy(Study, 'V' + oid)
+  for oid in limbo.levels[0][2:] + limbo.levels[1]:
+    limbo.objects[oid] = FakeProxy(Individual, 'V' + oid)
+  return limbo
+
+
+class TestRestore(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    self.logger = logging.getLogger('test_restore')
+    Reference.reset()
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_checkpoint(self):
+    path = os.path.join(self.wd, 'ckpt')
+    ckpt = Checkpoint(path)
+    ckpt.add([('I01', 'V01'), ('I02', 'V02')])
+    ckpt.add([('I03', 'V03')])
+    ckpt.close()
+    with open(path, 'a') as f:
+      f.write('[["I04", ')
+    ckpt = Checkpoint(path)
+    self.assertEqual(ckpt.saved, {'I01': 'V01', 'I02': 'V02', 'I03': 'V03'})
+    self.assertTrue('I01' in ckpt)
+    self.assertFalse('I04' in ckpt)
+    ckpt.close()
+    self.assertFalse('I01' in Checkpoint())
+
+  def test_restore(self):
+    store = {'VS2': 'existing study'}
+    kbs = [FakeKB(store) for _ in xrange(3)]
+    limbo = make_limbo()
+    with RestoreEngine(kbs, self.logger, batch_size=4) as engine:
+      self.assertEqual(engine.restore(limbo), 17)
+    self.assertEqual(len(store), 17)
+    self.assertEqual(store['VS2'], 'existing study')
+    calls = sum([kb.calls for kb in kbs], [])
+    self.assertEqual(sorted(len(vids) for _, vids in calls), [1, 2, 4, 4, 4])
+    level_0 = set('VI%02d' % i for i in xrange(10))
+    for _, vids in calls:
+      self.assertTrue(set(vids) <= level_0 or not set(vids) & level_0)
+
+  def test_resume(self):
+    path = os.path.join(self.wd, 'ckpt')
+    store = {}
+    kbs = [FakeKB(store, fail_on='VI11') for _ in xrange(2)]
+    with RestoreEngine(kbs, self.logger, batch_size=2,
+                       checkpoint=path) as engine:
+      self.assertRaises(KBError, engine.restore, make_limbo())
+    saved = Checkpoint(path).saved
+    self.assertTrue(len(saved) >= 12)
+    self.assertTrue('I11' not in saved)
+    kbs = [FakeKB(store)]
+    limbo = make_limbo()
+    with RestoreEngine(kbs, self.logger, batch_size=2,
+                       checkpoint=path) as engine:
+      self.assertEqual(engine.restore(limbo), 17 - len(saved))
+    self.assertEqual(len(store), 17)
+    for oid in saved:
+      self.assertTrue(limbo.objects[oid].object is store['V' + oid])
+    self.assertEqual(len(Checkpoint(path).saved), 17)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestRestore('test_checkpoint'))
+  suite.addTest(TestRestore('test_restore'))
+  suite.addTest(TestRestore('test_resume'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -1,7 +1,9 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import sys, shelve
+import sys
+
+from bl.vl.app.snp_manager.dbsnp_index import open_index
 
 try:
   db_fn = sys.argv[1]
@@ -10,7 +12,7 @@ except IndexError:
 
 db = None
 try:
-  db = shelve.open(db_fn, 'r')
+  db = open_index(db_fn)
   with open(db_fn+".dump", "w") as outf:
     for k, v in db.iteritems():
       outf.write("%s\t%r\n" % (k, v))
@@ -0,0 +1,57 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, unittest, tempfile, shutil, random
+from operator import itemgetter
+
+from bl.vl.utils.external_sort import ExternalSorter
+
+
+class TestExternalSorter(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp(prefix='bl_vl_')
+    rnd = random.Random(0)
+    self.records = [{'index': rnd.randint(0, 50), 'n': i}
+                    for i in xrange(500)]
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_sort(self):
+    expected = sorted(self.records, key=itemgetter('index'))
+    for run_size in 1000, 64, 1:
+      sorter = ExternalSorter(key=itemgetter('index'), run_size=run_size,
+                              tmp_dir=self.wd)
+      sorter.extend(self.records)
+      self.assertEqual(len(sorter), len(self.records))
+      # stable, and can be read more than once
+      self.assertEqual(list(sorter), expected)
+      self.assertEqual(list(sorter), expected)
+      self.assertRaises(ValueError, sorter.add, self.records[0])
+      sorter.close()
+      self.assertEqual(os.listdir(self.wd), [])
+
+  def test_no_key(self):
+    labels = ['M%d' % r['index'] for r in self.records]
+    with ExternalSorter(run_size=10, tmp_dir=self.wd) as sorter:
+      sorter.extend(labels)
+      self.assertEqual(list(sorter), sorted(labels))
+    self.assertEqual(os.listdir(self.wd), [])
+
+  def test_empty(self):
+    with ExternalSorter(run_size=10, tmp_dir=self.wd) as sorter:
+      self.assertEqual(list(sorter), [])
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestExternalSorter('test_sort'))
+  suite.addTest(TestExternalSorter('test_no_key'))
+  suite.addTest(TestExternalSorter('test_empty'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,133 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import os, time, unittest, tempfile, threading
+import numpy as np
+
+import bl.vl.utils.instrumentation as instr
+
+
+class Store(object):
+
+  @instr.instrumented(payload='result')
+  def read(self, n):
+    return np.zeros(n, dtype=np.int64)
+
+  @instr.instrumented(payload=1)
+  def write(self, records):
+    return len(records)
+
+  @instr.instrumented(detail=lambda self, service: service)
+  def call(self, service):
+    raise RuntimeError(service)
+
+  @instr.instrumented()
+  def sleep(self, t):
+    time.sleep(t)
+
+  @instr.instrumented()
+  def save(self, t):
+    time.sleep(t)
+    self.sleep(t)
+    self.sleep(t)
+
+
+def run_ops(store):
+  store.read(10)
+  store.read(5)
+  store.write(['a', 'b', 'c'])
+  try:
+    store.call('getQueryService')
+  except RuntimeError:
+    pass
+
+
+class TestInstrumentation(unittest.TestCase):
+
+  def tearDown(self):
+    instr.disable()
+
+  def test_disabled(self):
+    instr.disable()
+    run_ops(Store())
+    self.assertTrue(instr.get_recorder() is None)
+
+  def test_record(self):
+    recorder = instr.enable()
+    run_ops(Store())
+    ops = recorder.by_operation()
+    self.assertEqual(sorted(ops), ['call[getQueryService]', 'read', 'write'])
+    self.assertEqual(ops['read'].count, 2)
+    self.assertEqual(ops['read'].items, 15)
+    self.assertEqual(ops['read'].bytes, 15 * 8)
+    self.assertEqual(ops['write'].items, 3)
+    self.assertEqual(ops['call[getQueryService]'].errors, 1)
+    self.assertEqual(sum(ops['read'].buckets), 2)
+    sites = set(s.site for s in recorder.stats.itervalues())
+    self.assertEqual(sites, set(['%s:run_ops' % __name__]))
+
+  def test_dump_load(self):
+    recorder = instr.enable()
+    run_ops(Store())
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      recorder.dump(fname)
+      loaded = instr.Recorder.load(fname)
+    finally:
+      os.remove(fname)
+    self.assertEqual(sorted(recorder.stats), sorted(loaded.stats))
+    for k, s in recorder.stats.iteritems():
+      self.assertEqual(s.to_dict(), loaded.stats[k].to_dict())
+    self.assertEqual(loaded.top(1, key='count')[0].op, 'read')
+
+  def test_nested(self):
+    recorder = instr.enable()
+    Store().save(0.02)
+    ops = recorder.by_operation()
+    self.assertEqual(ops['sleep'].count, 2)
+    self.assertAlmostEqual(ops['sleep'].self_time, ops['sleep'].total_time)
+    self.assertTrue(ops['save'].total_time >= 0.06)
+    self.assertTrue(ops['save'].self_time >= 0.02)
+    self.assertTrue(ops['save'].self_time < ops['save'].total_time - 0.035)
+    self.assertAlmostEqual(ops['save'].self_time + ops['sleep'].self_time,
+                           ops['save'].total_time, 3)
+
+  def test_threads(self):
+    recorder = instr.enable()
+    store = Store()
+    def work():
+      for _ in xrange(2000):
+        store.write(['a'])
+    threads = [threading.Thread(target=work) for _ in xrange(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(recorder.by_operation()['write'].count, 8000)
+    self.assertEqual(recorder.by_operation()['write'].items, 8000)
+
+  def test_prometheus(self):
+    recorder = instr.enable()
+    run_ops(Store())
+    text = recorder.to_prometheus()
+    self.assertTrue('biobank_kb_operation_seconds_count{op="read"} 2' in text)
+    self.assertTrue(
+      'biobank_kb_operation_seconds_bucket{op="read",le="+Inf"} 2' in text)
+    self.assertTrue('biobank_kb_operation_items_total{op="write"} 3' in text)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestInstrumentation('test_disabled'))
+  suite.addTest(TestInstrumentation('test_record'))
+  suite.addTest(TestInstrumentation('test_dump_load'))
+  suite.addTest(TestInstrumentation('test_nested'))
+  suite.addTest(TestInstrumentation('test_threads'))
+  suite.addTest(TestInstrumentation('test_prometheus'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -1,7 +1,7 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import unittest
+import unittest, random
 
 import bl.vl.utils.snp as usnp
 
@@ -56,6 +56,21 @@ UNDECIDABLE = [
   ]
 
 
+def random_mask(rnd):
+  """
+  Random, mostly valid mask, with short low-complexity flanks so that
+  the strand is often decided late or not at all.
+  """
+  def flank():
+    bases = rnd.choice(['AT', 'CG', 'ACGT', 'acgtN'])
+    return ''.join(rnd.choice(bases) for _ in xrange(rnd.randint(0, 8)))
+  alleles = rnd.sample('ACGT', rnd.choice([1, 2, 2, 2, 3, 4]))
+  if rnd.random() < 0.1:
+    alleles.append(rnd.choice(['-', 'AAC', 'Z']))
+  return '%s[%s]%s%s' % (flank(), '/'.join(alleles), flank(),
+                         rnd.choice(['', '', '', '', ']', '\n']))
+
+
 class TestSplitMask(unittest.TestCase):
 
   def test_good(self):
@@ -65,6 +80,17 @@ class TestSplitMask(unittest.TestCase):
   def test_bad(self):
     self.assertRaises(ValueError, usnp.split_mask, 'N[N/N]')
 
+  def test_many(self):
+    rnd = random.Random(0)
+    masks = [random_mask(rnd) for _ in xrange(2000)]
+    masks.extend([s for s, _ in SPLIT_MASK_PAIRS] + ['N[N/N]', ''])
+    for m, split in zip(masks, usnp.split_masks(masks)):
+      try:
+        exp_split = usnp.split_mask(m)
+      except ValueError:
+        exp_split = None
+      self.assertEqual(split, exp_split)
+
 
 class TestJoinMask(unittest.TestCase):
 
@@ -93,16 +119,46 @@ class TestUSNP(unittest.TestCase):
     for s in UNDECIDABLE:
       self.assertRaises(ValueError, usnp.convert_to_top, s)
 
+  def test_convert_to_top_many(self):
+    rnd = random.Random(1)
+    masks = [random_mask(rnd) for _ in xrange(2000)]
+    masks.extend([s for s, _ in CONVERT_PAIRS] + UNDECIDABLE)
+    converted, errors = usnp.convert_to_top_many(masks)
+    for m, c, e in zip(masks, converted, errors):
+      try:
+        exp = usnp.convert_to_top(m)
+      except ValueError:
+        try:
+          usnp.split_mask(m)
+        except ValueError:
+          exp_error = usnp.BAD_MASK_FORMAT
+        else:
+          exp_error = usnp.UNDECIDABLE_STRAND
+        self.assertTrue(c is None)
+        self.assertEqual(e, exp_error)
+      else:
+        self.assertEqual(c, exp)
+        self.assertEqual(e, usnp.MASK_OK)
+    for m, c in zip(masks, usnp.convert_to_top_many(masks, toupper=False)[0]):
+      try:
+        self.assertEqual(c, usnp.convert_to_top(m, toupper=False))
+      except ValueError:
+        self.assertTrue(c is None)
+    converted, errors = usnp.convert_to_top_many([])
+    self.assertEqual((converted, len(errors)), ([], 0))
+
 
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestSplitMask('test_good'))
   suite.addTest(TestSplitMask('test_bad'))
+  suite.addTest(TestSplitMask('test_many'))
   suite.addTest(TestJoinMask('test_good'))
   suite.addTest(TestJoinMask('test_bad'))
   suite.addTest(TestUSNP('test_convert_to_top'))
   suite.addTest(TestUSNP('test_convert_to_top_split'))
   suite.addTest(TestUSNP('test_undecidable'))
+  suite.addTest(TestUSNP('test_convert_to_top_many'))
   return suite
 
 